@@ -0,0 +1,144 @@
+"""
+Benchmark for dm delivery acknowledgements (server/delivery.py).
+
+1. Throughput: a sender sends dms as fast as it can to a recipient that
+   acknowledges what it reads (the way client/chat_client.py does). The
+   script reports dms delivered per second and the acks the recipient sent.
+2. Silent recipient: the recipient never acknowledges (and reads nothing
+   until the burst is over). The script reports how many dms were sent at
+   once and how many waited in the history, and how much the server's
+   memory grew while they were sent, with the default window and with a
+   window as large as the whole burst. The outbound queue is made large
+   enough for the whole burst, so only the window limits it.
+3. Lost connection: the silent recipient's connection is closed and it
+   logs in again with the client library. The script reports how long it
+   took to get every dm.
+
+Ex: python3 ack_benchmark.py --dms 20000
+"""
+import os
+import sys
+import time
+import socket
+import argparse
+
+from bench_util import REPO_DIR, ServerProcess, login_client, recv_json, rss_kib
+from common.framing import FrameDecoder, encode_message, decode_message, RECV_SIZE
+
+sys.path.insert(0, os.path.join(REPO_DIR, "server"))
+sys.path.insert(0, os.path.join(REPO_DIR, "client"))
+from delivery import DEFAULT_ACK_WINDOW
+from chat_client import ChatClient
+
+def send_burst(sender, count, text="x" * 100):
+    """
+    This function sends count dms from "sender" to "reader" and waits for every status
+
+    Returns: Dictionary of status -> count
+    """
+    frame = encode_message({"command": "dm", "username": "sender", "recipient": "reader", "message": text})
+    chunk = 500
+    statuses = {}
+    for start in range(0, count, chunk):
+        sender.sendall(frame * min(chunk, count - start))
+    while sum(statuses.values()) < count:
+        message = recv_json(sender)
+        if "status" in message:
+            statuses[message["status"]] = statuses.get(message["status"], 0) + 1
+    return statuses
+
+def bench_throughput(engine, count):
+    """
+    This function times dms to a recipient that acknowledges each batch it reads
+
+    Returns: (dms per second, acks sent)
+    """
+    with ServerProcess(["--engine", engine]) as server:
+        reader = login_client(server.port, "reader")
+        sender = login_client(server.port, "sender")
+        time.sleep(0.3)
+        frame = encode_message({"command": "dm", "username": "sender", "recipient": "reader", "message": "x" * 100})
+        decoder = FrameDecoder(64 * 1024 * 1024)
+        received = acks = 0
+        start = time.perf_counter()
+        sender.sendall(frame * count)
+        while received < count:
+            data = reader.recv(RECV_SIZE)
+            if not data:
+                raise ConnectionError("Server closed the connection")
+            newest = None
+            for payload in decoder.feed(data):
+                message = decode_message(payload)
+                if message.get("type") == "dm":
+                    received += 1
+                    newest = message["id"]
+            if newest is not None:
+                reader.sendall(encode_message({"command": "ack", "username": "reader", "id": newest}))
+                acks += 1
+        elapsed = time.perf_counter() - start
+        reader.close()
+        sender.close()
+    return count / elapsed, acks
+
+def bench_silent(engine, count, window):
+    """
+    This function sends dms to a recipient that never acknowledges, then logs it in again
+
+    Returns: Dictionary of results
+    """
+    with ServerProcess(["--engine", engine, "--ack-window", str(window),
+                        "--send-queue-bytes", str(256 * 1024 * 1024)]) as server:
+        reader = login_client(server.port, "reader")
+        sender = login_client(server.port, "sender")
+        time.sleep(0.3)
+        before = rss_kib(server.pid)
+        statuses = send_burst(sender, count)
+        growth = rss_kib(server.pid) - before
+
+        # Read what was sent, without acknowledging it, then lose the connection
+        reader.settimeout(1.0)
+        try:
+            while reader.recv(RECV_SIZE):
+                pass
+        except socket.timeout:
+            pass
+        reader.close()
+        time.sleep(0.3)
+
+        client = ChatClient.connect("127.0.0.1", server.port)
+        start = time.perf_counter()
+        client.login("reader", "bench")
+        ids = set()
+        while len(ids) < count:
+            message = client.receive()
+            if message is None:
+                raise ConnectionError("Server closed the connection")
+            if message.get("type") == "dm":
+                ids.add(message["id"])
+        elapsed = time.perf_counter() - start
+        client.close()
+        sender.close()
+    return {"sent": statuses.get("message_sent", 0), "stored": statuses.get("message_stored", 0),
+            "growth": growth, "resend_s": elapsed}
+
+def main():
+    parser = argparse.ArgumentParser(description="dm acknowledgement benchmark")
+    parser.add_argument("--dms", type=int, default=20000, help="dms sent in each test")
+    parser.add_argument("--engines", nargs="+", default=["threaded", "asyncio"], choices=["threaded", "asyncio"])
+    args = parser.parse_args()
+
+    print(f"Throughput: {args.dms} dms to a recipient that acknowledges what it reads")
+    for engine in args.engines:
+        rate, acks = bench_throughput(engine, args.dms)
+        print(f"  {engine:<10} {rate:10,.0f} dms/s   {acks} acks ({args.dms / max(acks, 1):.0f} dms per ack)")
+
+    print(f"\nSilent recipient: {args.dms} dms never acknowledged, then a new login")
+    for engine in args.engines:
+        for window in (DEFAULT_ACK_WINDOW, args.dms):
+            results = bench_silent(engine, args.dms, window)
+            print(f"  {engine:<10} window {window:>6}: {results['sent']:6} sent at once, {results['stored']:6} waited"
+                  f" in the history   server memory +{results['growth'] / 1024:6.1f} MiB"
+                  f"   every dm again after login in {results['resend_s'] * 1000:7.1f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+"""
+Shared helpers for the benchmark scripts in this directory.
+
+The benchmarks start server.py as a subprocess in a scratch directory (so the
+real users.json is never touched) and talk to it over plain TCP sockets.
+"""
+import os
+import sys
+import time
+import socket
+import weakref
+import resource
+import tempfile
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER_SCRIPT = os.path.join(REPO_DIR, "server", "server.py")
+
+sys.path.insert(0, REPO_DIR)
+from common.framing import MessageReader, send_message
+
+# Cheap password hashing for benchmarks that are not about logins, so the
+# deliberately slow default hash does not drown out what they measure
+FAST_HASH_ARGS = ["--scrypt-n", "1024"]
+# Benchmarks send as fast as they can, which the default rate limits would refuse
+NO_RATE_LIMIT_ARGS = ["--no-rate-limits"]
+
+# One frame reader per socket, so frames that arrive together are not lost
+_readers = weakref.WeakKeyDictionary()
+
+def raise_fd_limit():
+    """
+    This function raises the open file limit to the hard limit
+
+    Returns: The new soft limit
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+def free_port():
+    """
+    This function asks the OS for an unused TCP port
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def rss_kib(pid, field="VmRSS"):
+    """
+    This function reads the resident set size of a process from /proc
+
+    field may be "RssAnon" to leave out file pages (Ex: mmapped files)
+
+    Returns: RSS in KiB (0 if it cannot be read)
+    """
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+def thread_count(pid):
+    """
+    This function reads the number of threads of a process from /proc
+    """
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("Threads:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+class ServerProcess:
+    """
+    This class runs server.py in a scratch directory for the length of a
+    with-block.
+
+    Extra command-line arguments (Ex: ["--engine", "asyncio"]) are passed
+    through to the server. setup(workdir) is called before the server starts
+    (Ex: to create a large user store). startup_s is how long the server
+    took to start listening. Password hashing uses FAST_HASH_ARGS unless
+    fast_hashing is False, and rate limits are off unless rate_limits is True.
+    """
+
+    def __init__(self, extra_args=(), port=None, setup=None, fast_hashing=True, rate_limits=False):
+        self.port = port or free_port()
+        self.extra_args = ((FAST_HASH_ARGS if fast_hashing else []) + ([] if rate_limits else NO_RATE_LIMIT_ARGS)
+                           + list(extra_args))
+        self.setup = setup
+        self.workdir = None
+        self.proc = None
+        self.startup_s = 0.0
+
+    def __enter__(self):
+        self.workdir = tempfile.TemporaryDirectory(prefix="chat-bench-")
+        if self.setup is not None:
+            self.setup(self.workdir.name)
+        start = time.perf_counter()
+        self.proc = subprocess.Popen(
+            [sys.executable, SERVER_SCRIPT, str(self.port)] + self.extra_args,
+            cwd=self.workdir.name,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            preexec_fn=raise_fd_limit,
+        )
+        wait_for_port(self.port)
+        self.startup_s = time.perf_counter() - start
+        return self
+
+    def __exit__(self, *exc):
+        self.proc.terminate()
+        try:
+            self.proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+        self.workdir.cleanup()
+
+    @property
+    def pid(self):
+        return self.proc.pid
+
+def wait_for_port(port, timeout=60.0):
+    """
+    This function blocks until something is listening on the port
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Server did not start listening on port {port}")
+
+def send_json(sock, data):
+    """
+    This function sends one message frame to the server
+    """
+    send_message(sock, data)
+
+def recv_json(sock):
+    """
+    This function receives one message frame from the server
+    """
+    reader = _readers.get(sock)
+    if reader is None:
+        reader = _readers[sock] = MessageReader(sock)
+    data = reader.read_message()
+    if data is None:
+        raise ConnectionError("Server closed the connection")
+    return data
+
+def recv_until(sock, predicate):
+    """
+    This function receives messages until one matches the predicate
+
+    Returns: The matching message
+    """
+    while True:
+        data = recv_json(sock)
+        if predicate(data):
+            return data
+
+def login_client(port, username, password="bench"):
+    """
+    This function connects, registers (if needed) and logs in a user
+
+    Returns: Connected socket
+    """
+    sock = socket.create_connection(("127.0.0.1", port))
+    send_json(sock, {"command": "register", "username": username, "password": password})
+    recv_json(sock)
+    send_json(sock, {"command": "login", "username": username, "password": password})
+    response = recv_until(sock, lambda data: "status" in data)
+    if response["status"] != "success":
+        raise RuntimeError(f"Login failed for {username}: {response}")
+    return sock
+
+def percentile(samples, fraction):
+    """
+    This function returns the sample at the given fraction (0.0 - 1.0)
+    """
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
@@ -0,0 +1,140 @@
+"""
+Benchmark for the multi-process server (--workers N).
+
+For each worker count, the server is started and a few load processes log
+in pairs of users. Every sender then sends dms to its partner as fast as
+the server takes them, and afterwards one sender per load process sends
+pms to everyone. The script reports dms delivered per second and pm
+deliveries per second.
+
+With one worker the server is limited to one core by the GIL; with more
+workers the numbers should grow with the number of cores (up to what the
+load processes on the same machine can generate).
+
+Ex: python3 cluster_benchmark.py --workers 1 2 4 --pairs 200 --messages 500
+"""
+import os
+import time
+import argparse
+import selectors
+import multiprocessing
+
+from bench_util import ServerProcess, login_client
+from common.framing import FrameDecoder, encode_message, decode_message, RECV_SIZE
+
+def drain(selector, decoders, usernames, counts, deadline):
+    """
+    This function reads whatever has arrived on the sockets and counts messages by type
+
+    The dms read from a socket are acknowledged with one ack, as a client
+    does, so the server keeps sending them (see server/delivery.py).
+    """
+    for key, _ in selector.select(timeout=max(0.0, deadline - time.monotonic())):
+        sock = key.fileobj
+        data = sock.recv(RECV_SIZE)
+        if not data:
+            raise ConnectionError("Server closed a connection")
+        newest = None
+        for payload in decoders[sock].feed(data):
+            message = decode_message(payload)
+            message_type = message.get("type")
+            counts[message_type] = counts.get(message_type, 0) + 1
+            if message_type == "dm":
+                newest = message["id"]
+        if newest is not None:
+            sock.sendall(encode_message({"command": "ack", "username": usernames[sock], "id": newest}))
+
+def receive_until(selector, decoders, usernames, counts, message_type, expected, timeout=300.0):
+    deadline = time.monotonic() + timeout
+    while counts.get(message_type, 0) < expected and time.monotonic() < deadline:
+        drain(selector, decoders, usernames, counts, deadline)
+
+def load_process(port, first_pair, pairs, messages, pm_total, pm_messages, barrier, results):
+    """
+    This function is one load process: it logs in its pairs, then sends dms and pms
+    """
+    senders = []
+    receivers = []
+    for pair in range(first_pair, first_pair + pairs):
+        senders.append((f"send{pair}", login_client(port, f"send{pair}")))
+        receivers.append((f"recv{pair}", login_client(port, f"recv{pair}")))
+
+    selector = selectors.DefaultSelector()
+    decoders = {}
+    usernames = {}
+    for username, sock in senders + receivers:
+        decoders[sock] = FrameDecoder(64 * 1024 * 1024)
+        usernames[sock] = username
+        selector.register(sock, selectors.EVENT_READ)
+    counts = {}
+
+    # Everyone logged in: wait for every other load process
+    barrier.wait()
+    start = time.perf_counter()
+    chunk = 50
+    for sent in range(0, messages, chunk):
+        for pair, (username, sock) in enumerate(senders):
+            frame = encode_message({"command": "dm", "username": username,
+                                    "recipient": f"recv{first_pair + pair}", "message": "x" * 64})
+            sock.sendall(frame * min(chunk, messages - sent))
+        drain(selector, decoders, usernames, counts, time.monotonic())
+    receive_until(selector, decoders, usernames, counts, "dm", pairs * messages)
+    dm_elapsed = time.perf_counter() - start
+    dms = counts.get("dm", 0)
+
+    # pm: every user of every load process receives each pm (except the sender)
+    barrier.wait()
+    counts.clear()
+    start = time.perf_counter()
+    username, sock = senders[0]
+    frame = encode_message({"command": "pm", "username": username, "message": "x" * 64})
+    for sent in range(0, pm_messages, chunk):
+        sock.sendall(frame * min(chunk, pm_messages - sent))
+        drain(selector, decoders, usernames, counts, time.monotonic())
+    expected = pm_total * (2 * pairs) - pm_messages
+    receive_until(selector, decoders, usernames, counts, "pm", expected)
+    pm_elapsed = time.perf_counter() - start
+
+    results.put((dms, dm_elapsed, counts.get("pm", 0), pm_elapsed))
+    for _, sock in senders + receivers:
+        sock.close()
+
+def run(workers, engine, loaders, pairs, messages, pm_messages):
+    with ServerProcess(["--engine", engine, "--workers", str(workers),
+                        "--send-queue-bytes", str(64 * 1024 * 1024)]) as server:
+        time.sleep(1.0 + 0.5 * workers) # Let every worker start listening
+        barrier = multiprocessing.Barrier(loaders)
+        results = multiprocessing.Queue()
+        per_loader = pairs // loaders
+        processes = [multiprocessing.Process(target=load_process,
+                                             args=(server.port, i * per_loader, per_loader, messages,
+                                                   loaders * pm_messages, pm_messages, barrier, results))
+                     for i in range(loaders)]
+        for process in processes:
+            process.start()
+        outcomes = [results.get(timeout=900) for _ in processes]
+        for process in processes:
+            process.join()
+
+    dms = sum(outcome[0] for outcome in outcomes)
+    dm_time = max(outcome[1] for outcome in outcomes)
+    pms = sum(outcome[2] for outcome in outcomes)
+    pm_time = max(outcome[3] for outcome in outcomes)
+    print(f"  {workers:2d} workers: {dms / dm_time:10.0f} dms/s   {pms / pm_time:10.0f} pm deliveries/s")
+
+def main():
+    parser = argparse.ArgumentParser(description="Multi-process server throughput benchmark")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--engine", default="asyncio", choices=["threaded", "asyncio"])
+    parser.add_argument("--loaders", type=int, default=min(4, os.cpu_count()))
+    parser.add_argument("--pairs", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=500, help="dms sent by each sender")
+    parser.add_argument("--pm-messages", type=int, default=50, help="pms sent by each load process")
+    args = parser.parse_args()
+
+    print(f"{os.cpu_count()} CPU cores, {args.loaders} load processes, {args.engine} engine:")
+    for workers in args.workers:
+        run(workers, args.engine, args.loaders, args.pairs, args.messages, args.pm_messages)
+
+if __name__ == "__main__":
+    main()
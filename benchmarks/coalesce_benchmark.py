@@ -0,0 +1,156 @@
+"""
+Benchmark for write coalescing (--coalesce-delay and --coalesce-bytes).
+
+A chatty room: a few senders each send pms one frame at a time, as fast as
+the server takes them, and every other logged-in user receives them all.
+For each engine and coalescing setting the script reports:
+- pm deliveries per second
+- socket writes per delivered frame, from the server's own counters
+  (chat_socket_writes_total / chat_frames_sent_total on its metrics endpoint)
+- TCP segments per delivered frame, from /proc/net/snmp (every TCP
+  segment sent on this machine while the test runs, including the
+  clients' ACKs and requests, so run it on an otherwise quiet machine)
+- the round trip of a single dm on an idle server, which is what a
+  coalescing window costs
+
+Ex: python3 coalesce_benchmark.py --senders 10 --receivers 50 --messages 500
+"""
+import time
+import argparse
+import selectors
+import urllib.request
+
+from bench_util import ServerProcess, free_port, login_client, send_json, recv_until, percentile
+from common.framing import FrameDecoder, encode_message, decode_message, RECV_SIZE
+
+# Label -> extra server arguments
+SETTINGS = {
+    "per frame": ["--coalesce-bytes", "0"],
+    "coalesced": [],
+    "window 2ms": ["--coalesce-delay", "0.002"],
+}
+
+def tcp_segments_sent():
+    """
+    This function reads how many TCP segments this machine has sent
+
+    Returns: OutSegs from /proc/net/snmp (0 if it cannot be read)
+    """
+    try:
+        with open("/proc/net/snmp") as snmp:
+            lines = [line.split() for line in snmp if line.startswith("Tcp:")]
+        return int(lines[1][lines[0].index("OutSegs")])
+    except (OSError, IndexError, ValueError):
+        return 0
+
+def scrape(metrics_port, names):
+    """
+    This function reads counters from the server's metrics endpoint
+
+    Returns: {name: value}
+    """
+    with urllib.request.urlopen(f"http://127.0.0.1:{metrics_port}/metrics") as response:
+        text = response.read().decode('utf-8')
+    values = dict.fromkeys(names, 0.0)
+    for line in text.splitlines():
+        name, _, value = line.partition(" ")
+        if name in values:
+            values[name] = float(value)
+    return values
+
+def measure_round_trip(port, samples):
+    """
+    This function times dms from one idle client to another and back
+
+    Returns: List of round trip times in seconds
+    """
+    first = login_client(port, "ping")
+    second = login_client(port, "pong")
+    round_trips = []
+    try:
+        for i in range(samples):
+            start = time.perf_counter()
+            send_json(first, {"command": "dm", "username": "ping", "recipient": "pong", "message": str(i)})
+            there = recv_until(second, lambda data: data.get("type") == "dm")
+            send_json(second, {"command": "dm", "username": "pong", "recipient": "ping", "message": str(i)})
+            back = recv_until(first, lambda data: data.get("type") == "dm")
+            round_trips.append(time.perf_counter() - start)
+            # Acknowledged outside the timing, so later dms are not held back (see server/delivery.py)
+            send_json(second, {"command": "ack", "username": "pong", "id": there["id"]})
+            send_json(first, {"command": "ack", "username": "ping", "id": back["id"]})
+    finally:
+        first.close()
+        second.close()
+    return round_trips
+
+def run(engine, label, senders, receivers, messages, samples):
+    metrics_port = free_port()
+    args = ["--engine", engine, "--metrics-port", str(metrics_port),
+            "--send-queue-bytes", str(64 * 1024 * 1024)] + SETTINGS[label]
+    with ServerProcess(args) as server:
+        round_trips = measure_round_trip(server.port, samples)
+
+        sending = [login_client(server.port, f"send{i}") for i in range(senders)]
+        receiving = [login_client(server.port, f"recv{i}") for i in range(receivers)]
+        selector = selectors.DefaultSelector()
+        decoders = {}
+        for sock in sending + receiving:
+            decoders[sock] = FrameDecoder(64 * 1024 * 1024)
+            selector.register(sock, selectors.EVENT_READ)
+        time.sleep(0.5)
+        counts = {"pm": 0}
+
+        def drain(timeout):
+            for key, _ in selector.select(timeout=timeout):
+                data = key.fileobj.recv(RECV_SIZE)
+                if not data:
+                    raise ConnectionError("Server closed a connection")
+                for payload in decoders[key.fileobj].feed(data):
+                    if decode_message(payload).get("type") == "pm":
+                        counts["pm"] += 1
+        # Read away the presence updates of the logins
+        drain(0.2)
+        counts["pm"] = 0
+
+        names = ("chat_socket_writes_total", "chat_frames_sent_total")
+        before = scrape(metrics_port, names)
+        segments = tcp_segments_sent()
+        expected = senders * messages * (senders + receivers - 1)
+        start = time.perf_counter()
+        for i in range(messages):
+            # One frame per send, the way a chatty user sends them
+            for sender, sock in enumerate(sending):
+                frame = encode_message({"command": "pm", "username": f"send{sender}", "message": f"chat line {i}"})
+                sock.sendall(frame)
+            drain(0)
+        deadline = time.monotonic() + 300
+        while counts["pm"] < expected and time.monotonic() < deadline:
+            drain(0.5)
+        elapsed = time.perf_counter() - start
+        segments = tcp_segments_sent() - segments
+        after = scrape(metrics_port, names)
+        for sock in sending + receiving:
+            sock.close()
+
+    writes = after["chat_socket_writes_total"] - before["chat_socket_writes_total"]
+    frames = after["chat_frames_sent_total"] - before["chat_frames_sent_total"]
+    print(f"  {engine:<10} {label:<11} {counts['pm'] / elapsed:10,.0f} pm deliveries/s"
+          f"   {writes / max(frames, 1):5.3f} writes/frame   {segments / max(counts['pm'], 1):5.3f} TCP segments/pm"
+          f"   dm round trip p50 {percentile(round_trips, 0.5) * 1000:6.3f} ms")
+
+def main():
+    parser = argparse.ArgumentParser(description="Write coalescing benchmark")
+    parser.add_argument("--senders", type=int, default=10)
+    parser.add_argument("--receivers", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=500, help="pms sent by each sender")
+    parser.add_argument("--samples", type=int, default=200, help="Idle dm round trips timed")
+    parser.add_argument("--engines", nargs="+", default=["threaded", "asyncio"])
+    args = parser.parse_args()
+
+    print(f"{args.senders} senders x {args.messages} pms, {args.senders + args.receivers - 1} recipients each")
+    for engine in args.engines:
+        for label in SETTINGS:
+            run(engine, label, args.senders, args.receivers, args.messages, args.samples)
+
+if __name__ == "__main__":
+    main()
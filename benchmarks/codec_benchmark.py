@@ -0,0 +1,147 @@
+"""
+Benchmark for the JSON and binary codecs.
+
+1. Codec: bytes per message and encode/decode time of common messages,
+   for JSON and for the binary codec once the usernames are interned
+   (runs in this process).
+2. Server: a sender writes a burst of pm frames in one sendall and
+   receivers count delivered messages, with every client on JSON and with
+   every client on the binary codec, for each server engine.
+
+Ex: python3 codec_benchmark.py --repeat 100000 --burst 5000 --receivers 20
+"""
+import time
+import socket
+import argparse
+
+from bench_util import ServerProcess, login_client
+from common.framing import FrameDecoder, RECV_SIZE
+from common.codec import JSON_CODEC, BinaryCodec, NameTable, CODECS
+
+SAMPLES = {
+    "pm request": {"command": "pm", "username": "user1234", "message": "Hello everyone, how is it going?"},
+    "dm request": {"command": "dm", "username": "user1234", "recipient": "user5678", "message": "See you at 5"},
+    "login request": {"command": "login", "username": "user1234", "password": "correct horse battery"},
+    "pm delivery": {"type": "pm", "from": "user1234", "message": "Hello everyone, how is it going?"},
+    "dm delivery": {"type": "dm", "from": "user1234", "message": "See you at 5"},
+    "status": {"status": "message_sent"},
+    "presence delta": {"type": "presence", "seq": 4821, "joined": ["user1", "user22", "user333"], "left": ["user4"]},
+    "presence 1000 users": {"type": "presence_snapshot", "seq": 4821,
+                            "active_users": [f"user{i}" for i in range(1000)]},
+    "stored dm": {"type": "dm", "from": "user1234", "message": "See you at 5", "id": 1048576,
+                  "time": 1700000000.25, "history": True},
+}
+
+def per_call(function, argument, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function(argument)
+    return (time.perf_counter() - start) / repeat
+
+def bench_codec(repeat):
+    print(f"{'message':<20} {'JSON bytes':>10} {'binary':>7}   {'encode JSON':>11} {'binary':>7}"
+          f"   {'decode JSON':>11} {'binary':>7}")
+    for label, message in SAMPLES.items():
+        repeat_here = max(1, repeat // 100) if len(message.get("active_users", ())) > 100 else repeat
+        encoder = BinaryCodec(NameTable())
+        decoder = BinaryCodec()
+        # The first frame defines the usernames; later ones use their ids
+        decoder.decode(encoder.encode(message)[4:])
+        json_frame = JSON_CODEC.encode(message)
+        binary_frame = encoder.encode(message)
+        assert decoder.decode(binary_frame[4:]) == message
+
+        json_encode = per_call(JSON_CODEC.encode, message, repeat_here)
+        binary_encode = per_call(encoder.encode, message, repeat_here)
+        json_decode = per_call(JSON_CODEC.decode, json_frame[4:], repeat_here)
+        binary_decode = per_call(decoder.decode, binary_frame[4:], repeat_here)
+        print(f"{label:<20} {len(json_frame):>10} {len(binary_frame):>7}   {json_encode * 1e6:>9.2f}us"
+              f" {binary_encode * 1e6:>5.2f}us   {json_decode * 1e6:>9.2f}us {binary_decode * 1e6:>5.2f}us")
+
+def binary_client(port, username):
+    """
+    This function connects, switches to the binary codec with hello, then registers and logs in
+
+    Returns: (socket, codec, frame decoder)
+    """
+    sock = socket.create_connection(("127.0.0.1", port))
+    decoder = FrameDecoder()
+    codec = JSON_CODEC
+    for request in ({"command": "hello", "codecs": list(CODECS)},
+                    {"command": "register", "username": username, "password": "bench"},
+                    {"command": "login", "username": username, "password": "bench"}):
+        sock.sendall(codec.encode(request))
+        frames = []
+        while not frames:
+            frames = decoder.feed(sock.recv(RECV_SIZE))
+        if request["command"] == "hello":
+            assert JSON_CODEC.decode(frames[0])["codec"] == "binary"
+            codec = BinaryCodec()
+        else:
+            # Decoded, since the login response defines usernames
+            for payload in frames:
+                codec.decode(payload)
+    return sock, codec, decoder
+
+def bench_server(engine, codec_name, burst, receivers):
+    """
+    This function sends a burst of pm frames and waits until every receiver has all of them
+
+    Returns: (pm deliveries per second, bytes received per delivered pm)
+    """
+    with ServerProcess(["--engine", engine]) as server:
+        clients = []
+        for i in range(receivers + 1):
+            if codec_name == "json":
+                clients.append((login_client(server.port, f"bench{i}"), JSON_CODEC, FrameDecoder()))
+            else:
+                clients.append(binary_client(server.port, f"bench{i}"))
+        time.sleep(0.5)
+        # Read away presence updates (decoding them, since they define usernames)
+        for sock, codec, decoder in clients:
+            sock.setblocking(False)
+            try:
+                while True:
+                    for payload in decoder.feed(sock.recv(RECV_SIZE)):
+                        codec.decode(payload)
+            except BlockingIOError:
+                pass
+            sock.setblocking(True)
+
+        (sender, codec, _), receiving = clients[0], clients[1:]
+        burst_bytes = b"".join(codec.encode({"command": "pm", "username": "bench0", "message": f"burst message {i}"})
+                               for i in range(burst))
+        start = time.perf_counter()
+        sender.sendall(burst_bytes)
+        received_bytes = 0
+        for sock, codec, decoder in receiving:
+            count = 0
+            while count < burst:
+                data = sock.recv(RECV_SIZE)
+                received_bytes += len(data)
+                for payload in decoder.feed(data):
+                    if codec.decode(payload).get("type") == "pm":
+                        count += 1
+        elapsed = time.perf_counter() - start
+        for sock, codec, decoder in clients:
+            sock.close()
+    return burst * receivers / elapsed, received_bytes / (burst * receivers)
+
+def main():
+    parser = argparse.ArgumentParser(description="JSON and binary codec benchmark")
+    parser.add_argument("--repeat", type=int, default=100000, help="Encodes/decodes timed per message")
+    parser.add_argument("--burst", type=int, default=5000, help="pm frames sent in one burst")
+    parser.add_argument("--receivers", type=int, default=20)
+    parser.add_argument("--engines", nargs="+", default=["threaded", "asyncio"])
+    args = parser.parse_args()
+
+    bench_codec(args.repeat)
+
+    print(f"\nServer: {args.burst} pms in one write, delivered to {args.receivers} receivers")
+    for engine in args.engines:
+        for codec_name in ("json", "binary"):
+            rate, size = bench_server(engine, codec_name, args.burst, args.receivers)
+            print(f"  {engine:<10} {codec_name:<7} {rate:>10,.0f} deliveries/s   {size:5.1f} bytes per pm received")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""
+Benchmark for per-connection compression of large frames.
+
+1. Codec: traffic is encoded and decoded in this process, once as it is
+   and once through a CompressedCodec (one connection's streams), for:
+   - chat: short pms and dms between 100 users
+   - logs: pasted log excerpts of a few KB
+   - replay: a history page of stored messages, a mix of both
+   For each codec and compression threshold the script reports bytes on
+   the wire (as a share of the uncompressed bytes) and the CPU time to
+   encode and decode one message.
+2. Server: a user logs in to an unread history of long dms, with and
+   without compression. The script reports the bytes the client received
+   and how long the replay took.
+
+Ex: python3 compression_benchmark.py --messages 2000 --replay 500
+"""
+import time
+import random
+import socket
+import argparse
+
+from bench_util import ServerProcess, login_client, send_json
+from common.framing import FrameDecoder, encode_message, RECV_SIZE, HEADER_SIZE
+from common.codec import BinaryCodec, NameTable, JSON_CODEC
+from common.compression import CompressedCodec, DEFAULT_COMPRESSION_THRESHOLD
+
+WORDS = ("the", "a", "meeting", "is", "at", "noon", "lunch", "today", "anyone", "free", "deploy", "done",
+         "thanks", "see", "you", "later", "build", "failed", "again", "fixed", "it", "now", "review",
+         "please", "ok", "sounds", "good", "on", "my", "way", "what", "time", "tomorrow", "works")
+
+def chat_message(rng):
+    sender = f"user{rng.randrange(100)}"
+    text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 15)))
+    if rng.random() < 0.2:
+        return {"type": "pm", "from": sender, "message": text}
+    return {"type": "dm", "from": sender, "message": text}
+
+def log_excerpt(rng, lines=40):
+    start = rng.randrange(100000)
+    return "\n".join(f"2026-10-17 12:{(i // 60) % 60:02d}:{i % 60:02d} {rng.choice(('INFO', 'WARN', 'DEBUG'))} "
+                     f"worker-{rng.randrange(8)} request id={start + i} path=/api/v1/messages status=200 "
+                     f"latency_ms={rng.randrange(1, 500)}" for i in range(lines))
+
+def traffic(kind, count, rng):
+    """
+    This function makes count messages of one kind of traffic
+
+    Returns: List of message dictionaries
+    """
+    messages = []
+    for i in range(count):
+        if kind == "chat":
+            messages.append(chat_message(rng))
+        elif kind == "logs":
+            messages.append({"type": "dm", "from": f"user{rng.randrange(100)}", "message": log_excerpt(rng)})
+        else:
+            message = chat_message(rng) if rng.random() < 0.8 else {"type": "dm", "from": "user1",
+                                                                    "message": log_excerpt(rng, 10)}
+            message.update(history=True, id=1000 + i, time=1760700000.0 + i)
+            messages.append(message)
+    return messages
+
+def new_codec(name):
+    return BinaryCodec(NameTable()) if name == "binary" else JSON_CODEC
+
+def measure(messages, codec_name, threshold):
+    """
+    This function sends messages through one connection's codecs
+
+    Returns: (bytes sent, seconds to encode and decode everything); threshold None is no compression
+    """
+    sender = new_codec(codec_name)
+    receiver = new_codec(codec_name)
+    if threshold is not None:
+        sender = CompressedCodec(sender, threshold)
+        receiver = CompressedCodec(receiver, threshold)
+    sent = 0
+    start = time.perf_counter()
+    for message in messages:
+        frame = sender.encode(message)
+        sent += len(frame)
+        decoded = receiver.decode(frame[HEADER_SIZE:])
+        assert decoded == message
+    return sent, time.perf_counter() - start
+
+def bench_codecs(count, seed):
+    thresholds = [("off", None), (f"{DEFAULT_COMPRESSION_THRESHOLD} B", DEFAULT_COMPRESSION_THRESHOLD), ("all", 0)]
+    print(f"Codec: {count} messages of each kind, bytes on the wire (share of uncompressed) and encode + decode time")
+    for kind in ("chat", "logs", "replay"):
+        messages = traffic(kind, count, random.Random(seed))
+        for codec_name in ("json", "binary"):
+            plain = None
+            for label, threshold in thresholds:
+                sent, elapsed = measure(messages, codec_name, threshold)
+                plain = plain or sent
+                print(f"  {kind:<7} {codec_name:<7} compress {label:<6} {sent / count:9.1f} B/message "
+                      f"({sent / plain:6.1%})   {elapsed / count * 1e6:8.2f} us/message")
+
+def bench_replay(engine, label, count, seed):
+    rng = random.Random(seed)
+    args = ["--engine", engine, "--history-replay", "0", "--send-queue-bytes", str(256 * 1024 * 1024)]
+    if label == "off":
+        args += ["--compression-level", "0"]
+    with ServerProcess(args) as server:
+        sender = login_client(server.port, "sender")
+        reader = login_client(server.port, "reader")
+        send_json(reader, {"command": "ex", "username": "reader"})
+        time.sleep(0.3)
+        reader.close()
+        for i in range(count):
+            send_json(sender, {"command": "dm", "username": "sender", "recipient": "reader",
+                               "message": log_excerpt(rng, 20)})
+        time.sleep(1.0)
+
+        sock = socket.create_connection(("127.0.0.1", server.port))
+        sock.sendall(encode_message({"command": "hello", "codecs": ["json"], "compression": ["zlib"]}))
+        sock.sendall(encode_message({"command": "login", "username": "reader", "password": "bench"}))
+        decoder = FrameDecoder(256 * 1024 * 1024)
+        codec = JSON_CODEC
+        received = replayed = 0
+        start = time.perf_counter()
+        while replayed < count:
+            data = sock.recv(RECV_SIZE)
+            if not data:
+                raise ConnectionError("Server closed the connection")
+            received += len(data)
+            newest = None
+            for payload in decoder.feed(data):
+                message = codec.decode(payload)
+                if message.get("status") == "hello" and message.get("compression"):
+                    codec = CompressedCodec(JSON_CODEC, max_size=256 * 1024 * 1024)
+                elif message.get("history"):
+                    replayed += 1
+                    newest = message["id"]
+            if newest is not None:
+                # The rest of the replay is sent as the dms are acknowledged (see server/delivery.py)
+                sock.sendall(encode_message({"command": "ack", "username": "reader", "id": newest}))
+        elapsed = time.perf_counter() - start
+        sock.close()
+        sender.close()
+    print(f"  {engine:<10} compression {label:<4} {received / 1024:10,.0f} KiB received   "
+          f"replay of {count} dms in {elapsed * 1000:8.1f} ms")
+
+def main():
+    parser = argparse.ArgumentParser(description="Compression benchmark")
+    parser.add_argument("--messages", type=int, default=2000, help="Messages of each kind in the codec test")
+    parser.add_argument("--replay", type=int, default=500, help="Unread long dms replayed at login")
+    parser.add_argument("--engines", nargs="+", default=["threaded", "asyncio"])
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    bench_codecs(args.messages, args.seed)
+    print(f"\nServer: login with {args.replay} unread dms of about 2 KB")
+    for engine in args.engines:
+        for label in ("on", "off"):
+            bench_replay(engine, label, args.replay, args.seed)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Load benchmark comparing the threaded and asyncio server engines.
+
+For each engine this script opens a number of idle connections, then measures
+pm latency between two logged-in clients while the idle connections are held,
+and reports the server's memory per connection.
+
+Ex: python3 engine_benchmark.py --connections 10000 --messages 200
+"""
+import time
+import socket
+import argparse
+
+from bench_util import (ServerProcess, raise_fd_limit, rss_kib, thread_count,
+                        login_client, send_json, recv_until, percentile)
+
+def open_idle_connections(port, count):
+    """
+    This function opens count idle TCP connections to the server
+
+    Returns: List of connected sockets
+    """
+    sockets = []
+    for _ in range(count):
+        sockets.append(socket.create_connection(("127.0.0.1", port)))
+    return sockets
+
+def measure_pm_latency(port, messages):
+    """
+    This function sends pm messages from one client to another
+
+    Returns: List of one-way delivery latencies in seconds
+    """
+    sender = login_client(port, "bench_sender")
+    receiver = login_client(port, "bench_receiver")
+    latencies = []
+    try:
+        for i in range(messages):
+            start = time.perf_counter()
+            send_json(sender, {"command": "pm", "username": "bench_sender", "message": f"ping {i}"})
+            recv_until(receiver, lambda data: data.get("type") == "pm")
+            latencies.append(time.perf_counter() - start)
+            recv_until(sender, lambda data: "status" in data)
+    finally:
+        sender.close()
+        receiver.close()
+    return latencies
+
+def run_engine(engine, connections, messages):
+    """
+    This function benchmarks one engine
+
+    Returns: Dictionary of results
+    """
+    with ServerProcess(["--engine", engine]) as server:
+        time.sleep(0.5)
+        base_rss = rss_kib(server.pid)
+
+        start = time.perf_counter()
+        idle = open_idle_connections(server.port, connections)
+        connect_time = time.perf_counter() - start
+
+        try:
+            # Latency is measured while all idle connections are being held
+            latencies = measure_pm_latency(server.port, messages)
+            loaded_rss = rss_kib(server.pid)
+            threads = thread_count(server.pid)
+        finally:
+            for sock in idle:
+                sock.close()
+
+    return {
+        "engine": engine,
+        "connections": len(idle),
+        "connect_s": connect_time,
+        "threads": threads,
+        "rss_mib": loaded_rss / 1024,
+        "kib_per_conn": (loaded_rss - base_rss) / max(1, len(idle)),
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare threaded and asyncio server engines")
+    parser.add_argument("--connections", type=int, default=10000, help="Idle connections to hold")
+    parser.add_argument("--messages", type=int, default=200, help="pm messages for the latency test")
+    parser.add_argument("--engines", nargs="+", default=["threaded", "asyncio"])
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    print(f"{'engine':<10} {'conns':>7} {'connect s':>10} {'threads':>8} {'RSS MiB':>8} "
+          f"{'KiB/conn':>9} {'p50 ms':>8} {'p99 ms':>8}")
+    for engine in args.engines:
+        result = run_engine(engine, args.connections, args.messages)
+        print(f"{result['engine']:<10} {result['connections']:>7} {result['connect_s']:>10.2f} "
+              f"{result['threads']:>8} {result['rss_mib']:>8.1f} {result['kib_per_conn']:>9.1f} "
+              f"{result['p50_ms']:>8.3f} {result['p99_ms']:>8.3f}")
+
+if __name__ == '__main__':
+    main()
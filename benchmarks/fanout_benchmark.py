@@ -0,0 +1,178 @@
+"""
+Benchmark for pm fan-out through the per-connection outbound queues.
+
+One sender broadcasts pm messages to N logged-in recipients. One extra
+client logs in last and never reads (a stalled client with a tiny receive
+buffer), so its outbound queue overflows during the run. For every message the script measures the time until the last
+recipient has it, and the time until the sender gets its response.
+With per-connection queues the stalled client should not slow anyone else.
+
+Ex: python3 fanout_benchmark.py --recipients 1000 --messages 200
+"""
+import time
+import socket
+import argparse
+import selectors
+import threading
+
+from bench_util import (ServerProcess, raise_fd_limit, login_client, send_json,
+                        recv_until, percentile)
+from common.framing import FrameDecoder, decode_message
+
+class RecipientPool:
+    """
+    This class reads every recipient socket on one thread with a selector.
+
+    It counts how many recipients have received each pm (by message text)
+    and sets an event when all of them have it.
+    """
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.members = 0
+        self.disconnected = 0
+        self.counts = {}
+        self.complete = {}
+        self.running = True
+        self.last_receive = time.monotonic()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def add(self, sock):
+        sock.setblocking(False)
+        with self.lock:
+            self.members += 1
+        self.selector.register(sock, selectors.EVENT_READ, FrameDecoder())
+
+    def expect(self, text):
+        event = threading.Event()
+        with self.lock:
+            self.counts[text] = 0
+            self.complete[text] = event
+        return event
+
+    def _run(self):
+        while self.running:
+            for key, _ in self.selector.select(timeout=0.1):
+                try:
+                    data = key.fileobj.recv(65536)
+                except BlockingIOError:
+                    continue
+                except OSError:
+                    data = b""
+                self.last_receive = time.monotonic()
+                if not data:
+                    # Disconnected (Ex: as a slow consumer during the login storm)
+                    self.selector.unregister(key.fileobj)
+                    with self.lock:
+                        self.members -= 1
+                        self.disconnected += 1
+                    continue
+                for payload in key.data.feed(data):
+                    message = decode_message(payload)
+                    if message.get("type") != "pm":
+                        continue
+                    with self.lock:
+                        text = message["message"]
+                        if text in self.counts:
+                            self.counts[text] += 1
+                            if self.counts[text] == self.members:
+                                self.complete.pop(text).set()
+
+    def wait_idle(self, quiet=0.05):
+        """
+        This function waits until no data has arrived for quiet seconds
+
+        Used to pace the login storm so recipients keep up with the
+        presence broadcasts.
+        """
+        while time.monotonic() - self.last_receive < quiet:
+            time.sleep(quiet)
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        for key in list(self.selector.get_map().values()):
+            key.fileobj.close()
+        self.selector.close()
+
+def run(engine, policy, recipients, messages, payload_size):
+    """
+    This function runs the fan-out benchmark for one engine and policy
+
+    Returns: Dictionary of results
+    """
+    server_args = ["--engine", engine, "--slow-consumer", policy]
+    with ServerProcess(server_args) as server:
+        pool = RecipientPool()
+        for i in range(recipients):
+            pool.add(login_client(server.port, f"recipient{i}"))
+            if i % 20 == 19:
+                pool.wait_idle()
+        sender = login_client(server.port, "sender")
+
+        # The stalled client logs in last and never reads again
+        stalled = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        stalled.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        stalled.connect(("127.0.0.1", server.port))
+        send_json(stalled, {"command": "register", "username": "stalled", "password": "bench"})
+        recv_until(stalled, lambda data: "status" in data)
+        send_json(stalled, {"command": "login", "username": "stalled", "password": "bench"})
+        recv_until(stalled, lambda data: "status" in data)
+        recv_until(sender, lambda data: data.get("type") == "presence" and "stalled" in data["joined"])
+        pool.wait_idle()
+
+        padding = "x" * payload_size
+        fanout = []
+        response = []
+        start_all = time.perf_counter()
+        try:
+            for i in range(messages):
+                text = f"{i} {padding}"
+                done = pool.expect(text)
+                start = time.perf_counter()
+                send_json(sender, {"command": "pm", "username": "sender", "message": text})
+                recv_until(sender, lambda data: "status" in data)
+                response.append(time.perf_counter() - start)
+                if not done.wait(timeout=30) and pool.counts.get(text, 0) < pool.members:
+                    raise RuntimeError(f"pm {i} was not delivered to every recipient")
+                fanout.append(time.perf_counter() - start)
+            elapsed = time.perf_counter() - start_all
+            delivered_to = pool.members
+        finally:
+            sender.close()
+            stalled.close()
+            pool.close()
+
+    return {
+        "engine": engine,
+        "policy": policy,
+        "resp_p50": percentile(response, 0.50) * 1000,
+        "fan_p50": percentile(fanout, 0.50) * 1000,
+        "fan_p99": percentile(fanout, 0.99) * 1000,
+        "deliveries": delivered_to * messages / elapsed,
+        "disconnected": recipients - delivered_to,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark pm fan-out with a stalled client")
+    parser.add_argument("--recipients", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--payload-size", type=int, default=8192, help="pm message size in bytes")
+    parser.add_argument("--engines", nargs="+", default=["threaded", "asyncio"])
+    parser.add_argument("--policies", nargs="+", default=["disconnect", "drop", "buffer"])
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    print(f"{'engine':<10} {'policy':<11} {'resp p50 ms':>12} {'fan-out p50 ms':>15} "
+          f"{'fan-out p99 ms':>15} {'deliveries/s':>13} {'dropped conns':>14}")
+    for engine in args.engines:
+        for policy in args.policies:
+            result = run(engine, policy, args.recipients, args.messages, args.payload_size)
+            print(f"{result['engine']:<10} {result['policy']:<11} {result['resp_p50']:>12.2f} "
+                  f"{result['fan_p50']:>15.2f} {result['fan_p99']:>15.2f} {result['deliveries']:>13,.0f} "
+                  f"{result['disconnected']:>14}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""
+Benchmark for the length-prefixed framing layer.
+
+1. Decoder: how fast FrameDecoder pulls frames out of one large buffer, and
+   out of the same stream split into small uneven chunks.
+2. Pipelined pm: a sender writes a burst of pm frames in one sendall and a
+   receiver counts delivered messages, for each server engine. A large
+   message (above the old 1 KB recv limit) is also checked end to end.
+
+Ex: python3 framing_benchmark.py --burst 5000
+"""
+import time
+import argparse
+
+from bench_util import ServerProcess, login_client, send_json, recv_until
+from common.framing import FrameDecoder, encode_message
+
+def bench_decoder(frames, chunk_size):
+    """
+    This function feeds an encoded stream to a decoder in chunk_size pieces
+
+    Returns: Frames decoded per second
+    """
+    stream = b"".join(encode_message({"type": "pm", "from": f"user{i}", "message": "hello there"})
+                      for i in range(frames))
+    decoder = FrameDecoder()
+    decoded = 0
+    start = time.perf_counter()
+    for offset in range(0, len(stream), chunk_size):
+        decoded += len(decoder.feed(stream[offset:offset + chunk_size]))
+    elapsed = time.perf_counter() - start
+    assert decoded == frames
+    return frames / elapsed
+
+def bench_pipelined(engine, burst, large_size):
+    """
+    This function sends a burst of pm frames in one write and waits for all of them
+
+    Returns: (messages per second, large message delivered)
+    """
+    with ServerProcess(["--engine", engine]) as server:
+        sender = login_client(server.port, "bench_sender")
+        receiver = login_client(server.port, "bench_receiver")
+        try:
+            burst_bytes = b"".join(
+                encode_message({"command": "pm", "username": "bench_sender", "message": f"burst {i}"})
+                for i in range(burst))
+
+            start = time.perf_counter()
+            sender.sendall(burst_bytes)
+            for _ in range(burst):
+                recv_until(receiver, lambda data: data.get("type") == "pm")
+            elapsed = time.perf_counter() - start
+
+            big = "x" * large_size
+            send_json(sender, {"command": "pm", "username": "bench_sender", "message": big})
+            delivered = recv_until(receiver, lambda data: data.get("type") == "pm")["message"] == big
+        finally:
+            sender.close()
+            receiver.close()
+    return burst / elapsed, delivered
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark message framing")
+    parser.add_argument("--frames", type=int, default=200000, help="Frames for the decoder benchmark")
+    parser.add_argument("--burst", type=int, default=5000, help="pm frames sent in one burst")
+    parser.add_argument("--large-size", type=int, default=256 * 1024, help="Size of the large message check")
+    parser.add_argument("--engines", nargs="+", default=["threaded", "asyncio"])
+    args = parser.parse_args()
+
+    print("Decoder")
+    for chunk_size in (65536, 1500, 7):
+        rate = bench_decoder(args.frames, chunk_size)
+        print(f"  chunk {chunk_size:>6} bytes: {rate:>12,.0f} frames/s")
+
+    print(f"Pipelined pm ({args.burst} frames in one write)")
+    for engine in args.engines:
+        rate, delivered = bench_pipelined(engine, args.burst, args.large_size)
+        print(f"  {engine:<10} {rate:>10,.0f} msgs/s   {args.large_size} byte message delivered: {delivered}")
+
+if __name__ == '__main__':
+    main()
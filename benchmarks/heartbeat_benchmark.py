@@ -0,0 +1,131 @@
+"""
+Benchmark for heartbeats and dead-connection reaping.
+
+1. Timers: the cost of setting and running a timer on the TimerWheel the
+   server uses (runs in this process), next to starting and cancelling a
+   threading.Timer, which needs a thread per pending timer.
+2. Server: many logged-in clients stop answering (as if their machines
+   lost power) while one observer keeps answering pings. The script
+   reports how long after the idle timeout the observer learns that they
+   have all left, and the server's thread count while they are connected
+   and after they are reaped.
+
+Ex: python3 heartbeat_benchmark.py --clients 1000 --timers 100000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import threading
+
+from bench_util import REPO_DIR, ServerProcess, raise_fd_limit, thread_count, login_client
+
+sys.path.insert(0, os.path.join(REPO_DIR, "client"))
+sys.path.insert(0, os.path.join(REPO_DIR, "server"))
+from chat_client import ChatClient
+from heartbeat import TimerWheel
+
+# Heartbeat settings of the server test (seconds)
+PING_INTERVAL = 1.0
+IDLE_TIMEOUT = 3.0
+
+def bench_timers(timers):
+    """
+    This function times timers on the wheel and threading.Timer
+    """
+    wheel = TimerWheel()
+    fired = [0]
+
+    def callback():
+        fired[0] += 1
+
+    start = time.perf_counter()
+    for _ in range(timers):
+        wheel.schedule(random.uniform(1, 90), callback)
+    schedule_time = (time.perf_counter() - start) / timers
+
+    # Runs everything by advancing the wheel's clock 100 seconds
+    start = time.perf_counter()
+    wheel.advance(wheel.started + 100)
+    run_time = (time.perf_counter() - start) / timers
+    assert fired[0] == timers
+
+    threads = min(timers, 1000)
+    before = threading.active_count()
+    pending = []
+    start = time.perf_counter()
+    for _ in range(threads):
+        timer = threading.Timer(90, callback)
+        timer.daemon = True
+        timer.start()
+        pending.append(timer)
+    thread_time = (time.perf_counter() - start) / threads
+    waiting = threading.active_count() - before
+    for timer in pending:
+        timer.cancel()
+
+    print(f"Timers: {timers} on the wheel, {threads} threading.Timer")
+    print(f"  wheel schedule             {schedule_time * 1e6:8.2f} us")
+    print(f"  wheel run                  {run_time * 1e6:8.2f} us")
+    print(f"  threading.Timer start      {thread_time * 1e6:8.2f} us   ({waiting} threads for {threads} timers)")
+
+def bench_server(engine, clients):
+    args = ["--engine", engine, "--ping-interval", str(PING_INTERVAL), "--idle-timeout", str(IDLE_TIMEOUT)]
+    with ServerProcess(args) as server:
+        observer = ChatClient.connect("127.0.0.1", server.port)
+        observer.register("observer", "bench")
+        observer.login("observer", "bench")
+        left = set()
+        done = threading.Event()
+
+        def watch():
+            # receive() answers the pings, so the observer is never reaped
+            while True:
+                message = observer.receive()
+                if message is None:
+                    break
+                if message.get("type") == "presence":
+                    left.update(message["left"])
+                    if len(left) >= clients:
+                        done.set()
+        threading.Thread(target=watch, daemon=True).start()
+
+        # These clients never read or answer a ping again
+        dead = [login_client(server.port, f"dead{i}") for i in range(clients)]
+        last_login = time.monotonic()
+        connected_threads = thread_count(server.pid)
+        finished = done.wait(IDLE_TIMEOUT + 60)
+        reap_time = time.monotonic() - last_login - IDLE_TIMEOUT
+        time.sleep(1.0)
+        reaped_threads = thread_count(server.pid)
+        observer.close()
+        for sock in dead:
+            sock.close()
+
+    if not finished:
+        print(f"  {engine:<10} only {len(left)} of {clients} silent clients were reaped")
+        return
+    print(f"  {engine:<10} every silent client reaped {reap_time:5.2f} s after the idle timeout   "
+          f"server threads: {connected_threads} connected, {reaped_threads} after reaping")
+
+def main():
+    parser = argparse.ArgumentParser(description="Heartbeat and reaping benchmark")
+    parser.add_argument("--clients", type=int, default=1000, help="Logged-in clients that stop answering")
+    parser.add_argument("--timers", type=int, default=100000, help="Timers set on the wheel")
+    parser.add_argument("--engines", nargs="+", default=["threaded", "asyncio"])
+    args = parser.parse_args()
+
+    bench_timers(args.timers)
+
+    limit = raise_fd_limit()
+    if limit < args.clients + 100:
+        print(f"\nThe open file limit ({limit}) is too low for {args.clients} connections")
+        return
+    print(f"\nServer: {args.clients} silent clients, pinged after {PING_INTERVAL:g} s, "
+          f"reaped after {IDLE_TIMEOUT:g} s of silence")
+    for engine in args.engines:
+        bench_server(engine, args.clients)
+
+if __name__ == "__main__":
+    main()
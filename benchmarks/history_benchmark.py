@@ -0,0 +1,87 @@
+"""
+Benchmark for the message history log.
+
+Runs the MessageLog in this process (in a scratch directory):
+1. Appends N messages (half public, half dms between U users) and reports
+   appends per second and the memory used by the index.
+2. Reopens the log and reports how long rebuilding the index took.
+3. Reads one user's whole unread backlog and pages back through their
+   history, reporting latency and how much heap memory the reads added
+   (mmapped file pages are left out).
+
+Ex: python3 history_benchmark.py --messages 1000000 --users 1000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+from bench_util import REPO_DIR, rss_kib, percentile
+
+sys.path.insert(0, os.path.join(REPO_DIR, "server"))
+from history import MessageLog
+
+def main():
+    parser = argparse.ArgumentParser(description="Message history benchmark")
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--message-bytes", type=int, default=100)
+    parser.add_argument("--pages", type=int, default=200)
+    args = parser.parse_args()
+
+    workdir = tempfile.TemporaryDirectory(prefix="chat-history-")
+    directory = os.path.join(workdir.name, "history")
+    text = "x" * args.message_bytes
+    random.seed(1)
+
+    base_rss = rss_kib(os.getpid(), "RssAnon")
+    log = MessageLog(directory)
+    start = time.perf_counter()
+    for i in range(args.messages):
+        sender = f"user{random.randrange(args.users)}"
+        if i % 2:
+            log.append({"type": "pm", "from": sender, "message": text})
+        else:
+            # user0 gets a large share of the dms, so it has a long unread backlog
+            recipient = "user0" if i % 8 == 0 else f"user{random.randrange(args.users)}"
+            log.append({"type": "dm", "from": sender, "to": recipient, "message": text})
+    elapsed = time.perf_counter() - start
+    index_kib = rss_kib(os.getpid(), "RssAnon") - base_rss
+    segments = len(log.segments)
+    log.close()
+    size_mib = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)) / 2 ** 20
+    print(f"append:  {args.messages / elapsed:10.0f} messages/s   log {size_mib:.0f} MiB in {segments} segments"
+          f"   index ~{index_kib / 1024:.0f} MiB")
+
+    start = time.perf_counter()
+    log = MessageLog(directory)
+    print(f"reopen:  {time.perf_counter() - start:10.2f} s to rebuild the index of {len(log)} messages")
+
+    before_read = rss_kib(os.getpid(), "RssAnon")
+    start = time.perf_counter()
+    ids, unread = log.unread("user0", limit=args.messages)
+    read_bytes = sum(len(record["message"]) for record in log.read(ids))
+    elapsed = time.perf_counter() - start
+    print(f"unread:  {unread} dms for user0 ({read_bytes / 2 ** 20:.1f} MiB) read in {elapsed:.2f} s"
+          f"   heap +{(rss_kib(os.getpid(), 'RssAnon') - before_read) / 1024:.1f} MiB")
+
+    latencies = []
+    before = None
+    for _ in range(args.pages):
+        start = time.perf_counter()
+        page, more = log.page("user0", before, 20)
+        records = list(log.read(page))
+        latencies.append(time.perf_counter() - start)
+        if not more:
+            break
+        before = records[0]["id"]
+    print(f"history: {len(latencies)} pages of 20   p50 {percentile(latencies, 0.50) * 1e6:.0f} us"
+          f"   p99 {percentile(latencies, 0.99) * 1e6:.0f} us")
+
+    log.close()
+    workdir.cleanup()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""
+End-to-end load generator: thousands of simulated users on one asyncio event loop.
+
+Every simulated user is an AsyncChatClient (see client/chat_client.py). The
+users are registered and logged in, then messages are sent at a fixed
+total rate for a fixed time, from random users: a pm to everyone with
+probability --pm-ratio, otherwise a dm to another random user. Each message
+carries the time it was sent, so every delivery gives a latency sample.
+
+Reports, per server engine (or for a server that is already running):
+- login rate
+- messages sent, deliveries expected and received
+- deliveries per second
+- p50, p99 and p999 delivery latency, for pms, dms and all deliveries
+
+The simulated users run on the same machine as the server; on a small
+machine they compete with it for CPU, so compare runs made the same way.
+
+Ex: python3 loadgen.py --users 2000 --rate 2000 --pm-ratio 0.01 --duration 10
+    python3 loadgen.py --engines asyncio --server-args "--workers 2"
+    python3 loadgen.py --port 12000 --users 500 (a server that is already running)
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+
+from bench_util import REPO_DIR, ServerProcess, raise_fd_limit, percentile
+
+sys.path.insert(0, os.path.join(REPO_DIR, "client"))
+from chat_client import AsyncChatClient
+
+# Start of every generated message: the marker and the send time in nanoseconds
+MARK = "lg:"
+# Logins waiting for the server at once (each needs a password hash, and
+# the server's hasher queue is bounded)
+LOGIN_CONCURRENCY = 100
+# Seconds between the sender's batches of messages
+SEND_INTERVAL = 0.005
+
+class Stats:
+    """
+    This class collects what the simulated users sent and received
+    """
+
+    def __init__(self):
+        self.sent = {"pm": 0, "dm": 0}
+        self.expected = {"pm": 0, "dm": 0}
+        self.latencies = {"pm": [], "dm": []}
+        self.statuses = {}
+        self.errors = 0
+
+    @property
+    def delivered(self):
+        return len(self.latencies["pm"]) + len(self.latencies["dm"])
+
+async def log_in(host, port, username, binary, semaphore):
+    """
+    This function connects, registers (if needed) and logs in one simulated user
+
+    Returns: AsyncChatClient
+    """
+    async with semaphore:
+        client = await AsyncChatClient.connect(host, port, binary, track_presence=False)
+        status = await client.register(username, "loadgen")
+        if status not in ("success", "username_taken"):
+            raise RuntimeError(f"Could not register {username}: {status}")
+        response = await client.login(username, "loadgen")
+        if response["status"] != "success":
+            raise RuntimeError(f"Could not log in {username}: {response}")
+    return client
+
+async def receive_loop(client, stats):
+    """
+    This function reads one simulated user's messages and records delivery latencies
+    """
+    while True:
+        try:
+            message = await client.receive()
+        except ValueError:
+            stats.errors += 1
+            continue
+        except OSError:
+            break
+        if message is None:
+            break
+        kind = message.get("type")
+        if kind in ("pm", "dm"):
+            text = message.get("message", "")
+            if text.startswith(MARK):
+                sent = int(text[len(MARK):text.index(" ")])
+                stats.latencies[kind].append((time.perf_counter_ns() - sent) / 1e9)
+        elif "status" in message:
+            stats.statuses[message["status"]] = stats.statuses.get(message["status"], 0) + 1
+
+async def generate(clients, rate, pm_ratio, duration, size, stats):
+    """
+    This function sends messages at rate per second (in total) for duration seconds
+    """
+    loop = asyncio.get_running_loop()
+    padding = "x" * max(0, size - 30)
+    start = loop.time()
+    sent = 0
+    while True:
+        elapsed = loop.time() - start
+        if elapsed >= duration:
+            break
+        # Catch up to where the schedule says we should be
+        for _ in range(int(elapsed * rate) - sent):
+            sender = random.choice(clients)
+            text = f"{MARK}{time.perf_counter_ns()} {padding}"
+            if random.random() < pm_ratio:
+                sender.pm(text)
+                stats.sent["pm"] += 1
+                stats.expected["pm"] += len(clients) - 1
+            else:
+                recipient = random.choice(clients)
+                while recipient is sender:
+                    recipient = random.choice(clients)
+                sender.dm(recipient.username, text)
+                stats.sent["dm"] += 1
+                stats.expected["dm"] += 1
+            sent += 1
+        await asyncio.sleep(SEND_INTERVAL)
+
+async def run_load(host, port, args):
+    """
+    This function runs one load test against a server
+
+    Returns: Stats, login seconds, seconds from the first message until the last delivery
+    """
+    semaphore = asyncio.Semaphore(LOGIN_CONCURRENCY)
+    start = time.perf_counter()
+    clients = await asyncio.gather(*(log_in(host, port, f"{args.prefix}{i}", args.codec == "binary", semaphore)
+                                     for i in range(args.users)))
+    login_time = time.perf_counter() - start
+
+    stats = Stats()
+    receivers = [asyncio.create_task(receive_loop(client, stats)) for client in clients]
+    # Let the presence updates of the logins settle
+    await asyncio.sleep(1.0)
+    stats.statuses.clear()
+
+    start = time.perf_counter()
+    await generate(clients, args.rate, args.pm_ratio, args.duration, args.size, stats)
+    expected = stats.expected["pm"] + stats.expected["dm"]
+    deadline = time.perf_counter() + args.drain
+    while stats.delivered < expected and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - start
+
+    for client in clients:
+        client.close()
+    for task in receivers:
+        task.cancel()
+    await asyncio.gather(*receivers, return_exceptions=True)
+    return stats, login_time, elapsed
+
+def report(label, args, stats, login_time, elapsed):
+    expected = stats.expected["pm"] + stats.expected["dm"]
+    everything = stats.latencies["pm"] + stats.latencies["dm"]
+    print(f"{label}: {args.users} users, {args.rate}/s offered for {args.duration} s, "
+          f"{args.pm_ratio:.0%} pm, {args.codec}")
+    print(f"  logins: {args.users / login_time:8.0f}/s")
+    print(f"  sent: {stats.sent['pm']} pm, {stats.sent['dm']} dm   "
+          f"delivered: {stats.delivered} of {expected} ({stats.delivered / max(expected, 1):.2%})")
+    print(f"  throughput: {stats.delivered / elapsed:10,.0f} deliveries/s")
+    for kind, samples in (("pm", stats.latencies["pm"]), ("dm", stats.latencies["dm"]), ("all", everything)):
+        if samples:
+            print(f"  {kind:<3} latency: p50 {percentile(samples, 0.5) * 1000:8.2f} ms"
+                  f"   p99 {percentile(samples, 0.99) * 1000:8.2f} ms"
+                  f"   p999 {percentile(samples, 0.999) * 1000:8.2f} ms")
+    failed = {status: count for status, count in stats.statuses.items() if status != "message_sent"}
+    if failed or stats.errors:
+        print(f"  other responses: {failed}   undecodable frames: {stats.errors}")
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end chat load generator")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--rate", type=float, default=1000, help="Messages sent per second (all users together)")
+    parser.add_argument("--pm-ratio", type=float, default=0.01, help="Fraction of messages that are pms")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds to send for")
+    parser.add_argument("--drain", type=float, default=30, help="Most seconds to wait for deliveries afterwards")
+    parser.add_argument("--size", type=int, default=64, help="Approximate message text size in bytes")
+    parser.add_argument("--codec", choices=["json", "binary"], default="json",
+                        help="Codec of the simulated users (binary keeps a username table per user)")
+    parser.add_argument("--engines", nargs="+", default=["threaded", "asyncio"],
+                        help="Server engines to start and test one after another")
+    parser.add_argument("--rate-limits", action="store_true",
+                        help="Start the servers with their default rate limits (off otherwise)")
+    parser.add_argument("--server-args", default="", help="Extra server arguments (Ex: \"--workers 2\")")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, help="Test a server that is already running instead")
+    parser.add_argument("--prefix", default="load", help="Username prefix of the simulated users")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    limit = raise_fd_limit()
+    if limit < args.users + 100:
+        print(f"The open file limit ({limit}) is too low for {args.users} users")
+        return
+
+    if args.port is not None:
+        report(f"{args.host}:{args.port}", args, *asyncio.run(run_load(args.host, args.port, args)))
+        return
+    for engine in args.engines:
+        with ServerProcess(["--engine", engine] + args.server_args.split(), rate_limits=args.rate_limits) as server:
+            time.sleep(1.0)
+            report(f"{engine} {args.server_args}".strip(), args, *asyncio.run(run_load("127.0.0.1", server.port, args)))
+
+if __name__ == "__main__":
+    main()
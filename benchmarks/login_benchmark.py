@@ -0,0 +1,122 @@
+"""
+Benchmark for logins during a reconnect storm.
+
+The server starts with N registered users (stored with the real password
+hash cost). Every round, all N users connect, log in and disconnect at once
+from a pool of client threads. The script reports logins per second and the
+p50/p99 login latency of each round.
+
+The first round is cold (every login runs a full hash verification); later
+rounds are what a reconnect storm looks like with the verification cache.
+Running with --verify-cache-ttl 0 shows the same storm without the cache.
+
+Ex: python3 login_benchmark.py --users 500 --rounds 3
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+
+from bench_util import REPO_DIR, ServerProcess, send_json, recv_until, percentile
+
+sys.path.insert(0, os.path.join(REPO_DIR, "server"))
+from passwords import hash_password
+
+PASSWORD = "bench"
+
+def populate(users):
+    """
+    This function returns a setup callback that writes a user log with hashed passwords
+    """
+    # One record shared by every user (same salt) keeps setup fast
+    record = hash_password(PASSWORD)
+
+    def setup(workdir):
+        with open(os.path.join(workdir, "users.log"), "w") as logfile:
+            for i in range(users):
+                logfile.write(json.dumps({"username": f"user{i}", "password": record}) + "\n")
+    return setup
+
+def login_once(port, username):
+    """
+    This function connects, logs in and disconnects one user
+
+    Returns: (latency in seconds, status)
+    """
+    sock = socket.create_connection(("127.0.0.1", port))
+    try:
+        start = time.perf_counter()
+        send_json(sock, {"command": "login", "username": username, "password": PASSWORD})
+        response = recv_until(sock, lambda data: "status" in data)
+        latency = time.perf_counter() - start
+        if response["status"] == "success":
+            send_json(sock, {"command": "ex", "username": username})
+            recv_until(sock, lambda data: data.get("status") == "exiting")
+        return latency, response["status"]
+    finally:
+        sock.close()
+
+def storm(port, users, concurrency):
+    """
+    This function logs every user in once, concurrency clients at a time
+
+    Returns: (elapsed seconds, latencies, {status: count})
+    """
+    names = [f"user{i}" for i in range(users)]
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not names:
+                    return
+                username = names.pop()
+            try:
+                latency, status = login_once(port, username)
+            except OSError as e:
+                latency, status = 0.0, type(e).__name__
+            with lock:
+                if status == "success":
+                    latencies.append(latency)
+                statuses[status] = statuses.get(status, 0) + 1
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, latencies, statuses
+
+def run(engine, users, rounds, concurrency, cache_ttl, hash_workers):
+    args = ["--engine", engine, "--verify-cache-ttl", str(cache_ttl), "--hash-workers", str(hash_workers)]
+    with ServerProcess(args, setup=populate(users), fast_hashing=False) as server:
+        for round_number in range(1, rounds + 1):
+            elapsed, latencies, statuses = storm(server.port, users, concurrency)
+            others = ", ".join(f"{status}: {count}" for status, count in statuses.items() if status != "success")
+            print(f"  round {round_number}: {len(latencies) / elapsed:8.0f} logins/s"
+                  f"   p50 {percentile(latencies, 0.50) * 1000:7.1f} ms"
+                  f"   p99 {percentile(latencies, 0.99) * 1000:7.1f} ms"
+                  + (f"   ({others})" if others else ""))
+
+def main():
+    parser = argparse.ArgumentParser(description="Login reconnect storm benchmark")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--hash-workers", type=int, default=2)
+    parser.add_argument("--engines", nargs="+", default=["threaded", "asyncio"])
+    args = parser.parse_args()
+
+    for engine in args.engines:
+        for cache_ttl in (60, 0):
+            print(f"{engine}, verify cache {'on' if cache_ttl else 'off'}:")
+            run(engine, args.users, args.rounds, args.concurrency, cache_ttl, args.hash_workers)
+
+if __name__ == "__main__":
+    main()
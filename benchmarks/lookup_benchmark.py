@@ -0,0 +1,131 @@
+"""
+Benchmark for username lookup by prefix (server/lookup.py).
+
+1. Index: a PrefixIndex of N usernames is built in this process. The
+   script reports the build time, memory, lookup time (p50/p99 for prefixes
+   of 1 to 4 letters of existing names), how quickly new names are added,
+   and the time to find suggestions for a misspelled name.
+2. Server: N users are registered before the server starts. A logged-in
+   client sends lookups one at a time and the script reports the server's
+   startup time and the lookup round trip (p50/p99).
+
+Ex: python3 lookup_benchmark.py --users 1000000 --lookups 5000
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tracemalloc
+
+from bench_util import REPO_DIR, ServerProcess, login_client, send_json, recv_until, percentile
+
+sys.path.insert(0, os.path.join(REPO_DIR, "server"))
+from lookup import PrefixIndex, DEFAULT_LOOKUP_LIMIT
+from passwords import hash_password
+
+SYLLABLES = ("al", "an", "be", "ca", "da", "el", "fa", "jo", "ka", "li", "ma", "mi", "no", "pa", "ra", "sa", "ta",
+             "to", "vi", "za")
+
+def usernames(count, seed=1):
+    """
+    This function makes count distinct usernames (Ex: "kalimi1234"), so prefixes match many names or few
+    """
+    rng = random.Random(seed)
+    names = set()
+    while len(names) < count:
+        name = "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(1, 3)))
+        names.add(name + str(rng.randrange(100000)))
+    return list(names)
+
+def prefixes(names, count, seed=2):
+    """
+    This function picks count prefixes (1 to 4 letters) of existing names
+    """
+    rng = random.Random(seed)
+    return [name[:rng.randint(1, 4)] for name in rng.sample(names, count)]
+
+def bench_index(names, lookups):
+    """
+    This function times building, searching and adding to an index of names
+
+    Returns: Dictionary of results
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    index = PrefixIndex(names)
+    build_s = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    samples = []
+    for prefix in prefixes(names, lookups):
+        start = time.perf_counter()
+        index.matches(prefix, DEFAULT_LOOKUP_LIMIT)
+        samples.append(time.perf_counter() - start)
+
+    new_names = [f"new{i}" for i in range(100000)]
+    start = time.perf_counter()
+    for name in new_names:
+        index.add(name)
+    add_s = (time.perf_counter() - start) / len(new_names)
+
+    # A typo at the end of the name, as in a dm to a name that is not registered
+    misspelled = [name[:-1] + "x" for name in random.Random(3).sample(names, 1000)]
+    start = time.perf_counter()
+    for name in misspelled:
+        index.closest(name, 5)
+    closest_s = (time.perf_counter() - start) / len(misspelled)
+    return {"build_s": build_s, "memory": memory, "p50": percentile(samples, 0.5), "p99": percentile(samples, 0.99),
+            "add_s": add_s, "closest_s": closest_s}
+
+def populate(names):
+    """
+    This function returns a setup callback that writes the users to the server's user log
+    """
+    record = hash_password("bench", 1024)
+
+    def setup(workdir):
+        with open(os.path.join(workdir, "users.log"), "w") as logfile:
+            for name in names:
+                logfile.write(json.dumps({"username": name, "password": record}) + "\n")
+    return setup
+
+def bench_server(names, lookups):
+    """
+    This function times lookups over a socket with the users registered
+
+    Returns: (server startup seconds, lookup round trip p50, p99)
+    """
+    with ServerProcess(setup=populate(names)) as server:
+        sock = login_client(server.port, names[0])
+        samples = []
+        for prefix in prefixes(names, lookups):
+            start = time.perf_counter()
+            send_json(sock, {"command": "lookup", "username": names[0], "prefix": prefix})
+            recv_until(sock, lambda data: data.get("status") == "lookup")
+            samples.append(time.perf_counter() - start)
+        sock.close()
+    return server.startup_s, percentile(samples, 0.5), percentile(samples, 0.99)
+
+def main():
+    parser = argparse.ArgumentParser(description="Username lookup benchmark")
+    parser.add_argument("--users", type=int, default=1000000, help="Registered users")
+    parser.add_argument("--lookups", type=int, default=5000, help="Lookups timed")
+    args = parser.parse_args()
+
+    names = usernames(args.users)
+    results = bench_index(names, args.lookups)
+    print(f"Prefix index of {args.users} usernames (top {DEFAULT_LOOKUP_LIMIT} matches)")
+    print(f"  build {results['build_s']:.2f} s, {results['memory'] / 1e6:.1f} MB")
+    print(f"  lookup p50 {results['p50'] * 1e6:.1f} us   p99 {results['p99'] * 1e6:.1f} us")
+    print(f"  add a name {results['add_s'] * 1e6:.1f} us   suggestions for a misspelled name "
+          f"{results['closest_s'] * 1e6:.1f} us")
+
+    startup, p50, p99 = bench_server(names, args.lookups)
+    print(f"Server with {args.users} registered users")
+    print(f"  startup {startup:.2f} s   lookup round trip p50 {p50 * 1e3:.3f} ms   p99 {p99 * 1e3:.3f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Benchmark for the server metrics (runs in this process).
+
+Reports the cost of one counter increment and one histogram observation
+(what the server adds to every request), the same with several threads
+updating at once, and how long rendering the /metrics page takes.
+
+Ex: python3 metrics_benchmark.py --updates 1000000 --threads 8
+"""
+import os
+import sys
+import time
+import argparse
+import threading
+
+from bench_util import REPO_DIR
+
+sys.path.insert(0, os.path.join(REPO_DIR, "server"))
+from metrics import MetricsRegistry
+
+COMMANDS = ("login", "register", "ex", "pm", "dm", "presence", "history")
+
+def update(counter, histogram, updates):
+    for i in range(updates):
+        command = COMMANDS[i % len(COMMANDS)]
+        counter.inc(command, "success")
+        histogram.observe(0.0003, command)
+
+def main():
+    parser = argparse.ArgumentParser(description="Metrics overhead benchmark")
+    parser.add_argument("--updates", type=int, default=1000000)
+    parser.add_argument("--threads", type=int, default=8)
+    args = parser.parse_args()
+
+    registry = MetricsRegistry()
+    counter = registry.counter("bench_requests_total", "Requests", ("command", "status"))
+    histogram = registry.histogram("bench_request_seconds", "Request time", ("command",))
+
+    start = time.perf_counter()
+    for i in range(args.updates):
+        counter.inc(COMMANDS[i % len(COMMANDS)], "success")
+    elapsed = time.perf_counter() - start
+    print(f"counter inc:         {elapsed / args.updates * 1e9:8.0f} ns")
+
+    start = time.perf_counter()
+    for i in range(args.updates):
+        histogram.observe(0.0003, COMMANDS[i % len(COMMANDS)])
+    elapsed = time.perf_counter() - start
+    print(f"histogram observe:   {elapsed / args.updates * 1e9:8.0f} ns")
+
+    per_thread = args.updates // args.threads
+    threads = [threading.Thread(target=update, args=(counter, histogram, per_thread)) for _ in range(args.threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    print(f"both, {args.threads} threads:   {elapsed / (per_thread * args.threads) * 1e9:8.0f} ns per request")
+
+    start = time.perf_counter()
+    text = registry.render()
+    print(f"render:              {(time.perf_counter() - start) * 1e3:8.2f} ms for {len(text.splitlines())} lines")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""
+Benchmark for presence deltas during login/logout churn.
+
+N observers stay logged in while waves of users log in and then out again.
+The script counts the bytes the observers receive and compares them with
+what full active user list broadcasts (one list per login or logout, sent
+to every other user) would have cost. Each observer applies the deltas to a
+local set, which must match the server's list at the end.
+
+Ex: python3 presence_benchmark.py --observers 500 --waves 20 --wave-size 50
+"""
+import time
+import socket
+import argparse
+import selectors
+
+from bench_util import (ServerProcess, raise_fd_limit, login_client, send_json,
+                        recv_until)
+from common.framing import FrameDecoder, decode_message, encode_message
+
+class Observer:
+    """
+    This class is one logged-in client that applies presence messages
+    """
+
+    def __init__(self, sock, username):
+        self.sock = sock
+        self.username = username
+        self.decoder = FrameDecoder()
+        self.users = None
+        self.seq = 0
+        self.bytes = 0
+        self.frames = 0
+        self.gaps = 0
+
+    def handle(self, message):
+        if message.get("type") == "presence":
+            if self.users is None or message["seq"] <= self.seq:
+                return
+            if message["seq"] != self.seq + 1:
+                self.gaps += 1
+            self.users.difference_update(message["left"])
+            self.users.update(message["joined"])
+            self.seq = message["seq"]
+        elif message.get("type") == "presence_snapshot":
+            self.users = set(message["active_users"])
+            self.seq = message["seq"]
+
+def drain(selector, timeout):
+    """
+    This function reads every observer until nothing arrives for timeout seconds
+    """
+    while True:
+        events = selector.select(timeout=timeout)
+        if not events:
+            return
+        for key, _ in events:
+            observer = key.data
+            data = observer.sock.recv(65536)
+            observer.bytes += len(data)
+            for payload in observer.decoder.feed(data):
+                observer.frames += 1
+                observer.handle(decode_message(payload))
+
+def run(engine, observers, waves, wave_size, window):
+    """
+    This function runs the churn for one engine
+
+    Returns: Dictionary of results
+    """
+    with ServerProcess(["--engine", engine, "--presence-window", str(window)]) as server:
+        selector = selectors.DefaultSelector()
+        watching = []
+        for i in range(observers):
+            observer = Observer(login_client(server.port, f"observer{i}"), f"observer{i}")
+            watching.append(observer)
+        drain_and_sync(selector, watching)
+
+        # Register the churn users before measuring
+        churners = [f"churn{i}" for i in range(wave_size)]
+        for username in churners:
+            login_client(server.port, username).close()
+        drain(selector, 0.5)
+        for observer in watching:
+            observer.bytes = observer.frames = 0
+
+        full_list_bytes = 0
+        online = set(observer.username for observer in watching)
+        start = time.perf_counter()
+        for wave in range(waves):
+            socks = []
+            for username in churners:
+                socks.append(login_client(server.port, username))
+                online.add(username)
+                full_list_bytes += _full_list_size(online) * observers
+            drain(selector, 0)
+            for username, sock in zip(churners, socks):
+                send_json(sock, {"command": "ex", "username": username})
+                recv_until(sock, lambda data: data.get("status") == "exiting")
+                sock.close()
+                online.discard(username)
+                full_list_bytes += _full_list_size(online) * observers
+            drain(selector, 0)
+        drain(selector, window * 4 + 0.2)
+        elapsed = time.perf_counter() - start
+
+        # Every observer must end up with the server's list
+        probe = socket.create_connection(("127.0.0.1", server.port))
+        send_json(probe, {"command": "presence"})
+        expected = set(recv_until(probe, lambda data: data.get("type") == "presence_snapshot")["active_users"])
+        probe.close()
+        in_sync = sum(1 for observer in watching if observer.users == expected)
+        received = sum(observer.bytes for observer in watching)
+        frames = sum(observer.frames for observer in watching)
+        gaps = sum(observer.gaps for observer in watching)
+        for observer in watching:
+            observer.sock.close()
+        selector.close()
+
+    return {
+        "engine": engine,
+        "events": waves * wave_size * 2,
+        "bytes": received,
+        "frames": frames,
+        "full_bytes": full_list_bytes,
+        "in_sync": in_sync,
+        "observers": observers,
+        "gaps": gaps,
+        "seconds": elapsed,
+    }
+
+def drain_and_sync(selector, watching):
+    """
+    This function gives every observer a starting snapshot, then reads all of them
+    """
+    for observer in watching:
+        send_json(observer.sock, {"command": "presence"})
+        observer.sock.setblocking(False)
+        selector.register(observer.sock, selectors.EVENT_READ, observer)
+    drain(selector, 0.5)
+
+def _full_list_size(online):
+    """
+    This function returns the size of one full active user list frame (the
+    old broadcast each observer received on every login and logout)
+    """
+    return len(encode_message({"type": "active_users", "active_users": sorted(online)}))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark presence deltas under login churn")
+    parser.add_argument("--observers", type=int, default=500)
+    parser.add_argument("--waves", type=int, default=20)
+    parser.add_argument("--wave-size", type=int, default=50, help="Users logging in and out per wave")
+    parser.add_argument("--window", type=float, default=0.05, help="Server --presence-window")
+    parser.add_argument("--engines", nargs="+", default=["threaded", "asyncio"])
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    print(f"{'engine':<10} {'events':>7} {'delta KiB':>10} {'frames':>9} {'full-list KiB':>14} "
+          f"{'saved':>7} {'in sync':>9} {'gaps':>5}")
+    for engine in args.engines:
+        r = run(engine, args.observers, args.waves, args.wave_size, args.window)
+        saved = 1 - r["bytes"] / r["full_bytes"] if r["full_bytes"] else 0
+        print(f"{r['engine']:<10} {r['events']:>7} {r['bytes'] / 1024:>10.0f} {r['frames']:>9} "
+              f"{r['full_bytes'] / 1024:>14.0f} {saved:>7.1%} {r['in_sync']:>4}/{r['observers']:<4} {r['gaps']:>5}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""
+Benchmark for the token bucket rate limits.
+
+1. Limiter: the time of one check and the memory held per user, with
+   many users sending at once, and the time to prune users whose buckets
+   are full again (runs in this process).
+2. Server: one user floods pm (a burst sent in one write) while other
+   users are logged in. With the default limits and with --no-rate-limits
+   the script reports how many pm deliveries the flood caused, how many of
+   its requests were refused, and how long a dm between two other users
+   took while the server worked through the flood.
+
+Ex: python3 ratelimit_benchmark.py --users 100000 --receivers 200 --flood 2000
+"""
+import os
+import sys
+import time
+import argparse
+import selectors
+import tracemalloc
+
+from bench_util import REPO_DIR, ServerProcess, login_client, percentile
+from common.framing import FrameDecoder, encode_message, decode_message, RECV_SIZE
+
+sys.path.insert(0, os.path.join(REPO_DIR, "server"))
+from ratelimit import RateLimiter, DEFAULT_RATE_LIMITS
+
+def bench_limiter(users):
+    """
+    This function times the limiter on its own (the per-user limits; the
+    global limit would refuse most of this test's requests)
+    """
+    limits = {name: limit for name, limit in DEFAULT_RATE_LIMITS.items() if name != "global"}
+    names = [f"user{i}" for i in range(users)]
+    # Memory is measured on a separate limiter, since tracing slows every allocation
+    limiter = RateLimiter(limits)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for name in names:
+        limiter.check(name, "pm")
+    per_user = (tracemalloc.get_traced_memory()[0] - before) / users
+    tracemalloc.stop()
+
+    limiter = RateLimiter(limits)
+    start = time.perf_counter()
+    for name in names:
+        limiter.check(name, "pm")
+    first_time = (time.perf_counter() - start) / users
+
+    start = time.perf_counter()
+    refused = 0
+    for _ in range(20):
+        for name in names[:1000]:
+            if limiter.check(name, "pm") is not None:
+                refused += 1
+    check_time = (time.perf_counter() - start) / 20000
+
+    # An hour later every bucket is full again
+    start = time.perf_counter()
+    pruned = limiter.prune(time.monotonic() + 3600)
+    prune_time = time.perf_counter() - start
+    assert pruned == users and len(limiter) == 0
+
+    print(f"Limiter: {users} users")
+    print(f"  first check of a user      {first_time * 1e6:8.2f} us")
+    print(f"  check                      {check_time * 1e6:8.2f} us   ({refused} of 20000 over the pm limit)")
+    print(f"  memory per user            {per_user:8.0f} bytes")
+    print(f"  prune all                  {prune_time * 1000:8.2f} ms")
+
+def run(engine, label, receivers, flood, samples):
+    server_args = ["--engine", engine, "--send-queue-bytes", str(64 * 1024 * 1024)]
+    with ServerProcess(server_args, rate_limits=(label == "limited")) as server:
+        flooder = login_client(server.port, "flooder")
+        sender = login_client(server.port, "sender")
+        sockets = [login_client(server.port, f"recv{i}") for i in range(receivers)]
+        selector = selectors.DefaultSelector()
+        decoders = {}
+        for sock in [flooder, sender] + sockets:
+            decoders[sock] = FrameDecoder(64 * 1024 * 1024)
+            selector.register(sock, selectors.EVENT_READ)
+        counts = {"pm": 0, "rate_limited": 0, "dm": 0}
+
+        def drain(timeout):
+            for key, _ in selector.select(timeout=timeout):
+                data = key.fileobj.recv(RECV_SIZE)
+                if not data:
+                    raise ConnectionError("Server closed a connection")
+                for payload in decoders[key.fileobj].feed(data):
+                    message = decode_message(payload)
+                    if message.get("type") in ("pm", "dm"):
+                        counts[message["type"]] += 1
+                    if message.get("type") == "dm":
+                        # Only recv0 gets dms; acknowledged so later ones are not held back
+                        key.fileobj.sendall(encode_message({"command": "ack", "username": "recv0",
+                                                            "id": message["id"]}))
+                    elif message.get("status") == "rate_limited":
+                        counts["rate_limited"] += 1
+        # Read away the presence updates of the logins
+        end = time.monotonic() + 0.5
+        while time.monotonic() < end:
+            drain(0.1)
+        counts.update(pm=0, rate_limited=0)
+
+        frame = encode_message({"command": "pm", "username": "flooder", "message": "spam " * 10})
+        latencies = []
+        start = time.perf_counter()
+        for i in range(samples):
+            flooder.sendall(frame * (flood // samples))
+            # A dm between two other users, behind the flood
+            dms = counts["dm"]
+            sent = time.perf_counter()
+            sender.sendall(encode_message({"command": "dm", "username": "sender", "recipient": "recv0",
+                                           "message": str(i)}))
+            while counts["dm"] == dms:
+                drain(0.5)
+            latencies.append(time.perf_counter() - sent)
+        # Wait for the rest of the flood to be processed
+        quiet = time.monotonic() + 1.0
+        while time.monotonic() < quiet:
+            before = counts["pm"] + counts["rate_limited"]
+            drain(0.2)
+            if counts["pm"] + counts["rate_limited"] != before:
+                quiet = time.monotonic() + 1.0
+        elapsed = time.perf_counter() - start
+        for sock in decoders:
+            sock.close()
+
+    print(f"  {engine:<10} {label:<10} {counts['pm']:9,} pm deliveries   {counts['rate_limited']:6,} refused"
+          f"   dm behind the flood p50 {percentile(latencies, 0.5) * 1000:8.2f} ms"
+          f"   p99 {percentile(latencies, 0.99) * 1000:8.2f} ms   ({elapsed:5.1f} s)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Rate limit benchmark")
+    parser.add_argument("--users", type=int, default=100000, help="Users checked by the in-process limiter test")
+    parser.add_argument("--receivers", type=int, default=200, help="Logged-in users receiving the flood")
+    parser.add_argument("--flood", type=int, default=2000, help="pms sent by the flooding user")
+    parser.add_argument("--samples", type=int, default=20, help="dms timed (the flood is sent in as many parts)")
+    parser.add_argument("--engines", nargs="+", default=["threaded", "asyncio"])
+    args = parser.parse_args()
+
+    bench_limiter(args.users)
+    print(f"\nServer: one user sends {args.flood} pms to {args.receivers + 1} other users")
+    for engine in args.engines:
+        for label in ("limited", "unlimited"):
+            run(engine, label, args.receivers, args.flood, args.samples)
+
+if __name__ == "__main__":
+    main()
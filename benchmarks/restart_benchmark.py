@@ -0,0 +1,247 @@
+"""
+Benchmark for restarting the server under load.
+
+Many users are logged in while a probe sends dms from one user to another
+one at a time. The server is then restarted in two ways:
+- hot restart (SIGUSR2): the new process takes over the listening socket
+  and the connections (see server/handoff.py)
+- drain and cold start (SIGTERM, then a new server on the same directory):
+  every client has to reconnect and log in again
+For each engine the script reports the longest gap between two dms reaching
+the probe's receiver, how many users were still logged in on their old
+connection afterwards, and how long it took until every user was logged in
+again.
+
+Ex: python3 restart_benchmark.py --users 1000 --scrypt-n 16384
+"""
+import os
+import sys
+import time
+import signal
+import argparse
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from bench_util import ServerProcess, REPO_DIR, SERVER_SCRIPT, login_client, send_json, recv_until, wait_for_port, \
+    raise_fd_limit
+sys.path.insert(0, os.path.join(REPO_DIR, "client"))
+from chat_client import ChatClient
+
+# Threads logging users in at once (the reconnect storm after a cold start)
+LOGIN_THREADS = 32
+
+# Seconds the probe waits for a response before it reconnects
+PROBE_TIMEOUT = 5.0
+
+class DmProbe:
+    """
+    This class sends dms from one user to another, one at a time, and
+    notes when each arrives. When the connection is lost it logs both
+    users in again, as a client would.
+    """
+
+    def __init__(self, port):
+        self.port = port
+        self.deliveries = []
+        self.reconnects = 0
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _connect(self):
+        clients = []
+        for username in ("probe-tx", "probe-rx"):
+            client = ChatClient.connect("localhost", self.port, track_presence=False)
+            clients.append(client)
+            # A dm that never arrives counts as a lost connection
+            client.sock.settimeout(PROBE_TIMEOUT)
+            client.register(username, "bench")
+            status = client.login(username, "bench").get("status")
+            if status != "success":
+                for client in clients:
+                    client.close()
+                raise ConnectionError(f"Login failed: {status}") # Ex: server_busy during the reconnect storm
+        return clients
+
+    def _run(self):
+        sender, receiver = self._connect()
+        count = 0
+        while not self.stopped:
+            try:
+                sender.dm("probe-rx", str(count))
+                while True:
+                    message = receiver.receive()
+                    if message is None:
+                        raise ConnectionError("Server closed the connection")
+                    if message.get("type") == "dm":
+                        break
+                self.deliveries.append(time.perf_counter())
+                count += 1
+            except (ConnectionError, OSError, ValueError):
+                sender.close()
+                receiver.close()
+                self.reconnects += 1
+                while not self.stopped:
+                    try:
+                        sender, receiver = self._connect()
+                        break
+                    except (ConnectionError, OSError, ValueError):
+                        time.sleep(0.02)
+        sender.close()
+        receiver.close()
+
+    def max_gap(self, start):
+        """
+        This function returns the longest time between two deliveries after start
+        """
+        times = [start] + [moment for moment in self.deliveries if moment >= start]
+        return max(later - earlier for earlier, later in zip(times, times[1:])) if len(times) > 1 else 0.0
+
+def log_in(port, username):
+    """
+    This function logs a user in, trying again while the server is too busy (Ex: server_busy)
+
+    Returns: Connected socket
+    """
+    while True:
+        try:
+            return login_client(port, username)
+        except RuntimeError:
+            time.sleep(0.05)
+
+def login_all(port, usernames):
+    """
+    This function logs every user in from LOGIN_THREADS threads
+
+    Returns: (sockets, seconds taken)
+    """
+    start = time.perf_counter()
+    with ThreadPoolExecutor(LOGIN_THREADS) as pool:
+        socks = list(pool.map(lambda username: log_in(port, username), usernames))
+    return socks, time.perf_counter() - start
+
+def still_logged_in(socks):
+    """
+    This function asks each connection for a presence snapshot
+
+    Returns: Number of connections that answered (the user is still logged in on them)
+    """
+    alive = 0
+    for sock in socks:
+        try:
+            sock.settimeout(5)
+            send_json(sock, {"command": "presence"})
+            recv_until(sock, lambda data: data.get("type") == "presence_snapshot")
+            alive += 1
+        except (ConnectionError, OSError, ValueError):
+            pass
+    return alive
+
+def successor_pids(port):
+    """
+    This function finds the server processes started by a hot restart on the port (from /proc)
+    """
+    pids = []
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/cmdline", "rb") as cmdline:
+                args = cmdline.read().split(b"\0")
+        except OSError:
+            continue
+        if SERVER_SCRIPT.encode() in args and str(port).encode() in args and b"--handoff-fd" in args:
+            pids.append(int(name))
+    return pids
+
+def stop_process(pid):
+    """
+    This function stops a server process that is not a child of this script
+    """
+    try:
+        os.kill(pid, signal.SIGTERM)
+        for _ in range(200):
+            os.kill(pid, 0)
+            time.sleep(0.05)
+        os.kill(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+def bench_hot_restart(server_args, users):
+    """
+    This function restarts the server with SIGUSR2 while the users stay connected
+
+    Returns: (longest dm gap, users still logged in, seconds until every user was logged in)
+    """
+    with ServerProcess(server_args, fast_hashing=False) as server:
+        socks, _ = login_all(server.port, users)
+        probe = DmProbe(server.port)
+        probe.thread.start()
+        time.sleep(1.0)
+        start = time.perf_counter()
+        server.proc.send_signal(signal.SIGUSR2)
+        server.proc.wait()
+        time.sleep(1.0)
+        alive = still_logged_in(socks)
+        probe.stopped = True
+        probe.thread.join()
+        gap = probe.max_gap(start)
+        # Users whose connection did not move log in again
+        if alive < len(socks):
+            _, relogin = login_all(server.port, users[:len(socks) - alive])
+        else:
+            relogin = 0.0
+        for sock in socks:
+            sock.close()
+        for pid in successor_pids(server.port):
+            stop_process(pid)
+    return gap, alive, relogin
+
+def bench_cold_restart(server_args, users):
+    """
+    This function drains the server with SIGTERM and starts a new one, and every user logs in again
+
+    Returns: (longest dm gap, users still logged in, seconds until every user was logged in)
+    """
+    with ServerProcess(server_args, fast_hashing=False) as server:
+        socks, _ = login_all(server.port, users)
+        probe = DmProbe(server.port)
+        probe.thread.start()
+        time.sleep(1.0)
+        start = time.perf_counter()
+        server.proc.terminate()
+        server.proc.wait()
+        server.proc = subprocess.Popen([sys.executable, SERVER_SCRIPT, str(server.port)] + server.extra_args,
+                                       cwd=server.workdir.name, stdout=subprocess.DEVNULL,
+                                       stderr=subprocess.DEVNULL, preexec_fn=raise_fd_limit)
+        wait_for_port(server.port)
+        alive = still_logged_in(socks)
+        for sock in socks:
+            sock.close()
+        _, relogin = login_all(server.port, users)
+        relogin = time.perf_counter() - start
+        time.sleep(0.5)
+        probe.stopped = True
+        probe.thread.join()
+        gap = probe.max_gap(start)
+    return gap, alive, relogin
+
+def main():
+    parser = argparse.ArgumentParser(description="Restart benchmark")
+    parser.add_argument("--users", type=int, default=1000, help="Logged-in users while the server restarts")
+    parser.add_argument("--scrypt-n", type=int, default=16384, help="Password hashing cost (the server's default)")
+    parser.add_argument("--engines", nargs="+", default=["threaded", "asyncio"])
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    users = [f"user{i}" for i in range(args.users)]
+    print(f"{args.users} logged-in users, scrypt cost {args.scrypt_n}")
+    for engine in args.engines:
+        server_args = ["--engine", engine, "--scrypt-n", str(args.scrypt_n)]
+        for label, bench in (("hot restart", bench_hot_restart), ("drain + start", bench_cold_restart)):
+            gap, alive, relogin = bench(server_args, users)
+            print(f"  {engine:<10} {label:<14} longest dm gap {gap * 1000:8.1f} ms   "
+                  f"{alive:6} still logged in   all logged in after {relogin:6.2f} s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+"""
+Benchmark for chat rooms with many users.
+
+1. Registry: joins, room member lookups and logout cleanup on the
+   RoomRegistry (runs in this process). Cleanup with the user -> rooms
+   index is compared with searching every room for the user.
+2. Server: users are logged in and spread evenly over the rooms (10000
+   users over 500 rooms is 20 members per room). The script measures the
+   latency of a room message to another member and of a pm to every user,
+   then has the first member of every room send a burst of room messages
+   and reports room deliveries per second.
+
+Ex: python3 rooms_benchmark.py --users 10000 --rooms 500 --messages 20
+"""
+import os
+import sys
+import time
+import socket
+import argparse
+import selectors
+
+from bench_util import (REPO_DIR, ServerProcess, raise_fd_limit, percentile)
+from common.framing import FrameDecoder, encode_message, decode_message, RECV_SIZE
+
+sys.path.insert(0, os.path.join(REPO_DIR, "server"))
+from rooms import RoomRegistry
+
+# Users logged in at a time while connecting (their requests are pipelined;
+# each has one password hash pending, which must stay under the hasher's queue limit)
+LOGIN_BATCH = 100
+
+def bench_registry(users, rooms, rooms_per_user):
+    """
+    This function times the registry on its own
+    """
+    registry = RoomRegistry()
+    start = time.perf_counter()
+    for user in range(users):
+        for extra in range(rooms_per_user):
+            registry.join(f"room{(user + extra) % rooms}", f"user{user}", None)
+    joins = users * rooms_per_user
+    join_time = (time.perf_counter() - start) / joins
+
+    # Building each room's member tuple, then the cached tuple (back-to-back room messages)
+    names = [f"room{room}" for room in range(rooms)]
+    start = time.perf_counter()
+    for room in names:
+        registry.members(room)
+    build_time = (time.perf_counter() - start) / rooms
+    start = time.perf_counter()
+    for room in names:
+        registry.members(room)
+    lookup_time = (time.perf_counter() - start) / rooms
+
+    # Searching every room for the user, as cleanup would without the user -> rooms index
+    start = time.perf_counter()
+    for user in range(0, users, max(1, users // 100)):
+        username = f"user{user}"
+        [room for room, members in registry.rooms.items() if username in members]
+    scan_time = (time.perf_counter() - start) / len(range(0, users, max(1, users // 100)))
+
+    start = time.perf_counter()
+    for user in range(users):
+        registry.leave_all(f"user{user}")
+    cleanup_time = (time.perf_counter() - start) / users
+    assert len(registry) == 0
+
+    print(f"Registry: {users} users in {rooms_per_user} of {rooms} rooms each")
+    print(f"  join                       {join_time * 1e6:8.2f} us")
+    print(f"  room members (first)       {build_time * 1e6:8.2f} us")
+    print(f"  room members (cached)      {lookup_time * 1e6:8.2f} us")
+    print(f"  logout cleanup, indexed    {cleanup_time * 1e6:8.2f} us")
+    print(f"  logout cleanup, scan rooms {scan_time * 1e6:8.2f} us")
+
+class Clients:
+    """
+    This class holds every benchmark connection and reads them all with one selector
+    """
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.decoders = {}
+        self.names = {}
+
+    def connect(self, port, username):
+        sock = socket.create_connection(("127.0.0.1", port))
+        self.decoders[sock] = FrameDecoder()
+        self.names[sock] = username
+        self.selector.register(sock, selectors.EVENT_READ)
+        return sock
+
+    def drain(self, handle, timeout):
+        """
+        This function reads whatever arrives within timeout and calls handle(sock, message)
+        """
+        for key, _ in self.selector.select(timeout=timeout):
+            sock = key.fileobj
+            data = sock.recv(RECV_SIZE)
+            if not data:
+                raise ConnectionError(f"Server closed the connection of {self.names[sock]}")
+            for payload in self.decoders[sock].feed(data):
+                handle(sock, decode_message(payload))
+
+    def wait(self, handle, done, timeout=600.0):
+        deadline = time.monotonic() + timeout
+        while not done():
+            if time.monotonic() > deadline:
+                raise RuntimeError("Timed out waiting for the server")
+            self.drain(handle, 0.5)
+
+    def close(self):
+        for sock in self.decoders:
+            sock.close()
+        self.selector.close()
+
+def room_of(user, rooms):
+    return f"room{user % rooms}"
+
+def log_in_everyone(clients, port, users, rooms):
+    """
+    This function registers and logs in every user and joins them to their room
+
+    Returns: List of sockets (socket i is user i)
+    """
+    sockets = []
+    joined = set()
+
+    def handle(sock, message):
+        if message.get("status") == "room_joined":
+            joined.add(sock)
+        elif message.get("status") in ("failed", "user_not_found", "server_busy", "invalid_room"):
+            raise RuntimeError(f"{clients.names[sock]}: {message}")
+
+    for first in range(0, users, LOGIN_BATCH):
+        for user in range(first, min(users, first + LOGIN_BATCH)):
+            username = f"user{user}"
+            sock = clients.connect(port, username)
+            sockets.append(sock)
+            sock.sendall(encode_message({"command": "register", "username": username, "password": "bench"})
+                         + encode_message({"command": "login", "username": username, "password": "bench"})
+                         + encode_message({"command": "join", "username": username, "room": room_of(user, rooms)}))
+        clients.wait(handle, lambda: len(joined) == len(sockets))
+    # Let the last presence batches arrive
+    end = time.monotonic() + 1.0
+    while time.monotonic() < end:
+        clients.drain(handle, 0.1)
+    return sockets
+
+def measure_latency(clients, sockets, users, rooms, samples):
+    """
+    This function times room messages between two members, and pms to everyone
+
+    Returns: (room latencies, pm latencies) in seconds
+    """
+    sender, member = sockets[0], sockets[rooms % users]
+    received = {}
+
+    def handle(sock, message):
+        kind = message.get("type")
+        if kind in ("room", "pm"):
+            received[kind] = received.get(kind, 0) + 1
+
+    room_latencies = []
+    for i in range(samples):
+        received.clear()
+        start = time.perf_counter()
+        sender.sendall(encode_message({"command": "room", "username": "user0", "room": room_of(0, rooms),
+                                       "message": f"room ping {i}"}))
+        clients.wait(handle, lambda: received.get("room", 0) >= users // rooms - 1)
+        room_latencies.append(time.perf_counter() - start)
+
+    pm_latencies = []
+    for i in range(max(1, samples // 10)):
+        received.clear()
+        start = time.perf_counter()
+        sender.sendall(encode_message({"command": "pm", "username": "user0", "message": f"pm ping {i}"}))
+        clients.wait(handle, lambda: received.get("pm", 0) >= users - 1)
+        pm_latencies.append(time.perf_counter() - start)
+    return room_latencies, pm_latencies
+
+def measure_throughput(clients, sockets, users, rooms, messages):
+    """
+    This function has the first member of every room send a burst of room messages
+
+    Returns: Room message deliveries per second
+    """
+    counts = {"room": 0}
+
+    def handle(sock, message):
+        if message.get("type") == "room":
+            counts["room"] += 1
+
+    senders = sockets[:rooms]
+    expected = 0
+    start = time.perf_counter()
+    for user, sock in enumerate(senders):
+        frame = encode_message({"command": "room", "username": f"user{user}", "room": room_of(user, rooms),
+                                "message": "x" * 64})
+        sock.sendall(frame * messages)
+        expected += messages * (len(range(user, users, rooms)) - 1)
+        clients.drain(handle, 0)
+    clients.wait(handle, lambda: counts["room"] >= expected)
+    return expected / (time.perf_counter() - start)
+
+def bench_server(engine, users, rooms, samples, messages):
+    clients = Clients()
+    with ServerProcess(["--engine", engine, "--send-queue-bytes", str(16 * 1024 * 1024)]) as server:
+        try:
+            start = time.perf_counter()
+            sockets = log_in_everyone(clients, server.port, users, rooms)
+            login_time = time.perf_counter() - start
+            room_latencies, pm_latencies = measure_latency(clients, sockets, users, rooms, samples)
+            rate = measure_throughput(clients, sockets, users, rooms, messages)
+        finally:
+            clients.close()
+    print(f"  {engine:<10} logged in and joined in {login_time:6.1f} s")
+    print(f"  {engine:<10} room message to {users // rooms - 1} members: "
+          f"p50 {percentile(room_latencies, 0.5) * 1000:7.2f} ms  p99 {percentile(room_latencies, 0.99) * 1000:7.2f} ms")
+    print(f"  {engine:<10} pm to {users - 1} users:          "
+          f"p50 {percentile(pm_latencies, 0.5) * 1000:7.2f} ms  p99 {percentile(pm_latencies, 0.99) * 1000:7.2f} ms")
+    print(f"  {engine:<10} {rate:10,.0f} room deliveries/s")
+
+def main():
+    parser = argparse.ArgumentParser(description="Chat room benchmark")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--rooms", type=int, default=500)
+    parser.add_argument("--rooms-per-user", type=int, default=5, help="Rooms each user joins in the registry test")
+    parser.add_argument("--samples", type=int, default=200, help="Room messages timed one at a time")
+    parser.add_argument("--messages", type=int, default=20, help="Room messages sent by each room's first member")
+    parser.add_argument("--engines", nargs="+", default=["asyncio", "threaded"])
+    args = parser.parse_args()
+
+    bench_registry(args.users, args.rooms, args.rooms_per_user)
+
+    limit = raise_fd_limit()
+    if limit < args.users + 100:
+        print(f"\nThe open file limit ({limit}) is too low for {args.users} connections")
+        return
+    print(f"\nServer: {args.users} users over {args.rooms} rooms")
+    for engine in args.engines:
+        bench_server(engine, args.users, args.rooms, args.samples, args.messages)
+
+if __name__ == "__main__":
+    main()
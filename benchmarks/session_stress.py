@@ -0,0 +1,202 @@
+"""
+Stress test for the session registry (server/sessions.py).
+
+1. In-process: many threads log users in and out of a SessionRegistry while
+   other threads iterate snapshots for fan-out. The same load is run against
+   a plain dictionary (the old active_users) to show the iteration errors.
+2. End to end: thousands of concurrent clients log in and out of a running
+   server (half send ex, half just disconnect) while another client sends
+   pm. Afterwards the server must report no users left logged in.
+
+Exits with status 1 if any check fails.
+
+Ex: python3 session_stress.py --threads 32 --clients 1000
+"""
+import os
+import sys
+import time
+import argparse
+import threading
+
+from bench_util import (REPO_DIR, ServerProcess, raise_fd_limit, login_client,
+                        send_json, recv_until)
+
+sys.path.insert(0, os.path.join(REPO_DIR, "server"))
+from sessions import SessionRegistry
+
+class DictRegistry:
+    """
+    This class gives a plain dictionary the registry interface (the old behaviour)
+    """
+
+    def __init__(self):
+        self.users = {}
+
+    def add(self, username, conn):
+        self.users[username] = conn
+
+    def remove(self, username, conn=None):
+        return self.users.pop(username, None)
+
+    def snapshot(self):
+        return self.users.items()
+
+    def __len__(self):
+        return len(self.users)
+
+def stress_registry(registry, threads, cycles, readers, resident):
+    """
+    This function runs concurrent logins/logouts and snapshot readers
+
+    resident users stay logged in the whole time, so every snapshot
+    iteration has real work to do while the writers churn.
+
+    Returns: (changes per second, iteration errors, sessions left over)
+    """
+    errors = []
+    stop = threading.Event()
+    for i in range(resident):
+        registry.add(f"resident{i}", object())
+
+    def churn(worker):
+        # Log in a batch of users, then log them all out again
+        for batch in range(0, cycles, 50):
+            logged_in = []
+            for i in range(50):
+                username = f"user{worker}-{i}"
+                conn = object()
+                registry.add(username, conn)
+                logged_in.append((username, conn))
+                # Real handlers block in recv between requests
+                time.sleep(0)
+            for username, conn in logged_in:
+                registry.remove(username, conn)
+                time.sleep(0)
+
+    def read():
+        while not stop.is_set():
+            try:
+                for i, (username, conn) in enumerate(registry.snapshot()):
+                    if i % 16 == 0:
+                        # Releases the GIL, like the socket send in the old pm loop
+                        time.sleep(0)
+            except RuntimeError as e:
+                errors.append(e)
+
+    reader_threads = [threading.Thread(target=read) for _ in range(readers)]
+    writer_threads = [threading.Thread(target=churn, args=(w,)) for w in range(threads)]
+    for thread in reader_threads:
+        thread.start()
+    start = time.perf_counter()
+    for thread in writer_threads:
+        thread.start()
+    for thread in writer_threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    stop.set()
+    for thread in reader_threads:
+        thread.join()
+    return threads * cycles * 2 / elapsed, len(errors), len(registry) - resident
+
+def stress_server(engine, clients, rounds):
+    """
+    This function logs clients in and out of a running server concurrently
+
+    Returns: (failed clients, users still logged in afterwards, seconds)
+    """
+    failures = []
+    barrier = threading.Barrier(clients)
+
+    def client(number):
+        username = f"stress{number}"
+        try:
+            barrier.wait()
+            for round_number in range(rounds):
+                sock = login_client(port, username)
+                if number % 2 == 0:
+                    send_json(sock, {"command": "ex", "username": username})
+                    recv_until(sock, lambda data: data.get("status") == "exiting")
+                # Odd clients disconnect without ex; the server must clean up
+                sock.close()
+        except (OSError, RuntimeError, threading.BrokenBarrierError) as e:
+            failures.append((username, e))
+
+    # A large send queue keeps clients that are busy logging in from being
+    # disconnected as slow readers, so only registry problems show up
+    with ServerProcess(["--engine", engine, "--send-queue-bytes", str(256 * 1024 * 1024)]) as server:
+        port = server.port
+        chatter = login_client(port, "chatter")
+        stop = threading.Event()
+
+        # Register everyone up front; only logins and logouts run concurrently
+        for number in range(clients):
+            login_client(port, f"stress{number}").close()
+        time.sleep(1.0)
+
+        def chat():
+            while not stop.is_set():
+                send_json(chatter, {"command": "pm", "username": "chatter", "message": "storm"})
+                recv_until(chatter, lambda data: "status" in data)
+
+        chat_thread = threading.Thread(target=chat)
+        chat_thread.start()
+
+        threads = [threading.Thread(target=client, args=(n,)) for n in range(clients)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        stop.set()
+        chat_thread.join()
+        chatter.close()
+
+        # Give the server a moment to notice the last disconnects, then check
+        # that nobody else is still logged in
+        time.sleep(1.0)
+        probe = login_client(port, "probe")
+        send_json(probe, {"command": "login", "username": "probe", "password": "bench"})
+        active = recv_until(probe, lambda data: "status" in data)["active_users"]
+        remaining = [name for name in active if name != "probe"]
+        probe.close()
+    return failures, remaining, elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description="Stress test concurrent logins and logouts")
+    parser.add_argument("--threads", type=int, default=32, help="Registry writer threads")
+    parser.add_argument("--cycles", type=int, default=5000, help="Login/logout cycles per writer")
+    parser.add_argument("--readers", type=int, default=4, help="Snapshot reader threads")
+    parser.add_argument("--resident", type=int, default=2000, help="Users logged in for the whole registry test")
+    parser.add_argument("--clients", type=int, default=1000, help="Concurrent clients for the server test")
+    parser.add_argument("--rounds", type=int, default=2, help="Login/logout rounds per client")
+    parser.add_argument("--engines", nargs="+", default=["threaded", "asyncio"])
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    threading.stack_size(256 * 1024)
+    ok = True
+
+    print("Registry (in-process)")
+    for name, registry in (("dict", DictRegistry()), ("SessionRegistry", SessionRegistry())):
+        rate, errors, left = stress_registry(registry, args.threads, args.cycles,
+                                               args.readers, args.resident)
+        print(f"  {name:<16} {rate:>12,.0f} changes/s   iteration errors: {errors:<6} left: {left}")
+        if name == "SessionRegistry" and (errors or left):
+            ok = False
+
+    print(f"Server ({args.clients} concurrent clients x {args.rounds} rounds)")
+    for engine in args.engines:
+        failures, remaining, elapsed = stress_server(engine, args.clients, args.rounds)
+        print(f"  {engine:<10} {elapsed:>7.2f} s   failed clients: {len(failures):<5} "
+              f"still logged in: {len(remaining)}")
+        for username, error in failures[:5]:
+            print(f"    {username}: {error}")
+        if failures or remaining:
+            ok = False
+
+    print("PASS" if ok else "FAIL")
+    sys.exit(0 if ok else 1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+"""
+Benchmark for the client's terminal interface (client/terminal.py).
+
+1. Scrollback: time to add a line to the ring buffer, and time to lay out
+   one screen (80x24) with more and more lines in the scrollback. The
+   buffer is bounded, so a long session costs no more than a short one.
+2. Burst: client.py runs in a pseudo-terminal, logged in, while another
+   user sends a burst of pms. The script reports how long it took until
+   the last pm was on the screen and how many bytes the client wrote to
+   the terminal, for:
+   - curses: the full-screen interface, with batched redraws
+   - curses, redraw per message: the same with a redraw for every line
+   - plain: printing line by line (--plain)
+
+Ex: python3 terminal_benchmark.py --burst 5000
+"""
+import os
+import pty
+import sys
+import time
+import fcntl
+import struct
+import select
+import signal
+import termios
+import argparse
+import threading
+
+from bench_util import ServerProcess, REPO_DIR, login_client, recv_json
+CLIENT_DIR = os.path.join(REPO_DIR, "client")
+sys.path.insert(0, CLIENT_DIR)
+from terminal import Scrollback, layout
+from common.framing import encode_message
+
+# Terminal size for the burst
+ROWS, COLUMNS = 24, 80
+
+# Runs client.py with a redraw for every line instead of batched redraws
+UNBATCHED_CLIENT = (
+    "import sys, runpy\n"
+    f"sys.path.insert(0, {CLIENT_DIR!r})\n"
+    "import terminal\n"
+    "terminal.CursesScreen._schedule_redraw = terminal.CursesScreen._redraw\n"
+    "sys.argv = sys.argv[1:]\n"
+    "runpy.run_path(sys.argv[0], run_name='__main__')\n"
+)
+
+def bench_scrollback(sizes):
+    """
+    This function times appends and layouts with sizes lines in the scrollback
+
+    Returns: list of (lines, seconds per append, seconds per layout)
+    """
+    results = []
+    for size in sizes:
+        scrollback = Scrollback(size)
+        line = "[PM] [SENT BY: user1]: " + "x" * 60
+        start = time.perf_counter()
+        for _ in range(size):
+            scrollback.append(line)
+        append_s = (time.perf_counter() - start) / size
+        repeat = 2000
+        start = time.perf_counter()
+        for index in range(repeat):
+            layout(scrollback, index % 50, ROWS - 2, COLUMNS)
+        results.append((size, append_s, (time.perf_counter() - start) / repeat))
+    return results
+
+class Terminal:
+    """
+    This class runs client.py in a pseudo-terminal and collects everything it writes
+    """
+
+    def __init__(self, args):
+        self.pid, self.fd = pty.fork()
+        if self.pid == 0:
+            os.environ["TERM"] = "xterm"
+            os.execv(sys.executable, [sys.executable] + args)
+        fcntl.ioctl(self.fd, termios.TIOCSWINSZ, struct.pack("HHHH", ROWS, COLUMNS, 0, 0))
+        self.output = bytearray()
+
+    def read_until(self, text, timeout=30.0):
+        """
+        This function reads the terminal until text was written after what was already read
+
+        Returns: Seconds waited
+        """
+        start = time.perf_counter()
+        searched = max(len(self.output) - len(text), 0)
+        while text.encode() not in self.output[searched:]:
+            if time.perf_counter() - start > timeout:
+                raise TimeoutError(f"{text!r} did not appear on the terminal")
+            readable, _, _ = select.select([self.fd], [], [], 0.1)
+            if readable:
+                self.output.extend(os.read(self.fd, 65536))
+        return time.perf_counter() - start
+
+    def settle(self, quiet=0.5):
+        """
+        This function reads the terminal until nothing was written for quiet seconds
+        """
+        while select.select([self.fd], [], [], quiet)[0]:
+            self.output.extend(os.read(self.fd, 65536))
+
+    def type(self, text):
+        os.write(self.fd, text.encode())
+
+    def close(self):
+        os.kill(self.pid, signal.SIGTERM)
+        os.waitpid(self.pid, 0)
+        os.close(self.fd)
+
+def bench_burst(port, viewer, client_args, burst):
+    """
+    This function logs a viewer in through client.py, sends it a burst of pms and times the last one's arrival
+
+    Returns: (seconds until the last pm was on the screen, bytes written to the terminal)
+    """
+    login_client(port, viewer).close() # Registers the viewer
+    terminal = Terminal(client_args + ["localhost", str(port)])
+    try:
+        terminal.read_until("Enter username")
+        terminal.type(viewer + "\r")
+        terminal.read_until("password") # curses only writes what changed: "Enter username: " -> "Enter password: "
+        terminal.type("bench\r")
+        terminal.read_until("Exit the chat")
+        terminal.settle() # Ex: the viewer's own presence update
+
+        sender = login_client(port, f"sender-{viewer}")
+        # The sender's replies are read by a thread, so its queue on the server never fills
+        threading.Thread(target=lambda: [recv_json(sender) for _ in range(burst)], daemon=True).start()
+        frames = [encode_message({"command": "pm", "username": f"sender-{viewer}",
+                                  "message": f"message {index} " + "x" * 40}) for index in range(burst - 1)]
+        frames.append(encode_message({"command": "pm", "username": f"sender-{viewer}", "message": "burst-end"}))
+        written = len(terminal.output)
+        start = time.perf_counter()
+        sender.sendall(b"".join(frames))
+        terminal.read_until("burst-end", timeout=300)
+        seconds = time.perf_counter() - start
+        # Output may still be coming (Ex: the last redraw); wait until the client is idle
+        terminal.settle()
+        sender.close()
+        return seconds, len(terminal.output) - written
+    finally:
+        terminal.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Terminal interface benchmark")
+    parser.add_argument("--burst", type=int, default=5000, help="pms sent to the client at once")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 100000, 1000000],
+                        help="Scrollback sizes to lay out")
+    args = parser.parse_args()
+
+    print("Scrollback ring buffer")
+    for size, append_s, layout_s in bench_scrollback(args.sizes):
+        print(f"  {size:>9} lines   append {append_s * 1e9:7.0f} ns/line   layout one screen {layout_s * 1e6:7.1f} us")
+
+    client = os.path.join(CLIENT_DIR, "client.py")
+    modes = (
+        ("curses", [client]),
+        ("curses, redraw per message", ["-c", UNBATCHED_CLIENT, client]),
+        ("plain", [client, "--plain"]),
+    )
+    print(f"\nBurst of {args.burst} pms ({COLUMNS}x{ROWS} terminal)")
+    with ServerProcess() as server:
+        for index, (label, client_args) in enumerate(modes):
+            seconds, written = bench_burst(server.port, f"viewer{index}", client_args, args.burst)
+            print(f"  {label:<28} last pm shown after {seconds:6.2f} s   {written / 1024:9.1f} KiB written to the terminal")
+
+if __name__ == "__main__":
+    main()
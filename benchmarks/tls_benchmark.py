@@ -0,0 +1,159 @@
+"""
+Benchmark for TLS connections against plaintext.
+
+A self-signed certificate is made with the openssl command in a temporary
+directory. For each engine the script reports:
+- handshakes per second while several clients reconnect over and over:
+  plaintext, TLS with a full handshake every time, and TLS resuming the
+  previous session (each connection sends hello and reads the answer,
+  which also brings the TLS 1.3 session ticket)
+- the share of resumed handshakes that the server really resumed
+- dm throughput between two logged-in users, and pm deliveries per second
+  to several receivers, over plaintext and over TLS
+
+Ex: python3 tls_benchmark.py --connections 2000 --concurrency 8 --messages 20000
+"""
+import os
+import time
+import shutil
+import tempfile
+import argparse
+import threading
+import subprocess
+
+from bench_util import ServerProcess, REPO_DIR
+import sys
+sys.path.insert(0, os.path.join(REPO_DIR, "client"))
+from chat_client import ChatClient
+from common.tls import client_context
+
+def make_certificate(directory):
+    """
+    This function makes a self-signed certificate for localhost
+
+    Returns: (certificate file, key file)
+    """
+    cert = os.path.join(directory, "cert.pem")
+    key = os.path.join(directory, "key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                    "-subj", "/CN=localhost", "-addext", "subjectAltName=DNS:localhost,IP:127.0.0.1",
+                    "-keyout", key, "-out", cert], check=True, capture_output=True)
+    return cert, key
+
+def bench_handshakes(port, tls, resume, connections, concurrency):
+    """
+    This function reconnects from several threads at once
+
+    Returns: (connections per second, fraction of connections resumed)
+    """
+    counts = {"done": 0, "resumed": 0}
+    lock = threading.Lock()
+
+    def reconnect(count):
+        session = None
+        for _ in range(count):
+            client = ChatClient.connect("localhost", port, track_presence=False,
+                                        compression=False, tls=tls, session=session)
+            if tls is not None:
+                resumed = client.sock.session_reused
+                if resume:
+                    session = client.session
+            else:
+                resumed = False
+            client.close()
+            with lock:
+                counts["done"] += 1
+                counts["resumed"] += resumed
+
+    threads = [threading.Thread(target=reconnect, args=(connections // concurrency,)) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return counts["done"] / elapsed, counts["resumed"] / max(counts["done"], 1)
+
+def bench_throughput(port, tls, messages, receivers):
+    """
+    This function times a burst of dms to one user, and a burst of pms to several
+
+    Returns: (dms per second, pm deliveries per second)
+    """
+    sender = ChatClient.connect("localhost", port, tls=tls, track_presence=False)
+    sender.register("sender", "bench")
+    sender.login("sender", "bench")
+    readers = []
+    for i in range(receivers):
+        reader = ChatClient.connect("localhost", port, tls=tls, track_presence=False)
+        reader.register(f"reader{i}", "bench")
+        reader.login(f"reader{i}", "bench")
+        readers.append(reader)
+    time.sleep(0.5)
+
+    def read(reader, kind, count, done):
+        received = 0
+        while received < count:
+            message = reader.receive()
+            if message is None:
+                break
+            if message.get("type") == kind:
+                received += 1
+        done.append(received)
+
+    rates = []
+    for kind, count, targets in (("dm", messages, readers[:1]), ("pm", messages // receivers, readers)):
+        done = []
+        threads = [threading.Thread(target=read, args=(reader, kind, count, done)) for reader in targets]
+        for thread in threads:
+            thread.start()
+        start = time.perf_counter()
+        for i in range(count):
+            if kind == "dm":
+                sender.dm("reader0", f"message {i}")
+            else:
+                sender.pm(f"message {i}")
+        for thread in threads:
+            thread.join()
+        rates.append(sum(done) / (time.perf_counter() - start))
+    for client in [sender] + readers:
+        client.close()
+    return rates
+
+def main():
+    parser = argparse.ArgumentParser(description="TLS benchmark")
+    parser.add_argument("--connections", type=int, default=2000, help="Connections made for each handshake test")
+    parser.add_argument("--concurrency", type=int, default=8, help="Clients reconnecting at once")
+    parser.add_argument("--messages", type=int, default=20000, help="dms in the throughput test (and pm deliveries)")
+    parser.add_argument("--receivers", type=int, default=10, help="Users receiving the pms")
+    parser.add_argument("--engines", nargs="+", default=["threaded", "asyncio"])
+    args = parser.parse_args()
+
+    if shutil.which("openssl") is None:
+        print("The openssl command is needed to make a test certificate")
+        return
+    with tempfile.TemporaryDirectory(prefix="chat-tls-") as directory:
+        cert, key = make_certificate(directory)
+        tls = client_context(cert)
+        print(f"{args.connections} connections from {args.concurrency} clients; "
+              f"{args.messages} dms, then pms to {args.receivers} users")
+        for engine in args.engines:
+            for label in ("plaintext", "TLS"):
+                server_args = ["--engine", engine, "--send-queue-bytes", str(64 * 1024 * 1024)]
+                context = None
+                if label == "TLS":
+                    server_args += ["--tls-cert", cert, "--tls-key", key]
+                    context = tls
+                with ServerProcess(server_args) as server:
+                    results = []
+                    for resume in ((False, True) if context is not None else (False,)):
+                        rate, resumed = bench_handshakes(server.port, context, resume, args.connections,
+                                                         args.concurrency)
+                        name = "connect" if context is None else ("resumed" if resume else "full handshake")
+                        results.append(f"{name} {rate:7,.0f}/s" + (f" ({resumed:.0%} resumed)" if resume else ""))
+                    dm_rate, pm_rate = bench_throughput(server.port, context, args.messages, args.receivers)
+                print(f"  {engine:<10} {label:<10} " + "   ".join(results))
+                print(f"  {engine:<10} {label:<10} {dm_rate:10,.0f} dms/s   {pm_rate:10,.0f} pm deliveries/s")
+
+if __name__ == "__main__":
+    main()
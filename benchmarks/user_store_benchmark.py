@@ -0,0 +1,113 @@
+"""
+Benchmark for the user store backends.
+
+Each backend is filled with N existing users before the server starts. The
+script reports how long the server took to start, then how many
+registrations per second it handles while several clients register new
+users in pipelined bursts.
+
+Ex: python3 user_store_benchmark.py --existing 100000 --registrations 5000
+"""
+import os
+import sys
+import json
+import time
+import socket
+import sqlite3
+import argparse
+import threading
+
+from bench_util import REPO_DIR, ServerProcess, recv_json
+from common.framing import encode_message
+
+sys.path.insert(0, os.path.join(REPO_DIR, "server"))
+from passwords import hash_password
+
+def populate(kind, existing):
+    """
+    This function returns a setup callback that writes existing users for a backend
+    """
+    # Already hashed, so the server has no plaintext passwords to migrate
+    record = hash_password("pass", 1024)
+
+    def setup(workdir):
+        users = ((f"existing{i}", record) for i in range(existing))
+        if kind == "log":
+            with open(os.path.join(workdir, "users.log"), "w") as logfile:
+                for username, password in users:
+                    logfile.write(json.dumps({"username": username, "password": password}) + "\n")
+        elif kind == "sqlite":
+            db = sqlite3.connect(os.path.join(workdir, "users.db"))
+            db.execute("CREATE TABLE users (username TEXT PRIMARY KEY, password TEXT NOT NULL)")
+            db.executemany("INSERT INTO users VALUES (?, ?)", users)
+            db.commit()
+            db.close()
+        else:
+            with open(os.path.join(workdir, "users.json"), "w") as outfile:
+                json.dump(dict(users), outfile)
+    return setup
+
+def register_burst(port, prefix, count, burst, results):
+    """
+    This function registers count users, burst requests at a time
+    """
+    sock = socket.create_connection(("127.0.0.1", port))
+    ok = 0
+    try:
+        for start in range(0, count, burst):
+            names = [f"{prefix}-{i}" for i in range(start, min(count, start + burst))]
+            sock.sendall(b"".join(encode_message({"command": "register", "username": name, "password": "pass"})
+                                  for name in names))
+            for _ in names:
+                if recv_json(sock).get("status") == "success":
+                    ok += 1
+    finally:
+        sock.close()
+    results.append(ok)
+
+def run(kind, existing, registrations, clients, burst):
+    """
+    This function benchmarks one backend
+
+    Returns: Dictionary of results
+    """
+    with ServerProcess(["--user-store", kind], setup=populate(kind, existing)) as server:
+        results = []
+        per_client = registrations // clients
+        threads = [threading.Thread(target=register_burst, args=(server.port, f"new{c}", per_client, burst, results))
+                   for c in range(clients)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        startup = server.startup_s
+    return {
+        "kind": kind,
+        "startup_s": startup,
+        "registered": sum(results),
+        "rate": sum(results) / elapsed,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark user store registrations")
+    parser.add_argument("--existing", type=int, default=100000, help="Users already registered")
+    parser.add_argument("--registrations", type=int, default=5000, help="New users to register")
+    parser.add_argument("--clients", type=int, default=8, help="Concurrent registering clients")
+    parser.add_argument("--burst", type=int, default=50, help="Register requests sent per write")
+    parser.add_argument("--stores", nargs="+", default=["log", "sqlite", "json"])
+    args = parser.parse_args()
+
+    print(f"{args.existing} existing users, {args.registrations} registrations from {args.clients} clients")
+    print(f"{'store':<8} {'startup s':>10} {'registered':>11} {'registrations/s':>16}")
+    for kind in args.stores:
+        registrations = args.registrations
+        if kind == "json":
+            # Every registration rewrites the whole file, so keep this run short
+            registrations = min(registrations, 200)
+        r = run(kind, args.existing, registrations, args.clients, args.burst)
+        print(f"{r['kind']:<8} {r['startup_s']:>10.2f} {r['registered']:>11} {r['rate']:>16,.0f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,441 @@
+"""
+Headless chat client library.
+
+The protocol side of client.py without any input() or printing, so the
+chat can be driven by a script (Ex: tests or the load generator in
+benchmarks/loadgen.py) as well as by a person:
+
+ChatClient: a blocking socket client
+    client = ChatClient.connect("localhost", 12000)
+    client.register("user1", "pass")
+    client.login("user1", "pass")
+    client.pm("Hello")
+    message = client.receive()
+
+AsyncChatClient: the same for asyncio
+    client = await AsyncChatClient.connect("localhost", 12000)
+    await client.login("user1", "pass")
+    client.dm("user2", "Hi")
+    message = await client.receive()
+
+Both negotiate the binary codec unless binary=False, and compression of
+large frames unless compression=False (see common/compression.py). Both keep the set of
+active users up to date from presence messages (asking for a snapshot if
+a delta was missed). A simulated user that does not need the set passes
+track_presence=False, since thousands of copies of it add up quickly. Commands (pm, dm, join, ...) only queue the request;
+responses and messages from other users are read with receive().
+receive() also answers the server's heartbeat pings, so a client that
+keeps calling it is never disconnected for being idle.
+lookup(prefix) asks for the registered users whose name starts with prefix
+(Ex: to complete a dm recipient); the matches also arrive through receive().
+
+pms and dms carry the id the server stored them under, and so do the
+statuses of the pms and dms sent: {"status": "message_sent", "id": 42}.
+receive() acknowledges the dms it returned (one ack for everything it read,
+before it waits for more), so the server sends again at the next login any
+dm that never arrived, and the sender gets {"type": "delivered", "to":
+"user2", "ids": [42]}. A message that arrives twice is only returned once.
+
+When the server stops it sends {"type": "shutdown", "reconnect": false}
+before closing the connection. During a hot restart connections normally
+stay open and logged in, but one that cannot be kept (Ex: TLS) is sent
+"reconnect": true and closed; connect and log in again.
+
+Pass tls (an ssl.SSLContext, see common/tls.py) to connect to a TLS server.
+A ChatClient can resume its previous connection's TLS session when it
+reconnects, which makes the handshake much cheaper:
+    client = ChatClient.connect(host, port, tls=context, session=old_client.session)
+"""
+import asyncio
+import threading
+from collections import deque
+from socket import create_connection
+
+from common.framing import FrameDecoder, MessageReader, DEFAULT_MAX_FRAME_SIZE, RECV_SIZE
+from common.codec import JSON_CODEC, JSON, CODECS, new_codec
+from common.compression import CompressedCodec, COMPRESSIONS
+
+# Ids of the last messages received that are remembered, to drop a message sent twice
+SEEN_IDS = 1024
+
+class PresenceState:
+    """
+    This class is a client's copy of the server's active users.
+
+    It is built from the login response and updated with presence deltas,
+    which must arrive in sequence. apply() may be called by one thread while
+    another reads the users under self.lock.
+    """
+
+    def __init__(self):
+        self.active_users = set()
+        self.seq = 0
+        self.snapshot_requested = False
+        self.lock = threading.Lock()
+
+    def reset(self, usernames, seq):
+        """
+        This function starts over from a login response's list of active users
+        """
+        with self.lock:
+            self.active_users = set(usernames)
+            self.seq = seq
+            self.snapshot_requested = False
+
+    def apply(self, message):
+        """
+        This function applies a presence or presence_snapshot message
+
+        Returns: "applied" if active_users changed, "stale" if the message
+        was already included (or a snapshot is on its way), or "gap" if a
+        delta was missed and a snapshot should be requested (said only once)
+        """
+        with self.lock:
+            if message["type"] == "presence_snapshot":
+                self.snapshot_requested = False
+                if message["seq"] < self.seq:
+                    return "stale"
+                self.active_users = set(message["active_users"])
+                self.seq = message["seq"]
+                return "applied"
+
+            seq = message["seq"]
+            if seq <= self.seq:
+                return "stale" # Already included in the snapshot we have
+            if seq != self.seq + 1:
+                if self.snapshot_requested:
+                    return "stale"
+                self.snapshot_requested = True
+                return "gap"
+            self.active_users.difference_update(message["left"])
+            self.active_users.update(message["joined"])
+            self.seq = seq
+            return "applied"
+
+    def usernames(self):
+        """
+        This function returns a sorted list of the active users
+        """
+        with self.lock:
+            return sorted(self.active_users)
+
+class _ClientBase:
+    """
+    This class holds what the blocking and asyncio clients share: the
+    codec, the logged-in username, presence, and the chat commands.
+
+    A subclass provides send(message), which must not block for long.
+    """
+
+    def __init__(self, max_frame_size, track_presence=True):
+        # JSON until hello picks another codec (see common/codec.py)
+        self.codec = JSON_CODEC
+        self.max_frame_size = max_frame_size
+        self.username = None
+        self.track_presence = track_presence
+        self.presence = PresenceState()
+        self.unread = 0
+        # Result of the last presence message handled by receive()
+        self.presence_result = None
+        # Ids of the messages received most recently (at most SEEN_IDS), oldest first in seen_order
+        self.seen = set()
+        self.seen_order = deque()
+        # Id of the newest dm received and not acknowledged yet
+        self.unacknowledged = None
+        # history pages asked for and not finished (they show messages again on purpose)
+        self.pages = 0
+
+    def _hello_request(self, binary, compression):
+        request = {"command": "hello", "codecs": list(CODECS) if binary else [JSON]}
+        if compression:
+            request["compression"] = list(COMPRESSIONS)
+        return request
+
+    def _hello(self, response):
+        # Switches codec if the server answered hello (an older server answers unknown_command)
+        if response is None:
+            raise ConnectionError("Server closed the connection")
+        if response.get("status") == "hello":
+            self.codec = new_codec(response["codec"])
+            if response.get("compression") in COMPRESSIONS:
+                self.codec = CompressedCodec(self.codec, max_size=self.max_frame_size)
+            return True
+        return False
+
+    def _logged_in(self, username, response):
+        # Called with the login response
+        if response is None:
+            raise ConnectionError("Server closed the connection")
+        if response.get("status") == "success":
+            self.username = username
+            if self.track_presence:
+                self.presence.reset(response.get("active_users", []), response.get("presence_seq", 0))
+            self.unread = response.get("unread", 0)
+        return response
+
+    def _received(self, message):
+        # Answers heartbeat pings, applies presence messages, and notes the
+        # dms to acknowledge, before they are returned to the caller (None
+        # for a message that was already received)
+        message_type = message.get("type")
+        if message_type == "ping":
+            self.send({"command": "pong"})
+        elif self.track_presence and message_type in ("presence", "presence_snapshot"):
+            self.presence_result = self.presence.apply(message)
+            if self.presence_result == "gap":
+                self.send({"command": "presence"})
+        elif message_type in ("pm", "dm") and isinstance(message.get("id"), int):
+            return self._delivered(message)
+        elif message.get("status") == "history_end" and self.pages:
+            self.pages -= 1
+        return message
+
+    def _delivered(self, message):
+        # A pm or dm with its id: returns None if it was already received
+        message_id = message["id"]
+        if message["type"] == "dm" and (self.unacknowledged is None or message_id > self.unacknowledged):
+            self.unacknowledged = message_id
+        if message.get("history") and self.pages:
+            return message
+        if message_id in self.seen:
+            return None
+        self.seen.add(message_id)
+        self.seen_order.append(message_id)
+        if len(self.seen_order) > SEEN_IDS:
+            self.seen.discard(self.seen_order.popleft())
+        return message
+
+    def _acknowledge(self):
+        # Acknowledges every dm received so far with one ack (called before waiting for more frames)
+        if self.unacknowledged is not None:
+            self.send({"command": "ack", "username": self.username, "id": self.unacknowledged})
+            self.unacknowledged = None
+
+    def pm(self, text):
+        self.send({"command": "pm", "username": self.username, "message": text})
+
+    def dm(self, recipient, text):
+        self.send({"command": "dm", "username": self.username, "recipient": recipient, "message": text})
+
+    def join(self, room):
+        self.send({"command": "join", "username": self.username, "room": room})
+
+    def leave(self, room):
+        self.send({"command": "leave", "username": self.username, "room": room})
+
+    def room(self, room, text):
+        self.send({"command": "room", "username": self.username, "room": room, "message": text})
+
+    def history(self, before=None):
+        self.pages += 1
+        self.send({"command": "history", "username": self.username, "before": before})
+
+    def lookup(self, prefix, limit=10):
+        # The answer is {"status": "lookup", "prefix": ..., "matches": [{"username": ..., "online": ...}]}
+        self.send({"command": "lookup", "username": self.username, "prefix": prefix, "limit": limit})
+
+    def ex(self):
+        # The dms received since the last ack would otherwise be sent again at the next login
+        self._acknowledge()
+        self.send({"command": "ex", "username": self.username})
+
+class ChatClient(_ClientBase):
+    """
+    This class is a blocking chat client on one socket.
+
+    send() may be called from any thread; receive() should be called from
+    one thread only (Ex: a receive thread, as in client.py).
+    """
+
+    def __init__(self, sock, max_frame_size=DEFAULT_MAX_FRAME_SIZE, track_presence=True):
+        super().__init__(max_frame_size, track_presence)
+        self.sock = sock
+        self.reader = MessageReader(sock, max_frame_size, self.codec.decode)
+        self.send_lock = threading.Lock()
+
+    @classmethod
+    def connect(cls, host, port, binary=True, track_presence=True, compression=True, tls=None, session=None):
+        """
+        This function connects to a server and picks the codec and compression
+
+        tls is an ssl.SSLContext for a TLS server, and session a previous
+        connection's TLS session to resume (see the session property).
+
+        Returns: ChatClient
+        Raises: OSError (Ex: ConnectionRefusedError, ssl.SSLCertVerificationError) if it cannot connect
+        """
+        sock = create_connection((host, port))
+        if tls is not None:
+            try:
+                sock = tls.wrap_socket(sock, server_hostname=host, session=session)
+            except OSError:
+                sock.close()
+                raise
+        client = cls(sock, track_presence=track_presence)
+        if binary or compression:
+            try:
+                client.negotiate(binary, compression)
+            except (ConnectionError, OSError):
+                client.close()
+                raise
+        return client
+
+    def negotiate(self, binary=True, compression=True):
+        """
+        This function asks the server for the compact binary codec and compression (before login)
+
+        Returns: True if the server answered (the codec may still be JSON)
+        """
+        self.send(self._hello_request(binary, compression))
+        if not self._hello(self.reader.read_message()):
+            return False
+        self.reader.decode = self.codec.decode
+        return True
+
+    def send(self, message):
+        """
+        This function sends a message dictionary to the server as one frame
+        """
+        with self.send_lock:
+            self.sock.sendall(self.codec.encode(message))
+
+    def register(self, username, password):
+        """
+        This function registers a new user
+
+        Returns: The server's status (Ex: "success", "username_taken")
+        """
+        self.send({"command": "register", "username": username, "password": password})
+        response = self.reader.read_message()
+        if response is None:
+            raise ConnectionError("Server closed the connection")
+        return response["status"]
+
+    def login(self, username, password):
+        """
+        This function logs in
+
+        Returns: The login response (status "success" has active_users and unread)
+        """
+        self.send({"command": "login", "username": username, "password": password})
+        return self._logged_in(username, self.reader.read_message())
+
+    def receive(self):
+        """
+        This function waits for the next message from the server
+
+        Returns: Message dictionary, or None if the server closed the connection
+        Raises: ValueError if one frame could not be decoded (the next call
+        reads the next frame), FrameTooLarge, or OSError
+        """
+        while True:
+            if not self.reader.ready:
+                self._acknowledge()
+            message = self.reader.read_message()
+            if message is None:
+                return None
+            message = self._received(message)
+            if message is not None:
+                return message
+
+    @property
+    def session(self):
+        """
+        The TLS session to resume when reconnecting (None without TLS)
+
+        With TLS 1.3 the server sends it after the handshake, so it is only
+        available once something has been received (Ex: after negotiate or login).
+        """
+        return getattr(self.sock, "session", None)
+
+    def close(self):
+        self.sock.close()
+
+class AsyncChatClient(_ClientBase):
+    """
+    This class is a chat client for asyncio.
+
+    send() only buffers the frame in the stream writer, so it can be called
+    for thousands of clients in one event loop pass; await drain() to wait
+    for the buffer to empty.
+    """
+
+    def __init__(self, reader, writer, max_frame_size=DEFAULT_MAX_FRAME_SIZE, track_presence=True):
+        super().__init__(max_frame_size, track_presence)
+        self.reader = reader
+        self.writer = writer
+        self.decoder = FrameDecoder(max_frame_size)
+        self.payloads = []
+        self.next_payload = 0
+
+    @classmethod
+    async def connect(cls, host, port, binary=True, track_presence=True, compression=True, tls=None):
+        """
+        This function connects to a server and picks the codec and compression
+
+        tls is an ssl.SSLContext for a TLS server (asyncio cannot resume a TLS session).
+
+        Returns: AsyncChatClient
+        """
+        reader, writer = await asyncio.open_connection(host, port, ssl=tls,
+                                                       server_hostname=host if tls is not None else None)
+        client = cls(reader, writer, track_presence=track_presence)
+        if binary or compression:
+            try:
+                await client.negotiate(binary, compression)
+            except (ConnectionError, OSError):
+                client.close()
+                raise
+        return client
+
+    async def negotiate(self, binary=True, compression=True):
+        self.send(self._hello_request(binary, compression))
+        return self._hello(await self._next())
+
+    def send(self, message):
+        self.writer.write(self.codec.encode(message))
+
+    async def drain(self):
+        await self.writer.drain()
+
+    async def register(self, username, password):
+        self.send({"command": "register", "username": username, "password": password})
+        response = await self._next()
+        if response is None:
+            raise ConnectionError("Server closed the connection")
+        return response["status"]
+
+    async def login(self, username, password):
+        self.send({"command": "login", "username": username, "password": password})
+        return self._logged_in(username, await self._next())
+
+    async def _next(self):
+        # The next decoded message, or None once the connection is closed
+        while self.next_payload == len(self.payloads):
+            self._acknowledge()
+            data = await self.reader.read(RECV_SIZE)
+            if not data:
+                return None
+            self.payloads = self.decoder.feed(data)
+            self.next_payload = 0
+        payload = self.payloads[self.next_payload]
+        self.next_payload += 1
+        return self.codec.decode(payload)
+
+    async def receive(self):
+        """
+        This function waits for the next message from the server
+
+        Returns: Message dictionary, or None if the server closed the connection
+        Raises: ValueError if one frame could not be decoded, FrameTooLarge, or OSError
+        """
+        while True:
+            message = await self._next()
+            if message is None:
+                return None
+            message = self._received(message)
+            if message is not None:
+                return message
+
+    def close(self):
+        self.writer.close()
@@ -1,11 +1,29 @@
-import threading
+import argparse
+import asyncio
 import sys
-from socket import *
-import json
+import os
+import time
+import ssl
+
+# The framing layer is shared with the server (repository root /common)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common.framing import FrameTooLarge
+from common.tls import client_context
+from chat_client import AsyncChatClient
+from terminal import PlainScreen, CursesScreen, DEFAULT_SCROLLBACK_LINES, curses
 
 # Global variable to track the user's login status
 loggedIn = False
 
+# Where messages are shown and commands are typed (see terminal.py); main() switches to a CursesScreen
+screen = PlainScreen()
+
+# Id of the oldest stored message received, so history asks for older ones
+history_oldest = None
+
+# Username being completed with Tab, until the server's lookup answer arrives
+completing = None
+
 def printMessage(*args, newline=False):
     """
     This function formats all incoming messages.
@@ -25,14 +43,14 @@ def printMessage(*args, newline=False):
 
     # if newLine, print the extra newLine
     if newline:
-        print()
+        screen.add_line("")
     # if no arguments are provided
     if len(args) <= 0:
-        print("[INFO]: Empty message.")
+        screen.add_line("[INFO]: Empty message.")
         return
     # if one argument is provided
     elif len(args) == 1:
-        print(f"{args[0]}")
+        screen.add_line(f"{args[0]}")
         return
     # if two or more arguments are provided
     else:
@@ -44,73 +62,78 @@ def printMessage(*args, newline=False):
 
         # Create the string with info args surrounded by brackets
         brack_text = " ".join(f"[{br}]" for br in brackets)
-        print(f"{brack_text}: {message}")
+        screen.add_line(f"{brack_text}: {message}")
+
+def update_status(client):
+    """
+    This function shows who is logged in and how many users are online on the status line
+    """
+    if client.username is None:
+        screen.set_status(" Not logged in | PgUp/PgDn scroll | ^D exits")
+    else:
+        screen.set_status(f" {client.username} | {len(client.presence.usernames())} online | PgUp/PgDn scroll")
 
-def login(sock):
+async def login(client):
     """
     This function handles the login process for the client.
 
     The user is prompted for their login information. If the userame does not
     exist in the JSON file, the user is offerred the option to register a new user.
+    The requests are sent by client (an AsyncChatClient, see chat_client.py).
 
     Returns: valid username
+    Raises: EOFError if input ends (Ex: ^D)
     """
     global loggedIn
     while True:
         # Prompt the user for their username, while ensuring the input is not null and cleaning the input
-        username = input("Enter username: ")
+        username = await screen.read_line("Enter username: ")
         username = username.strip()
 
         while not username:
-            username = input("Enter valid username: ")
+            username = await screen.read_line("Enter valid username: ")
             username = username.strip()
 
-        password = input("Enter password: ")
+        password = await screen.read_line("Enter password: ", secret=True)
         password = password.strip()
 
         while not password:
-            password = input("Enter valid password: ")
+            password = await screen.read_line("Enter valid password: ", secret=True)
             password = password.strip()
 
-        login_data = {
-            "command": "login",
-            "username": username,
-            "password": password
-        }
-
         try:
-            # Send the login data to the server as a JSON-encoded message
-            sock.send(json.dumps(login_data).encode('utf-8'))
-
-            # Wait for the server's response (1024 bytes)
-            response = sock.recv(1024).decode('utf-8')
-            response_data = json.loads(response)
+            # Send the login data to the server and wait for its response
+            response_data = await client.login(username, password)
 
             # Process the response_data based on the status
             if response_data["status"] == "success":
                 printMessage("INFO", "Login successful!")
-                printMessage("ACTIVE USERS", response_data.get("active_users", [])) # if success, dispaly active users
+                # if success, dispaly active users (client keeps them up to date)
+                printMessage("ACTIVE USERS", client.presence.usernames())
+                if client.unread:
+                    printMessage("INFO", f"{client.unread} unread direct message(s) while you were away.")
+                update_status(client)
                 loggedIn = True
                 return username  # Login successful, return the username to indicate success
 
             elif response_data["status"] == "user_not_found":
                 printMessage("INFO", "Username does not exist.") # Notify user that their username does not exist
-                choice = input("Would you like to register? (yes/no): ").strip().lower()
+                choice = (await screen.read_line("Would you like to register? (yes/no): ")).strip().lower()
 
                 if choice == "yes":
                     # Call the registration function if the user chooses to register
-                    return register_user(sock, username)
+                    return await register_user(client, username)
                 else:
                     printMessage("INFO", "Returning to login page.")
             else:
                 # If a failure occurred, inform the user and repeat the login process
                 printMessage("INFO", "Login failed. Try again.")
 
-        except ConnectionError:
+        except (ConnectionError, OSError):
             printMessage("INFO", "Connection error. Unable to communicate with the server.")
             return None  # Exit login attempt if connection is lost
 
-def register_user(sock, username):
+async def register_user(client, username):
     """
     This function handles the registration process for the client.
 
@@ -118,47 +141,117 @@ def register_user(sock, username):
     a password for the username.
 
     Returns: Valid username
+    Raises: EOFError if input ends (Ex: ^D)
     """
     while True:
         # Prompt the user to enter a password
-        password = input(f"Enter password for new user [{username}]: ")
+        password = await screen.read_line(f"Enter password for new user [{username}]: ", secret=True)
         password = password.strip()
 
         while not password:
-            password = input(f"Enter valid password for new user [{username}]: ")
+            password = await screen.read_line(f"Enter valid password for new user [{username}]: ", secret=True)
             password = password.strip()
 
-        register_data = {
-            "command": "register",
-            "username": username,
-            "password": password
-        }
-
         try:
-            # Send the registration data to the server as a JSON-encoded message
-            sock.send(json.dumps(register_data).encode('utf-8'))
-
-            # Wait for the server's response
-            response = sock.recv(1024).decode('utf-8')
-            response_data = json.loads(response)
+            # Send the registration data to the server and wait for its status
+            status = await client.register(username, password)
 
-            # Process the response_data based on the status
-            if response_data["status"] == "success":
+            # Process the response based on the status
+            if status == "success":
                 printMessage("INFO", "Registration successful. You can now log in.") # If successful, return to the login page
-                return login(sock)
+                return await login(client)
 
-            elif response_data["status"] == "username_taken":
+            elif status == "username_taken":
                 printMessage("INFO", "Username already exists. Choose a different username.") # If username is taken, return to the login page and enter new username
-                return login(sock)
+                return await login(client)
 
             else:
                 printMessage("INFO", "Registration failed. Try again.") # If an error occurs try again
 
-        except ConnectionError:
+        except (ConnectionError, OSError):
             printMessage("INFO", "Connection error. Unable to communicate with the server.")
             return False  # Exit registration attempt if connection is lost
 
-def receive_messages(sock):
+def print_presence(client, data):
+    """
+    This function prints a presence message the client has applied
+
+    A delta that was missed makes the client ask for a full snapshot
+    (see PresenceState in chat_client.py), which is printed when it arrives.
+    """
+    if client.presence_result != "applied":
+        return
+    if data["type"] == "presence_snapshot":
+        printMessage("ACTIVE USERS", client.presence.usernames())
+        update_status(client)
+        return
+    update_status(client)
+    if data["joined"]:
+        printMessage("PRESENCE", "JOINED", data["joined"])
+    if data["left"]:
+        printMessage("PRESENCE", "LEFT", data["left"])
+
+def print_history(data):
+    """
+    This function prints a stored message sent by the server (replay or history)
+
+    Example output:
+    [HISTORY] [14:02] [DM] [SENT BY: user1]: Hello
+    """
+    global history_oldest
+    if history_oldest is None or data["id"] < history_oldest:
+        history_oldest = data["id"]
+    sent_at = time.strftime("%H:%M", time.localtime(data["time"]))
+    printMessage("HISTORY", sent_at, data["type"].upper(), f"SENT BY: {data['from']}", data['message'])
+
+def describe_users(matches):
+    """
+    This function formats users from a lookup answer (or dm suggestions)
+
+    Example output: alice (online), alicia
+    """
+    return ", ".join(match["username"] + (" (online)" if match["online"] else "") for match in matches)
+
+def request_completion(client, before_cursor):
+    """
+    This function is called when Tab is pressed: it asks the server for
+    the users whose name starts with the dm recipient being typed
+    (Ex: "dm al" -> lookup "al"). The answer is applied by print_lookup.
+    """
+    global completing
+    words = before_cursor.split(" ")
+    if len(words) != 2 or words[0].lower() != "dm" or not words[1]:
+        return
+    completing = words[1]
+    try:
+        client.lookup(completing)
+    except Exception as e:
+        printMessage("INFO", f"Error sending lookup: {e}")
+
+def print_lookup(data):
+    """
+    This function prints the users from a lookup answer, and completes the
+    name being typed if the answer is for a Tab (one match is completed in
+    full, several as far as they agree)
+
+    Example output:
+    [LOOKUP] [al]: alice (online), alicia
+    """
+    global completing
+    prefix = data["prefix"]
+    names = [match["username"] for match in data["matches"]]
+    if prefix == completing:
+        completing = None
+        if len(names) == 1:
+            screen.complete(prefix, names[0] + " ")
+            return
+        screen.complete(prefix, os.path.commonprefix(names) or prefix)
+    if names:
+        printMessage("LOOKUP", prefix, describe_users(data["matches"]))
+    else:
+        printMessage("LOOKUP", prefix, "No users found.")
+
+async def receive_messages(client):
     """
     This function continuously listens for messages from the server.
 
@@ -167,161 +260,299 @@ def receive_messages(sock):
     """
     while True:
         try:
-            message = sock.recv(1024).decode('utf-8')
-            if not message: # catch empty message
+            data = await client.receive()
+            if data is None: # catch closed connection
                 break
 
-            data = json.loads(message)
-
             message_type = data.get("type")
             # Check the message type and print
-            if message_type in ("pm", "dm"):
+            if message_type in ("pm", "dm") and data.get("history"):
+                print_history(data)
+            elif message_type in ("pm", "dm"):
                 printMessage(message_type.upper(), f"SENT BY: {data['from']}", data['message'])
-            elif message_type == "active_users":
-                printMessage("ACTIVE USERS", data['active_users'])
+            elif message_type == "room":
+                printMessage("ROOM", f"#{data['room']}", f"SENT BY: {data['from']}", data['message'])
+            elif message_type == "ping":
+                pass # Heartbeat, already answered by the client library
+            elif message_type == "delivered":
+                # The recipient received dms this user sent (Ex: [DELIVERED] [TO: user2]: 1 direct message(s))
+                printMessage("DELIVERED", f"TO: {data['to']}", f"{len(data['ids'])} direct message(s)")
+            elif message_type in ("presence", "presence_snapshot"):
+                print_presence(client, data)
+            elif message_type == "shutdown":
+                # The server is stopping; with reconnect, it is restarting and this connection could not be kept
+                if data.get("reconnect"):
+                    printMessage("SERVER", "The server is restarting. Reconnect to keep chatting.")
+                else:
+                    printMessage("SERVER", "The server is shutting down.")
+            elif data.get("status") == "lookup":
+                print_lookup(data)
+            elif data.get("suggestions"):
+                # Ex: [SERVER] [recipient_username_not_found]: Did you mean: alice (online), alicia
+                printMessage("SERVER", data['status'], f"Did you mean: {describe_users(data['suggestions'])}")
+            elif data.get("status") == "history_end":
+                if not data["more"]:
+                    printMessage("HISTORY", "No older messages.")
+            elif "room" in data:
+                # Ex: [SERVER] [room_joined]: lobby
+                printMessage("SERVER", data['status'], data['room'])
             # For other types, print the status message from the server
             else:
                 printMessage("SERVER", data['status'])
 
+        except FrameTooLarge as e:
+            printMessage("INFO", f"Invalid message from server: {e}")
+            break
+        except ValueError as e:
+            # One frame could not be decoded; the next one may be fine
+            printMessage("INFO", f"Invalid message from server: {e}")
         except (ConnectionError, OSError) as e:
             if not loggedIn:
                 break
             printMessage("INFO", f"Connection error: {e}")
             break
 
-def send_messages(sock, username):
+def valid_room_name(room_name):
+    """
+    This function checks a room name typed by the user
+
+    Room names have no spaces and are at most 32 characters (checked again by the server).
+
+    Returns: True if the room name is valid
+    """
+    return 0 < len(room_name) <= 32 and len(room_name.split()) == 1
+
+async def send_messages(client, username):
     """
-    This function continuously listens for the user to input message types.
+    This function continuously listens for the user to input commands.
 
-    After enterring a message type, the user is prompted to send the corresponding
-    message to the server.
+    Each command is one line: the command word, then its arguments
+    (Ex: "dm user2 Hello there" or "room lobby Hi all"), which are sent to
+    the server.
     """
     global loggedIn
 
-    # Message type instructions
+    # Command instructions
     instructions = (
-        "\nPM: Public message to all clients.\n"
-        "DM: Direct message to a specific client.\n"
-        "EX: Exit the chat.\n"
+        "\npm MESSAGE: Public message to all clients.\n"
+        "dm USER MESSAGE: Direct message to a specific client.\n"
+        "join ROOM: Join a room (it is created if nobody is in it).\n"
+        "leave ROOM: Leave a room.\n"
+        "room ROOM MESSAGE: Message the members of a room you joined.\n"
+        "users: List active clients.\n"
+        "lookup PREFIX: Find users by the start of their name (Tab after dm completes it).\n"
+        "history: Show older messages.\n"
+        "ex: Exit the chat.\n"
     )
 
     # Print the instructions with the preceding newLine
     printMessage("INFO", instructions, newline=True)
 
     while loggedIn:
-        message = input()
-        message = message.strip()
+        try:
+            message = await screen.read_line("> " if isinstance(screen, CursesScreen) else "")
+        except EOFError:
+            message = "ex" # Input ended (Ex: ^D), so exit as if "ex" was typed
+
+        # Split the line into the command and its arguments (Ex: "dm user2 Hello" -> "dm", ["user2", "Hello"])
+        command, _, arguments = message.strip().partition(" ")
+        command = command.lower()
+        arguments = arguments.strip()
+
+        if not command: # Empty line
+            continue
 
-        if message.lower() == 'ex': # Client typed "ex" to exit
+        elif command == 'ex': # Client typed "ex" to exit
             printMessage("INFO", "Exiting...")
             loggedIn = False
-            ex_data = {
-                "command": "ex",
-                "username": username
-            }
             try:
-                # Send the shutdown command (ex) to the server
-                sock.send(json.dumps(ex_data).encode('utf-8'))
-                # Ensure the socket is closed in both directions
-                sock.shutdown(SHUT_RDWR)
+                # Send the shutdown command (ex) to the server, and wait for it to be sent
+                client.ex()
+                await client.drain()
             except Exception as e:
                 printMessage("INFO", f"Error exiting and closing socket: {e}")
             finally:
                 # Ensure the socket is closed
-                sock.close()
+                client.close()
             break
 
-        # Client typed "pm" to send a public message
-        elif message.lower() == 'pm':
-            # Prompt user for message to send
-            pm_message = input("Enter message to broadcast: ")
-
-            while not pm_message:
-                pm_message = input("Enter valid message to broadcast: ")
-
-            pm_data = {
-                "command": "pm",
-                "username": username,
-                "message": pm_message
-            }
+        # Client typed "pm MESSAGE" to send a public message
+        elif command == 'pm':
+            if not arguments:
+                printMessage("INFO", "Usage: pm MESSAGE")
+                continue
             try:
                 # Send the public message to the server
-                sock.send(json.dumps(pm_data).encode('utf-8'))
+                client.pm(arguments)
+                await client.drain()
             except Exception as e:
                 printMessage("INFO", f"Error sending broadcast_data: {e}")
 
-        elif message.lower() == 'dm': # Client typed "dm" to send a direct message
-            # Prompt user for who to send message to
-            dm_recipient = input("Enter recipient username: ")
-            dm_recipient = dm_recipient.strip()
+        elif command == 'users': # Client typed "users" to list active users
+            printMessage("ACTIVE USERS", client.presence.usernames())
 
-            # If invalid empty username, ask user again
-            while not dm_recipient:
-                dm_recipient = input("Enter valid recipient username: ")
-                dm_recipient = dm_recipient.strip()
+        elif command == 'lookup': # Client typed "lookup PREFIX" to find users by the start of their name
+            if not arguments or len(arguments.split()) != 1:
+                printMessage("INFO", "Usage: lookup PREFIX")
+                continue
+            try:
+                client.lookup(arguments)
+                await client.drain()
+            except Exception as e:
+                printMessage("INFO", f"Error sending lookup: {e}")
 
-            # Prompt user for message to send
-            dm_message = input("Enter message to broadcast: ")
-            while not dm_message:
-                dm_message = input("Enter valid message to broadcast: ")
+        elif command == 'history': # Client typed "history" to page back through older messages
+            try:
+                client.history(history_oldest)
+                await client.drain()
+            except Exception as e:
+                printMessage("INFO", f"Error requesting history: {e}")
+
+        elif command == 'dm': # Client typed "dm USER MESSAGE" to send a direct message
+            recipient_and_text = arguments.split(None, 1)
+            if len(recipient_and_text) != 2:
+                printMessage("INFO", "Usage: dm USER MESSAGE")
+                continue
+            dm_recipient, dm_message = recipient_and_text
 
-            dm_data = {"command": "dm", "username": username, "recipient": dm_recipient, "message": dm_message}
             try:
-                # Send the public message to the server
-                sock.send(json.dumps(dm_data).encode('utf-8'))
+                # Send the direct message to the server
+                client.dm(dm_recipient, dm_message)
+                await client.drain()
             except Exception as e:
                 printMessage("INFO", f"Error sending broadcast_data: {e}")
 
+        elif command in ('join', 'leave'): # Client typed "join ROOM" or "leave ROOM"
+            if not valid_room_name(arguments):
+                printMessage("INFO", f"Usage: {command} ROOM (no spaces, at most 32 characters)")
+                continue
+            try:
+                if command == 'join':
+                    client.join(arguments)
+                else:
+                    client.leave(arguments)
+                await client.drain()
+            except Exception as e:
+                printMessage("INFO", f"Error sending room request: {e}")
+
+        elif command == 'room': # Client typed "room ROOM MESSAGE" to message a room's members
+            room_and_text = arguments.split(None, 1)
+            if len(room_and_text) != 2 or not valid_room_name(room_and_text[0]):
+                printMessage("INFO", "Usage: room ROOM MESSAGE (room names have no spaces, at most 32 characters)")
+                continue
+            room_name, room_message = room_and_text
+
+            try:
+                client.room(room_name, room_message)
+                await client.drain()
+            except Exception as e:
+                printMessage("INFO", f"Error sending room message: {e}")
+
         else:
             # If invalid command, reprint the instructions and don't send anything to the server
             printMessage("INFO", "[INVALID COMMAND] [ENTER VALID COMMAND]")
             printMessage("INFO", instructions)
 
-def run_client(server_name, server_port):
+async def run_client(server_name, server_port, binary=True, tls=None):
     """
     Main function to run the client.
 
     This function connects to server and handles calling all other functions.
-    First, this function has the client login, then it creates seperate threads
-    for receiving and sending. Finally, it waits for both threads to complete
-    before closing the client connection.
+    It connects with TLS if tls (an ssl.SSLContext) is given.
+    First, this function picks the codec (binary unless binary is False) and
+    has the client login, then it runs two tasks on the event loop: one
+    receiving messages and one reading commands. When the user exits, or
+    the server closes the connection, the client connection is closed.
     """
 
-    # Create TCP socket and connect to the server based on the fucntion arguments
-    client_sock = socket(AF_INET, SOCK_STREAM)
-    client_sock.connect((server_name, server_port))
+    # Connect to the server based on the fucntion arguments and pick the codec
+    # (an older server keeps the connection on JSON)
+    try:
+        client = await AsyncChatClient.connect(server_name, server_port, binary, tls=tls)
+    except ssl.SSLError as e:
+        printMessage("INFO", f"TLS connection failed: {e}")
+        return
+    except (ConnectionError, OSError):
+        printMessage("INFO", "Connection error. Unable to communicate with the server.")
+        return
     printMessage("INFO", "Connected to Chat Room")
+    update_status(client)
 
     # Call the login function to assign username (registration function is called within the login function)
-    username = login(client_sock)
+    try:
+        username = await login(client)
+    except EOFError:
+        username = None
     if not username:
         printMessage("INFO", "Login failed. Exiting.")
-        client_sock.close()
+        client.close()
         return
 
-    # Create two threads: one for receiving messages, one for sending them
-    receive_thread = threading.Thread(target=receive_messages, args=(client_sock,))
-    send_thread = threading.Thread(target=send_messages, args=(client_sock, username))
+    # Tab completes dm recipients in the full-screen interface
+    screen.on_tab = lambda before_cursor: request_completion(client, before_cursor)
 
-    # Start both threads
-    receive_thread.start()
-    send_thread.start()
+    # Create two tasks: one for receiving messages, one for sending them
+    receive_task = asyncio.create_task(receive_messages(client))
+    send_task = asyncio.create_task(send_messages(client, username))
 
-    # Wait for both threads to finish
-    receive_thread.join()
-    send_thread.join()
+    # Wait for either one to finish
+    await asyncio.wait((receive_task, send_task), return_when=asyncio.FIRST_COMPLETED)
+    if not send_task.done():
+        # The connection was closed by the server; let the user read why before exiting
+        send_task.cancel()
+        printMessage("INFO", "Disconnected from the server. Press Enter to exit.")
+        try:
+            await screen.read_line()
+        except EOFError:
+            pass
+    receive_task.cancel()
+    client.close()
 
+async def main(args, tls):
+    """
+    This function sets up the terminal interface (curses when the terminal supports it) and runs the client
+    """
+    global screen
+    if not args.plain and curses is not None and sys.stdin.isatty() and sys.stdout.isatty():
+        try:
+            screen = CursesScreen(args.scrollback)
+        except curses.error as e:
+            printMessage("INFO", f"Full-screen interface unavailable ({e}), using plain output.")
+    try:
+        await run_client(args.server_name, args.server_port, not args.json, tls)
+    finally:
+        # Give the terminal back
+        screen.close()
+        screen = PlainScreen()
     printMessage("INFO", "Client connection closed.")
 
 if __name__ == '__main__':
-    # Ensure the correct number of arguments were passed (Ex: python3 client.py localhost 12000)
-    if len(sys.argv) != 3:
-        print(f'Usage: python3 {sys.argv[0]} server_name server_port')
-        sys.exit(1)
-
-    # Retrieve the server name and port from command-line arguments
-    server_name = sys.argv[1]
-    server_port = int(sys.argv[2])
+    # Ensure the correct arguments were passed (Ex: python3 client.py localhost 12000)
+    parser = argparse.ArgumentParser(description="Online Chat Room client")
+    parser.add_argument("server_name", help="Server host name or address")
+    parser.add_argument("server_port", type=int, help="Server port number")
+    # Optional "--json" keeps the connection on JSON instead of the binary codec
+    parser.add_argument("--json", action="store_true", help="Always use JSON instead of the binary codec")
+    parser.add_argument("--tls", action="store_true", help="Connect with TLS (checked against the system's certificates)")
+    parser.add_argument("--tls-ca", help="Certificate file to trust for TLS (Ex: the server's self-signed certificate)")
+    # Optional "--plain" prints lines instead of using the full-screen interface (Ex: for a terminal without curses)
+    parser.add_argument("--plain", action="store_true", help="Print messages line by line instead of the full-screen interface")
+    parser.add_argument("--scrollback", type=int, default=DEFAULT_SCROLLBACK_LINES,
+                        help=f"Lines kept for scrolling back with PgUp (default {DEFAULT_SCROLLBACK_LINES})")
+    args = parser.parse_args()
+    if args.scrollback < 1:
+        parser.error("--scrollback must be at least 1")
+
+    tls = None
+    if args.tls or args.tls_ca:
+        try:
+            tls = client_context(args.tls_ca)
+        except (OSError, ssl.SSLError) as e:
+            print(f"Could not load the TLS certificate: {e}")
+            sys.exit(1)
 
     # Run the chat client
-    run_client(server_name, server_port)
+    try:
+        asyncio.run(main(args, tls))
+    except KeyboardInterrupt:
+        printMessage("INFO", "Client connection closed.")
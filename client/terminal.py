@@ -0,0 +1,488 @@
+"""
+Terminal user interface for client.py.
+
+The client runs on one asyncio event loop, so this module never blocks:
+keys are read when the terminal has input (loop.add_reader) and typed
+lines are handed to the client through read_line().
+
+CursesScreen: a full-screen interface on the standard curses module
+    +--------------------------------------------+
+    | [PM] [SENT BY: user2]: Hello               |  messages (scrollback)
+    | [DM] [SENT BY: user3]: Hi                  |
+    | user1 | 3 online                           |  status line
+    | > dm user2 see you at 5_                   |  input line
+    +--------------------------------------------+
+    The input line is edited in place (left/right, home/end, ^A/^E,
+    backspace/delete, ^U/^K/^W, up/down for earlier lines), so messages
+    that arrive while typing never break up the prompt. Tab calls
+    on_tab(text before the cursor), which may later fill in the word
+    being typed with complete() (Ex: a username looked up on the server).
+    PgUp/PgDn scroll back through the last --scrollback lines. ^D on an
+    empty line exits.
+PlainScreen: prints lines and reads standard input, for a terminal without
+    curses support (Ex: Windows) or when the client's input is a pipe.
+
+Messages often arrive in bursts (Ex: replayed history after login), so
+CursesScreen does not redraw for every line: a redraw is scheduled
+REDRAW_DELAY seconds after the first new line, and every line added in the
+meantime shares it. Only what fits on the screen is laid out, however long
+the scrollback is.
+"""
+import os
+import sys
+import signal
+import asyncio
+import threading
+from collections import deque
+
+try:
+    import curses
+except ImportError:
+    # Python on Windows has no curses module; the client uses PlainScreen
+    curses = None
+
+# Lines kept for scrolling back (set with --scrollback); older lines are dropped
+DEFAULT_SCROLLBACK_LINES = 10000
+
+# Seconds between the first new message and the redraw that shows it (and
+# every other message that arrived in the meantime)
+REDRAW_DELAY = 0.02
+
+# Typed lines remembered for the up and down keys
+INPUT_HISTORY_LINES = 100
+
+class Scrollback:
+    """
+    This class is a bounded ring buffer of output lines.
+
+    Once capacity lines are stored, each new line overwrites the oldest, so
+    appending is constant time and memory stays bounded. Lines are numbered
+    from the newest one (0) back.
+    """
+
+    def __init__(self, capacity=DEFAULT_SCROLLBACK_LINES):
+        if capacity < 1:
+            raise ValueError("Scrollback capacity must be at least 1 line")
+        self.lines = [None] * capacity
+        self.start = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, line):
+        """
+        This function adds a line, dropping the oldest one if the buffer is full
+
+        Returns: True if a line was dropped
+        """
+        capacity = len(self.lines)
+        if self.count < capacity:
+            self.lines[(self.start + self.count) % capacity] = line
+            self.count += 1
+            return False
+        self.lines[self.start] = line
+        self.start = (self.start + 1) % capacity
+        return True
+
+    def newest(self, skip=0):
+        """
+        This function yields lines from the newest back to the oldest, after skipping skip lines
+        """
+        capacity = len(self.lines)
+        for index in range(self.count - 1 - skip, -1, -1):
+            yield self.lines[(self.start + index) % capacity]
+
+def layout(scrollback, offset, height, width):
+    """
+    This function wraps the lines that end the view to the screen width
+
+    offset is how many lines the view is scrolled back. Only the lines that
+    fill height rows are wrapped, so the cost does not grow with the scrollback.
+
+    Returns: Up to height rows, top to bottom
+    """
+    rows = []
+    if height <= 0 or width <= 0:
+        return rows
+    for line in scrollback.newest(offset):
+        pieces = [line[start:start + width] for start in range(0, len(line), width)] or [""]
+        rows.extend(reversed(pieces))
+        if len(rows) >= height:
+            break
+    del rows[height:]
+    rows.reverse()
+    return rows
+
+class LineEditor:
+    """
+    This class is the text being typed and its cursor.
+
+    edit() takes a printable string to insert or the name of an editing key
+    (Ex: "left", "backspace", "kill_word"). Submitted lines are remembered,
+    and "up"/"down" bring them back.
+    """
+
+    def __init__(self, history_size=INPUT_HISTORY_LINES):
+        self.text = ""
+        self.cursor = 0
+        self.history = deque(maxlen=history_size)
+        # Position while browsing history (None when editing a new line), and the new line being typed
+        self.browsing = None
+        self.draft = ""
+
+    def edit(self, key):
+        """
+        This function applies a key to the line
+
+        Returns: True if the line or cursor changed
+        """
+        text, cursor = self.text, self.cursor
+        if key == "left":
+            self.cursor = max(cursor - 1, 0)
+        elif key == "right":
+            self.cursor = min(cursor + 1, len(text))
+        elif key == "home":
+            self.cursor = 0
+        elif key == "end":
+            self.cursor = len(text)
+        elif key == "backspace":
+            if cursor:
+                self.text = text[:cursor - 1] + text[cursor:]
+                self.cursor = cursor - 1
+        elif key == "delete":
+            self.text = text[:cursor] + text[cursor + 1:]
+        elif key == "kill_start":
+            self.text = text[cursor:]
+            self.cursor = 0
+        elif key == "kill_end":
+            self.text = text[:cursor]
+        elif key == "kill_word":
+            # Removes the word before the cursor and the spaces after it
+            self.cursor = len(text[:cursor].rstrip())
+            start = self.word_start()
+            self.text = text[:start] + text[cursor:]
+            self.cursor = start
+        elif key in ("up", "down"):
+            self._browse(-1 if key == "up" else 1)
+        elif len(key) == 1 and key.isprintable():
+            self.text = text[:cursor] + key + text[cursor:]
+            self.cursor = cursor + 1
+        else:
+            return False
+        return (self.text, self.cursor) != (text, cursor)
+
+    def _browse(self, step):
+        # Moves through the remembered lines (step -1 is older)
+        if self.browsing is None:
+            if step > 0 or not self.history:
+                return
+            self.draft = self.text
+            self.browsing = len(self.history)
+        self.browsing = max(self.browsing + step, 0)
+        if self.browsing >= len(self.history):
+            self.browsing = None
+            self.text = self.draft
+        else:
+            self.text = self.history[self.browsing]
+        self.cursor = len(self.text)
+
+    def word_start(self):
+        """
+        This function finds where the word before the cursor starts
+
+        Returns: Index into text
+        """
+        start = self.cursor
+        while start and not self.text[start - 1].isspace():
+            start -= 1
+        return start
+
+    def complete(self, word, completion):
+        """
+        This function replaces the word before the cursor with completion, if that word is still word
+
+        Returns: True if the line changed
+        """
+        start = self.word_start()
+        if self.text[start:self.cursor] != word or completion == word:
+            return False
+        self.text = self.text[:start] + completion + self.text[self.cursor:]
+        self.cursor = start + len(completion)
+        return True
+
+    def submit(self, remember=True):
+        """
+        This function ends the line and starts a new one
+
+        remember=False keeps the line out of the history (Ex: a password).
+
+        Returns: The line
+        """
+        line = self.text
+        if remember and line.strip() and (not self.history or self.history[-1] != line):
+            self.history.append(line)
+        self.text = ""
+        self.cursor = 0
+        self.browsing = None
+        self.draft = ""
+        return line
+
+    def view(self, width):
+        """
+        This function picks the part of the line that fits in width columns, keeping the cursor visible
+
+        Returns: (visible text, cursor column)
+        """
+        if width <= 0:
+            return "", 0
+        start = max(self.cursor - width + 1, 0)
+        return self.text[start:start + width], self.cursor - start
+
+class PlainScreen:
+    """
+    This class is the interface without curses: lines are printed as they
+    arrive and typed lines are read from standard input by a thread.
+    """
+
+    def __init__(self):
+        self.lines = None
+        # Lines are read whole, so there is no tab completion
+        self.on_tab = None
+
+    def add_line(self, text):
+        print(text)
+
+    def complete(self, word, completion):
+        pass
+
+    def set_status(self, text):
+        pass # No status line
+
+    async def read_line(self, prompt="", secret=False):
+        """
+        This function waits for the next typed line
+
+        Returns: The line, without its newline
+        Raises: EOFError when standard input is closed
+        """
+        if self.lines is None:
+            # A daemon thread reads standard input, so nothing blocks the event loop
+            self.lines = asyncio.Queue()
+            thread = threading.Thread(target=self._read_input, args=(asyncio.get_running_loop(),), daemon=True)
+            thread.start()
+        if prompt:
+            print(prompt, end="", flush=True)
+        line = await self.lines.get()
+        if line is None:
+            self.lines.put_nowait(None) # Every later read sees the end of input too
+            raise EOFError("End of input")
+        return line
+
+    def _read_input(self, loop):
+        # The input thread: passes each line to the event loop (None at the end of input)
+        while True:
+            line = sys.stdin.readline()
+            try:
+                loop.call_soon_threadsafe(self.lines.put_nowait, line.rstrip("\r\n") if line else None)
+            except RuntimeError:
+                return # The event loop has stopped
+            if not line:
+                return
+
+    def close(self):
+        pass
+
+class CursesScreen:
+    """
+    This class is the full-screen curses interface (see the top of this file).
+
+    It must be created inside the running event loop, and close() must be
+    called to give the terminal back.
+
+    Raises: curses.error if the terminal cannot be used (Ex: unknown TERM)
+    """
+
+    def __init__(self, scrollback_lines=DEFAULT_SCROLLBACK_LINES):
+        self.loop = asyncio.get_running_loop()
+        self.scrollback = Scrollback(scrollback_lines)
+        self.editor = LineEditor()
+        self.lines = asyncio.Queue()
+        self.prompt = ""
+        self.secret = False
+        self.status = ""
+        # Called with the text before the cursor when Tab is pressed (see complete)
+        self.on_tab = None
+        # How many lines the view is scrolled back (0 follows new lines)
+        self.offset = 0
+        self.redraw_handle = None
+        # Escape sequences (Ex: arrow keys) arrive together, so curses need not wait long for the rest
+        os.environ.setdefault("ESCDELAY", "25")
+        self.window = curses.initscr()
+        try:
+            curses.noecho()
+            curses.cbreak()
+            self.window.keypad(True)
+            self.window.nodelay(True)
+        except curses.error:
+            curses.endwin()
+            raise
+        self.keys = {
+            curses.KEY_LEFT: "left", curses.KEY_RIGHT: "right", curses.KEY_HOME: "home", curses.KEY_END: "end",
+            curses.KEY_BACKSPACE: "backspace", "\x7f": "backspace", "\b": "backspace", curses.KEY_DC: "delete",
+            curses.KEY_UP: "up", curses.KEY_DOWN: "down", "\x01": "home", "\x05": "end", "\x15": "kill_start",
+            "\x0b": "kill_end", "\x17": "kill_word",
+        }
+        self.loop.add_reader(sys.stdin.fileno(), self._on_input)
+        self.loop.add_signal_handler(signal.SIGWINCH, self._resize)
+        self._redraw()
+
+    def add_line(self, text):
+        """
+        This function adds text (split at newlines) to the scrollback and schedules a redraw
+        """
+        for line in text.split("\n"):
+            dropped = self.scrollback.append(line)
+            if self.offset:
+                # Keep a scrolled-back view on the same lines
+                self.offset = min(self.offset + (not dropped), len(self.scrollback) - 1)
+        self._schedule_redraw()
+
+    def set_status(self, text):
+        self.status = text
+        self._schedule_redraw()
+
+    def complete(self, word, completion):
+        """
+        This function fills in the word before the cursor, unless it was changed since Tab was pressed
+        """
+        if self.editor.complete(word, completion):
+            self._draw_input()
+            self.window.refresh()
+
+    async def read_line(self, prompt="", secret=False):
+        """
+        This function shows prompt on the input line and waits for a line to be typed
+
+        With secret the typed characters are shown as '*' (Ex: a password).
+
+        Returns: The line
+        Raises: EOFError if ^D was pressed on an empty line
+        """
+        self.prompt = prompt
+        self.secret = secret
+        self._draw_input()
+        self.window.refresh()
+        line = await self.lines.get()
+        if line is None:
+            raise EOFError("End of input")
+        return line
+
+    def _schedule_redraw(self):
+        # Lines that arrive before the redraw runs share it
+        if self.redraw_handle is None:
+            self.redraw_handle = self.loop.call_later(REDRAW_DELAY, self._redraw)
+
+    def _on_input(self):
+        # Called by the event loop when the terminal has input: handles every key that is waiting
+        while True:
+            try:
+                key = self.window.get_wch()
+            except curses.error:
+                return # No more input
+            self._key(key)
+
+    def _key(self, key):
+        height = self.window.getmaxyx()[0]
+        if key in ("\n", "\r", curses.KEY_ENTER):
+            line = self.editor.submit(remember=not self.secret)
+            # The typed line joins the scrollback, as it would in a plain terminal
+            self.add_line(self.prompt + ("*" * len(line) if self.secret else line))
+            self.lines.put_nowait(line)
+            self.prompt = ""
+            self.secret = False
+            self.offset = 0
+        elif key == "\x04" and not self.editor.text:
+            self.lines.put_nowait(None)
+        elif key == "\t":
+            if self.on_tab is not None and not self.secret:
+                self.on_tab(self.editor.text[:self.editor.cursor])
+        elif key == curses.KEY_PPAGE:
+            self.offset = min(self.offset + max(height - 3, 1), max(len(self.scrollback) - 1, 0))
+            self._redraw()
+        elif key == curses.KEY_NPAGE:
+            self.offset = max(self.offset - max(height - 3, 1), 0)
+            self._redraw()
+        elif key == curses.KEY_RESIZE:
+            self._redraw()
+        else:
+            action = self.keys.get(key, key)
+            if isinstance(action, str) and self.editor.edit(action):
+                # Typing only changes the input line, which is drawn straight away
+                self._draw_input()
+                self.window.refresh()
+
+    def _resize(self):
+        # SIGWINCH: tell curses the new terminal size and draw everything again
+        columns, rows = os.get_terminal_size(sys.stdout.fileno())
+        curses.resizeterm(rows, columns)
+        self._redraw()
+
+    def _redraw(self):
+        """
+        This function draws the whole screen
+
+        curses only sends the terminal what changed since the last refresh.
+        """
+        if self.redraw_handle is not None:
+            self.redraw_handle.cancel()
+            self.redraw_handle = None
+        height, width = self.window.getmaxyx()
+        self.window.erase()
+        rows = layout(self.scrollback, self.offset, height - 2, width)
+        top = height - 2 - len(rows)
+        for y, row in enumerate(rows):
+            self._put(top + y, row)
+        status = self.status
+        if self.offset:
+            status += f" | scrolled back {self.offset} lines (PgDn)"
+        self._put(height - 2, status.ljust(width), curses.A_REVERSE)
+        self._draw_input()
+        self.window.refresh()
+
+    def _draw_input(self):
+        height, width = self.window.getmaxyx()
+        prompt = self.prompt[:max(width - 1, 0)]
+        text, cursor = self.editor.view(width - len(prompt) - 1)
+        if self.secret:
+            text = "*" * len(text)
+        self.window.move(height - 1, 0)
+        self.window.clrtoeol()
+        self._put(height - 1, prompt + text)
+        try:
+            self.window.move(height - 1, len(prompt) + cursor)
+        except curses.error:
+            pass
+
+    def _put(self, y, text, attributes=0):
+        # Writing the last column of the last row makes curses raise after writing, which is harmless
+        if y < 0:
+            return
+        try:
+            self.window.addnstr(y, 0, text, self.window.getmaxyx()[1], attributes)
+        except curses.error:
+            pass
+
+    def close(self):
+        """
+        This function gives the terminal back and prints the last screen of messages, so they stay visible
+        """
+        if self.redraw_handle is not None:
+            self.redraw_handle.cancel()
+            self.redraw_handle = None
+        self.loop.remove_reader(sys.stdin.fileno())
+        self.loop.remove_signal_handler(signal.SIGWINCH)
+        height, width = self.window.getmaxyx()
+        curses.endwin()
+        for row in layout(self.scrollback, 0, height - 2, width):
+            print(row)
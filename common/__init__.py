@@ -0,0 +1,3 @@
+"""
+Code shared by the chat client and server (wire protocol helpers).
+"""
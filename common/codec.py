@@ -0,0 +1,542 @@
+"""
+Message codecs shared by the client and server.
+
+A codec turns a message dictionary into a frame (see framing.py) and a
+frame payload back into a dictionary. Every connection starts with JSON.
+A client may ask for the compact binary codec with a hello request, sent
+as JSON before it logs in:
+{"command": "hello", "codecs": ["binary", "json"]}
+
+The server answers in JSON with the codec it picked, and both sides use it
+for every later frame:
+{"status": "hello", "codec": "binary"}
+
+A server that does not know hello answers unknown_command, so the client
+simply stays on JSON.
+
+Binary payloads start with an opcode byte. The common messages (login,
+pm, dm, rooms, statuses, presence, stored messages, heartbeats, acknowledgements)
+have a fixed layout of fields:
+- numbers are varints (7 bits per byte, low bits first)
+- strings are a varint byte length, then UTF-8
+- usernames are interned: a varint id, or the first time the sender uses a
+  name on the connection, a 0 byte, the id and the name as a string
+Anything else (Ex: a message with an extra field) is sent as opcode 0
+followed by the JSON document, so every message can still be encoded.
+
+Example: {"type": "pm", "from": "user1", "message": "Hi"}
+JSON:   48 bytes
+binary: b'\\x12\\x00\\x01\\x05user1\\x02Hi' (12 bytes), then b'\\x12\\x01\\x02Hi' (5 bytes)
+"""
+import json
+import struct
+import threading
+
+from common.framing import encode_frame
+
+JSON = "json"
+BINARY = "binary"
+# Codecs in order of preference
+CODECS = (BINARY, JSON)
+
+# Opcodes (never renumber: both sides must agree)
+OP_JSON = 0x00
+OP_LOGIN = 0x01
+OP_REGISTER = 0x02
+OP_EX = 0x03
+OP_PM = 0x04
+OP_DM = 0x05
+OP_PRESENCE_REQUEST = 0x06
+OP_JOIN = 0x07
+OP_LEAVE = 0x08
+OP_ROOM = 0x09
+OP_PONG = 0x0A
+OP_ACK = 0x0B
+OP_STATUS = 0x10
+OP_LOGIN_SUCCESS = 0x11
+OP_PM_MESSAGE = 0x12
+OP_DM_MESSAGE = 0x13
+OP_PRESENCE = 0x14
+OP_PRESENCE_SNAPSHOT = 0x15
+OP_PM_RECORD = 0x16
+OP_DM_RECORD = 0x17
+OP_ROOM_MESSAGE = 0x18
+OP_ROOM_STATUS = 0x19
+OP_PING = 0x1A
+OP_PM_MESSAGE_ID = 0x1B
+OP_DM_MESSAGE_ID = 0x1C
+OP_STATUS_ID = 0x1D
+
+# Field kinds: username, string, unsigned integer, list of usernames, float, status
+NAME, STRING, UINT, NAMES, FLOAT, STATUS = range(6)
+
+# opcode -> (fields with a fixed value, fields sent in order as (key, kind))
+LAYOUTS = {
+    OP_LOGIN: ({"command": "login"}, (("username", NAME), ("password", STRING))),
+    OP_REGISTER: ({"command": "register"}, (("username", NAME), ("password", STRING))),
+    OP_EX: ({"command": "ex"}, (("username", NAME),)),
+    OP_PM: ({"command": "pm"}, (("username", NAME), ("message", STRING))),
+    OP_DM: ({"command": "dm"}, (("username", NAME), ("recipient", NAME), ("message", STRING))),
+    OP_PRESENCE_REQUEST: ({"command": "presence"}, ()),
+    OP_JOIN: ({"command": "join"}, (("username", NAME), ("room", STRING))),
+    OP_LEAVE: ({"command": "leave"}, (("username", NAME), ("room", STRING))),
+    OP_ROOM: ({"command": "room"}, (("username", NAME), ("room", STRING), ("message", STRING))),
+    OP_STATUS: ({}, (("status", STATUS),)),
+    OP_LOGIN_SUCCESS: ({"status": "success"},
+                       (("active_users", NAMES), ("presence_seq", UINT), ("unread", UINT))),
+    OP_PM_MESSAGE: ({"type": "pm"}, (("from", NAME), ("message", STRING))),
+    OP_DM_MESSAGE: ({"type": "dm"}, (("from", NAME), ("message", STRING))),
+    OP_PRESENCE: ({"type": "presence"}, (("seq", UINT), ("joined", NAMES), ("left", NAMES))),
+    OP_PRESENCE_SNAPSHOT: ({"type": "presence_snapshot"}, (("seq", UINT), ("active_users", NAMES))),
+    OP_PM_RECORD: ({"type": "pm", "history": True},
+                   (("from", NAME), ("message", STRING), ("id", UINT), ("time", FLOAT))),
+    OP_DM_RECORD: ({"type": "dm", "history": True},
+                   (("from", NAME), ("message", STRING), ("id", UINT), ("time", FLOAT))),
+    OP_ROOM_MESSAGE: ({"type": "room"}, (("room", STRING), ("from", NAME), ("message", STRING))),
+    OP_ROOM_STATUS: ({}, (("status", STATUS), ("room", STRING))),
+    OP_PONG: ({"command": "pong"}, ()),
+    OP_PING: ({"type": "ping"}, ()),
+    # Messages with the id the server stored them under, and the statuses that carry it (see server/delivery.py)
+    OP_ACK: ({"command": "ack"}, (("username", NAME), ("id", UINT))),
+    OP_PM_MESSAGE_ID: ({"type": "pm"}, (("from", NAME), ("message", STRING), ("id", UINT))),
+    OP_DM_MESSAGE_ID: ({"type": "dm"}, (("from", NAME), ("message", STRING), ("id", UINT))),
+    OP_STATUS_ID: ({}, (("status", STATUS), ("id", UINT))),
+}
+
+# Status codes of OP_STATUS (only ever append to this list)
+STATUSES = (
+    "success", "failed", "user_not_found", "username_taken", "exiting", "user_not_logged_in",
+    "message_sent", "message_stored", "message_failed", "sender_not_active", "cannot_message_self",
+    "recipient_username_not_found", "unknown_command", "invalid_message", "server_busy",
+    "frame_too_large", "room_joined", "room_left", "not_in_room", "invalid_room", "too_many_rooms",
+    "rate_limited",
+)
+STATUS_CODES = {status: code for code, status in enumerate(STATUSES)}
+
+def _shape(message):
+    # The command or type of a message (None for a status) and its keys
+    tag = message.get("command", message.get("type"))
+    return (tag if isinstance(tag, str) else None, frozenset(message))
+
+# (tag, keys) -> opcode, for finding a message's layout
+SHAPES = {}
+for _op, (_fixed, _fields) in LAYOUTS.items():
+    _keys = frozenset(_fixed) | {key for key, kind in _fields}
+    SHAPES[(_fixed.get("command", _fixed.get("type")), _keys)] = _op
+
+DOUBLE = struct.Struct("!d")
+OPCODE_BYTES = {op: bytes((op,)) for op in LAYOUTS}
+NO_NAMES = frozenset()
+
+# Most usernames one side may define on a connection (bounds a peer's memory use)
+MAX_RECEIVED_NAMES = 1000000
+
+def _varint(value):
+    if value < 0x80:
+        return bytes((value,))
+    out = bytearray()
+    while value >= 0x80:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+def _string(text):
+    data = text.encode('utf-8')
+    return _varint(len(data)) + data
+
+class NameTable:
+    """
+    This class gives every username an id (1, 2, 3...) for the binary codec.
+
+    The server shares one table between all connections, so a message is
+    encoded once for every recipient. Ids are never reused. The encoded id
+    of each name, and its inline definition, are kept ready to copy.
+    """
+
+    def __init__(self):
+        # name -> varint id, and name -> definition (a 0 byte, the id, then the name)
+        self.refs = {}
+        self.definitions = {}
+        self.lock = threading.Lock()
+
+    def add(self, name):
+        """
+        This function gives a name the next id, if it has none yet
+        """
+        with self.lock:
+            if name not in self.refs:
+                ref = _varint(len(self.refs) + 1)
+                self.definitions[name] = b"\x00" + ref + _string(name)
+                # Set last: encoders read refs without the lock
+                self.refs[name] = ref
+
+class SharedMessage:
+    """
+    This class is a message sent to many connections (Ex: a pm or presence batch).
+
+    Each codec encodes it at most once, however many connections it is
+    sent to.
+    """
+
+    def __init__(self, message):
+        self.message = message
+        self.json_frame = None
+        # Usernames in the message, the binary frame using their ids, and
+        # the binary frame defining them all inline
+        self.names = None
+        self.binary_frame = None
+        self.binary_inline_frame = None
+        # Compressed copies of its large frames (see compression.py)
+        self.compressed = {}
+
+class JsonCodec:
+    """
+    This class is the JSON codec: one UTF-8 JSON document per frame.
+
+    It has no state, so every JSON connection shares JSON_CODEC.
+    """
+    name = JSON
+
+    def encode(self, message, tentative=False):
+        """
+        This function encodes a message dictionary (or a SharedMessage)
+
+        Returns: Frame bytes ready to send
+        """
+        if isinstance(message, SharedMessage):
+            if message.json_frame is None:
+                message.json_frame = encode_frame(json.dumps(message.message).encode('utf-8'))
+            return message.json_frame
+        return encode_frame(json.dumps(message).encode('utf-8'))
+
+    def decode(self, payload):
+        """
+        This function decodes a frame payload
+
+        Returns: Message dictionary
+        Raises: ValueError if the payload is not valid
+        """
+        return json.loads(payload)
+
+    def forget(self):
+        pass
+
+    def confirm(self):
+        pass
+
+JSON_CODEC = JsonCodec()
+
+class BinaryCodec:
+    """
+    This class is the binary codec of one connection.
+
+    names is the NameTable for usernames this side sends (the server passes
+    its shared table). known holds the usernames the other side has been told,
+    and received maps the other side's ids back to usernames.
+
+    Encoding and sending must happen in the same order (the connection
+    encodes under its own lock), or a name could be used before it is defined.
+
+    A tentative frame may still be dropped after later frames were encoded
+    (the buffer policy drops the oldest queued frames, see
+    server/outbound.py). The names it defines are kept in unconfirmed, and
+    later frames define them again, until confirm() says every frame
+    encoded so far was sent; so no frame uses a name defined only in a
+    frame that might be dropped.
+    """
+    name = BINARY
+
+    def __init__(self, names=None):
+        self.names = names if names is not None else NameTable()
+        self.known = set()
+        self.unconfirmed = set()
+        self.received = {}
+
+    def forget(self):
+        """
+        This function is called when frames to the other side were dropped
+        (Ex: by the slow consumer policy); names are defined again when next used
+        """
+        self.known = set()
+        self.unconfirmed = set()
+
+    def confirm(self):
+        """
+        This function is called once every frame encoded so far has left the
+        connection's queue, so the names tentative frames defined are known
+        """
+        if self.unconfirmed:
+            self.known |= self.unconfirmed
+            self.unconfirmed = set()
+
+    def encode(self, message, tentative=False):
+        """
+        This function encodes a message dictionary (or a SharedMessage)
+
+        tentative: The frame may be dropped from the queue after later frames
+        are encoded (see the class docstring)
+
+        Returns: Frame bytes ready to send
+        """
+        if isinstance(message, SharedMessage):
+            return self._encode_shared(message, tentative)
+        encoded = self._payload(message, NO_NAMES)
+        if encoded is None:
+            return encode_frame(_json_payload(message))
+        payload, names = encoded
+        if not names <= self.known:
+            # Define the names the other side has not seen yet
+            inline = names - self.known
+            payload, names = self._payload(message, inline)
+            self._defined(inline, tentative)
+        return encode_frame(payload)
+
+    def _defined(self, inline, tentative):
+        # A name defined in a tentative frame is only known once the frame is sent
+        if tentative:
+            self.unconfirmed |= inline
+        else:
+            self.known |= inline
+
+    def _encode_shared(self, shared, tentative=False):
+        if shared.names is None:
+            encoded = self._payload(shared.message, NO_NAMES)
+            if encoded is None:
+                shared.binary_frame = encode_frame(_json_payload(shared.message))
+                shared.names = NO_NAMES
+            else:
+                shared.binary_frame = encode_frame(encoded[0])
+                shared.names = encoded[1]
+        if shared.names <= self.known:
+            return shared.binary_frame
+        if shared.binary_inline_frame is None:
+            shared.binary_inline_frame = encode_frame(self._payload(shared.message, shared.names)[0])
+        self._defined(shared.names, tentative)
+        return shared.binary_inline_frame
+
+    def _payload(self, message, inline):
+        """
+        This function writes a message in its binary layout
+
+        Usernames in inline are defined in the payload; the others are sent
+        as their ids.
+
+        Returns: (payload, set of usernames in the message), or None if the
+        message has no layout and must be sent as JSON
+        """
+        op = SHAPES.get(_shape(message))
+        if op is None:
+            return None
+        fixed, fields = LAYOUTS[op]
+        for key, value in fixed.items():
+            if message[key] != value or type(message[key]) is not type(value):
+                return None
+        refs = self.names.refs
+        definitions = self.names.definitions
+        names = set()
+        parts = [OPCODE_BYTES[op]]
+        for key, kind in fields:
+            value = message[key]
+            if kind == STRING:
+                if type(value) is not str:
+                    return None
+                data = value.encode('utf-8')
+                parts.append(_varint(len(data)))
+                parts.append(data)
+            elif kind == NAME:
+                ref = refs.get(value) if type(value) is str else None
+                if ref is None:
+                    if type(value) is not str:
+                        return None
+                    self.names.add(value)
+                    ref = refs[value]
+                names.add(value)
+                parts.append(definitions[value] if value in inline else ref)
+            elif kind == NAMES:
+                if type(value) is not list:
+                    return None
+                try:
+                    ids = [refs[name] for name in value]
+                except (KeyError, TypeError):
+                    # A new name (or not a string)
+                    if not all(type(name) is str for name in value):
+                        return None
+                    for name in value:
+                        if name not in refs:
+                            self.names.add(name)
+                    ids = [refs[name] for name in value]
+                names.update(value)
+                parts.append(_varint(len(value)))
+                if inline:
+                    ids = [definitions[name] if name in inline else ref for name, ref in zip(value, ids)]
+                parts.extend(ids)
+            elif kind == UINT:
+                if type(value) is not int or value < 0:
+                    return None
+                parts.append(_varint(value))
+            elif kind == FLOAT:
+                if type(value) is not float:
+                    return None
+                parts.append(DOUBLE.pack(value))
+            else:
+                code = STATUS_CODES.get(value) if type(value) is str else None
+                if code is None:
+                    return None
+                parts.append(bytes((code,)))
+        return b"".join(parts), names
+
+    def decode(self, payload):
+        """
+        This function decodes a frame payload
+
+        Returns: Message dictionary
+        Raises: ValueError if the payload is not valid
+        """
+        if not payload:
+            raise ValueError("Empty payload")
+        op = payload[0]
+        if op == OP_JSON:
+            return json.loads(payload[1:])
+        layout = LAYOUTS.get(op)
+        if layout is None:
+            raise ValueError(f"Unknown opcode {op}")
+        fixed, fields = layout
+        message = dict(fixed)
+        reader = _PayloadReader(payload, self.received)
+        try:
+            for key, kind in fields:
+                if kind == STRING:
+                    message[key] = reader.string()
+                elif kind == NAME:
+                    message[key] = reader.name()
+                elif kind == NAMES:
+                    message[key] = reader.names()
+                elif kind == UINT:
+                    message[key] = reader.varint()
+                elif kind == FLOAT:
+                    message[key] = reader.double()
+                else:
+                    message[key] = STATUSES[reader.byte()]
+        except (IndexError, struct.error, UnicodeDecodeError) as e:
+            raise ValueError(f"Invalid binary payload: {e}")
+        if reader.offset != len(payload):
+            raise ValueError("Trailing bytes in binary payload")
+        return message
+
+def _json_payload(message):
+    return bytes((OP_JSON,)) + json.dumps(message).encode('utf-8')
+
+class _PayloadReader:
+    """
+    This class reads the fields of one binary payload in order
+    """
+
+    def __init__(self, payload, received):
+        self.payload = payload
+        self.offset = 1
+        self.received = received
+
+    def byte(self):
+        value = self.payload[self.offset]
+        self.offset += 1
+        return value
+
+    def varint(self):
+        value = self.payload[self.offset]
+        self.offset += 1
+        if value < 0x80:
+            return value
+        value &= 0x7F
+        shift = 7
+        while True:
+            byte = self.payload[self.offset]
+            self.offset += 1
+            value |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return value
+            shift += 7
+
+    def string(self):
+        length = self.varint()
+        end = self.offset + length
+        if end > len(self.payload):
+            raise IndexError("String runs past the end of the payload")
+        text = self.payload[self.offset:end].decode('utf-8')
+        self.offset = end
+        return text
+
+    def name(self):
+        number = self.varint()
+        if number == 0:
+            # A new name: its id, then the name
+            number = self.varint()
+            if len(self.received) >= MAX_RECEIVED_NAMES and number not in self.received:
+                raise ValueError("Too many usernames defined")
+            self.received[number] = self.string()
+        name = self.received.get(number)
+        if name is None:
+            raise ValueError(f"Unknown username id {number}")
+        return name
+
+    def names(self):
+        # name() for a whole list, with the varint read inline (lists can be long)
+        count = self.varint()
+        payload = self.payload
+        received = self.received
+        offset = self.offset
+        names = []
+        for _ in range(count):
+            number = payload[offset]
+            if number == 0:
+                # A new name
+                self.offset = offset
+                names.append(self.name())
+                offset = self.offset
+                continue
+            offset += 1
+            if number >= 0x80:
+                number &= 0x7F
+                shift = 7
+                while True:
+                    byte = payload[offset]
+                    offset += 1
+                    number |= (byte & 0x7F) << shift
+                    if byte < 0x80:
+                        break
+                    shift += 7
+            name = received.get(number)
+            if name is None:
+                raise ValueError(f"Unknown username id {number}")
+            names.append(name)
+        self.offset = offset
+        return names
+
+    def double(self):
+        value, = DOUBLE.unpack_from(self.payload, self.offset)
+        self.offset += DOUBLE.size
+        return value
+
+def new_codec(name, names=None):
+    """
+    This function creates a codec for a connection by name
+
+    Returns: JSON_CODEC, or a new BinaryCodec using the NameTable names
+    """
+    if name == BINARY:
+        return BinaryCodec(names)
+    if name == JSON:
+        return JSON_CODEC
+    raise ValueError(f"Unknown codec: {name}")
+
+def choose_codec(offered):
+    """
+    This function picks the codec for a hello request
+
+    Returns: The first codec in offered that is supported (JSON if none is)
+    """
+    if isinstance(offered, list):
+        for name in offered:
+            if name in CODECS:
+                return name
+    return JSON
@@ -0,0 +1,173 @@
+"""
+Per-connection compression of large frames, shared by the client and server.
+
+Compression is asked for in the hello request, next to the codecs (see
+codec.py), and the server answers with the method it picked:
+{"command": "hello", "codecs": ["binary", "json"], "compression": ["zlib"]}
+{"status": "hello", "codec": "binary", "compression": "zlib"}
+
+After that, each side compresses the frames it sends whose payload is at
+least a threshold (Ex: a pasted log, or a long history page); smaller frames
+are sent exactly as before, since compressing them costs more CPU than it
+saves. A compressed payload starts with a marker byte that no codec uses
+(binary opcodes are below 0x80 and JSON starts with "{"):
+STREAM: the next part of the connection's deflate stream. The stream keeps
+        its 32 KiB window between frames, so keys, usernames and text that
+        were sent before compress to a few bytes.
+STREAM_START: starts a new stream (the first compressed frame, and the
+        first after a frame was dropped by the slow consumer policy, since
+        the other side never saw the dropped part of the old stream)
+STANDALONE: compressed by itself. A message sent to many connections (a
+        SharedMessage, Ex: a long pm) is compressed once and the same
+        frame is queued for every recipient.
+A frame that does not get smaller is sent uncompressed.
+
+Under the buffer policy a queued frame may be dropped after later frames
+were encoded (see server/outbound.py), and a later part of the stream
+cannot be decompressed without it. So while a streamed frame that may
+still be dropped waits in the queue, frames are compressed STANDALONE.
+"""
+import zlib
+
+from common.framing import encode_frame, HEADER_SIZE, DEFAULT_MAX_FRAME_SIZE
+from common.codec import SharedMessage
+
+ZLIB = "zlib"
+# Compression methods in order of preference
+COMPRESSIONS = (ZLIB,)
+
+# Smallest payload in bytes that is compressed, and the zlib level (1 fastest, 9 smallest)
+DEFAULT_COMPRESSION_THRESHOLD = 512
+DEFAULT_COMPRESSION_LEVEL = 6
+
+# Marker bytes of compressed payloads (see the top of this file)
+STREAM = 0xF0
+STREAM_START = 0xF1
+STANDALONE = 0xF2
+
+# Raw deflate (no zlib header or checksum: the frame already has a length)
+WBITS = -15
+# A sync flush ends every streamed frame with these bytes; they are left
+# out of the frame and added back before decompressing
+SYNC_TAIL = b"\x00\x00\xff\xff"
+
+class CompressedCodec:
+    """
+    This class wraps a connection's codec (see codec.py) and compresses its large frames.
+
+    Each connection needs its own CompressedCodec, since the deflate streams
+    in both directions are part of the connection's state.
+    """
+
+    def __init__(self, codec, threshold=DEFAULT_COMPRESSION_THRESHOLD, level=DEFAULT_COMPRESSION_LEVEL,
+                 max_size=DEFAULT_MAX_FRAME_SIZE):
+        self.codec = codec
+        self.threshold = threshold
+        self.level = level
+        # Most bytes a compressed payload may expand to
+        self.max_size = max_size
+        self.compressor = None
+        self.decompressor = None
+        # A tentative frame continued the stream and has not been confirmed sent
+        self.unconfirmed = False
+
+    def encode(self, message, tentative=False):
+        """
+        This function encodes a message dictionary (or a SharedMessage), compressing a large frame
+
+        tentative: The frame may be dropped from the queue after later frames
+        are encoded (see the top of this file)
+
+        Returns: Frame bytes ready to send
+        """
+        frame = self.codec.encode(message, tentative)
+        if len(frame) - HEADER_SIZE < self.threshold:
+            return frame
+        if isinstance(message, SharedMessage):
+            return self._encode_shared(message, frame)
+        if tentative and self.unconfirmed:
+            # Streaming would depend on a frame that may still be dropped
+            return self._standalone(frame)
+
+        marker = STREAM
+        if self.compressor is None:
+            self.compressor = zlib.compressobj(self.level, zlib.DEFLATED, WBITS)
+            marker = STREAM_START
+        payload = memoryview(frame)[HEADER_SIZE:]
+        data = self.compressor.compress(payload) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        if len(data) - len(SYNC_TAIL) + 1 >= len(payload):
+            # Does not compress (Ex: random data). The other side's stream
+            # will not see this part, so the next compressed frame starts a new one
+            self.compressor = None
+            return frame
+        self.unconfirmed = tentative
+        return encode_frame(bytes((marker,)) + data[:-len(SYNC_TAIL)])
+
+    def _encode_shared(self, shared, frame):
+        # One standalone compressed copy of each of the message's frames, for every recipient
+        compressed = shared.compressed.get(frame)
+        if compressed is None:
+            compressed = self._standalone(frame)
+            shared.compressed[frame] = compressed
+        return compressed
+
+    def _standalone(self, frame):
+        # The frame compressed by itself (or as it is, if that is not smaller)
+        data = zlib.compress(memoryview(frame)[HEADER_SIZE:], self.level, WBITS)
+        return encode_frame(bytes((STANDALONE,)) + data) if len(data) + 1 < len(frame) - HEADER_SIZE else frame
+
+    def decode(self, payload):
+        """
+        This function decodes a frame payload, decompressing it first if needed
+
+        Returns: Message dictionary
+        Raises: ValueError if the payload cannot be decompressed or decoded,
+        or expands to more than max_size bytes
+        """
+        marker = payload[0] if payload else None
+        if marker == STREAM_START:
+            self.decompressor = zlib.decompressobj(WBITS)
+        if marker == STREAM or marker == STREAM_START:
+            if self.decompressor is None:
+                raise ValueError("Compressed frame before the start of the stream")
+            payload = self._inflate(self.decompressor, payload[1:] + SYNC_TAIL)
+        elif marker == STANDALONE:
+            payload = self._inflate(zlib.decompressobj(WBITS), payload[1:])
+        return self.codec.decode(payload)
+
+    def _inflate(self, decompressor, data):
+        try:
+            payload = decompressor.decompress(data, self.max_size)
+        except zlib.error as e:
+            raise ValueError(f"Cannot decompress frame: {e}") from None
+        if decompressor.unconsumed_tail:
+            raise ValueError(f"Compressed frame expands to more than {self.max_size} bytes")
+        return payload
+
+    def forget(self):
+        """
+        This function is called when a queued frame was dropped (see outbound.py)
+        """
+        self.codec.forget()
+        # The next compressed frame starts a new stream
+        self.compressor = None
+        self.unconfirmed = False
+
+    def confirm(self):
+        """
+        This function is called once every frame encoded so far has left the connection's queue
+        """
+        self.codec.confirm()
+        self.unconfirmed = False
+
+def choose_compression(offered):
+    """
+    This function picks the compression method for a hello request
+
+    Returns: The first method in offered that is supported, or None
+    """
+    if isinstance(offered, list):
+        for name in offered:
+            if name in COMPRESSIONS:
+                return name
+    return None
@@ -0,0 +1,150 @@
+"""
+Length-prefixed message framing shared by the client and server.
+
+Every message on the wire is a frame: a 4-byte big-endian payload length
+followed by the payload (a UTF-8 JSON document, or a binary message once a
+client negotiates the binary codec, see codec.py). TCP is a byte stream, so a
+single recv may hold several frames or only part of one. FrameDecoder buffers
+the stream and pulls out every complete frame, however the bytes arrive.
+
+Example frame for {"command": "ex"}:
+b'\\x00\\x00\\x00\\x11{"command": "ex"}'
+"""
+import json
+import struct
+from collections import deque
+
+# Frame header: payload length as an unsigned 32-bit big-endian integer
+HEADER = struct.Struct("!I")
+HEADER_SIZE = HEADER.size
+
+# Largest payload accepted by default (1 MiB)
+DEFAULT_MAX_FRAME_SIZE = 1024 * 1024
+
+# Bytes requested per recv call. Large reads let one call return many frames
+RECV_SIZE = 65536
+
+class FrameTooLarge(ValueError):
+    """
+    Raised when a frame header announces a payload above the maximum size
+    """
+
+def encode_frame(payload):
+    """
+    This function prefixes a payload (bytes) with its length
+
+    Returns: Frame bytes ready to send
+    """
+    return HEADER.pack(len(payload)) + payload
+
+def encode_message(message):
+    """
+    This function encodes a message dictionary as a JSON frame
+
+    Returns: Frame bytes ready to send
+    """
+    return encode_frame(json.dumps(message).encode('utf-8'))
+
+def decode_message(payload):
+    """
+    This function decodes a frame payload back to a message dictionary
+    """
+    return json.loads(payload)
+
+class FrameDecoder:
+    """
+    This class is an incremental frame decoder.
+
+    Bytes are fed in as they arrive from recv, and every complete frame is
+    returned. Partial frames stay buffered until the rest arrives. A frame
+    whose header is larger than max_frame_size raises FrameTooLarge before
+    any of its payload is buffered.
+    """
+
+    def __init__(self, max_frame_size=DEFAULT_MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self._buffer = bytearray()
+
+    @property
+    def buffered(self):
+        """
+        Number of bytes waiting for the rest of their frame
+        """
+        return len(self._buffer)
+
+    def remaining(self):
+        """
+        This function returns the bytes of a partly received frame (Ex: to
+        hand the connection to another process)
+        """
+        return bytes(self._buffer)
+
+    def feed(self, data):
+        """
+        This function adds received bytes to the decoder
+
+        Returns: List of complete frame payloads (may be empty)
+        """
+        buffer = self._buffer
+        buffer += data
+        frames = []
+        offset = 0
+        end = len(buffer)
+
+        # Pull out as many complete frames as the buffer holds
+        while end - offset >= HEADER_SIZE:
+            (length,) = HEADER.unpack_from(buffer, offset)
+            if length > self.max_frame_size:
+                raise FrameTooLarge(f"Frame of {length} bytes exceeds the {self.max_frame_size} byte limit")
+            start = offset + HEADER_SIZE
+            if end - start < length:
+                break
+            frames.append(bytes(buffer[start:start + length]))
+            offset = start + length
+
+        # Drop the consumed bytes in one step
+        if offset:
+            del buffer[:offset]
+        return frames
+
+class MessageReader:
+    """
+    This class reads whole messages from a blocking socket.
+
+    It keeps the decoder state between calls, so frames that arrive together
+    in one recv are returned one at a time by later calls. decode turns a
+    payload into a message (Ex: the decode of a negotiated codec, see codec.py).
+    """
+
+    def __init__(self, sock, max_frame_size=DEFAULT_MAX_FRAME_SIZE, decode=None):
+        self.sock = sock
+        self.decoder = FrameDecoder(max_frame_size)
+        self.decode = decode if decode is not None else decode_message
+        self._frames = deque()
+
+    @property
+    def ready(self):
+        """
+        The number of messages already received, which read_message returns without waiting
+        """
+        return len(self._frames)
+
+    def read_message(self):
+        """
+        This function returns the next message dictionary from the socket
+
+        Returns: Message dictionary, or None if the connection was closed
+        Raises: ValueError if a payload cannot be decoded (the next call reads the next frame)
+        """
+        while not self._frames:
+            data = self.sock.recv(RECV_SIZE)
+            if not data:
+                return None
+            self._frames.extend(self.decoder.feed(data))
+        return self.decode(self._frames.popleft())
+
+def send_message(sock, message):
+    """
+    This function sends a message dictionary as one frame on a socket
+    """
+    sock.sendall(encode_message(message))
@@ -0,0 +1,57 @@
+"""
+TLS settings shared by the client and server (stdlib ssl).
+
+The server is given a certificate and its private key (--tls-cert and
+--tls-key) and then only accepts TLS connections. Clients check the
+server's certificate against the system's trusted certificates, or
+against a certificate file given to them (Ex: a self-signed certificate:
+client.py --tls-ca cert.pem).
+
+Handshakes never run on the server's accept loop: the threaded engine
+does each one in the new connection's handler thread, and the asyncio
+engine does them on the event loop alongside other work.
+
+Reconnecting is cheap because sessions are resumed. With TLS 1.3 the
+server sends session tickets after the handshake, and with TLS 1.2 it keeps
+a session cache. A blocking client that passes its previous connection's
+session to connect() skips the certificate exchange and key agreement of
+a full handshake. (Each worker of a multi-process server has its own
+ticket keys, so a session is only resumed by the worker that issued it.)
+
+Ex: a self-signed certificate for testing:
+openssl req -x509 -newkey rsa:2048 -nodes -days 365 -subj "/CN=localhost" \\
+    -addext "subjectAltName=DNS:localhost,IP:127.0.0.1" -keyout key.pem -out cert.pem
+"""
+import ssl
+
+# Seconds a new connection has to finish its handshake
+HANDSHAKE_TIMEOUT = 10.0
+
+# Session tickets the server sends after a TLS 1.3 handshake (each resumes one reconnect)
+SESSION_TICKETS = 2
+
+def server_context(certfile, keyfile=None):
+    """
+    This function creates the server's TLS settings
+
+    Returns: ssl.SSLContext
+    Raises: OSError or ssl.SSLError if the certificate or key cannot be loaded
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certfile, keyfile)
+    context.num_tickets = SESSION_TICKETS
+    return context
+
+def client_context(cafile=None):
+    """
+    This function creates a client's TLS settings
+
+    cafile is a certificate file to trust (Ex: the server's self-signed
+    certificate); without it the system's trusted certificates are used.
+
+    Returns: ssl.SSLContext
+    """
+    context = ssl.create_default_context(cafile=cafile)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    return context
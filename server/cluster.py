@@ -0,0 +1,499 @@
+"""
+Multi-process mode (--workers N).
+
+The main process becomes the hub and starts N worker processes. Each worker
+runs the normal server engine on its own listening socket, bound to the same
+port with SO_REUSEPORT, so the kernel spreads new connections across the
+workers and every worker's Python runs on its own core.
+
+Workers talk to the hub over a Unix socket pair (the routing bus), using the
+same framing as clients. Bus messages are dictionaries with an "op":
+{"op": "join", "user": "user1"}
+
+The hub owns everything that has to be global:
+- The user store. A registration is checked and saved by the hub, and every
+  worker keeps an in-memory copy (ReplicaUserStore) for logins.
+- Presence. Workers report logins and logouts; the hub keeps the
+  username -> worker map and sends each coalesced, sequenced delta to every
+  worker, which passes it on to its own clients.
+- Message history and routing. A pm is stored by the hub, which gives it
+  its id, and sent to every worker (the one it arrived on sends the sender
+  its status). A dm is stored by the hub and sent on to the worker the
+  recipient is on, and its status goes back to the sender's worker.
+- Read cursors. A worker keeps each of its users' window of unacknowledged
+  dms (see delivery.py), tells the hub when dms are acknowledged, and asks
+  it for the dms a window fell behind on. The hub sends the delivered
+  receipts on to the senders' workers.
+- Room messages. Each worker indexes its own users' rooms (see rooms.py)
+  and the hub passes a room message on to every other worker, which sends
+  it to its members of the room.
+"""
+import os
+import sys
+import time
+import asyncio
+import signal
+import threading
+import subprocess
+from socket import socket, socketpair, AF_UNIX, SOCK_STREAM, SOL_SOCKET, SO_REUSEPORT
+from concurrent.futures import Future
+
+from common.framing import FrameDecoder, encode_message, decode_message, RECV_SIZE
+from common.codec import SharedMessage
+from presence import PresenceTracker, DEFAULT_PRESENCE_WINDOW
+from sessions import SessionRegistry
+from outbound import ThreadedConnection
+
+# Bus frames can carry a batch of stored messages or a chunk of the user store
+BUS_MAX_FRAME_SIZE = 256 * 1024 * 1024
+# Bytes that may wait to be sent to the hub before a worker gives up
+BUS_QUEUE_BYTES = 256 * 1024 * 1024
+# Users sent per frame when a worker starts
+USER_CHUNK = 10000
+# A worker that exits sooner than this after starting is not restarted
+MIN_WORKER_UPTIME = 2.0
+
+class WorkerBus:
+    """
+    This class is a worker's end of the routing bus.
+
+    publish() may be called from any thread; frames are written by a writer
+    thread (the same ThreadedConnection used for clients). A reader thread
+    receives from the hub and hands each batch of messages to dispatch,
+    which the engine sets so handlers run where the connections live
+    (directly for the threaded engine, loop.call_soon_threadsafe for
+    asyncio). handlers maps an op to a function(message).
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.link = ThreadedConnection(sock, "hub", BUS_QUEUE_BYTES, "disconnect")
+        self.decoder = FrameDecoder(BUS_MAX_FRAME_SIZE)
+        self.handlers = {}
+        self.dispatch = None
+        # Messages received with "ready" that are handled once the reader starts
+        self.backlog = []
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.next_request = 0
+
+    def publish(self, message):
+        """
+        This function sends a message to the hub without waiting
+        """
+        self.link.send_frame(encode_message(message))
+
+    def register(self, username, hashed):
+        """
+        This function asks the hub to register username once its password is hashed
+
+        Returns: Future with the password record if the hub added the user,
+        or None if the username is taken
+        """
+        registered = Future()
+
+        def send(done):
+            try:
+                record = done.result()
+            except Exception as e:
+                registered.set_exception(e)
+                return
+            with self.lock:
+                self.next_request += 1
+                request = self.next_request
+                self.requests[request] = (registered, record)
+            self.publish({"op": "register", "req": request, "user": username, "record": record})
+
+        hashed.add_done_callback(send)
+        return registered
+
+    def _receive(self):
+        data = self.sock.recv(RECV_SIZE)
+        if not data:
+            print("Lost the connection to the hub")
+            os._exit(1)
+        return [decode_message(payload) for payload in self.decoder.feed(data)]
+
+    def sync(self):
+        """
+        This function handles the hub's start-up messages (the user store
+        and presence state) until the hub says the worker is ready
+        """
+        while True:
+            messages = self._receive()
+            for index, message in enumerate(messages):
+                if message["op"] == "ready":
+                    self.backlog = messages[index + 1:]
+                    return
+                self.handlers[message["op"]](message)
+
+    def start(self, dispatch):
+        """
+        This function starts the reader thread (called by the engine)
+        """
+        self.dispatch = dispatch
+        threading.Thread(target=self._read_loop, name="bus-reader", daemon=True).start()
+
+    def _read_loop(self):
+        messages = self.backlog
+        while True:
+            batch = []
+            for message in messages:
+                if message["op"] == "reply":
+                    # Futures are thread-safe, so replies are handled right here
+                    with self.lock:
+                        registered, record = self.requests.pop(message["req"])
+                    registered.set_result(record if message["ok"] else None)
+                else:
+                    batch.append(message)
+            if batch:
+                self.dispatch(self._handle, batch)
+            messages = self._receive()
+
+    def _handle(self, messages):
+        for message in messages:
+            self.handlers[message["op"]](message)
+
+class ClusterPresence:
+    """
+    This class is a worker's presence tracker (PresenceTracker's interface).
+
+    sessions holds this worker's own logged-in users. Logins and logouts are
+    reported to the hub, and the hub's batches keep a copy of the global
+    active user set here, so a login response and the deltas after it line
+    up the same way as with one process.
+    """
+
+    def __init__(self, sessions, bus):
+        self.sessions = sessions
+        self.bus = bus
+        self.lock = threading.Lock()
+        self.online = set()
+        self.seq = 0
+
+    def login(self, username, conn):
+        with self.lock:
+            self.sessions.add(username, conn)
+            self.bus.publish({"op": "join", "user": username})
+            # The user's own join arrives in a later batch
+            return sorted(self.online | {username}), self.seq
+
+    def logout(self, username, conn=None):
+        with self.lock:
+            if self.sessions.remove(username, conn) is None:
+                return False
+            self.bus.publish({"op": "leave", "user": username})
+            return True
+
+    def disconnect(self, conn):
+        username = self.sessions.username_for(conn)
+        if username is None or not self.logout(username, conn):
+            return None
+        return username
+
+    def evict(self, message):
+        """
+        This function drops a local session because the user logged in on another worker
+
+        (The same as logging in again in one process: the old connection
+        stays open but no longer gets the user's messages.)
+        """
+        with self.lock:
+            self.sessions.remove(message["user"])
+
+    def is_online(self, username):
+        return username in self.online or username in self.sessions
+
+    def apply(self, message):
+        """
+        This function applies a presence batch from the hub and passes it to local users
+        """
+        batch = message["batch"]
+        with self.lock:
+            if batch["type"] == "presence_snapshot":
+                # Sent once when the worker starts, before it has any users
+                self.online = set(batch["active_users"])
+                self.seq = batch["seq"]
+                return
+            self.seq = batch["seq"]
+            self.online.difference_update(batch["left"])
+            self.online.update(batch["joined"])
+            shared = SharedMessage(batch)
+            for user, user_conn in self.sessions.snapshot():
+                try:
+                    user_conn.send_message(shared)
+                except ConnectionError:
+                    pass
+
+    def flush(self):
+        pass # Batches are built by the hub
+
+    def snapshot_message(self):
+        with self.lock:
+            return {"type": "presence_snapshot", "seq": self.seq, "active_users": sorted(self.online)}
+
+class HubPresence(PresenceTracker):
+    """
+    This class is the hub's presence tracker.
+
+    Its sessions map username -> WorkerLink. Batches are sent once to every
+    worker instead of once to every user.
+    """
+
+    def __init__(self, sessions, hub, window=DEFAULT_PRESENCE_WINDOW, schedule=None):
+        super().__init__(sessions, window, schedule)
+        self.hub = hub
+
+    def join(self, username, link):
+        """
+        This function records that username logged in on a worker
+
+        Returns: The worker the user was on before (or None)
+        """
+        with self.lock:
+            previous = self.sessions.add(username, link)
+            self._note(username, joined=True)
+            return previous
+
+    def _send(self, batch):
+        self.hub.broadcast({"op": "presence", "batch": batch})
+
+class WorkerLink(asyncio.Protocol):
+    """
+    This class is the hub's end of one worker's bus connection
+    """
+
+    def __init__(self, hub, index):
+        self.hub = hub
+        self.index = index
+        self.transport = None
+        self.decoder = FrameDecoder(BUS_MAX_FRAME_SIZE)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        for payload in self.decoder.feed(data):
+            self.hub.handle(self, decode_message(payload))
+
+    def connection_lost(self, exc):
+        self.hub.worker_lost(self)
+
+    def send(self, message):
+        if not self.transport.is_closing():
+            self.transport.write(encode_message(message))
+
+class Hub:
+    """
+    This class is the hub: it starts the workers and routes between them.
+
+    It runs on one asyncio event loop. users is the real UserStore, history
+    the MessageLog, and worker_command the command line that starts a
+    worker (the bus socket's fd is added to it). When the hub stops, each
+    worker has stop_timeout seconds to drain its clients before it is killed.
+    """
+
+    def __init__(self, users, history, workers, worker_command, window=DEFAULT_PRESENCE_WINDOW,
+                 replay_public=20, stop_timeout=10):
+        self.users = users
+        self.history = history
+        self.workers = workers
+        self.worker_command = worker_command
+        self.window = window
+        self.replay_public = replay_public
+        self.stop_timeout = stop_timeout
+        self.links = {}
+        self.processes = {}
+        self.started = {}
+        self.stopping = False
+        self.loop = None
+        self.done = None
+        self.presence = None
+
+    async def run(self):
+        """
+        This function starts every worker and routes until shut down
+        """
+        self.loop = asyncio.get_running_loop()
+        self.done = self.loop.create_future()
+        self.presence = HubPresence(SessionRegistry(), self, self.window, self.loop.call_later)
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            self.loop.add_signal_handler(signum, self.stop)
+        # The listening sockets belong to the workers, so they cannot be handed to a new hub
+        self.loop.add_signal_handler(signal.SIGUSR2, print, "Hot restart is not supported with --workers")
+        for index in range(self.workers):
+            await self._spawn(index)
+        try:
+            await self.done
+        finally:
+            self.stopping = True
+            for process in self.processes.values():
+                process.terminate()
+            for process in self.processes.values():
+                try:
+                    process.wait(timeout=self.stop_timeout)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+
+    def stop(self):
+        self.stopping = True
+        if not self.done.done():
+            self.done.set_result(None)
+
+    async def _spawn(self, index):
+        hub_sock, worker_sock = socketpair(AF_UNIX, SOCK_STREAM)
+        command = self.worker_command + ["--worker-fd", str(worker_sock.fileno()), "--worker-index", str(index)]
+        self.processes[index] = subprocess.Popen(command, pass_fds=(worker_sock.fileno(),))
+        self.started[index] = time.monotonic()
+        worker_sock.close()
+        _, link = await self.loop.connect_accepted_socket(lambda: WorkerLink(self, index), hub_sock)
+        self.links[index] = link
+
+        # Start-up state: the user store, then presence
+        items = self.users.items()
+        for start in range(0, len(items), USER_CHUNK):
+            link.send({"op": "users", "items": items[start:start + USER_CHUNK]})
+        link.send({"op": "presence", "batch": self.presence.snapshot_message()})
+        link.send({"op": "ready"})
+
+    def worker_lost(self, link):
+        """
+        This function logs out every user of a worker that exited, and starts a new one
+        """
+        if self.links.get(link.index) is not link:
+            return
+        del self.links[link.index]
+        for username, user_link in self.presence.sessions.snapshot():
+            if user_link is link:
+                self.presence.logout(username, link)
+        if self.stopping:
+            return
+        self.loop.create_task(self._replace(link.index))
+
+    async def _replace(self, index):
+        """
+        This function starts a new worker once the lost one has exited
+
+        A worker may close its bus socket a while before its process ends, so
+        the wait runs on the default executor and the hub keeps routing for
+        the other workers meanwhile. The process stays in self.processes
+        until it exits, so a hub that stops meanwhile still terminates it.
+        """
+        process = self.processes[index]
+        await self.loop.run_in_executor(None, process.wait)
+        self.processes.pop(index, None)
+        print(f"Worker {index} exited with status {process.returncode}")
+        if self.stopping:
+            return
+        if time.monotonic() - self.started[index] < MIN_WORKER_UPTIME:
+            print("Worker failed at start-up; shutting down")
+            self.stop()
+            return
+        await self._spawn(index)
+
+    def broadcast(self, message, exclude=None):
+        frame = encode_message(message)
+        for link in list(self.links.values()):
+            if link is not exclude and not link.transport.is_closing():
+                link.transport.write(frame)
+
+    def handle(self, link, message):
+        """
+        This function handles one message from a worker
+        """
+        op = message["op"]
+        username = message.get("user")
+
+        if op == "join":
+            previous = self.presence.join(username, link)
+            if previous is not None and previous is not link:
+                previous.send({"op": "evict", "user": username})
+
+        elif op == "leave":
+            if self.presence.logout(username, link):
+                self.history.save_cursor(username)
+
+        elif op == "register":
+            added = self.users.add(username, message["record"])
+            link.send({"op": "reply", "req": message["req"], "ok": added})
+            if added:
+                self.broadcast({"op": "users", "items": [[username, message["record"]]]}, exclude=link)
+
+        elif op == "user":
+            # A worker changed a record (Ex: rehashed a plaintext password)
+            self.users.set(username, message["record"])
+            self.broadcast({"op": "users", "items": [[username, message["record"]]]}, exclude=link)
+
+        elif op == "pm":
+            # Stored first for its id; the worker it came from sends it to its own users too
+            record = self.history.append(message["message"])
+            self.broadcast({"op": "pm", "message": dict(message["message"], id=record["id"])})
+
+        elif op == "room":
+            # Rooms are not stored; each worker sends it to its own members of the room
+            self.broadcast(message, exclude=link)
+
+        elif op == "dm":
+            record = self.history.append(dict(message["message"], to=message["to"]))
+            target = self.presence.sessions.get(message["to"])
+            if target is not None:
+                # The recipient's worker sends the sender's status back (see "sent")
+                target.send({"op": "deliver", "user": message["to"], "id": record["id"],
+                             "message": message["message"]})
+            else:
+                link.send({"op": "sent", "user": message["message"]["from"], "id": record["id"],
+                           "status": "message_stored"})
+
+        elif op == "sent":
+            # A dm's status, with its id, for the worker the sender is on
+            target = self.presence.sessions.get(username)
+            if target is not None:
+                target.send(message)
+
+        elif op == "read":
+            # dms acknowledged by username: the cursor moves, and their senders get receipts
+            self.history.mark_read(username, message["id"])
+            for sender, ids in message["receipts"].items():
+                target = self.presence.sessions.get(sender)
+                if target is not None:
+                    target.send({"op": "delivered", "user": sender, "to": username, "ids": ids})
+
+        elif op == "replay":
+            # A login replay (with the last public messages), or the dms a window fell behind on
+            unread_ids, unread = self.history.unread(username, message["limit"], message.get("after"))
+            ids = unread_ids
+            if message.get("public"):
+                ids = self.history.recent_public(self.replay_public) + unread_ids
+            link.send({"op": "replay", "user": username, "records": list(self.history.read(ids)),
+                       "more": unread > len(unread_ids), "resets": message["resets"]})
+
+        elif op == "history":
+            before = message["before"]
+            if message["before_time"] is not None:
+                before = self.history.id_before_time(message["before_time"])
+            ids, more = self.history.page(username, before, message["limit"])
+            link.send({"op": "history", "user": username, "records": list(self.history.read(ids)),
+                       "before": before, "more": more})
+
+def reuse_port_probe(port_number):
+    """
+    This function binds the port with SO_REUSEPORT (without listening)
+
+    The hub holds this socket so a port that is already taken fails at once,
+    instead of in every worker.
+
+    Returns: The bound socket
+    """
+    probe = socket()
+    probe.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+    probe.bind(('', port_number))
+    return probe
+
+def worker_command(argv):
+    """
+    This function builds the command line for a worker from the hub's own
+
+    Returns: Argument list (the bus fd is added by the hub)
+    """
+    # A later --workers wins, so the worker does not start workers of its own
+    return [sys.executable, os.path.abspath(sys.modules["__main__"].__file__)] + list(argv) + ["--workers", "1"]
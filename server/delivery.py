@@ -0,0 +1,119 @@
+"""
+Delivery acknowledgements for dms.
+
+Every pm and dm gets its id from the history log (see history.py), and the
+frames sent to clients carry it:
+{"type": "dm", "from": "user1", "message": "Hello", "id": 42}
+
+A client acknowledges the dms it received with the id of the newest one.
+Frames on a connection arrive in order, so one ack covers every dm sent
+before it and a client only needs to send one per batch of frames it reads:
+{"command": "ack", "username": "user2", "id": 42}
+
+Only an acknowledged dm moves the recipient's read cursor, so a dm that was
+queued but never reached the client (Ex: the connection dropped) is sent
+again at the next login. A dm may therefore arrive twice; clients drop ids
+they have already seen (see client/chat_client.py). Once the recipient has
+acknowledged a dm, its sender is told, if they are logged in:
+{"type": "delivered", "to": "user2", "ids": [41, 42]}
+
+Each logged-in user has a DeliveryWindow: the dms sent on their connection
+and not acknowledged yet, at most size of them (set with --ack-window).
+While the window is full, new dms are only stored and the window falls
+behind; as acknowledgements make room, the dms it missed are read back from
+the history log, in order. So a client that stops acknowledging holds a
+window of ids on the server, never a growing buffer of messages.
+"""
+import threading
+from collections import deque
+
+# dms sent on one connection that may wait for an acknowledgement
+DEFAULT_ACK_WINDOW = 128
+
+class DeliveryWindow:
+    """
+    This class is the dms sent to one logged-in user's connection that they have not acknowledged.
+
+    pending holds (id, sender) pairs, oldest first. behind is True while dms
+    stored in the history have not been sent (a new window starts behind,
+    until its login replay is sent). Callers hold self.lock from the check
+    to the sends, so dms are sent in id order.
+
+    dropped is the connection's count of frames dropped by the slow consumer
+    policy (see outbound.py) when the window was last reset: once it changes,
+    a pending dm may never have been sent, so acknowledgements cannot be
+    trusted to cover it.
+    """
+
+    def __init__(self, size=DEFAULT_ACK_WINDOW, dropped=0):
+        self.size = size
+        self.lock = threading.Lock()
+        self.pending = deque()
+        # Id of the newest dm sent since the window started (or was reset)
+        self.newest = None
+        self.behind = True
+        # With workers: the missed dms were asked of the hub and have not arrived yet
+        self.requested = False
+        self.dropped = dropped
+        # Times the window was reset, so an answer the hub sent before a reset is not trusted
+        self.resets = 0
+
+    def room(self):
+        """
+        This function returns how many more dms may be sent before the window is full
+        """
+        return self.size - len(self.pending)
+
+    def open(self):
+        """
+        This function checks whether a new dm may be sent at once
+
+        Returns: False if the window is full or behind (the dm waits in the history)
+        """
+        return not self.behind and len(self.pending) < self.size
+
+    def sent(self, message_id, sender):
+        """
+        This function records a dm about to be sent
+
+        Returns: False if it was already sent (Ex: it was in a replay as well)
+        """
+        if self.newest is not None and message_id <= self.newest:
+            return False
+        self.pending.append((message_id, sender))
+        self.newest = message_id
+        return True
+
+    def acknowledge(self, message_id):
+        """
+        This function removes the dms up to message_id, which the client received
+
+        Returns: List of (id, sender) acknowledged, oldest first
+        """
+        acknowledged = []
+        while self.pending and self.pending[0][0] <= message_id:
+            acknowledged.append(self.pending.popleft())
+        return acknowledged
+
+    def reset(self, dropped):
+        """
+        This function forgets the pending dms after frames were dropped
+
+        They stay unread in the history, and are sent again as the window catches up.
+        """
+        self.pending.clear()
+        self.newest = None
+        self.behind = True
+        self.dropped = dropped
+        self.resets += 1
+
+def receipts(acknowledged):
+    """
+    This function groups acknowledged dms by sender, for their delivered receipts
+
+    Returns: Dictionary of sender -> list of ids
+    """
+    grouped = {}
+    for message_id, sender in acknowledged:
+        grouped.setdefault(sender, []).append(message_id)
+    return grouped
@@ -0,0 +1,269 @@
+"""
+Graceful shutdown (drain) and hot restart.
+
+Drain (SIGTERM, or ^C): the server stops accepting, tells every client
+    {"type": "shutdown", "reconnect": false}
+writes what is still queued for each client (for up to --drain-timeout
+seconds), logs everyone out (saving their read cursors) and writes any
+pending user store records before it exits.
+
+Hot restart (SIGUSR2): the server starts a new copy of itself (Ex: after a
+deploy) and hands it the listening socket and the client connections, so
+clients stay connected and logged in:
+1. The new process is started with --handoff-fd and says it is ready once
+   its code is loaded and its arguments are checked. If it fails before
+   that, the old process keeps serving.
+2. The old process stops accepting (new connections wait in the listen
+   queue) and stops reading from clients, finishes password checks that
+   are running, and writes what is queued for each client.
+3. It saves read cursors, closes the user store and history, and sends the
+   new process the listening sockets, the presence state, the username ids
+   of the binary codec, and for each connection its socket and session:
+   the user logged in on it, their rooms, the codec state and any partly
+   received request (see connection_state).
+4. The new process opens the stores, takes over the connections, sends a
+   presence update for users that did not move, and starts serving. The
+   old process exits.
+Some connections cannot move. They are told
+    {"type": "shutdown", "reconnect": true}
+and closed, and the client logs in again to the new process:
+- TLS connections (the encryption state stays in the old process)
+- connections whose client has started compressing what it sends (its
+  deflate stream cannot be copied)
+- clients too slow to take their queued frames within the drain timeout
+
+Sockets are passed over a Unix socket pair (SCM_RIGHTS), in frames like the
+ones clients use (see common/framing.py):
+{"op": "ready"}                                          new -> old
+{"op": "state", "presence_seq": 7, "active_users": [...], "names": [...]}
+{"op": "listeners", "fds": 2}
+{"op": "connections", "fds": 2, "connections": [{...}, {...}]}
+{"op": "done"}
+"""
+import os
+import sys
+import base64
+import subprocess
+from collections import deque
+from socket import socket, socketpair, send_fds, recv_fds, AF_UNIX, SOCK_STREAM, MSG_CTRUNC
+
+from common.framing import FrameDecoder, encode_message, decode_message, RECV_SIZE
+from common.codec import SharedMessage, BINARY, new_codec
+from common.compression import CompressedCodec, DEFAULT_COMPRESSION_LEVEL
+
+# Seconds to write what is queued for clients when the server stops (set with --drain-timeout)
+DEFAULT_DRAIN_TIMEOUT = 10.0
+
+# Seconds the new process of a hot restart has to load and say it is ready
+READY_TIMEOUT = 30.0
+
+# Sockets sent per frame (the kernel allows 253 per message)
+FDS_PER_FRAME = 200
+
+# The state frame holds every username id (Ex: a million names is about 20 MB)
+HANDOFF_MAX_FRAME_SIZE = 1024 * 1024 * 1024
+
+# Sent to every client when the server stops, or when its connection cannot move to the new process
+SHUTDOWN = SharedMessage({"type": "shutdown", "reconnect": False})
+RESTARTING = SharedMessage({"type": "shutdown", "reconnect": True})
+
+def successor_command(argv):
+    """
+    This function builds the new process's command line from the running server's own
+
+    Returns: Argument list (the handoff fd is added by start_successor)
+    """
+    args = list(argv)
+    # A server that was itself started by a hot restart drops its old --handoff-fd
+    if "--handoff-fd" in args:
+        index = args.index("--handoff-fd")
+        del args[index:index + 2]
+    return [sys.executable, os.path.abspath(sys.modules["__main__"].__file__)] + args
+
+def start_successor(argv):
+    """
+    This function starts the new process of a hot restart and waits until it is ready
+
+    Returns: The old process's end of the handoff socket, or None if the new
+    process exited or did not get ready within READY_TIMEOUT seconds
+    """
+    channel, child_end = socketpair(AF_UNIX, SOCK_STREAM)
+    command = successor_command(argv) + ["--handoff-fd", str(child_end.fileno())]
+    process = subprocess.Popen(command, pass_fds=(child_end.fileno(),))
+    child_end.close()
+    channel.settimeout(READY_TIMEOUT)
+    try:
+        message, fds = HandoffReader(channel).read()
+        ready = message.get("op") == "ready"
+    except (ConnectionError, OSError, ValueError):
+        ready = False
+    if not ready:
+        print("The new server process did not start; still serving")
+        process.kill()
+        process.wait()
+        channel.close()
+        return None
+    channel.settimeout(None)
+    print(f"Handing over to the new server process (pid {process.pid})")
+    return channel
+
+def send_frame(sock, message, fds=()):
+    """
+    This function sends one handoff frame, with file descriptors attached to its first byte
+    """
+    frame = encode_message(message)
+    sent = send_fds(sock, [frame], list(fds)) if fds else 0
+    if sent < len(frame):
+        sock.sendall(memoryview(frame)[sent:])
+
+class HandoffReader:
+    """
+    This class reads handoff frames and the file descriptors sent with them.
+
+    The descriptors of a frame arrive with its first bytes, so they are kept
+    in order and each frame takes as many as its "fds" field says.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.decoder = FrameDecoder(HANDOFF_MAX_FRAME_SIZE)
+        self.messages = deque()
+        self.fds = deque()
+
+    def read(self):
+        """
+        This function returns the next frame
+
+        Returns: (message dictionary, list of file descriptors)
+        Raises: ConnectionError if the other process closed the socket
+        """
+        while not self.messages:
+            data, fds, flags, _ = recv_fds(self.sock, RECV_SIZE, FDS_PER_FRAME)
+            if flags & MSG_CTRUNC:
+                raise ConnectionError("File descriptors were lost in the handoff")
+            self.fds.extend(fds)
+            if not data:
+                raise ConnectionError("The other server process closed the handoff socket")
+            self.messages.extend(decode_message(payload) for payload in self.decoder.feed(data))
+        message = self.messages.popleft()
+        return message, [self.fds.popleft() for _ in range(message.get("fds", 0))]
+
+def connection_state(addr, codec, username, rooms, buffered, pending):
+    """
+    This function describes a connection for the new process of a hot restart
+
+    buffered is the start of a partly received frame, and pending the
+    payloads received but not processed yet.
+
+    Returns: State dictionary, or None if the connection cannot move (see
+    the top of this file)
+    """
+    compression = isinstance(codec, CompressedCodec)
+    if compression:
+        if codec.decompressor is not None:
+            return None # The client's deflate stream cannot be copied
+        codec = codec.codec
+    state = {
+        "addr": list(addr) if addr else None,
+        "codec": codec.name,
+        "compression": compression,
+        "user": username,
+        "rooms": rooms,
+        "buffered": base64.b64encode(buffered).decode('ascii'),
+        "pending": [base64.b64encode(payload).decode('ascii') for payload in pending],
+    }
+    if codec.name == BINARY:
+        # The usernames this client has been told, and the ids it gave its own
+        state["known"] = list(codec.known)
+        state["received"] = list(codec.received.items())
+    return state
+
+def restore_codec(state, names, threshold, level, max_size):
+    """
+    This function rebuilds a moved connection's codec
+
+    Frames to the client start a new deflate stream, which the client
+    expects after any STREAM_START frame (see common/compression.py).
+
+    Returns: Codec for the connection
+    """
+    codec = new_codec(state["codec"], names)
+    if state["codec"] == BINARY:
+        codec.known = set(state["known"])
+        codec.received = {number: name for number, name in state["received"]}
+    if state["compression"]:
+        # The client may still send compressed frames, even if this process does not compress
+        codec = CompressedCodec(codec, threshold, level or DEFAULT_COMPRESSION_LEVEL, max_size)
+    return codec
+
+def restored_input(state):
+    """
+    This function decodes a moved connection's received bytes
+
+    Returns: (start of a partly received frame, list of payloads to process first)
+    """
+    return (base64.b64decode(state["buffered"]),
+            [base64.b64decode(payload) for payload in state["pending"]])
+
+def send_handoff(channel, listener_fds, presence_seq, active_users, names, moving):
+    """
+    This function sends everything the new process takes over
+
+    listener_fds are the listening sockets (Ex: IPv4 and IPv6), and moving
+    a list of (state, socket fd) for the connections that move.
+    """
+    send_frame(channel, {"op": "state", "presence_seq": presence_seq, "active_users": active_users,
+                         "names": names})
+    send_frame(channel, {"op": "listeners", "fds": len(listener_fds)}, listener_fds)
+    for start in range(0, len(moving), FDS_PER_FRAME):
+        batch = moving[start:start + FDS_PER_FRAME]
+        send_frame(channel, {"op": "connections", "fds": len(batch), "connections": [state for state, _ in batch]},
+                   [fd for _, fd in batch])
+    send_frame(channel, {"op": "done"})
+
+class Inheritance:
+    """
+    This class is what the new process of a hot restart received from the old one.
+
+    listeners: the listening sockets
+    presence_seq, active_users: presence as the clients last heard it
+    names: usernames in binary codec id order
+    connections: list of (state, socket) for the connections that moved
+    """
+
+    def __init__(self):
+        self.listeners = []
+        self.presence_seq = 0
+        self.active_users = []
+        self.names = []
+        self.connections = []
+
+def receive_handoff(fd):
+    """
+    This function is the new process's side of a hot restart: it says it
+    is ready, then waits for the old process to hand everything over
+
+    Returns: Inheritance
+    Raises: ConnectionError if the old process stopped before it was done
+    """
+    channel = socket(fileno=fd)
+    inheritance = Inheritance()
+    try:
+        send_frame(channel, {"op": "ready"})
+        reader = HandoffReader(channel)
+        while True:
+            message, fds = reader.read()
+            op = message["op"]
+            if op == "state":
+                inheritance.presence_seq = message["presence_seq"]
+                inheritance.active_users = message["active_users"]
+                inheritance.names = message["names"]
+            elif op == "listeners":
+                inheritance.listeners = [socket(fileno=listener_fd) for listener_fd in fds]
+            elif op == "connections":
+                for state, conn_fd in zip(message["connections"], fds):
+                    inheritance.connections.append((state, socket(fileno=conn_fd)))
+            elif op == "done":
+                return inheritance
+    finally:
+        channel.close()
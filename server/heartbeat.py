@@ -0,0 +1,208 @@
+"""
+Heartbeats, idle/read timeouts and reaping of dead connections.
+
+A client that vanishes without closing its connection (Ex: its machine
+lost power) would otherwise stay logged in forever. The server watches
+when it last received anything from each connection:
+- After --ping-interval seconds of silence it sends {"type": "ping"}, and
+  the client answers {"command": "pong"} (any request counts as well).
+- After --idle-timeout seconds of silence the connection is reaped.
+- A frame that has started arriving must be complete within
+  --read-timeout seconds (Ex: a client that sends half a frame and stops).
+Reaping closes the connection, which logs the user out, so every other
+client gets the usual presence update.
+
+The checks run on one TimerWheel per process, advanced by a single timer
+thread (threaded engine) or by the event loop (asyncio engine), instead of
+a timer thread per connection. Each connection has one timer at a time,
+set for the earliest moment something could be due; receiving data only
+records the time, and the timer looks again when it fires.
+
+TCP keepalive (--tcp-keepalive SECONDS) additionally lets the kernel
+notice dead peers of connections that have data stuck in their send queue.
+"""
+import math
+import time
+import threading
+from socket import SOL_SOCKET, SO_KEEPALIVE, IPPROTO_TCP
+import socket as socket_module
+
+from common.codec import SharedMessage
+from metrics import connections_reaped
+
+# Seconds of silence before a ping, before reaping, and to finish a started frame
+DEFAULT_PING_INTERVAL = 30.0
+DEFAULT_IDLE_TIMEOUT = 90.0
+DEFAULT_READ_TIMEOUT = 30.0
+# Seconds of silence before the kernel sends keepalive probes (0 disables)
+DEFAULT_TCP_KEEPALIVE = 60
+# Keepalive probes sent, and seconds between them, before the kernel drops the connection
+KEEPALIVE_PROBES = 4
+KEEPALIVE_INTERVAL = 15
+
+# Timer wheel resolution in seconds, and number of slots (one turn is 512 seconds)
+DEFAULT_TICK = 1.0
+DEFAULT_SLOTS = 512
+
+# Every ping is the same frame, so it is encoded once per codec for the whole process
+PING = SharedMessage({"type": "ping"})
+
+class TimerWheel:
+    """
+    This class is a hashed timing wheel: timers are kept in a ring of
+    slots, one slot per tick, so adding a timer and running the due ones
+    are O(1) per timer however many timers there are.
+
+    A timer further away than one turn of the wheel stays in its slot until
+    its tick comes round. schedule() and cancel() may be called from any
+    thread; callbacks run on whichever thread calls advance().
+    """
+
+    def __init__(self, tick=DEFAULT_TICK, slots=DEFAULT_SLOTS):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.ticks = 0
+        self.started = time.monotonic()
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def schedule(self, delay, callback, *args):
+        """
+        This function runs callback(*args) after delay seconds (rounded up to a tick)
+
+        Returns: The timer, for cancel()
+        """
+        with self.lock:
+            # Ticks count from when the wheel started, and the current tick may be partly over
+            due = (time.monotonic() - self.started + delay) / self.tick
+            timer = [max(self.ticks + 1, math.ceil(due)), callback, args]
+            self.slots[timer[0] % len(self.slots)].append(timer)
+            self.count += 1
+        return timer
+
+    def cancel(self, timer):
+        """
+        This function stops a timer from running (it is dropped when its slot comes round)
+        """
+        timer[1] = None
+
+    def advance(self, now=None):
+        """
+        This function runs every timer that is due
+
+        Returns: Number of callbacks run
+        """
+        now = time.monotonic() if now is None else now
+        target = int((now - self.started) / self.tick)
+        due = []
+        with self.lock:
+            while self.ticks < target:
+                self.ticks += 1
+                index = self.ticks % len(self.slots)
+                waiting = []
+                for timer in self.slots[index]:
+                    (due if timer[0] <= self.ticks else waiting).append(timer)
+                self.slots[index] = waiting
+            self.count -= len(due)
+        ran = 0
+        for _, callback, args in due:
+            if callback is None:
+                continue # Cancelled
+            try:
+                callback(*args)
+            except Exception as e:
+                print(f"Timer callback failed: {e!r}")
+            ran += 1
+        return ran
+
+    def __len__(self):
+        return self.count
+
+class HeartbeatMonitor:
+    """
+    This class pings silent connections and reaps dead ones.
+
+    A watched connection provides:
+    last_received: time.monotonic() of the last data received
+    frame_started: time.monotonic() when a partly received frame started, or None
+    last_ping: time.monotonic() of the last ping sent (0 if none)
+    closed: True once the connection is closed
+    send_message(message) and abort()
+
+    A timeout of 0 disables that check.
+    """
+
+    def __init__(self, wheel, ping_interval=DEFAULT_PING_INTERVAL, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT):
+        self.wheel = wheel
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        self.read_timeout = read_timeout
+
+    @property
+    def enabled(self):
+        return bool(self.ping_interval or self.idle_timeout or self.read_timeout)
+
+    def watch(self, conn):
+        """
+        This function starts watching a new connection
+        """
+        if self.enabled:
+            self._schedule(conn, time.monotonic())
+
+    def _schedule(self, conn, now):
+        # The timer is set for the earliest check that could be due
+        deadlines = []
+        if self.idle_timeout:
+            deadlines.append(conn.last_received + self.idle_timeout)
+        if self.read_timeout and conn.frame_started is not None:
+            deadlines.append(conn.frame_started + self.read_timeout)
+        if self.ping_interval:
+            deadlines.append(max(conn.last_received, conn.last_ping) + self.ping_interval)
+        if self.read_timeout:
+            # A frame may start arriving at any time; look again within one read timeout
+            deadlines.append(now + self.read_timeout)
+        self.wheel.schedule(max(0.0, min(deadlines) - now), self._check, conn)
+
+    def _check(self, conn):
+        """
+        This function is a connection's timer: it reaps, pings, or sets the next timer
+        """
+        if conn.closed:
+            return # Nothing more to watch
+        now = time.monotonic()
+        if self.idle_timeout and now - conn.last_received >= self.idle_timeout:
+            self._reap(conn, "idle")
+            return
+        if self.read_timeout and conn.frame_started is not None and now - conn.frame_started >= self.read_timeout:
+            self._reap(conn, "read_timeout")
+            return
+        if self.ping_interval and now - max(conn.last_received, conn.last_ping) >= self.ping_interval:
+            conn.last_ping = now
+            try:
+                conn.send_message(PING)
+            except ConnectionError:
+                return # Closed meanwhile
+        self._schedule(conn, now)
+
+    def _reap(self, conn, reason):
+        # Closing the connection logs the user out (the engine calls end_session)
+        print(f"Reaping connection {conn.addr} ({reason})")
+        connections_reaped.inc(reason)
+        conn.abort()
+
+def set_keepalive(sock, idle):
+    """
+    This function turns on TCP keepalive for a connected socket
+
+    idle is the seconds of silence before the first probe (0 leaves keepalive off).
+    Options the platform lacks (Ex: TCP_KEEPIDLE on some systems) are skipped.
+    """
+    if not idle:
+        return
+    sock.setsockopt(SOL_SOCKET, SO_KEEPALIVE, 1)
+    for name, value in (("TCP_KEEPIDLE", idle), ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL),
+                        ("TCP_KEEPCNT", KEEPALIVE_PROBES)):
+        option = getattr(socket_module, name, None)
+        if option is not None:
+            sock.setsockopt(IPPROTO_TCP, option, value)
@@ -0,0 +1,388 @@
+"""
+Persistent message history.
+
+Every pm and dm is appended to a segmented log in HISTORY_DIR. Each segment
+is a file of records in the same framing as the wire protocol (a 4-byte
+length, then a JSON document), named after the id of its first message:
+history/000000000001.seg
+history/000000004213.seg
+
+Messages get increasing ids. A record looks like:
+{"id": 7, "time": 1700000000.5, "type": "dm", "from": "user1", "to": "user2", "message": "Hello"}
+
+Read cursors are records too: {"type": "read", "user": "user2", "id": 7}
+means user2 has acknowledged every dm up to id 7 (see delivery.py). A dm
+sent to an offline user, or sent but not acknowledged, stays unread and is
+replayed at the next login.
+
+Only the index is kept in memory (arrays of ids, offsets and times). Message
+bodies are read back one record at a time, from an mmap of a full segment
+or with os.pread from the segment still being written. When a segment
+reaches segment_bytes a new one is started; with max_segments set, the
+oldest segments are deleted.
+"""
+import os
+import mmap
+import time
+import bisect
+import threading
+from array import array
+
+from common.framing import HEADER, HEADER_SIZE, encode_message, decode_message
+from user_store import _fsync_directory
+
+HISTORY_DIR = "history"
+SEGMENT_SUFFIX = ".seg"
+
+DEFAULT_SEGMENT_BYTES = 16 * 1024 * 1024
+# Number of segments kept (0 keeps everything)
+DEFAULT_MAX_SEGMENTS = 0
+DEFAULT_SYNC_INTERVAL = 0.2
+
+# Public messages replayed at login
+DEFAULT_REPLAY_PUBLIC = 20
+# Most unread dms one unread() call returns by default
+MAX_REPLAY_DIRECT = 500
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+class Segment:
+    """
+    This class is one segment file.
+
+    The active segment is appended with os.write and read with os.pread.
+    A sealed segment never changes again, so it is read through an mmap.
+    """
+
+    def __init__(self, path, base_id):
+        self.path = path
+        self.base_id = base_id
+        self.fd = os.open(path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o600)
+        self.size = os.fstat(self.fd).st_size
+        self.map = None
+
+    def append(self, data):
+        """
+        This function appends bytes to the segment
+
+        Returns: Offset the bytes were written at
+        """
+        offset = self.size
+        view = memoryview(data)
+        while view:
+            written = os.write(self.fd, view)
+            view = view[written:]
+        self.size += len(data)
+        return offset
+
+    def seal(self):
+        """
+        This function marks the segment full and maps it for reading
+        """
+        os.fsync(self.fd)
+        if self.size:
+            self.map = mmap.mmap(self.fd, self.size, access=mmap.ACCESS_READ)
+
+    def read(self, offset):
+        """
+        This function reads the record at offset
+
+        Returns: Payload bytes
+        """
+        if self.map is not None:
+            length, = HEADER.unpack_from(self.map, offset)
+            start = offset + HEADER_SIZE
+            return self.map[start:start + length]
+        length, = HEADER.unpack(os.pread(self.fd, HEADER_SIZE, offset))
+        return os.pread(self.fd, length, offset + HEADER_SIZE)
+
+    def records(self):
+        """
+        This function walks the segment from the start (used when loading)
+
+        Yields: (offset, payload) for every complete record
+        """
+        if not self.size:
+            return
+        view = mmap.mmap(self.fd, self.size, access=mmap.ACCESS_READ)
+        try:
+            offset = 0
+            while offset + HEADER_SIZE <= self.size:
+                length, = HEADER.unpack_from(view, offset)
+                end = offset + HEADER_SIZE + length
+                if end > self.size:
+                    break
+                yield offset, view[offset + HEADER_SIZE:end]
+                offset = end
+        finally:
+            view.close()
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        os.close(self.fd)
+
+class MessageLog:
+    """
+    This class appends messages to the segmented log and indexes them.
+
+    Index (all in memory, a few bytes per message):
+    offsets/times: Offset in its segment and send time, by id - first_id
+    public: Ids of public messages
+    mailboxes: username -> ids of the dms they sent or received
+    inboxes: username -> ids of the dms they received
+    cursors: username -> id of the last dm they acknowledged
+    """
+
+    def __init__(self, directory=HISTORY_DIR, segment_bytes=DEFAULT_SEGMENT_BYTES,
+                 max_segments=DEFAULT_MAX_SEGMENTS, sync_interval=DEFAULT_SYNC_INTERVAL):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.sync_interval = sync_interval
+        self.lock = threading.Lock()
+
+        self.segments = []
+        # First message id of each segment, for finding a message's segment
+        self.base_ids = []
+        self.first_id = 1
+        self.next_id = 1
+        self.offsets = array('Q')
+        self.times = array('d')
+        self.public = array('Q')
+        self.mailboxes = {}
+        self.inboxes = {}
+        self.cursors = {}
+        # Cursors as last written to the log
+        self.saved_cursors = {}
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._load()
+        if not self.segments:
+            self._start_segment()
+        self._drop_old_segments()
+
+        self.dirty = False
+        self.closed = False
+        self.syncer = threading.Thread(target=self._sync_loop, name="history-sync", daemon=True)
+        self.syncer.start()
+
+    def _load(self):
+        """
+        This function rebuilds the index from the segment files
+
+        A torn record at the end of a segment (from a crash mid-write) is
+        cut off.
+        """
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(SEGMENT_SUFFIX))
+        for name in names:
+            segment = Segment(os.path.join(self.directory, name), int(name[:-len(SEGMENT_SUFFIX)]))
+            if not self.segments:
+                self.first_id = self.next_id = segment.base_id
+            good_size = 0
+            for offset, payload in segment.records():
+                try:
+                    record = decode_message(payload)
+                except ValueError:
+                    break
+                self._index(record, offset)
+                good_size = offset + HEADER_SIZE + len(payload)
+            if good_size != segment.size:
+                print(f"Discarding {segment.size - good_size} bytes of incomplete history in {name}")
+                os.truncate(segment.path, good_size)
+                segment.size = good_size
+            if self.segments:
+                self.segments[-1].seal()
+            self.segments.append(segment)
+            self.base_ids.append(segment.base_id)
+
+    def _index(self, record, offset):
+        # Called with self.lock held (or while loading)
+        if record["type"] == "read":
+            self.cursors[record["user"]] = self.saved_cursors[record["user"]] = record["id"]
+            return
+        self.next_id = record["id"] + 1
+        self.offsets.append(offset)
+        self.times.append(record["time"])
+        if record["type"] == "pm":
+            self.public.append(record["id"])
+        else:
+            for username in {record["from"], record["to"]}:
+                mailbox = self.mailboxes.get(username)
+                if mailbox is None:
+                    mailbox = self.mailboxes[username] = array('Q')
+                mailbox.append(record["id"])
+            inbox = self.inboxes.get(record["to"])
+            if inbox is None:
+                inbox = self.inboxes[record["to"]] = array('Q')
+            inbox.append(record["id"])
+
+    def _start_segment(self):
+        path = os.path.join(self.directory, f"{self.next_id:012d}{SEGMENT_SUFFIX}")
+        self.segments.append(Segment(path, self.next_id))
+        self.base_ids.append(self.next_id)
+        _fsync_directory(path)
+
+        # Cursors in older segments may be deleted, so carry them over
+        for username, message_id in self.saved_cursors.items():
+            self.segments[-1].append(encode_message({"type": "read", "user": username, "id": message_id}))
+
+    def _rotate(self):
+        self.segments[-1].seal()
+        self._start_segment()
+        self._drop_old_segments()
+
+    def _drop_old_segments(self):
+        while self.max_segments and len(self.segments) > self.max_segments:
+            oldest = self.segments.pop(0)
+            self.base_ids.pop(0)
+            oldest.close()
+            os.unlink(oldest.path)
+            dropped = self.segments[0].base_id - self.first_id
+            del self.offsets[:dropped]
+            del self.times[:dropped]
+            self.first_id = self.segments[0].base_id
+            del self.public[:bisect.bisect_left(self.public, self.first_id)]
+            # Mailboxes and inboxes are trimmed when they are next read
+
+    def append(self, message):
+        """
+        This function stores a pm or dm message dictionary
+
+        Returns: The stored record (the message with "id" and "time" added)
+        """
+        with self.lock:
+            record = dict(message, id=self.next_id, time=time.time())
+            frame = encode_message(record)
+            active = self.segments[-1]
+            # (A segment holding no message yet is never rotated, so names stay unique)
+            if self.next_id > active.base_id and active.size + len(frame) > self.segment_bytes:
+                self._rotate()
+            self._index(record, self.segments[-1].append(frame))
+            self.dirty = True
+            return record
+
+    def mark_read(self, username, message_id):
+        """
+        This function records that username acknowledged every dm up to message_id
+
+        Only memory is updated; save_cursor() writes it to the log.
+        """
+        with self.lock:
+            if message_id > self.cursors.get(username, 0):
+                self.cursors[username] = message_id
+
+    def save_cursor(self, username):
+        """
+        This function writes username's read cursor to the log (at logout)
+        """
+        with self.lock:
+            message_id = self.cursors.get(username)
+            if message_id is None or self.saved_cursors.get(username) == message_id:
+                return
+            self.segments[-1].append(encode_message({"type": "read", "user": username, "id": message_id}))
+            self.saved_cursors[username] = message_id
+            self.dirty = True
+
+    def _read(self, message_id):
+        # Called with self.lock held
+        index = bisect.bisect_right(self.base_ids, message_id) - 1
+        return decode_message(self.segments[index].read(self.offsets[message_id - self.first_id]))
+
+    def read(self, ids):
+        """
+        This function reads messages back one at a time
+
+        Yields: Record dictionaries (ids that were deleted are skipped)
+        """
+        for message_id in ids:
+            with self.lock:
+                if message_id < self.first_id:
+                    continue
+                record = self._read(message_id)
+            yield record
+
+    def _mailbox(self, username, boxes=None):
+        # Called with self.lock held; boxes is self.mailboxes (the default) or self.inboxes
+        mailbox = (self.mailboxes if boxes is None else boxes).get(username)
+        if mailbox is None:
+            return array('Q')
+        if mailbox and mailbox[0] < self.first_id:
+            del mailbox[:bisect.bisect_left(mailbox, self.first_id)]
+        return mailbox
+
+    def unread(self, username, limit=MAX_REPLAY_DIRECT, after=None):
+        """
+        This function finds the dms username has not received yet
+
+        after is the id of the last dm already sent to them (Ex: sent but not
+        acknowledged yet); by default their read cursor. Once the client
+        acknowledges them, mark_read(username, newest).
+
+        Returns: (ids of the oldest limit unread dms, total unread)
+        """
+        with self.lock:
+            inbox = self._mailbox(username, self.inboxes)
+            start = bisect.bisect_right(inbox, self.cursors.get(username, 0) if after is None else after)
+            return inbox[start:start + limit].tolist(), len(inbox) - start
+
+    def recent_public(self, limit=DEFAULT_REPLAY_PUBLIC):
+        """
+        This function returns the ids of the last limit public messages
+        """
+        with self.lock:
+            return self.public[max(0, len(self.public) - limit):].tolist()
+
+    def id_before_time(self, timestamp):
+        """
+        This function finds the first message id sent at or after timestamp
+        (Ex: to page from a point in time with history)
+        """
+        with self.lock:
+            return self.first_id + bisect.bisect_left(self.times, timestamp)
+
+    def page(self, username, before=None, limit=DEFAULT_PAGE_SIZE):
+        """
+        This function finds a page of history for username: public messages
+        and their own dms, older than the id before
+
+        Returns: (ids oldest first, True if there are older messages)
+        """
+        with self.lock:
+            if before is None:
+                before = self.next_id
+            mailbox = self._mailbox(username)
+            public_end = bisect.bisect_left(self.public, before)
+            mailbox_end = bisect.bisect_left(mailbox, before)
+            # The newest limit ids of both lists
+            ids = sorted(self.public[max(0, public_end - limit):public_end].tolist()
+                         + mailbox[max(0, mailbox_end - limit):mailbox_end].tolist())[-limit:]
+            more = public_end + mailbox_end > len(ids)
+        return ids, more
+
+    def _sync_loop(self):
+        # fsync the active segment every sync_interval while there are new records
+        while not self.closed:
+            time.sleep(self.sync_interval)
+            with self.lock:
+                if not self.dirty or self.closed:
+                    continue
+                self.dirty = False
+                fd = self.segments[-1].fd
+            # Outside the lock, so appends are not held up by the disk.
+            # (A segment is only closed when it is deleted, well after it is sealed.)
+            try:
+                os.fsync(fd)
+            except OSError as e:
+                if not self.closed:
+                    print(f"History sync failed: {e}")
+
+    def __len__(self):
+        return self.next_id - self.first_id
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            os.fsync(self.segments[-1].fd)
+            for segment in self.segments:
+                segment.close()
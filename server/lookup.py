@@ -0,0 +1,139 @@
+"""
+Username lookup by prefix (autocomplete).
+
+A logged-in client asks for the users whose name starts with a prefix:
+{"command": "lookup", "username": "user1", "prefix": "al", "limit": 5}
+and gets up to limit matches in name order, each with its online status:
+{"status": "lookup", "prefix": "al", "matches": [{"username": "al", "online": false},
+                                                {"username": "alice", "online": true}]}
+A dm to a name that is not registered gets the same kind of list as
+"suggestions" (the registered names closest to the typed one by prefix).
+
+Every registered username is kept in a PrefixIndex: a sorted list
+searched with bisect. The names that start with a prefix are one run of the
+list, so a lookup is one binary search and a slice of limit names, however
+many users are registered (a few microseconds with a million). Inserting
+into the middle of a list of a million names moves the rest of it, so new
+names wait in a small sorted list of recent names that is merged into the
+main one when it reaches MERGE_SIZE names; a lookup searches both.
+"""
+import threading
+from bisect import bisect_left
+
+# Matches returned when the client does not say how many, and the most it may ask for
+DEFAULT_LOOKUP_LIMIT = 10
+MAX_LOOKUP_LIMIT = 50
+
+# Longest prefix accepted
+MAX_PREFIX_LENGTH = 64
+
+# Recent names kept apart from the main sorted list before they are merged into it
+MERGE_SIZE = 4096
+
+class PrefixIndex:
+    """
+    This class is a sorted index of usernames for prefix searches.
+
+    It may be used from several threads (every method takes its lock).
+    """
+
+    def __init__(self, names=(), merge_size=MERGE_SIZE):
+        self.names = sorted(set(names))
+        self.recent = []
+        self.merge_size = merge_size
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.names) + len(self.recent)
+
+    def __contains__(self, name):
+        with self.lock:
+            return self._contains(name)
+
+    def _contains(self, name):
+        # Called with self.lock held
+        for names in (self.names, self.recent):
+            index = bisect_left(names, name)
+            if index < len(names) and names[index] == name:
+                return True
+        return False
+
+    def add(self, name):
+        """
+        This function adds a username (nothing happens if it is already indexed)
+        """
+        self.update((name,))
+
+    def update(self, names):
+        """
+        This function adds usernames that are not indexed yet (Ex: a batch of
+        users copied from the hub, see cluster.py)
+        """
+        with self.lock:
+            fresh = [name for name in dict.fromkeys(names) if not self._contains(name)]
+            if not fresh:
+                return
+            self.recent.extend(fresh)
+            if len(self.recent) >= self.merge_size:
+                # sort() finds the two sorted runs and merges them in one pass
+                self.names.extend(self.recent)
+                self.names.sort()
+                self.recent = []
+            else:
+                self.recent.sort()
+
+    def matches(self, prefix, limit=DEFAULT_LOOKUP_LIMIT):
+        """
+        This function finds the first limit usernames (in sorted order) that start with prefix
+
+        Returns: List of usernames
+        """
+        with self.lock:
+            found = _run(self.names, prefix, limit) + _run(self.recent, prefix, limit)
+        found.sort()
+        return found[:limit]
+
+    def closest(self, name, limit=DEFAULT_LOOKUP_LIMIT):
+        """
+        This function finds usernames sharing the longest prefix with name
+        (Ex: "alic" and "alicf" both find "alice"), at least its first letter
+
+        Returns: List of usernames (empty if none start with name's first letter)
+        """
+        for length in range(len(name), 0, -1):
+            found = self.matches(name[:length], limit)
+            if found:
+                return found
+        return []
+
+def _run(names, prefix, limit):
+    """
+    This function returns up to limit names of a sorted list that start with prefix
+    """
+    start = bisect_left(names, prefix)
+    found = []
+    for name in names[start:start + limit]:
+        if not name.startswith(prefix):
+            break
+        found.append(name)
+    return found
+
+def valid_lookup(prefix, limit):
+    """
+    This function checks a lookup request's prefix and limit
+
+    Returns: True if the prefix is a string of at most MAX_PREFIX_LENGTH
+    characters and the limit is between 1 and MAX_LOOKUP_LIMIT
+    """
+    return (isinstance(prefix, str) and len(prefix) <= MAX_PREFIX_LENGTH and isinstance(limit, int)
+            and not isinstance(limit, bool) and 1 <= limit <= MAX_LOOKUP_LIMIT)
+
+def described(names, is_online):
+    """
+    This function adds the online status to a list of usernames
+
+    is_online(username) tells whether a user is logged in (Ex: the presence tracker's is_online).
+
+    Returns: List of {"username": ..., "online": ...}
+    """
+    return [{"username": name, "online": is_online(name)} for name in names]
@@ -0,0 +1,369 @@
+"""
+Server metrics and a sampling profiler, served over a local HTTP endpoint.
+
+Metrics are kept in memory as counters, gauges and latency histograms and
+rendered in the Prometheus text format:
+chat_requests_total{command="pm",status="message_sent"} 1520
+chat_request_seconds_bucket{command="login",le="0.005"} 37
+
+Updating a metric is a dictionary lookup and an addition under a lock, so it
+can be done for every request. Gauges (Ex: logged-in users, queued bytes)
+call a function when they are scraped instead.
+
+With --metrics-port N the server answers on 127.0.0.1:N:
+GET /metrics                   Every metric in the Prometheus text format
+GET /profile?seconds=10        Samples every thread's stack for 10 seconds
+GET /profile/start?interval=0.01, then GET /profile/stop
+                               Starts the profiler, and later stops it
+
+A profile is returned in the folded stack format (one line per distinct
+stack with its sample count), which flamegraph.pl and speedscope read:
+MainThread;<module> (server/server.py);run_server (server/server.py);accept (python3.11/socket.py) 212
+"""
+import os
+import sys
+import math
+import time
+import bisect
+import threading
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Seconds between profiler samples, and the longest /profile?seconds=N
+DEFAULT_PROFILE_INTERVAL = 0.01
+MAX_PROFILE_SECONDS = 300
+
+def _labels_text(labelnames, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _number(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    """
+    This class is a counter per combination of label values.
+
+    Ex: requests_total.inc("pm", "message_sent")
+    """
+    kind = "counter"
+
+    def __init__(self, name, description, labelnames=()):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        """
+        Returns: (name, labels text, value) for every label combination
+        """
+        with self.lock:
+            items = sorted(self.values.items())
+        return [(self.name, _labels_text(self.labelnames, labels), value) for labels, value in items]
+
+class Histogram:
+    """
+    This class counts observations (Ex: request latencies in seconds) into
+    fixed buckets, per combination of label values.
+
+    Ex: request_seconds.observe(0.0042, "login")
+    """
+    kind = "histogram"
+
+    def __init__(self, name, description, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # labels -> [count per bucket (last one is +Inf), sum]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(labels)
+            if state is None:
+                state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def samples(self):
+        """
+        Returns: (name, labels text, value) for every bucket, sum and count
+        (bucket counts are cumulative, as Prometheus expects)
+        """
+        with self.lock:
+            items = sorted((labels, (list(counts), total)) for labels, (counts, total) in self.values.items())
+        samples = []
+        for labels, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = 'le="' + _number(bound) + '"'
+                samples.append((self.name + "_bucket", _labels_text(self.labelnames, labels, le), cumulative))
+            samples.append((self.name + "_sum", _labels_text(self.labelnames, labels), total))
+            samples.append((self.name + "_count", _labels_text(self.labelnames, labels), cumulative))
+        return samples
+
+class Gauge:
+    """
+    This class is a value read from a function when metrics are scraped.
+
+    function returns a number, or with labelnames, a dictionary of
+    label value tuples -> number.
+    """
+    kind = "gauge"
+
+    def __init__(self, name, description, function, labelnames=()):
+        self.name = name
+        self.description = description
+        self.function = function
+        self.labelnames = labelnames
+
+    def samples(self):
+        value = self.function()
+        if not self.labelnames:
+            return [(self.name, "", value)]
+        return [(self.name, _labels_text(self.labelnames, labels), number)
+                for labels, number in sorted(value.items())]
+
+class MetricsRegistry:
+    """
+    This class holds every metric of the process and renders them.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def _add(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, description, labelnames=()):
+        return self._add(Counter(name, description, labelnames))
+
+    def histogram(self, name, description, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, description, labelnames, buckets))
+
+    def gauge(self, name, description, function, labelnames=()):
+        return self._add(Gauge(name, description, function, labelnames))
+
+    def render(self):
+        """
+        This function renders every metric in the Prometheus text format
+
+        Returns: Text (a gauge whose function fails is left out)
+        """
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                print(f"Metric {metric.name} failed: {e!r}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in samples:
+                lines.append(f"{name}{labels} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+# The process's metrics; modules add theirs when they are imported
+REGISTRY = MetricsRegistry()
+
+# Metrics updated on the server's hot paths
+requests_total = REGISTRY.counter("chat_requests_total", "Requests handled, by command and response status",
+                                  ("command", "status"))
+request_seconds = REGISTRY.histogram("chat_request_seconds",
+                                     "Time from receiving a request to queueing its response (login and register include password hashing)",
+                                     ("command",))
+broadcast_seconds = REGISTRY.histogram("chat_broadcast_seconds",
+                                       "Time to queue one message for every logged-in user, by message kind",
+                                       ("kind",))
+broadcast_recipients = REGISTRY.counter("chat_broadcast_recipients_total",
+                                        "Frames queued by broadcasts, by message kind", ("kind",))
+send_failures = REGISTRY.counter("chat_send_failures_total",
+                                 "Frames that could not be queued or sent to a client, by reason", ("reason",))
+socket_writes = REGISTRY.counter("chat_socket_writes_total",
+                                 "Write system calls made to send queued frames (one call may carry many frames)")
+frames_sent = REGISTRY.counter("chat_frames_sent_total", "Frames handed to socket writes")
+accept_errors = REGISTRY.counter("chat_accept_errors_total", "Failed accepts of new connections (Ex: out of file descriptors)")
+connections_reaped = REGISTRY.counter("chat_connections_reaped_total",
+                                      "Connections closed by the heartbeat monitor, by reason (idle, read_timeout)",
+                                      ("reason",))
+tls_handshakes = REGISTRY.counter("chat_tls_handshakes_total",
+                                  "TLS handshakes, by result (full, resumed, or failed in the threaded engine)",
+                                  ("result",))
+rate_limited = REGISTRY.counter("chat_rate_limited_total",
+                                "Requests refused by a rate limit, by limit (user, global or the command) and command",
+                                ("limit", "command"))
+
+class SamplingProfiler:
+    """
+    This class samples the stack of every thread at a fixed interval.
+
+    It is a thread of its own that reads sys._current_frames(), so nothing
+    is added to the server's hot paths while it is off, and only the
+    sampling thread's own work while it is on.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopping = threading.Event()
+        # Folded stack text -> samples
+        self.stacks = {}
+        self.samples = 0
+        self.started = 0.0
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    def start(self, interval=DEFAULT_PROFILE_INTERVAL):
+        """
+        This function starts sampling
+
+        Returns: False if the profiler was already running
+        """
+        with self.lock:
+            if self.thread is not None:
+                return False
+            self.stacks = {}
+            self.samples = 0
+            self.started = time.monotonic()
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self._run, args=(interval,), name="profiler", daemon=True)
+            self.thread.start()
+            return True
+
+    def stop(self):
+        """
+        This function stops sampling
+
+        Returns: The profile in the folded stack format ("" if it was not running)
+        """
+        with self.lock:
+            thread = self.thread
+            if thread is None:
+                return ""
+            self.stopping.set()
+        thread.join()
+        with self.lock:
+            self.thread = None
+            elapsed = time.monotonic() - self.started
+            lines = [f"{stack} {count}" for stack, count in
+                     sorted(self.stacks.items(), key=lambda item: item[1], reverse=True)]
+        header = f"# {self.samples} samples over {elapsed:.1f} s\n"
+        return header + "\n".join(lines) + "\n"
+
+    def _run(self, interval):
+        own = threading.get_ident()
+        while not self.stopping.wait(interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            frames = sys._current_frames()
+            with self.lock:
+                self.samples += 1
+                for ident, frame in frames.items():
+                    if ident == own:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append(f"{code.co_name} ({_short_path(code.co_filename)})")
+                        frame = frame.f_back
+                    stack.append(names.get(ident, str(ident)))
+                    folded = ";".join(reversed(stack))
+                    self.stacks[folded] = self.stacks.get(folded, 0) + 1
+            del frames
+
+def _short_path(path):
+    # The file and its directory (Ex: "http/server.py" and "server/server.py" differ)
+    directory, name = os.path.split(path)
+    return os.path.join(os.path.basename(directory), name)
+
+class _AdminHandler(BaseHTTPRequestHandler):
+    """
+    This class answers one request to the metrics endpoint
+    """
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        profiler = self.server.profiler
+        try:
+            interval = float(query.get("interval", [DEFAULT_PROFILE_INTERVAL])[0])
+            seconds = float(query.get("seconds", [10])[0])
+        except ValueError:
+            self._reply(400, "interval and seconds must be numbers\n")
+            return
+        if not 0 < interval <= 1 or not 0 < seconds <= MAX_PROFILE_SECONDS:
+            self._reply(400, f"interval must be in (0, 1] and seconds in (0, {MAX_PROFILE_SECONDS}]\n")
+            return
+
+        if url.path == "/metrics":
+            self._reply(200, self.server.registry.render(), "text/plain; version=0.0.4; charset=utf-8")
+        elif url.path == "/profile":
+            if not profiler.start(interval):
+                self._reply(409, "The profiler is already running\n")
+                return
+            time.sleep(seconds)
+            self._reply(200, profiler.stop())
+        elif url.path == "/profile/start":
+            if profiler.start(interval):
+                self._reply(200, "Profiler started\n")
+            else:
+                self._reply(409, "The profiler is already running\n")
+        elif url.path == "/profile/stop":
+            if profiler.running:
+                self._reply(200, profiler.stop())
+            else:
+                self._reply(409, "The profiler is not running\n")
+        else:
+            self._reply(404, "Not found\n")
+
+    def _reply(self, status, text, content_type="text/plain; charset=utf-8"):
+        body = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # Scrapes would flood the server's output
+
+def serve_metrics(port, registry=REGISTRY, profiler=None):
+    """
+    This function starts the metrics endpoint on 127.0.0.1:port, on a thread of its own
+
+    Returns: The HTTP server (call shutdown() to stop it)
+    Raises: OSError if the port cannot be bound
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), _AdminHandler)
+    server.daemon_threads = True
+    server.registry = registry
+    server.profiler = profiler if profiler is not None else SamplingProfiler()
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
@@ -0,0 +1,400 @@
+"""
+Bounded outbound queues for client connections.
+
+Every connection owns an OutboundQueue. Other handlers only append encoded
+frames to it and return straight away. The connection's own writer drains
+the queue, so a client that stops reading only ever stalls itself.
+
+When a queue is full the slow consumer policy decides what happens:
+disconnect: The slow client is disconnected
+drop: New frames are dropped until the client catches up
+buffer: The newest frames are kept, the oldest queued frames are dropped
+
+Codecs keep state between frames (usernames defined once, a deflate
+stream). Under the buffer policy a frame may be dropped after later frames
+were encoded, so frames are encoded as tentative: they only depend on
+frames that already left the queue (see common/codec.py and
+common/compression.py), and the codec is told when the writer takes the
+queue.
+
+Writes are coalesced: the writer takes every frame that has queued up and
+sends them with one scatter/gather write (sendmsg, or writev for the
+asyncio engine) straight from the frame buffers, without joining them into
+one copy. A coalescing window (--coalesce-delay SECONDS) can hold the first
+frame briefly so more frames share its write, and the queue is written at
+once when it reaches --coalesce-bytes. Since the server batches small
+frames itself, Nagle's algorithm is turned off (TCP_NODELAY) for clients.
+With --coalesce-bytes 0 every frame is written by itself, as soon as it is
+queued, and Nagle's algorithm is left on.
+"""
+import ssl
+import time
+import select
+import threading
+from socket import SHUT_RDWR
+from collections import deque
+
+from common.codec import JSON_CODEC
+from metrics import send_failures, socket_writes, frames_sent
+
+SLOW_CONSUMER_POLICIES = ("disconnect", "drop", "buffer")
+DEFAULT_SLOW_CONSUMER_POLICY = "disconnect"
+
+# Bytes that may wait in one connection's queue (set with --send-queue-bytes)
+DEFAULT_SEND_QUEUE_BYTES = 1024 * 1024
+
+# Seconds the first queued frame may wait for others to share its write
+# (set with --coalesce-delay; 0 writes whatever has queued as soon as the
+# writer gets to it), and queued bytes that are written without waiting
+# (set with --coalesce-bytes; 0 writes every frame by itself)
+DEFAULT_COALESCE_DELAY = 0.0
+DEFAULT_COALESCE_BYTES = 64 * 1024
+
+# Most buffers passed to one scatter/gather write (Linux's IOV_MAX)
+MAX_IOV = 1024
+
+class SlowConsumer(ConnectionError):
+    """
+    Raised when a full queue uses the disconnect policy
+    """
+
+class OutboundQueue:
+    """
+    This class is a byte-bounded FIFO of encoded frames.
+
+    It does no locking of its own. The threaded engine guards it with the
+    connection's condition variable, and the asyncio engine only touches it
+    from the event loop.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_SEND_QUEUE_BYTES, policy=DEFAULT_SLOW_CONSUMER_POLICY):
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Unknown slow consumer policy: {policy}")
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.frames = deque()
+        self.queued_bytes = 0
+        self.dropped = 0
+        # Queued frames may be dropped later, so they are encoded as tentative (see the top of this file)
+        self.tentative = policy == "buffer"
+
+    def __len__(self):
+        return len(self.frames)
+
+    def push(self, frame):
+        """
+        This function appends a frame, applying the policy if the queue is full
+
+        A frame is always accepted into an empty queue, so a single frame
+        larger than max_bytes is still delivered.
+
+        Returns: True if the frame was queued, False if it was dropped
+        Raises: SlowConsumer under the disconnect policy
+        """
+        size = len(frame)
+        if self.frames and self.queued_bytes + size > self.max_bytes:
+            if self.policy == "disconnect":
+                send_failures.inc("slow_consumer")
+                raise SlowConsumer(f"Send queue over {self.max_bytes} bytes")
+            if self.policy == "drop":
+                self.dropped += 1
+                send_failures.inc("dropped")
+                return False
+            # buffer: make room by discarding the oldest frames
+            dropped = self.dropped
+            while self.frames and self.queued_bytes + size > self.max_bytes:
+                self.queued_bytes -= len(self.frames.popleft())
+                self.dropped += 1
+            send_failures.inc("dropped", amount=self.dropped - dropped)
+        self.frames.append(frame)
+        self.queued_bytes += size
+        return True
+
+    def fits(self, size):
+        """
+        This function checks whether a frame of size bytes would be queued without applying the policy
+        """
+        return not self.frames or self.queued_bytes + size <= self.max_bytes
+
+    def pop(self):
+        """
+        This function removes and returns the oldest frame
+        """
+        frame = self.frames.popleft()
+        self.queued_bytes -= len(frame)
+        return frame
+
+    def pop_all(self):
+        """
+        This function removes and returns every queued frame (oldest first)
+        """
+        frames = list(self.frames)
+        self.frames.clear()
+        self.queued_bytes = 0
+        return frames
+
+def write_frames(write, frames):
+    """
+    This function sends frames with scatter/gather writes
+
+    write(buffers) is a socket's sendmsg (or os.writev on its file
+    descriptor) and returns how many bytes it wrote. It is called again
+    until everything is written, or until a non-blocking socket is full.
+
+    Returns: The buffers that were not written (empty if all were; the first
+    one may be the unsent end of a partly written frame)
+    Raises: OSError if the write fails
+    """
+    frames_sent.inc(amount=len(frames))
+    buffers = frames
+    while buffers:
+        try:
+            written = write(buffers[:MAX_IOV])
+        except BlockingIOError:
+            break
+        socket_writes.inc()
+        # Drop the buffers that were written whole
+        index = 0
+        while index < len(buffers) and written >= len(buffers[index]):
+            written -= len(buffers[index])
+            index += 1
+        buffers = buffers[index:]
+        if written:
+            buffers[0] = memoryview(buffers[0])[written:]
+    return buffers
+
+class ThreadedConnection:
+    """
+    This class wraps a client socket for the threaded engine.
+
+    Any thread may call send_frame, which only queues the frame. A writer
+    thread owned by this connection does the blocking writes, sending every
+    frame queued since its last write with one sendmsg (one send of the
+    joined frames with TLS). send_message encodes a message with the
+    connection's codec first.
+
+    delay and flush_bytes are the coalescing window (see the top of this file).
+
+    OpenSSL cannot read and write one TLS connection from two threads at
+    once, so a TLS socket is made non-blocking and every read (recv_tls, on
+    the handler thread) and write (on the writer thread) holds tls_lock.
+    Waiting for the socket to be ready is done without the lock.
+    """
+
+    def __init__(self, sock, addr, max_bytes=DEFAULT_SEND_QUEUE_BYTES,
+                 policy=DEFAULT_SLOW_CONSUMER_POLICY, delay=DEFAULT_COALESCE_DELAY,
+                 flush_bytes=DEFAULT_COALESCE_BYTES):
+        self.sock = sock
+        self.addr = addr
+        self.queue = OutboundQueue(max_bytes, policy)
+        self.delay = delay
+        self.flush_bytes = flush_bytes
+        self.codec = JSON_CODEC
+        self.tls_lock = None
+        if isinstance(sock, ssl.SSLSocket):
+            # TLS encrypts one buffer at a time, so the frames are joined first
+            self.tls_lock = threading.Lock()
+            sock.setblocking(False)
+            self.write = self._write_tls
+            self.send_all = lambda frame: self._write_tls((frame,))
+        else:
+            self.write = sock.sendmsg
+            self.send_all = sock.sendall
+        self.condition = threading.Condition()
+        self.closed = False
+        # When data last arrived, when a partly received frame started, and
+        # when the last ping was sent (see heartbeat.py)
+        self.last_received = time.monotonic()
+        self.frame_started = None
+        self.last_ping = 0.0
+        # The user's DeliveryWindow once logged in (see delivery.py in the server)
+        self.window = None
+        self.writer = threading.Thread(target=self._write_loop, name=f"writer-{addr}", daemon=True)
+        self.writer.start()
+
+    def send_frame(self, frame):
+        """
+        This function queues an encoded frame for the writer thread
+
+        Returns: True if queued, False if dropped by the slow consumer policy
+        Raises: ConnectionError if the connection is closed or was too slow
+        """
+        with self.condition:
+            if self.closed:
+                send_failures.inc("closed")
+                raise ConnectionError(f"Connection to {self.addr} is closed")
+            try:
+                queued = self.queue.push(frame)
+            except SlowConsumer:
+                print(f"Disconnecting slow client {self.addr}")
+                self._abort()
+                raise
+            self.condition.notify()
+        return queued
+
+    def send_message(self, message):
+        """
+        This function encodes a message (or a SharedMessage) with the connection's codec and queues it
+
+        Encoding happens under the connection's lock, so frames are queued in
+        the order the codec encoded them.
+
+        Returns: True if queued, False if dropped by the slow consumer policy
+        Raises: ConnectionError if the connection is closed or was too slow
+        """
+        with self.condition:
+            dropped = self.queue.dropped
+            queued = self.send_frame(self.codec.encode(message, self.queue.tentative))
+            if self.queue.dropped != dropped:
+                # A dropped frame may have defined usernames for the binary codec
+                self.codec.forget()
+            return queued
+
+    def _write_loop(self):
+        """
+        This function is the writer thread: it drains the queue to the socket
+        """
+        while True:
+            with self.condition:
+                while not self.queue and not self.closed:
+                    self.condition.wait()
+                if self.delay and self.flush_bytes:
+                    # Let more frames join the first one, for up to delay seconds
+                    deadline = time.monotonic() + self.delay
+                    while not self.closed and self.queue.queued_bytes < self.flush_bytes:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self.condition.wait(remaining)
+                frames = self.queue.pop_all()
+                if not frames:
+                    return
+                # Nothing encoded so far can be dropped any more
+                self.codec.confirm()
+            try:
+                if self.flush_bytes:
+                    write_frames(self.write, frames)
+                else:
+                    # Not coalescing: one write per frame
+                    for frame in frames:
+                        self.send_all(frame)
+                        socket_writes.inc()
+                    frames_sent.inc(amount=len(frames))
+            except OSError:
+                send_failures.inc("socket_error")
+                with self.condition:
+                    self._abort()
+                return
+
+    def recv_tls(self, size):
+        """
+        This function receives data from a TLS client (the handler thread's recv)
+
+        Returns: Received bytes (b"" if the client disconnected)
+        Raises: OSError if the connection failed
+        """
+        while True:
+            with self.tls_lock:
+                try:
+                    return self.sock.recv(size)
+                except ssl.SSLWantReadError:
+                    events = select.POLLIN
+                except ssl.SSLWantWriteError:
+                    events = select.POLLOUT
+            self._wait_tls(events)
+
+    def _write_tls(self, buffers):
+        """
+        This function writes buffers to a TLS client, waiting until the socket takes them (the writer thread)
+
+        Returns: Bytes written (all of them)
+        Raises: OSError if the write fails
+        """
+        data = b"".join(buffers)
+        while True:
+            with self.tls_lock:
+                try:
+                    return self.sock.send(data)
+                except ssl.SSLWantWriteError:
+                    events = select.POLLOUT
+                except ssl.SSLWantReadError:
+                    # The TLS layer must read first (Ex: a renegotiation)
+                    events = select.POLLIN
+            self._wait_tls(events)
+
+    def _wait_tls(self, events):
+        # Waits, without tls_lock, until the socket is ready (or shut down, which fails the retry)
+        poller = select.poll()
+        poller.register(self.sock, events)
+        poller.poll()
+
+    def abort(self):
+        """
+        This function closes the connection at once, dropping queued frames (Ex: a dead connection)
+
+        The handler's recv returns, and the handler ends the session.
+        """
+        with self.condition:
+            self._abort()
+
+    def _abort(self):
+        """
+        This function marks the connection closed and unblocks both directions
+
+        The caller must hold self.condition
+        """
+        self.closed = True
+        self.queue.pop_all()
+        self.condition.notify()
+        try:
+            # Wakes the handler's recv and the writer's sendall
+            self.sock.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _stop_writer(self, timeout):
+        """
+        This function lets the writer thread write what is queued, then end
+
+        Returns: True if the writer ended within timeout (everything queued was written)
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.writer.join(timeout)
+        return not self.writer.is_alive()
+
+    def finish(self, timeout):
+        """
+        This function writes what is queued (for up to timeout), then shuts the socket down
+
+        Used when the server stops (see handoff.py). The handler's recv
+        returns, and the handler ends the session and closes the socket.
+        """
+        self._stop_writer(timeout)
+        with self.condition:
+            self._abort()
+
+    def detach(self, timeout):
+        """
+        This function writes what is queued (for up to timeout) and stops
+        the writer, leaving the socket open (Ex: to hand it to a new process)
+
+        Returns: True if everything queued was written
+        """
+        return self._stop_writer(timeout)
+
+    def close(self, timeout=5.0):
+        """
+        This function flushes queued frames (up to timeout) and closes the socket
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        if self.writer is not threading.current_thread():
+            self.writer.join(timeout)
+        if self.writer.is_alive():
+            # The client is not reading; give up on the rest of the queue
+            with self.condition:
+                self._abort()
+        self.sock.close()
@@ -0,0 +1,241 @@
+"""
+Salted password hashing for the user store.
+
+Passwords are stored as scrypt records:
+scrypt$16384$8$1$<salt base64>$<hash base64>
+
+(pbkdf2_sha256$<iterations>$<salt>$<hash> is used if this Python's OpenSSL
+has no scrypt.) Records without a known prefix are legacy plaintext
+passwords from users.json; they still verify, and are rehashed in the
+background the first time the user logs in (or by migrate_plaintext).
+
+Hashing is slow on purpose, so it never runs on a handler thread or the
+event loop. PasswordHasher runs it on a small worker pool with a bounded
+queue, and remembers recent successful verifications for a short time so a
+reconnect storm does not redo the work for every login.
+"""
+import os
+import hmac
+import time
+import base64
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+PBKDF2_ITERATIONS = 200000
+SALT_BYTES = 16
+HASH_BYTES = 32
+
+DEFAULT_HASH_WORKERS = 2
+# Hash jobs that may wait for a worker before new ones are refused
+DEFAULT_MAX_PENDING = 256
+DEFAULT_CACHE_TTL = 60.0
+DEFAULT_CACHE_SIZE = 10000
+
+HAS_SCRYPT = hasattr(hashlib, "scrypt")
+
+class HasherBusy(Exception):
+    """
+    Raised when the hashing queue is full
+    """
+
+def _b64(data):
+    return base64.b64encode(data).decode('ascii')
+
+def hash_password(password, scrypt_n=SCRYPT_N):
+    """
+    This function hashes a password with a new random salt
+
+    scrypt_n is the scrypt cost (a power of two). It is stored in the
+    record, so records made with different costs all still verify.
+
+    Returns: Password record string
+    """
+    salt = os.urandom(SALT_BYTES)
+    secret = password.encode('utf-8')
+    if HAS_SCRYPT:
+        digest = hashlib.scrypt(secret, salt=salt, n=scrypt_n, r=SCRYPT_R, p=SCRYPT_P, dklen=HASH_BYTES,
+                                maxmem=256 * scrypt_n * SCRYPT_R)
+        return f"scrypt${scrypt_n}${SCRYPT_R}${SCRYPT_P}${_b64(salt)}${_b64(digest)}"
+    digest = hashlib.pbkdf2_hmac("sha256", secret, salt, PBKDF2_ITERATIONS, HASH_BYTES)
+    return f"pbkdf2_sha256${PBKDF2_ITERATIONS}${_b64(salt)}${_b64(digest)}"
+
+def is_hashed(record):
+    """
+    This function tells hashed records apart from legacy plaintext passwords
+    """
+    return record.startswith(("scrypt$", "pbkdf2_sha256$"))
+
+def verify_password(password, record):
+    """
+    This function checks a password against a stored record
+
+    Returns: True if the password matches
+    """
+    secret = password.encode('utf-8')
+    try:
+        if record.startswith("scrypt$"):
+            _, n, r, p, salt, expected = record.split("$")
+            expected = base64.b64decode(expected)
+            digest = hashlib.scrypt(secret, salt=base64.b64decode(salt), n=int(n), r=int(r), p=int(p),
+                                    dklen=len(expected), maxmem=256 * int(n) * int(r))
+        elif record.startswith("pbkdf2_sha256$"):
+            _, iterations, salt, expected = record.split("$")
+            expected = base64.b64decode(expected)
+            digest = hashlib.pbkdf2_hmac("sha256", secret, base64.b64decode(salt), int(iterations), len(expected))
+        else:
+            # Legacy plaintext record
+            return hmac.compare_digest(secret, record.encode('utf-8'))
+    except ValueError:
+        return False
+    return hmac.compare_digest(digest, expected)
+
+class PasswordHasher:
+    """
+    This class runs hashing and verification on a bounded worker pool.
+
+    The *_async methods return concurrent futures (the asyncio engine
+    wraps them with asyncio.wrap_future). hash() and verify() block the
+    calling handler thread until the worker is done.
+    """
+
+    def __init__(self, workers=DEFAULT_HASH_WORKERS, max_pending=DEFAULT_MAX_PENDING,
+                 cache_ttl=DEFAULT_CACHE_TTL, cache_size=DEFAULT_CACHE_SIZE, scrypt_n=SCRYPT_N):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="hasher")
+        self.scrypt_n = scrypt_n
+        self.max_pending = max_pending
+        self.pending = 0
+        self.lock = threading.Lock()
+        # Successful verifications: keyed digest -> expiry time
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        # Random per-process key, so cache keys reveal nothing about passwords
+        self.cache_key = os.urandom(32)
+
+    def _submit(self, function, *args):
+        with self.lock:
+            if self.pending >= self.max_pending:
+                raise HasherBusy("Too many password hashes waiting")
+            self.pending += 1
+        future = self.pool.submit(function, *args)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self.lock:
+            self.pending -= 1
+
+    def _cache_entry(self, username, password, record):
+        # The record is part of the key, so a changed password never hits
+        message = "\0".join((username, password, record)).encode('utf-8')
+        return hmac.new(self.cache_key, message, hashlib.sha256).digest()
+
+    def cached(self, username, password, record):
+        """
+        This function checks for a recent successful verification
+
+        Returns: True if this exact password was verified for this record recently
+        """
+        if self.cache_ttl <= 0:
+            return False
+        entry = self._cache_entry(username, password, record)
+        with self.lock:
+            expires = self.cache.get(entry)
+            if expires is None:
+                return False
+            if expires < time.monotonic():
+                del self.cache[entry]
+                return False
+            return True
+
+    def _remember(self, username, password, record):
+        if self.cache_ttl <= 0:
+            return
+        entry = self._cache_entry(username, password, record)
+        with self.lock:
+            self.cache[entry] = time.monotonic() + self.cache_ttl
+            self.cache.move_to_end(entry)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def _verify_and_remember(self, username, password, record):
+        if verify_password(password, record):
+            self._remember(username, password, record)
+            return True
+        return False
+
+    def hash_async(self, password):
+        """
+        This function queues a hash of password
+
+        Returns: Future with the password record
+        Raises: HasherBusy if the queue is full
+        """
+        return self._submit(hash_password, password, self.scrypt_n)
+
+    def verify_async(self, username, password, record):
+        """
+        This function queues a verification (or answers from the cache)
+
+        Returns: Future with True/False
+        Raises: HasherBusy if the queue is full
+        """
+        return self._submit(self._verify_and_remember, username, password, record)
+
+    def hash(self, password):
+        return self.hash_async(password).result()
+
+    def verify(self, username, password, record):
+        if self.cached(username, password, record):
+            return True
+        return self.verify_async(username, password, record).result()
+
+    def rehash_later(self, users, username, password, record):
+        """
+        This function replaces a plaintext record with a hash in the background
+
+        The store is only changed if the record is still the same one.
+        """
+        def rehash():
+            users.replace(username, record, hash_password(password, self.scrypt_n))
+        try:
+            self._submit(rehash)
+        except HasherBusy:
+            pass # Tried again at the next login
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
+
+def migrate_plaintext(users, hasher):
+    """
+    This function hashes every legacy plaintext record in the user store
+
+    It runs on its own thread at startup and sends one record at a time
+    through the pool, so logins are not starved while it works. The new
+    records are saved together at the end (one rewrite of users.json with
+    the json backend, not one per user); a record that changed meanwhile
+    (Ex: rehashed at login) is left as it is.
+
+    Returns: Number of records migrated
+    """
+    replacements = []
+    for username, record in users.items():
+        if is_hashed(record):
+            continue
+        while True:
+            try:
+                new_record = hasher.hash_async(record).result()
+                break
+            except HasherBusy:
+                time.sleep(0.1)
+        replacements.append((username, record, new_record))
+    migrated = users.replace_many(replacements)
+    if migrated:
+        users.compact()
+        print(f"Migrated {migrated} plaintext passwords to {'scrypt' if HAS_SCRYPT else 'pbkdf2_sha256'}")
+    return migrated
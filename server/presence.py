@@ -0,0 +1,184 @@
+"""
+Incremental presence updates for logged-in users.
+
+Instead of sending the whole active user list on every login and logout,
+the server sends small deltas:
+{"type": "presence", "seq": 7, "joined": ["user2"], "left": ["user5"]}
+
+Logins and logouts that happen within one window (default 50 ms) are
+coalesced into a single batch. Every batch has the next sequence number. A
+client that sees a gap in the sequence (Ex: a frame dropped by the slow
+consumer policy) asks for a full snapshot with the presence command:
+{"type": "presence_snapshot", "seq": 7, "active_users": [...]}
+
+Clients apply "left" and then "joined"; a username is never in both lists.
+"""
+import time
+import threading
+
+from common.codec import SharedMessage
+from metrics import broadcast_seconds, broadcast_recipients
+
+# Seconds to collect presence changes before sending one batch
+DEFAULT_PRESENCE_WINDOW = 0.05
+
+class PresenceTracker:
+    """
+    This class logs users in and out of the session registry and
+    broadcasts the changes as sequenced, coalesced deltas.
+
+    schedule(delay, callback) is supplied by the server engine (a timer
+    thread for the threaded engine, loop.call_later for asyncio).
+    """
+
+    def __init__(self, sessions, window=DEFAULT_PRESENCE_WINDOW, schedule=None):
+        self.sessions = sessions
+        self.window = window
+        self.schedule = schedule
+        self.seq = 0
+        self.lock = threading.Lock()
+        # Pending changes; dictionaries are used as ordered sets
+        self.joined = {}
+        self.left = {}
+        self.flush_scheduled = False
+        # Set when the sessions are handed to a new process (hot restart); nothing more is sent
+        self.frozen = False
+
+    def login(self, username, conn):
+        """
+        This function logs a user in on a connection and queues a join
+
+        Returns: (active usernames, seq) so the login response and the
+        following deltas line up
+        """
+        with self.lock:
+            self.sessions.add(username, conn)
+            self._note(username, joined=True)
+            return self.sessions.usernames(), self.seq
+
+    def logout(self, username, conn=None):
+        """
+        This function logs a user out and queues a leave
+
+        Returns: True if the user was logged in
+        """
+        with self.lock:
+            if self.sessions.remove(username, conn) is None:
+                return False
+            self._note(username, joined=False)
+            return True
+
+    def disconnect(self, conn):
+        """
+        This function logs out whichever user is on a closed connection
+
+        Returns: The username that was logged out, or None
+        """
+        username = self.sessions.username_for(conn)
+        if username is None or not self.logout(username, conn):
+            return None
+        return username
+
+    def is_online(self, username):
+        """
+        This function tells whether a user is logged in
+        """
+        return username in self.sessions
+
+    def _note(self, username, joined):
+        # A later change cancels an earlier opposite one in the same window
+        if joined:
+            self.left.pop(username, None)
+            self.joined[username] = None
+        else:
+            self.joined.pop(username, None)
+            self.left[username] = None
+
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            if self.schedule is None:
+                self._flush_locked()
+            else:
+                self.schedule(self.window, self.flush)
+
+    def flush(self):
+        """
+        This function sends the pending changes as one batch to every user
+        """
+        with self.lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        self.flush_scheduled = False
+        if self.frozen or (not self.joined and not self.left):
+            return
+        self.seq += 1
+        batch = {
+            "type": "presence",
+            "seq": self.seq,
+            "joined": list(self.joined),
+            "left": list(self.left),
+        }
+        self.joined.clear()
+        self.left.clear()
+        self._send(batch)
+
+    def _send(self, batch):
+        """
+        This function sends one batch to every logged-in user
+
+        Called with self.lock held. (The multi-process hub overrides this to
+        send the batch to each worker instead, see cluster.py.)
+        """
+        # Encode once per codec; queueing never blocks, so this is done under
+        # the lock to keep batches in sequence order on every connection
+        start = time.perf_counter()
+        shared = SharedMessage(batch)
+        recipients = self.sessions.snapshot()
+        for user, user_conn in recipients:
+            try:
+                user_conn.send_message(shared)
+            except ConnectionError:
+                pass # Counted in chat_send_failures_total
+        broadcast_seconds.observe(time.perf_counter() - start, "presence")
+        broadcast_recipients.inc("presence", amount=len(recipients))
+
+    def freeze(self):
+        """
+        This function sends the pending changes, then stops sending (the
+        sessions are being handed to a new process, see handoff.py)
+
+        Returns: (seq, active usernames) as the clients last heard them
+        """
+        with self.lock:
+            self._flush_locked()
+            self.frozen = True
+            return self.seq, self.sessions.usernames()
+
+    def restore(self, seq, sessions, departed):
+        """
+        This function takes over the sessions of the previous process of a hot restart
+
+        sessions are the (username, connection) pairs that moved, and
+        departed the users the clients still think are online that did not
+        move; they are sent as one leave batch after seq.
+        """
+        with self.lock:
+            self.seq = seq
+            for username, conn in sessions:
+                self.sessions.add(username, conn)
+            for username in departed:
+                self._note(username, joined=False)
+
+    def snapshot_message(self):
+        """
+        This function builds a full presence snapshot message
+
+        Returns: {"type": "presence_snapshot", "seq": n, "active_users": [...]}
+        """
+        with self.lock:
+            return {
+                "type": "presence_snapshot",
+                "seq": self.seq,
+                "active_users": self.sessions.usernames(),
+            }
@@ -0,0 +1,173 @@
+"""
+Token bucket rate limits for client requests.
+
+One client sending pm in a tight loop would make the server send to every
+logged-in user for each message, so requests are limited:
+- user: every request of one user (or one connection before login)
+- pm, dm, room, ...: one command of one user
+- global: every request this server process receives
+A request over any of its limits is not processed; the client gets
+{"status": "rate_limited"} instead.
+
+Limits are given as RATE/BURST: up to BURST requests at once, refilled at
+RATE per second (Ex: pm=5/20). A rate of 0 turns that limit off.
+
+Each bucket is kept as a single number, the time at which it will be full
+again (the generic cell rate algorithm, which behaves exactly like a token
+bucket). A check is a few comparisons whatever the number of sessions. A
+user's buckets are one small array of floats, and users whose buckets are
+all full again are forgotten by prune(), so idle sessions cost nothing.
+The state is split into shards with their own locks, like the session
+registry (see sessions.py).
+"""
+import time
+import threading
+from array import array
+
+# Name -> (requests per second, burst); the name is a command, "user" or "global"
+DEFAULT_RATE_LIMITS = {
+    "user": (50.0, 100),
+    "pm": (5.0, 20),
+    "dm": (20.0, 50),
+    "room": (20.0, 50),
+    "lookup": (20.0, 50),
+    "global": (20000.0, 20000),
+}
+
+# Commands that are never limited (a heartbeat answer, a delivery acknowledgement, and logging out)
+EXEMPT_COMMANDS = ("pong", "ack", "ex")
+
+# Seconds between prune() runs, which drop buckets that are full again
+PRUNE_INTERVAL = 60.0
+
+DEFAULT_SHARDS = 16
+
+def parse_rate_limit(spec):
+    """
+    This function reads a limit from the command line
+
+    Ex: "pm=5/20" (5 per second, bursts of 20), "dm=10" (burst 10), "room=0" (no limit)
+
+    Returns: (name, rate, burst)
+    Raises: ValueError if spec is not NAME=RATE[/BURST]
+    """
+    name, sep, value = spec.partition("=")
+    if not name or not sep:
+        raise ValueError(f"Rate limit must be NAME=RATE[/BURST]: {spec}")
+    rate, sep, burst = value.partition("/")
+    try:
+        rate = float(rate)
+        burst = int(burst) if sep else max(1, int(rate))
+    except ValueError:
+        raise ValueError(f"Rate limit must be NAME=RATE[/BURST]: {spec}") from None
+    if rate < 0 or burst < 1:
+        raise ValueError(f"Rate must not be negative and burst must be positive: {spec}")
+    return name, rate, burst
+
+class _Shard:
+    """
+    This class is one lock-protected slice of the buckets
+    """
+    __slots__ = ("lock", "buckets")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+class RateLimiter:
+    """
+    This class checks requests against the user, command and global limits.
+
+    A key is whatever identifies the sender (the username once logged in,
+    the connection before). check() may be called from any thread.
+    """
+
+    def __init__(self, limits=DEFAULT_RATE_LIMITS, shards=DEFAULT_SHARDS):
+        # Per-key buckets: slot -> name, seconds per request, and the
+        # seconds a bucket may run ahead of the clock (burst - 1 requests)
+        self.names = []
+        self.intervals = []
+        self.tolerances = []
+        self.slots = {}
+        self.global_interval = self.global_tolerance = 0.0
+        for name, (rate, burst) in limits.items():
+            if not rate:
+                continue
+            if name == "global":
+                self.global_interval = 1.0 / rate
+                self.global_tolerance = (burst - 1) / rate
+                continue
+            self.slots[name] = len(self.names)
+            self.names.append(name)
+            self.intervals.append(1.0 / rate)
+            self.tolerances.append((burst - 1) / rate)
+        self.user_slot = self.slots.pop("user", None)
+        self.global_due = 0.0
+        self.global_lock = threading.Lock()
+        self._shards = [_Shard() for _ in range(shards)]
+
+    @property
+    def enabled(self):
+        return bool(self.names or self.global_interval)
+
+    def check(self, key, command, now=None):
+        """
+        This function takes one request from key's buckets, if every one has room
+
+        Returns: None if the request may go ahead, otherwise the name of the
+        limit it is over ("user", "global", or the command)
+        """
+        if command in EXEMPT_COMMANDS:
+            return None
+        now = time.monotonic() if now is None else now
+        command_slot = self.slots.get(command)
+        if self.user_slot is not None or command_slot is not None:
+            shard = self._shards[hash(key) % len(self._shards)]
+            with shard.lock:
+                buckets = shard.buckets.get(key)
+                updates = []
+                for slot in (self.user_slot, command_slot):
+                    if slot is None:
+                        continue
+                    due = max(buckets[slot], now) if buckets is not None else now
+                    if due - now > self.tolerances[slot]:
+                        return self.names[slot]
+                    updates.append((slot, due + self.intervals[slot]))
+                if self.global_interval and self._over_global(now):
+                    return "global"
+                if buckets is None:
+                    buckets = shard.buckets[key] = array('d', bytes(8 * len(self.names)))
+                for slot, due in updates:
+                    buckets[slot] = due
+            return None
+        if self.global_interval and self._over_global(now):
+            return "global"
+        return None
+
+    def _over_global(self, now):
+        # Takes a request from the global bucket if it has room
+        with self.global_lock:
+            due = max(self.global_due, now)
+            if due - now > self.global_tolerance:
+                return True
+            self.global_due = due + self.global_interval
+            return False
+
+    def prune(self, now=None):
+        """
+        This function forgets every key whose buckets are all full again
+
+        Returns: Number of keys forgotten
+        """
+        now = time.monotonic() if now is None else now
+        pruned = 0
+        for shard in self._shards:
+            with shard.lock:
+                full = [key for key, buckets in shard.buckets.items() if max(buckets) <= now]
+                for key in full:
+                    del shard.buckets[key]
+            pruned += len(full)
+        return pruned
+
+    def __len__(self):
+        return sum(len(shard.buckets) for shard in self._shards)
@@ -0,0 +1,152 @@
+"""
+Chat rooms: named groups of logged-in users.
+
+A user joins a room with the join command and leaves it with leave, and a
+room message is only sent to that room's members:
+{"command": "room", "username": "user1", "room": "lobby", "message": "Hi"}
+{"type": "room", "room": "lobby", "from": "user1", "message": "Hi"}
+
+The registry keeps two indexes that always agree:
+- room -> members (username -> connection), so a room message is queued
+  for the members only instead of for every logged-in user
+- username -> rooms, so logging a user out (ex, a disconnect, or a login
+  somewhere else) leaves their rooms in O(rooms joined) instead of
+  searching every room
+
+Room membership belongs to a session: it is not stored, and a user starts
+with no rooms at every login. A room exists while it has members.
+"""
+import threading
+
+# Longest room name, and most rooms one user may be in at a time
+MAX_ROOM_NAME_LENGTH = 32
+MAX_ROOMS_PER_USER = 100
+
+def valid_room_name(room):
+    """
+    This function checks a room name sent by a client
+
+    Room names are 1 to MAX_ROOM_NAME_LENGTH printable characters without
+    spaces (Ex: "lobby", "team-7"), so the client can send "room lobby Hi".
+    """
+    return (isinstance(room, str) and 0 < len(room) <= MAX_ROOM_NAME_LENGTH
+            and room.isprintable() and not any(c.isspace() for c in room))
+
+class RoomRegistry:
+    """
+    This class tracks the members of every room.
+
+    One lock protects both indexes. members() returns an immutable tuple of
+    (username, connection) pairs that is cached until the room changes, the
+    same copy-on-write idea as SessionRegistry.snapshot(), so room messages
+    never iterate a dictionary another thread is changing.
+    """
+
+    def __init__(self, max_rooms_per_user=MAX_ROOMS_PER_USER):
+        self.max_rooms_per_user = max_rooms_per_user
+        self.lock = threading.Lock()
+        # room -> {username: connection}
+        self.rooms = {}
+        # username -> set of rooms
+        self.joined = {}
+        # room -> cached tuple of (username, connection), dropped on every change
+        self.snapshots = {}
+
+    def join(self, room, username, conn):
+        """
+        This function adds a user to a room (creating the room if needed)
+
+        Joining a room the user is already in only updates their connection.
+
+        Returns: False if the user is already in max_rooms_per_user rooms
+        """
+        with self.lock:
+            rooms = self.joined.get(username)
+            if rooms is None:
+                rooms = self.joined[username] = set()
+            elif room not in rooms and len(rooms) >= self.max_rooms_per_user:
+                return False
+            rooms.add(room)
+            members = self.rooms.get(room)
+            if members is None:
+                members = self.rooms[room] = {}
+            members[username] = conn
+            self.snapshots.pop(room, None)
+            return True
+
+    def leave(self, room, username):
+        """
+        This function removes a user from a room (the room goes away with its last member)
+
+        Returns: True if the user was in the room
+        """
+        with self.lock:
+            rooms = self.joined.get(username)
+            if rooms is None or room not in rooms:
+                return False
+            rooms.discard(room)
+            if not rooms:
+                del self.joined[username]
+            self._remove_member(room, username)
+            return True
+
+    def leave_all(self, username):
+        """
+        This function removes a user from every room they are in (Ex: when they log out)
+
+        Returns: List of the rooms the user left
+        """
+        with self.lock:
+            rooms = self.joined.pop(username, None)
+            if rooms is None:
+                return []
+            for room in rooms:
+                self._remove_member(room, username)
+            return list(rooms)
+
+    def _remove_member(self, room, username):
+        # Called with self.lock held
+        members = self.rooms[room]
+        del members[username]
+        if not members:
+            del self.rooms[room]
+        self.snapshots.pop(room, None)
+
+    def is_member(self, room, username):
+        with self.lock:
+            rooms = self.joined.get(username)
+            return rooms is not None and room in rooms
+
+    def members(self, room):
+        """
+        This function returns the members of a room as a tuple of (username, connection)
+
+        The tuple is cached until the room changes, so back-to-back room
+        messages share one copy. It is safe to iterate while other threads
+        change the registry.
+        """
+        with self.lock:
+            snapshot = self.snapshots.get(room)
+            if snapshot is None:
+                members = self.rooms.get(room)
+                if members is None:
+                    return ()
+                snapshot = self.snapshots[room] = tuple(members.items())
+            return snapshot
+
+    def rooms_of(self, username):
+        """
+        This function returns a sorted list of the rooms a user is in
+        """
+        with self.lock:
+            return sorted(self.joined.get(username, ()))
+
+    def __len__(self):
+        return len(self.rooms)
+
+    def memberships(self):
+        """
+        This function counts every (room, member) pair
+        """
+        with self.lock:
+            return sum(len(rooms) for rooms in self.joined.values())
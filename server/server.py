@@ -1,216 +1,2047 @@
 import threading
+import asyncio
+import time
+import argparse
 import sys
+import os
+import ssl
+import select
+import signal
+from collections import deque
+from concurrent.futures import Future
 from socket import *
-import json
 
-# In-memory storage for users (username -> password)
-active_users = {}
-USER_FILE = "users.json"
+# The framing layer is shared with the client (repository root /common)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common.framing import FrameDecoder, FrameTooLarge, DEFAULT_MAX_FRAME_SIZE, RECV_SIZE
+from common.codec import NameTable, SharedMessage, JSON_CODEC, new_codec, choose_codec
+from common.tls import server_context, HANDSHAKE_TIMEOUT
+from common.compression import (CompressedCodec, choose_compression, DEFAULT_COMPRESSION_THRESHOLD,
+                                DEFAULT_COMPRESSION_LEVEL)
+from user_store import open_user_store, ReplicaUserStore, USER_STORES, DEFAULT_USER_STORE, DEFAULT_FLUSH_INTERVAL
+from passwords import (PasswordHasher, HasherBusy, is_hashed, migrate_plaintext,
+                       DEFAULT_HASH_WORKERS, DEFAULT_CACHE_TTL, SCRYPT_N)
+from sessions import SessionRegistry
+from presence import PresenceTracker, DEFAULT_PRESENCE_WINDOW
+from rooms import RoomRegistry, valid_room_name
+from lookup import PrefixIndex, valid_lookup, described, DEFAULT_LOOKUP_LIMIT, MAX_PREFIX_LENGTH
+from history import (MessageLog, DEFAULT_SEGMENT_BYTES, DEFAULT_MAX_SEGMENTS, DEFAULT_REPLAY_PUBLIC,
+                     DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+from delivery import DeliveryWindow, receipts, DEFAULT_ACK_WINDOW
+from cluster import WorkerBus, ClusterPresence, Hub, reuse_port_probe, worker_command
+from outbound import (OutboundQueue, ThreadedConnection, SlowConsumer, SLOW_CONSUMER_POLICIES,
+                      DEFAULT_SLOW_CONSUMER_POLICY, DEFAULT_SEND_QUEUE_BYTES, DEFAULT_COALESCE_DELAY,
+                      DEFAULT_COALESCE_BYTES, write_frames)
+from heartbeat import (TimerWheel, HeartbeatMonitor, set_keepalive, DEFAULT_PING_INTERVAL, DEFAULT_IDLE_TIMEOUT,
+                       DEFAULT_READ_TIMEOUT, DEFAULT_TCP_KEEPALIVE)
+from ratelimit import RateLimiter, parse_rate_limit, DEFAULT_RATE_LIMITS, PRUNE_INTERVAL
+from handoff import (start_successor, receive_handoff, send_handoff, connection_state, restore_codec, restored_input,
+                     SHUTDOWN, RESTARTING, DEFAULT_DRAIN_TIMEOUT)
+from metrics import (REGISTRY, requests_total, request_seconds, broadcast_seconds, broadcast_recipients,
+                     accept_errors, frames_sent, rate_limited, tls_handshakes, serve_metrics)
 
-def load_users():
+# users is the UserStore (username -> password record), opened by load_users
+# Password hashing runs on the hasher's worker pool (see passwords.py)
+hasher = PasswordHasher()
+# active_users tracks logged-in users: username <-> connection (see sessions.py)
+active_users = SessionRegistry()
+# Logins and logouts go through presence so clients get join/leave deltas
+presence = PresenceTracker(active_users)
+# rooms indexes room -> members and user -> rooms (see rooms.py)
+rooms = RoomRegistry()
+# Sorted index of registered usernames for the lookup command (see lookup.py),
+# built once the user store is open
+user_index = PrefixIndex()
+# history is the MessageLog of every pm and dm (see history.py), opened in main
+history = None
+# Username ids shared by every connection using the binary codec (see common/codec.py)
+username_ids = NameTable()
+# Every timer of the process (heartbeats, the periodic broadcast) runs on one wheel,
+# and heartbeats pings silent connections and reaps dead ones (see heartbeat.py)
+wheel = TimerWheel()
+heartbeats = HeartbeatMonitor(wheel)
+# Token bucket limits per user, per command and for the whole process (see ratelimit.py)
+limiter = RateLimiter()
+
+# Public messages replayed to a user at login (set with --history-replay)
+replay_public = DEFAULT_REPLAY_PUBLIC
+
+# dms a client may leave unacknowledged before more wait in the history (set with --ack-window, see delivery.py)
+ack_window = DEFAULT_ACK_WINDOW
+
+# In a worker process of a multi-process server (--workers N), cluster is
+# the WorkerBus to the hub, and users/presence are replaced by copies that
+# the hub keeps up to date (see cluster.py). history is then None: the hub
+# stores and routes every message.
+cluster = None
+# Workers share the port with SO_REUSEPORT
+reuse_port = False
+
+# Pending connection queue size for the listening socket
+LISTEN_BACKLOG = 1024
+
+# Largest frame accepted from a client (set with --max-frame-size)
+max_frame_size = DEFAULT_MAX_FRAME_SIZE
+
+# Outbound queue limit per connection and what to do when it is full
+# (set with --send-queue-bytes and --slow-consumer)
+send_queue_bytes = DEFAULT_SEND_QUEUE_BYTES
+slow_consumer_policy = DEFAULT_SLOW_CONSUMER_POLICY
+
+# Write coalescing window (set with --coalesce-delay and --coalesce-bytes, see outbound.py)
+coalesce_delay = DEFAULT_COALESCE_DELAY
+coalesce_bytes = DEFAULT_COALESCE_BYTES
+
+# Frames compressed for clients that ask for it: smallest payload, and zlib level
+# (set with --compression-threshold and --compression-level, 0 turns compression off)
+compression_threshold = DEFAULT_COMPRESSION_THRESHOLD
+compression_level = DEFAULT_COMPRESSION_LEVEL
+
+# TLS settings when the server has a certificate (set with --tls-cert and --tls-key, see common/tls.py)
+tls_context = None
+
+# Seconds of silence before the kernel probes a client (set with --tcp-keepalive, 0 disables)
+tcp_keepalive = DEFAULT_TCP_KEEPALIVE
+
+# Seconds to write what is queued for clients when the server stops (set with --drain-timeout, see handoff.py)
+drain_timeout = DEFAULT_DRAIN_TIMEOUT
+# How the server is stopping: None while serving, then "drain" or "restart"
+stopping = None
+# Set once a hot restart has taken the sessions for the new process: from
+# then on no session is ended (or saved) by this process
+handed_over = False
+# What a stop signal asked the threaded engine's accept loop to do ("drain" or "restart")
+stop_requested = None
+# Client connections of this process. In the threaded engine, handler threads
+# that stopped reading wait in park() with their frame decoders in parked,
+# until release_parked is set
+connections = set()
+parked = {}
+release_parked = False
+connections_changed = threading.Condition()
+# Pipe that wakes the threaded engine's handler threads when the server stops
+wakeup_pipe = None
+# What the previous process of a hot restart handed over (see handoff.py)
+inheritance = None
+# The metrics endpoint, closed before a hot restart hands its port to the new process
+metrics_server = None
+# The user store and history are closed once (see close_stores)
+stores_closed = False
+
+# asyncio connections with frames waiting to be written, and whether a
+# flush of all of them is scheduled on the event loop
+pending_flushes = []
+flush_scheduled = False
+
+# asyncio transport buffer size before frames wait in the connection's queue
+TRANSPORT_HIGH_WATER = 64 * 1024
+
+# Seconds to wait before accepting again after accept fails (Ex: out of file descriptors)
+ACCEPT_RETRY_DELAY = 0.1
+
+# Seconds a worker has after its drain timeout to log its users out before the hub kills it
+WORKER_STOP_GRACE = 5.0
+
+# Usernames suggested when a dm's recipient is not registered
+SUGGESTIONS = 5
+
+# Signals that stop the server, and how
+STOP_SIGNALS = {signal.SIGTERM: "drain", signal.SIGINT: "drain", signal.SIGUSR2: "restart"}
+
+# Commands counted under their own name in the metrics (anything else is "unknown")
+METERED_COMMANDS = ("hello", "login", "register", "ex", "pm", "dm", "join", "leave", "room", "presence", "history", "lookup",
+                    "pong", "ack")
+
+def load_users(kind=DEFAULT_USER_STORE, flush_interval=DEFAULT_FLUSH_INTERVAL):
+    """
+    This function opens the user store (see user_store.py).
+
+    The default store is an append-only log that is streamed in line by
+    line, so startup does not parse one giant JSON file. An existing
+    USER_FILE is imported the first time.
+
+    Returns: UserStore with usernames as keys and passwords as values (username -> password)
+    """
+    return open_user_store(kind, flush_interval)
+
+def handle_client(client_sock, addr, adopted=None):
+    """
+    This function handles communication with a client (threaded engine).
+
+    It continuously recieves frames from the client and passes each message
+    to process_request, then queues the response for the client. One recv
+    may hold many frames (a burst from the client), and all of them are
+    processed before the next recv. Outgoing frames are written by the
+    connection's own writer thread (see outbound.py).
+    Any data from the client shows the heartbeat monitor it is alive; the
+    monitor shuts the socket down when it is not (see heartbeat.py).
+
+    With TLS, the handshake is done here first, so a slow handshake only
+    holds up its own thread and never the accept loop.
+
+    When the server stops, the thread stops reading between requests and
+    waits in park() (see handoff.py). adopted is (connection, decoder,
+    payloads) for a connection taken over from the previous process of a
+    hot restart, with the payloads it received but did not process.
+    """
+    if adopted is None:
+        print(f"Connection established with {addr}")
+        if tls_context is not None:
+            try:
+                client_sock = start_tls(client_sock)
+            except OSError as e:
+                tls_handshakes.inc("failed")
+                print(f"TLS handshake with {addr} failed: {e}")
+                client_sock.close()
+                return
+        decoder = FrameDecoder(max_frame_size)
+        client_conn = ThreadedConnection(client_sock, addr, send_queue_bytes, slow_consumer_policy,
+                                         coalesce_delay, coalesce_bytes)
+        payloads = []
+    else:
+        client_conn, decoder, payloads = adopted
+    # A plaintext socket is read without blocking, so the thread can notice
+    # the server stopping (the main thread shuts a TLS connection down instead)
+    poller = None
+    if not isinstance(client_sock, ssl.SSLSocket):
+        poller = select.poll()
+        poller.register(client_sock, select.POLLIN)
+        poller.register(wakeup_pipe[0], select.POLLIN)
+    with connections_changed:
+        connections.add(client_conn)
+    heartbeats.watch(client_conn)
+    try:
+        while True:
+            for payload in payloads:
+                response = handle_payload(client_conn, payload)
+                if response is not None:
+                    client_conn.send_message(response)
+
+            # Receive data from client
+            if poller is None:
+                data = client_conn.recv_tls(RECV_SIZE)
+            else:
+                data = receive(client_sock, poller)
+                if data is None:
+                    park(client_conn, decoder)
+                    break
+            if not data:
+                print(f"Client {addr} disconnected.")
+                break
+
+            payloads = decoder.feed(data)
+            received(client_conn, decoder)
+    except FrameTooLarge as e:
+        print(f"Closing {addr}: {e}")
+        try:
+            client_conn.send_message({"status": "frame_too_large"})
+        except ConnectionError:
+            pass
+    except (ConnectionError, OSError):
+        print(f"Connection error with {addr}.")
+    finally:
+        with connections_changed:
+            connections.discard(client_conn)
+            connections_changed.notify_all()
+        if not handed_over:
+            # Ensure queued frames are flushed and the client socket is closed upon exit
+            print(f"Closing connection to {addr}")
+            end_session(client_conn)
+        # After a hot restart only this process's copy of a moved socket is closed
+        client_conn.close()
+
+def receive(client_sock, poller):
+    """
+    This function waits for data from a plaintext client (threaded engine)
+
+    Data that is already waiting is read straight away; otherwise the thread
+    waits in poll() on the socket and on the wakeup pipe, which becomes
+    readable when the server stops.
+
+    Returns: Received bytes (b"" if the client disconnected), or None if the server is stopping
+    Raises: OSError if the connection failed
+    """
+    while stopping is None:
+        try:
+            return client_sock.recv(RECV_SIZE, MSG_DONTWAIT)
+        except BlockingIOError:
+            poller.poll()
+    return None
+
+def park(client_conn, decoder):
+    """
+    This function holds a handler thread that stopped reading until the server has stopped
+
+    Meanwhile the main thread closes the connection, or hands it with the
+    decoder's partly received frame to the new process of a hot restart.
+    """
+    with connections_changed:
+        parked[client_conn] = decoder
+        connections_changed.notify_all()
+        while not release_parked:
+            connections_changed.wait()
+
+def start_tls(client_sock):
+    """
+    This function does the server side of a TLS handshake (threaded engine)
+
+    Returns: ssl.SSLSocket
+    Raises: OSError (Ex: ssl.SSLError, or a timeout after HANDSHAKE_TIMEOUT seconds)
+    """
+    client_sock.settimeout(HANDSHAKE_TIMEOUT)
+    tls_sock = tls_context.wrap_socket(client_sock, server_side=True)
+    tls_sock.settimeout(None)
+    tls_handshakes.inc("resumed" if tls_sock.session_reused else "full")
+    return tls_sock
+
+def received(client_conn, decoder):
     """
-    This function loads user credentials from the USER_FILE (JSON).
+    This function notes that data arrived on a connection, for the heartbeat monitor
 
-    Returns: Dictionary with usernames as keys and passwords as values (username -> password)
+    A frame that is still partly in the decoder keeps the time it started
+    arriving, so a client cannot hold half a frame open forever.
     """
+    now = time.monotonic()
+    client_conn.last_received = now
+    if not decoder.buffered:
+        client_conn.frame_started = None
+    elif client_conn.frame_started is None:
+        client_conn.frame_started = now
+
+def decode_request(client_conn, payload):
+    """
+    This function decodes one frame payload into a request, with the connection's codec
+
+    A request needs a string command; username, password, recipient, room
+    and prefix may be left out or null (Ex: hello, or ex before login), but
+    are otherwise strings (a list or dict could not be looked up by name).
+    A message may be left out, but is otherwise a string, since it is sent
+    on to other clients and stored in history.
+
+    Returns: Request dictionary, or None if the payload is not a valid request
+    """
+    # Client JSON (or binary) -> request dictionary
     try:
-        with open(USER_FILE, 'r') as openfile:
-            json_object = json.load(openfile)
-            return json_object
-    except FileNotFoundError:
-        # If file does not exist, return empty ictionary
-        return {}
+        request = client_conn.codec.decode(payload)
+    except ValueError:
+        return None
+    if not isinstance(request, dict) or not isinstance(request.get("command"), str):
+        return None
+    for field in ("username", "password", "recipient", "room", "prefix"):
+        if request.get(field) is not None and not isinstance(request[field], str):
+            return None
+    if "message" in request and not isinstance(request["message"], str):
+        return None
+    return request
+
+def handle_payload(client_conn, payload):
+    """
+    This function decodes one frame payload and processes the request (threaded engine)
+
+    The handler thread waits here while the hasher pool checks a password.
 
-def save_users(users):
+    Returns: Response dictionary to send back to the client
     """
-    This function saves users to the USER_FILE.
-    It overwrites each time (it does not append)
+    start = time.perf_counter()
+    request = decode_request(client_conn, payload)
+    if request is None:
+        response = {"status": "invalid_message"}
+    else:
+        response = rate_limit(client_conn, request)
+    if response is None:
+        try:
+            work = password_work(request)
+        except HasherBusy:
+            response = {"status": "server_busy"}
+        else:
+            response = process_request(client_conn, request, work.result() if work is not None else None)
+    record_request(request, response, start)
+    return response
+
+def rate_limit(client_conn, request):
     """
-    with open(USER_FILE, "w") as outfile:
-        json.dump(users, outfile)
+    This function checks a request against the rate limits (see ratelimit.py)
+
+    A logged-in user is limited by username, so reconnecting does not
+    refill their buckets; before login the connection is the key.
 
-def handle_client(client_sock, addr):
+    Returns: {"status": "rate_limited"} if the request is over a limit, otherwise None
     """
-    This function handles communication with a client.
+    if not limiter.enabled:
+        return None
+    command = command_label(request)
+    username = active_users.username_for(client_conn)
+    over = limiter.check(username if username is not None else client_conn, command)
+    if over is None:
+        return None
+    rate_limited.inc(over, command)
+    return {"status": "rate_limited"}
 
-    It continuously recieves messages from the client.
-    It decides what to do based on the command type sent.
+def command_label(request):
+    """
+    This function names a request's command for the metrics and rate limits
+
+    Returns: The command, "unknown" if it is not in METERED_COMMANDS, or "invalid" for no request
+    """
+    command = request.get("command") if request is not None else None
+    command = command.lower() if isinstance(command, str) else None
+    if command not in METERED_COMMANDS:
+        command = "unknown" if request is not None else "invalid"
+    return command
 
-    login: Checks if username and password is in USER_FILE
-    register: Saves login info in USER_FILE as long as it's username is not taken
+def record_request(request, response, start):
+    """
+    This function updates the request metrics once a request is handled
+
+    start is the time.perf_counter() value when the request was received.
+    """
+    command = command_label(request)
+    # (None: the response was already queued, Ex: a login ahead of its replay)
+    status = response.get("status", "success") if response is not None else "success"
+    requests_total.inc(command, status)
+    request_seconds.observe(time.perf_counter() - start, command)
+
+def password_work(request):
+    """
+    This function starts the password hashing a request needs, if any
+
+    login: Verifies the password against the stored record (or answers
+    from the recent verification cache)
+    register: Hashes the new password
+
+    Returns: Future whose result is passed to process_request as prepared,
+    or None if the request needs no hashing
+    Raises: HasherBusy if the hashing queue is full
+    """
+    command = request.get("command")
+    username = request.get("username")
+    password = request.get("password")
+    if not isinstance(username, str) or not isinstance(password, str):
+        return None
+
+    if command == "login":
+        record = users.get(username)
+        if record is None:
+            return None
+        if hasher.cached(username, password, record):
+            done = Future()
+            done.set_result(True)
+            return done
+        return hasher.verify_async(username, password, record)
+
+    if command == "register":
+        if not username or not password or username in users:
+            return None
+        work = hasher.hash_async(password)
+        if cluster is not None:
+            # The hub checks the username across every worker and saves it
+            work = cluster.register(username, work)
+        return work
+
+    return None
+
+def process_request(client_conn, request, prepared=None):
+    """
+    This function processes a single request from a client.
+
+    It decides what to do based on the command type sent. It is shared by
+    both server engines, so client_conn may be a ThreadedConnection or an
+    AsyncConnection. Both provide send_message(), which encodes a message
+    with the connection's codec and queues it without blocking.
+
+    hello: Picks the codec and compression for the rest of the connection (before login)
+    login: Checks if username and password is in the user store
+    register: Saves login info in the user store as long as it's username is not taken
     ex: Logs the user out and removes from active_users
     pm: Broadcasts a public message to all active_users
-    dm: Sends a direct message to a specified recipient
+    dm: Sends a direct message to a specified recipient (stored for later if they are offline)
+    ack: Acknowledges the dms a client received, up to an id (nothing is sent back, see delivery.py)
+    join: Adds the user to a room (see rooms.py)
+    leave: Removes the user from a room
+    room: Sends a message to the members of a room the user is in
+    presence: Replies with a full snapshot of active_users (Ex: after a sequence gap)
+    history: Sends a page of older messages
+    lookup: Replies with the registered users whose name starts with a prefix, and whether they are online
+    pong: Answers a heartbeat ping (nothing is sent back, see heartbeat.py)
+
+    Every pm and dm is stored in history, which gives it its id. The pm and
+    dm statuses carry that id. After a successful login the user is sent
+    their unread dms and the last public messages.
+
+    prepared is the result of password_work: True/False for login (password
+    verified), or the new password record for register.
+
+    Returns: Response dictionary to send back to the client, or None if
+    there is nothing more to send (login queues its response ahead of the replay)
     """
     global users
-    print(f"Connection established with {addr}")
-    try:
-        while True:
-            # Receive message from client
-            message = client_sock.recv(1024).decode('utf-8')
-            if not message:
-                print(f"Client {addr} disconnected.")
-                break
+    command = request.get("command")
+    username = request.get("username")
+    password = request.get("password")
 
-            # Client JSON -> variables
-            request = json.loads(message)
-            command = request.get("command")
-            username = request.get("username")
-            password = request.get("password")
-
-            # Process login message from client
-            if command == "login":
-                # Valid login
-                if username in users and users[username] == password:
-                    active_users[username] = client_sock
-                    response = {"status": "success", "active_users": list(active_users.keys())}
-                    broadcast_active_users(client_sock) # Broadcast active_users to all active clients
-                # Catch invalid logins and update status to the client
-                elif username not in users:
-                    response = {"status": "user_not_found"}
-                else:
-                    response = {"status": "failed"}
+    # Process login message from client
+    if command == "login":
+        # Valid login
+        stored_password = users.get(username)
+        if stored_password is not None and prepared is True:
+            # A user already logged in on this connection is logged out first,
+            # so the others see them leave
+            end_session(client_conn)
+            # A new session starts with no rooms (Ex: the user was logged in elsewhere)
+            rooms.leave_all(username)
+            # Live dms wait until the login replay has been sent (see delivery.py)
+            client_conn.window = DeliveryWindow(ack_window, client_conn.queue.dropped)
+            # Other clients learn about the login from the next presence batch
+            usernames, seq = presence.login(username, client_conn)
+            response = {"status": "success", "active_users": usernames, "presence_seq": seq}
+            if not is_hashed(stored_password):
+                # Legacy plaintext record: replace it with a hash in the background
+                hasher.rehash_later(users, username, password, stored_password)
+            try:
+                # The client reads the login response first, then the replay
+                send_login_replay(client_conn, username, response)
+            except ConnectionError:
+                pass # Disconnected; the dms stay unread
+            response = None
+        # Catch invalid logins and update status to the client
+        elif stored_password is None:
+            response = {"status": "user_not_found"}
+        else:
+            response = {"status": "failed"}
 
-            # Process register message from client
-            elif command == "register":
-                if username in users:
-                    response = {"status": "username_taken"}
-                else:
-                    users[username] = password  # Store user in memory
-                    save_users(users)
-                    response = {"status": "success"}
-
-            # Process exit message from client
-            elif command.lower() == "ex":
-                # Handle the EX command (logout)
-                if username in active_users:
-                    del active_users[username]
-                    response = {"status": "exiting"}
-                    broadcast_active_users(client_sock) # Broadcast active_users to all active clients
+    # Process register message from client
+    elif command == "register":
+        if not username or not password:
+            response = {"status": "failed"}
+        # add() checks and stores in one step, so concurrent registrations cannot race
+        elif prepared is None or not users.add(username, prepared):
+            response = {"status": "username_taken"}
+        else:
+            user_index.add(username)
+            response = {"status": "success"}
+
+    # Process codec negotiation from client
+    elif command == "hello":
+        if active_users.username_for(client_conn) is not None:
+            # Messages may already be on their way in the current codec
+            response = {"status": "failed"}
+        else:
+            codec_name = choose_codec(request.get("codecs"))
+            compression = choose_compression(request.get("compression")) if compression_level else None
+            answer = {"status": "hello", "codec": codec_name}
+            if compression is not None:
+                answer["compression"] = compression
+            try:
+                # The answer is in the old codec; every later frame uses the new one
+                client_conn.send_message(answer)
+            except ConnectionError:
+                pass
+            client_conn.codec = new_codec(codec_name, username_ids)
+            if compression is not None:
+                # Large frames in both directions are compressed (see common/compression.py)
+                client_conn.codec = CompressedCodec(client_conn.codec, compression_threshold, compression_level,
+                                                    max_frame_size)
+            response = None
+
+    # Process exit message from client
+    elif command.lower() == "ex":
+        # Handle the EX command (logout)
+        if history is not None and active_users.get(username) is client_conn:
+            # Remember which dms were delivered before the user goes offline
+            history.save_cursor(username)
+        # Only the connection the user logged in on may log them out
+        if presence.logout(username, client_conn):
+            rooms.leave_all(username)
+            response = {"status": "exiting"}
+        else:
+            response = {"status": "user_not_logged_in"}
+
+    # Process pm message from client
+    elif command.lower() == "pm":
+        # Only the connection the user logged in on may send as them
+        if active_users.get(username) is client_conn:
+            message_content = request.get("message", "")
+            broadcast_message = {
+                "type": "pm",
+                "from": username,
+                "message": message_content
+            }
+
+            if cluster is not None:
+                # The hub stores it, which gives it its id, and sends it to every
+                # worker; this one sends the sender its status (see deliver_public)
+                cluster.publish({"op": "pm", "message": broadcast_message})
+                response = None
+            else:
+                # Store it first, so it is sent with its id
+                broadcast_message["id"] = history.append(broadcast_message)["id"]
+                response = send_public(broadcast_message, client_conn)
+        else:
+            response = {"status": "sender_not_active"}
+
+    # Process room join/leave from client
+    elif command.lower() in ("join", "leave"):
+        room = request.get("room")
+        if active_users.get(username) is not client_conn:
+            response = {"status": "sender_not_active"}
+        elif not valid_room_name(room):
+            response = {"status": "invalid_room"}
+        elif command.lower() == "join":
+            if rooms.join(room, username, client_conn):
+                response = {"status": "room_joined", "room": room}
+            else:
+                response = {"status": "too_many_rooms"}
+        elif rooms.leave(room, username):
+            response = {"status": "room_left", "room": room}
+        else:
+            response = {"status": "not_in_room", "room": room}
+
+    # Process room message from client
+    elif command.lower() == "room":
+        room = request.get("room")
+        if active_users.get(username) is not client_conn:
+            response = {"status": "sender_not_active"}
+        elif not valid_room_name(room) or not rooms.is_member(room, username):
+            response = {"status": "not_in_room", "room": room if isinstance(room, str) else ""}
+        else:
+            room_message = {
+                "type": "room",
+                "room": room,
+                "from": username,
+                "message": request.get("message", "")
+            }
+            if cluster is not None:
+                # The hub sends it on to the other workers, which have their own members
+                cluster.publish({"op": "room", "message": room_message})
+            send_room_message(room_message, client_conn)
+            response = {"status": "message_sent"}
+
+    # Heartbeat answer: receiving it was enough
+    elif command == "pong":
+        response = None
+
+    # Delivery acknowledgement: nothing is sent back
+    elif command == "ack":
+        message_id = request.get("id")
+        # Not isinstance: true and false would acknowledge ids 1 and 0
+        if active_users.get(username) is client_conn and type(message_id) is int:
+            acknowledge(client_conn, username, message_id)
+        response = None
+
+    # Process presence snapshot request from client
+    elif command.lower() == "presence":
+        response = presence.snapshot_message()
+
+    # Process history request from client
+    elif command.lower() == "history":
+        if active_users.get(username) is client_conn:
+            response = send_history_page(client_conn, username, request)
+        else:
+            response = {"status": "sender_not_active"}
+
+    # Process username lookup from client (Ex: tab completion of a dm recipient)
+    elif command.lower() == "lookup":
+        prefix = request.get("prefix")
+        limit = request.get("limit", DEFAULT_LOOKUP_LIMIT)
+        if active_users.get(username) is not client_conn:
+            response = {"status": "sender_not_active"}
+        elif not valid_lookup(prefix, limit):
+            response = {"status": "invalid_lookup"}
+        else:
+            response = {"status": "lookup", "prefix": prefix,
+                        "matches": described(user_index.matches(prefix, limit), presence.is_online)}
+
+    # Process dm message from client
+    elif command.lower() == "dm":
+        # Only the connection the user logged in on may send as them
+        if active_users.get(username) is client_conn:
+            message_content = request.get("message", "")
+            recipient_username = request.get("recipient")
+
+            recipient_conn = active_users.get(recipient_username)
+            if recipient_username == username:
+                response = {"status": "cannot_message_self"} # Prevent user sending to themselves
+            elif recipient_conn is not None or recipient_username in users:
+                direct_message = {
+                    "type": "dm",
+                    "from": username,
+                    "message": message_content
+                }
+                if cluster is not None:
+                    # The hub stores it, sends it to the recipient's worker, and
+                    # sends the sender's status with its id back here (see deliver_status)
+                    cluster.publish({"op": "dm", "to": recipient_username, "message": direct_message})
+                    response = None
+                elif recipient_conn is None:
+                    # Stored, so it is replayed at the next login
+                    record = history.append(dict(direct_message, to=recipient_username))
+                    response = {"status": "message_stored", "id": record["id"]} # Recipient is offline
                 else:
-                    response = {"status": "user_not_logged_in"}
-
-            # Process pm message from client
-            elif command.lower() == "pm":
-                if username in active_users:
-                    message_content = request.get("message", "")
-                    broadcast_message = {
-                        "type": "pm",
-                        "from": username,
-                        "message": message_content
-                    }
-
-                    # Send the message to all active users
-                    for user, user_sock in active_users.items():
-                        if user_sock != client_sock:  # Don't send back to the sender
-                            try:
-                                # Send to user
-                                user_sock.send(json.dumps(broadcast_message).encode('utf-8'))
-                            except:
-                                response = {"status": "message_failed"}
-                response = {"status": "message_sent"}
-
-            # Process dm message from client
-            elif command.lower() == "dm":
-                if username in active_users:
-                    message_content = request.get("message", "")
-                    recipient_username = request.get("recipient")
-
-                    if recipient_username in active_users:
-                        if recipient_username != username:
-                            recipient_sock = active_users[recipient_username]
-                            if recipient_sock:
-                                direct_message = {
-                                    "type": "dm",
-                                    "from": username,
-                                    "message": message_content
-                                }
-                                try:
-                                    # Send to specific user
-                                    recipient_sock.send(json.dumps(direct_message).encode('utf-8'))
-                                    response = {"status": "message_sent"}
-                                except:
-                                    response = {"status": "message_failed"}
-                            else:
-                                response = {"status": "recipient_sock_not_found"}
-                        else:
-                            response = {"status": "cannot_message_self"} # Prevent user sending to themselves
-                    else:
-                        response = {"status": "recipient_username_not_found"}
+                    # Stored first, so it is replayed at the next login if it is not acknowledged;
+                    # under the recipient's window lock, so their dms are sent in id order
+                    with recipient_conn.window.lock:
+                        direct_message["id"] = history.append(dict(direct_message, to=recipient_username))["id"]
+                        response = {"status": send_direct(recipient_conn, recipient_username, direct_message),
+                                    "id": direct_message["id"]}
+            else:
+                response = {"status": "recipient_username_not_found"}
+                if isinstance(recipient_username, str):
+                    # Registered names that start the same way (Ex: a typo at the end of the name)
+                    suggestions = user_index.closest(recipient_username[:MAX_PREFIX_LENGTH], SUGGESTIONS)
+                    if suggestions:
+                        response["suggestions"] = described(suggestions, presence.is_online)
+        else:
+            response = {"status": "sender_not_active"}
+
+    # Catch invlaid command
+    else:
+        response = {"status": "unknown_command"}
+
+    return response
+
+def send_room_message(room_message, excluded_conn=None):
+    """
+    This function queues a room message for every member of its room on this server
+
+    Only the room's members are visited, however many users are logged in.
+    """
+    start = time.perf_counter()
+    # Encode once per codec, then queue the same frame for every member
+    shared = SharedMessage(room_message)
+    members = rooms.members(room_message["room"])
+    for user, user_conn in members:
+        if user_conn is not excluded_conn:  # Don't send back to the sender
+            try:
+                user_conn.send_message(shared)
+            except ConnectionError:
+                pass # The member disconnected (counted in chat_send_failures_total)
+    broadcast_seconds.observe(time.perf_counter() - start, "room")
+    broadcast_recipients.inc("room", amount=len(members) - (excluded_conn is not None))
+
+def send_login_replay(client_conn, username, response):
+    """
+    This function queues a login response, then the user's replay: the last
+    public messages and their unread dms
+
+    Only as many unread dms as fit in the user's window are sent; the rest
+    follow as the client acknowledges them (see delivery.py). With workers,
+    the hub holds the history, so the replay is sent when the hub's answer
+    arrives (see deliver_replay).
+
+    Raises: ConnectionError if the client disconnected
+    """
+    window = client_conn.window
+    if cluster is not None:
+        client_conn.send_message(response)
+        with window.lock:
+            window.requested = True
+        cluster.publish({"op": "replay", "user": username, "public": True, "limit": window.size,
+                         "resets": window.resets})
+        return
+
+    with window.lock:
+        unread_ids, unread = history.unread(username, window.size)
+        response["unread"] = unread
+        client_conn.send_message(response)
+        window.behind = unread > len(unread_ids)
+        replay_history(client_conn, history.read(history.recent_public(replay_public) + unread_ids), window)
+
+def replay_history(client_conn, records, window=None):
+    """
+    This function sends stored messages to a client, oldest first
+
+    records is an iterable of history records (Ex: history.read(ids), which
+    reads them from the log one at a time, so a long replay never has to be
+    held in memory at once). With window (the user's DeliveryWindow, its
+    lock held), the dms are added to it, and dms it already sent are skipped.
+    The dms stop before one that would overfill the connection's queue while
+    an earlier one still waits for its ack: the slow consumer policy would
+    drop a frame, the window would be reset, and the same dms sent again at
+    every ack. The rest is sent as the acks arrive (window.behind).
+
+    Ex: {"type": "dm", "from": "user1", "message": "Hello", "id": 7, "time": 1700000000.5, "history": true}
+
+    Returns: Id of the oldest message sent (None if there were none)
+    Raises: ConnectionError if the client disconnected (Ex: too slow to take the replay)
+    """
+    oldest = None
+    for record in records:
+        record.pop("to", None)
+        record["history"] = True
+        if window is not None and record["type"] == "dm":
+            # The JSON frame is the largest any codec makes of it
+            if window.pending and not client_conn.queue.fits(len(JSON_CODEC.encode(record))):
+                window.behind = True
+                break
+            if not window.sent(record["id"], record["from"]):
+                continue
+        client_conn.send_message(record)
+        if oldest is None:
+            oldest = record["id"]
+    return oldest
+
+def send_public(public_message, sender_conn=None):
+    """
+    This function queues a pm (with its id) for every user on this server except its sender
+
+    Returns: {"status": "message_sent", "id": ...}, with "message_failed"
+    instead if it could not be queued for anyone it was sent to (it is
+    stored either way)
+    """
+    start = time.perf_counter()
+    # Encode once per codec, then queue the same frame for every recipient
+    shared = SharedMessage(public_message)
+
+    # Send the message to all active users (snapshot is safe to iterate)
+    recipients = active_users.snapshot()
+    queued = failed = 0
+    for user, user_conn in recipients:
+        if user_conn is not sender_conn:  # Don't send back to the sender
+            try:
+                # Queue for user (a slow user only fills its own queue)
+                if user_conn.send_message(shared):
+                    queued += 1
                 else:
-                    response = {"status": "sender_not_active"}
+                    failed += 1 # Dropped by the slow consumer policy
+            except ConnectionError:
+                failed += 1 # The recipient disconnected (counted in chat_send_failures_total)
+    broadcast_seconds.observe(time.perf_counter() - start, "pm")
+    broadcast_recipients.inc("pm", amount=queued + failed)
+    return {"status": "message_failed" if failed and not queued else "message_sent", "id": public_message["id"]}
 
-            # Catch invlaid command
-            else:
-                response = {"status": "unknown_command"}
+def send_direct(recipient_conn, recipient_username, direct_message):
+    """
+    This function sends a stored dm (with its id) to its logged-in recipient, after the dms before it
 
-            client_sock.send(json.dumps(response).encode('utf-8'))
+    Called with the recipient's window lock held. A dm that does not fit in
+    the window waits in the history until acknowledgements make room (see delivery.py).
+
+    Returns: "message_sent" if it was queued, "message_stored" if it waits
+    for the window, or "message_failed" if the recipient disconnected or the
+    slow consumer policy dropped it (it stays unread, and is sent again)
+    """
+    window = recipient_conn.window
+    check_dropped(recipient_conn)
+    try:
+        if window.open():
+            if window.sent(direct_message["id"], direct_message["from"]) and \
+                    not recipient_conn.send_message(direct_message):
+                return "message_failed"
+        else:
+            # Full or behind: this dm waits in the history, after the dms the
+            # window missed (they go first, this one too if there is room)
+            window.behind = True
+            catch_up(recipient_conn, recipient_username)
     except ConnectionError:
-        print(f"Connection error with {addr}.")
+        return "message_failed"
+    sent = window.newest is not None and window.newest >= direct_message["id"]
+    return "message_sent" if sent else "message_stored"
+
+def check_dropped(client_conn):
+    """
+    This function resets a connection's window if frames were dropped since it last looked
+
+    A dropped frame may have been one of its dms, which a later
+    acknowledgement would then cover; so every dm not acknowledged yet is
+    sent again (clients drop the ones they already have). Called with the
+    window's lock held.
+    """
+    dropped = client_conn.queue.dropped
+    if dropped != client_conn.window.dropped:
+        client_conn.window.reset(dropped)
+
+def catch_up(user_conn, username):
+    """
+    This function sends the stored dms a window fell behind on, as many as it has room for
+
+    Called with the window's lock held. With workers, the hub is asked for
+    them instead (they are sent by deliver_replay).
+
+    Raises: ConnectionError if the client disconnected
+    """
+    window = user_conn.window
+    room = window.room()
+    if room <= 0:
+        return # Sent once the client acknowledges some of its dms
+    if cluster is not None:
+        if not window.requested:
+            window.requested = True
+            cluster.publish({"op": "replay", "user": username, "after": window.newest, "limit": room,
+                             "resets": window.resets})
+        return
+    ids, unread = history.unread(username, room, window.newest)
+    window.behind = unread > len(ids)
+    replay_history(user_conn, history.read(ids), window)
+
+def acknowledge(client_conn, username, message_id):
+    """
+    This function handles an ack: the client received every dm up to message_id
+
+    The read cursor moves to the newest dm acknowledged, their senders are
+    sent receipts, and a window that fell behind sends the dms it missed.
+    """
+    window = client_conn.window
+    with window.lock:
+        check_dropped(client_conn)
+        acknowledged = window.acknowledge(message_id)
+        if acknowledged and cluster is not None:
+            # The hub moves the read cursor and sends the receipts on to the senders' workers
+            cluster.publish({"op": "read", "user": username, "id": acknowledged[-1][0],
+                             "receipts": receipts(acknowledged)})
+        elif acknowledged:
+            history.mark_read(username, acknowledged[-1][0])
+        if window.behind:
+            try:
+                catch_up(client_conn, username)
+            except ConnectionError:
+                pass
+    if acknowledged and cluster is None:
+        for sender, ids in receipts(acknowledged).items():
+            send_receipt(sender, username, ids)
+
+def send_receipt(sender, recipient, ids):
+    """
+    This function tells the sender of dms, if they are logged in here, that the recipient received them
+
+    Ex: {"type": "delivered", "to": "user2", "ids": [41, 42]}
+    """
+    sender_conn = active_users.get(sender)
+    if sender_conn is not None:
+        notify(sender_conn, {"type": "delivered", "to": recipient, "ids": ids})
+
+def send_history_page(client_conn, username, request):
+    """
+    This function sends one page of older messages for the history command
+
+    Request fields (all optional):
+    before: Only messages with a smaller id (Ex: the "before" of the last page)
+    before_time: Only messages sent before this Unix time
+    limit: Page size (at most MAX_PAGE_SIZE)
+
+    The messages are sent first, then the returned end-of-page response.
+
+    Returns: {"status": "history_end", "before": oldest id sent, "more": True if there are older messages},
+    or None if the client disconnected (or, with workers, if the hub will send the page)
+    """
+    before = request.get("before")
+    before_time = request.get("before_time")
+    # bool is an int subclass, so true would otherwise be read as 1
+    if type(before_time) not in (int, float):
+        before_time = None
+    limit = request.get("limit", DEFAULT_PAGE_SIZE)
+    if type(limit) is not int or limit <= 0:
+        return {"status": "invalid_message"}
+    if before is not None and (type(before) is not int or before <= 0):
+        return {"status": "invalid_message"}
+    limit = min(limit, MAX_PAGE_SIZE)
+
+    if cluster is not None:
+        # Sent with its history_end by deliver_history_page
+        cluster.publish({"op": "history", "user": username, "before": before,
+                         "before_time": before_time, "limit": limit})
+        return None
+
+    if before_time is not None:
+        before = history.id_before_time(before_time)
+    ids, more = history.page(username, before, limit)
+    try:
+        oldest = replay_history(client_conn, history.read(ids))
+    except ConnectionError:
+        return None
+    return {"status": "history_end", "before": oldest if oldest is not None else before, "more": more}
+
+class AsyncConnection(asyncio.Protocol):
+    """
+    This class handles communication with a client (asyncio engine).
+
+    It is the event loop version of handle_client. Each connection is a small
+    protocol object instead of a thread, so one process can hold many
+    thousands of idle connections.
+
+    Outgoing frames are queued, and every connection with queued frames is
+    flushed once the event loop has finished what it is doing (or after
+    coalesce_delay), so all the frames one pass produced for a client (Ex:
+    replies to a burst of requests, and pms from other users) go out in a
+    single writev.
+
+    Password hashing must not run on the event loop. While a login or
+    register waits for the hasher pool, this connection's later requests
+    wait in self.backlog (and reading is paused), so responses stay in order.
+
+    restored is the state of a connection taken over from the previous
+    process of a hot restart (see handoff.py).
+    """
+
+    def __init__(self, restored=None):
+        self.restored = restored
+        self.transport = None
+        self.addr = None
+        self.loop = None
+        self.decoder = FrameDecoder(max_frame_size)
+        self.codec = JSON_CODEC
+        # Frames wait here until the next flush, or while the transport's own buffer is full
+        self.queue = OutboundQueue(send_queue_bytes, slow_consumer_policy)
+        self.paused = False
+        self.flush_pending = False
+        # Writes the socket directly (see _flush)
+        self.write = None
+        # Received payloads not processed yet, and whether one is waiting for the hasher
+        self.backlog = deque()
+        self.waiting = False
+        # When data last arrived, when a partly received frame started, and
+        # when the last ping was sent (see heartbeat.py)
+        self.last_received = time.monotonic()
+        self.frame_started = None
+        self.last_ping = 0.0
+        # The user's DeliveryWindow once logged in (see delivery.py)
+        self.window = None
+
+    @property
+    def closed(self):
+        return self.transport.is_closing()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.addr = transport.get_extra_info('peername')
+        self.loop = asyncio.get_running_loop()
+        transport.set_write_buffer_limits(high=TRANSPORT_HIGH_WATER)
+        # asyncio turns Nagle's algorithm off for TCP; writes are coalesced here instead
+        sock = transport.get_extra_info('socket')
+        fd = sock.fileno()
+        self.write = lambda buffers: os.writev(fd, buffers)
+        ssl_object = transport.get_extra_info('ssl_object')
+        if ssl_object is not None:
+            # The event loop did the TLS handshake; frames must go through the transport to be encrypted
+            self.write = None
+            tls_handshakes.inc("resumed" if ssl_object.session_reused else "full")
+        set_keepalive(sock, tcp_keepalive)
+        heartbeats.watch(self)
+        connections.add(self)
+        if self.restored is not None:
+            # Reading starts once every moved session is restored (see adopt_async)
+            transport.pause_reading()
+            self.backlog.extend(restore_connection(self, self.decoder, self.restored))
+        else:
+            print(f"Connection established with {self.addr}")
+
+    def data_received(self, data):
+        try:
+            payloads = self.decoder.feed(data)
+        except FrameTooLarge as e:
+            print(f"Closing {self.addr}: {e}")
+            self._flush()
+            self.transport.write(self.codec.encode({"status": "frame_too_large"}))
+            self.transport.close()
+            return
+
+        received(self, self.decoder)
+        self.backlog.extend(payloads)
+        self._process_backlog()
+
+    def _process_backlog(self):
+        """
+        This function processes received requests until one has to wait for the hasher
+        """
+        while self.backlog and not self.waiting and stopping is None and not self.transport.is_closing():
+            start = time.perf_counter()
+            request = decode_request(self, self.backlog.popleft())
+            if request is None:
+                self._respond(request, {"status": "invalid_message"}, start)
+                continue
+            response = rate_limit(self, request)
+            if response is not None:
+                self._respond(request, response, start)
+                continue
+            try:
+                work = password_work(request)
+            except HasherBusy:
+                self._respond(request, {"status": "server_busy"}, start)
+                continue
+
+            if work is not None and not work.done():
+                # Finish this request when the hasher is done
+                self.waiting = True
+                self.transport.pause_reading()
+                work.add_done_callback(lambda done, request=request, start=start:
+                                       self.loop.call_soon_threadsafe(self._work_done, request, done, start))
+                return
+            self._respond(request, process_request(self, request, work.result() if work is not None else None), start)
+
+    def _work_done(self, request, work, start):
+        """
+        This function finishes a request once its password hashing is done
+        """
+        self.waiting = False
+        if self.transport.is_closing():
+            return
+        self._respond(request, process_request(self, request, work.result()), start)
+        if stopping is not None:
+            return # Reading stays paused while the server stops
+        self.transport.resume_reading()
+        self._process_backlog()
+
+    def _respond(self, request, response, start):
+        record_request(request, response, start)
+        if response is None:
+            return # Nothing more to send (Ex: a login response queued ahead of its replay)
+        try:
+            self.send_message(response)
+        except ConnectionError:
+            print(f"Connection error with {self.addr}.")
+
+    def eof_received(self):
+        print(f"Client {self.addr} disconnected.")
+        # Returning a false value lets the transport close itself
+        return False
+
+    def connection_lost(self, exc):
+        connections.discard(self)
+        self.queue.pop_all()
+        self.backlog.clear()
+        if handed_over:
+            return # The session moved to the new process of a hot restart
+        print(f"Closing connection to {self.addr}")
+        end_session(self)
+
+    def abort(self):
+        # Closes at once, dropping queued frames (Ex: a dead connection reaped by heartbeats)
+        self.queue.pop_all()
+        self.transport.abort()
+
+    def finish(self):
+        # Hands every queued frame to the transport, which closes once it has written them (Ex: when the server stops)
+        if self.transport.is_closing():
+            return
+        frames = self.queue.pop_all()
+        if frames:
+            self.transport.writelines(frames)
+        self.transport.close()
+
+    def flushed(self):
+        """
+        This function writes what is queued, if the socket takes it
+
+        Returns: True if nothing is left to write and no request is waiting for the hasher
+        """
+        self._flush()
+        return not self.waiting and not self.queue and self.transport.get_write_buffer_size() == 0
+
+    def pause_writing(self):
+        # The transport buffer passed TRANSPORT_HIGH_WATER: hold frames in the queue
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        self._flush()
+
+    def send_frame(self, frame):
+        """
+        This function queues an encoded frame for the client (never blocks)
+
+        Returns: True if queued, False if dropped by the slow consumer policy
+        Raises: ConnectionError if the connection is closing or was too slow
+        """
+        if self.transport.is_closing():
+            raise ConnectionError(f"Connection to {self.addr} is closed")
+        try:
+            queued = self.queue.push(frame)
+        except SlowConsumer:
+            print(f"Disconnecting slow client {self.addr}")
+            self.transport.abort()
+            raise
+        if not self.paused:
+            if self.queue.queued_bytes >= coalesce_bytes:
+                self._flush()
+            elif not self.flush_pending:
+                self.flush_pending = True
+                schedule_flush(self)
+        return queued
+
+    def send_message(self, message):
+        """
+        This function encodes a message (or a SharedMessage) with the connection's codec and queues it
+
+        Returns: True if queued, False if dropped by the slow consumer policy
+        Raises: ConnectionError if the connection is closing or was too slow
+        """
+        dropped = self.queue.dropped
+        queued = self.send_frame(self.codec.encode(message, self.queue.tentative))
+        if self.queue.dropped != dropped:
+            # A dropped frame may have defined usernames for the binary codec
+            self.codec.forget()
+        return queued
+
+    def _flush(self):
+        """
+        This function writes every queued frame with one writev (unless the transport is paused)
+
+        While the transport has nothing buffered, the frames are written to
+        the socket directly from their own buffers (except with TLS). Whatever the socket does
+        not take (or everything, while the transport still has buffered
+        data) is handed to the transport, which keeps it in order and writes
+        it when the socket is ready.
+        """
+        if self.paused or not self.queue:
+            return
+        if self.transport.is_closing():
+            self.queue.pop_all()
+            return
+        frames = self.queue.pop_all()
+        # Nothing encoded so far can be dropped any more
+        self.codec.confirm()
+        if self.write is not None and self.transport.get_write_buffer_size() == 0:
+            try:
+                frames = write_frames(self.write, frames)
+            except OSError:
+                pass # The transport gets the same error when it writes, and closes the connection
+        else:
+            frames_sent.inc(amount=len(frames))
+        if frames:
+            self.transport.writelines(frames)
+
+def schedule_flush(client_conn):
+    """
+    This function flushes a connection once the event loop finishes its current work
+
+    Every connection with queued frames shares one scheduled call, so a pm
+    to thousands of users costs one callback, not one per user.
+    """
+    global flush_scheduled
+    pending_flushes.append(client_conn)
+    if not flush_scheduled:
+        flush_scheduled = True
+        loop = asyncio.get_running_loop()
+        if coalesce_delay:
+            loop.call_later(coalesce_delay, flush_connections)
+        else:
+            loop.call_soon(flush_connections)
+
+def flush_connections():
+    """
+    This function flushes every connection waiting in pending_flushes
+    """
+    global pending_flushes, flush_scheduled
+    connections = pending_flushes
+    pending_flushes = []
+    flush_scheduled = False
+    for client_conn in connections:
+        client_conn.flush_pending = False
+        client_conn._flush()
+
+def end_session(client_conn):
+    """
+    This function logs out the user on a closed connection, if any
+
+    A client that disconnects without sending ex would otherwise stay in
+    active_users.
+    """
+    username = active_users.username_for(client_conn)
+    if username is not None and history is not None:
+        history.save_cursor(username)
+    if presence.disconnect(client_conn) is not None:
+        # Only the user's own rooms are visited
+        rooms.leave_all(username)
+
+def notify(client_conn, notice):
+    """
+    This function queues a notice for a client, if its connection is still open (Ex: SHUTDOWN)
+    """
+    try:
+        client_conn.send_message(notice)
+    except ConnectionError:
+        pass
+
+def close_stores():
+    """
+    This function writes pending user store records, then closes the user store and history (once)
+    """
+    global stores_closed
+    if stores_closed:
+        return
+    stores_closed = True
+    hasher.shutdown()
+    users.close()
+    if history is not None:
+        history.close()
+
+def begin_restart():
+    """
+    This function starts the new process of a hot restart (see handoff.py)
+
+    Returns: The handoff socket to the new process, or None to keep serving
+    """
+    if cluster is not None:
+        print("Hot restart is not supported with --workers; still serving")
+        return None
+    print("Hot restart: starting a new server process")
+    return start_successor(sys.argv[1:])
+
+def hand_over(channel, listener_fds, candidates, flushed):
+    """
+    This function freezes the sessions and sends them, with the listening
+    sockets and the connections that can move, to the new process
+
+    candidates are (connection, socket fd, decoder, payloads not processed)
+    for the connections that stopped reading. flushed(connection) writes what
+    is queued for the connection and says whether all of it went out.
+
+    Returns: (connections that moved, connections the engine must tell to
+    reconnect and close)
+    """
+    global handed_over, metrics_server
+    # No presence update is sent from here on; the new process continues the sequence
+    seq, active = presence.freeze()
+    handed_over = True
+    moving = []
+    staying = []
+    for client_conn, fd, decoder, pending in candidates:
+        username = active_users.username_for(client_conn)
+        state = connection_state(client_conn.addr, client_conn.codec, username,
+                                 rooms.rooms_of(username) if username is not None else [],
+                                 decoder.remaining(), pending)
+        if state is not None and flushed(client_conn):
+            moving.append((client_conn, state, fd))
+        else:
+            staying.append(client_conn)
+
+    # The new process opens the stores once the old one is done with them
+    if history is not None:
+        for username in active:
+            history.save_cursor(username)
+    close_stores()
+    if metrics_server is not None:
+        metrics_server.shutdown()
+        metrics_server.server_close()
+        metrics_server = None
+    try:
+        send_handoff(channel, listener_fds, seq, active, list(username_ids.refs),
+                     [(state, fd) for _, state, fd in moving])
+    except OSError as e:
+        print(f"Hot restart failed: {e}")
+        return [], staying + [client_conn for client_conn, _, _ in moving]
     finally:
-        # Ensure client socket is closed upon exit
-        print(f"Closing connection to {addr}")
-        client_sock.close()
+        channel.close()
+    print(f"Handed {len(moving)} connections to the new server process")
+    return [client_conn for client_conn, _, _ in moving], staying
+
+def restore_connection(client_conn, decoder, state):
+    """
+    This function sets up the codec and decoder of a connection taken over
+    from the previous process of a hot restart
+
+    Returns: Payloads the old process received but did not process
+    """
+    client_conn.codec = restore_codec(state, username_ids, compression_threshold, compression_level,
+                                      max_frame_size)
+    buffered, pending = restored_input(state)
+    if buffered:
+        decoder.feed(buffered)
+        client_conn.frame_started = time.monotonic()
+    return pending
+
+def restore_sessions(adopted):
+    """
+    This function logs the moved users back in on their connections, with their rooms
+
+    Users that were logged in on connections that could not move are sent
+    as a presence update, since their clients log in again.
+    adopted is a list of (connection, state).
+    """
+    sessions = [(state["user"], client_conn) for client_conn, state in adopted if state["user"] is not None]
+    moved = {username for username, _ in sessions}
+    presence.restore(inheritance.presence_seq, sessions,
+                     [username for username in inheritance.active_users if username not in moved])
+    for client_conn, state in adopted:
+        for room in state["rooms"]:
+            rooms.join(room, state["user"], client_conn)
+        if state["user"] is not None:
+            # The unacknowledged dms were not handed over, so they are sent again from the read cursor
+            client_conn.window = DeliveryWindow(ack_window, client_conn.queue.dropped)
+            with client_conn.window.lock:
+                try:
+                    catch_up(client_conn, state["user"])
+                except ConnectionError:
+                    pass
 
 def broadcast_active_users(excluded_usersock=None):
     """
-    This function sends the list of active users to all connected users
+    This function sends a full snapshot of active users to all connected users
+
+    Logins and logouts are sent as presence deltas, so this is only needed
+    to resynchronise every client at once.
 
     Optional argument allows for a user (the sender) to be excluded
     """
-    updated_users_list = {
-        "type": "active_users",
-        "active_users": list(active_users.keys())
-    }
+    start = time.perf_counter()
+    updated_users_list = presence.snapshot_message()
 
-    for user_sock in list(active_users.values()):
-        if excluded_usersock is None or user_sock != excluded_usersock:
+    # Encode once per codec, then queue the same frame for every recipient
+    shared = SharedMessage(updated_users_list)
+
+    recipients = active_users.snapshot()
+    for user, user_conn in recipients:
+        if excluded_usersock is None or user_conn is not excluded_usersock:
             try:
-                user_sock.send(json.dumps(updated_users_list).encode('utf-8'))
-            except:
+                user_conn.send_message(shared)
+            except ConnectionError:
                 print(f"Failed to send updated user list to a client.")
+    broadcast_seconds.observe(time.perf_counter() - start, "active_users")
+    broadcast_recipients.inc("active_users", amount=len(recipients))
+
+def register_gauges():
+    """
+    This function adds the metrics that are read when the metrics endpoint is scraped
+    """
+    REGISTRY.gauge("chat_active_users", "Users logged in to this process", lambda: len(active_users))
+    REGISTRY.gauge("chat_send_queue_bytes", "Bytes waiting in client outbound queues (total, and the largest queue)",
+                   send_queue_depths, ("queue",))
+    REGISTRY.gauge("chat_hash_pending", "Password hashes waiting for or running on the hasher pool",
+                   lambda: hasher.pending)
+    REGISTRY.gauge("chat_registered_users", "Users in the user store", lambda: len(users))
+    REGISTRY.gauge("chat_timers", "Timers waiting on the timer wheel (about one per connection)",
+                   lambda: len(wheel))
+    REGISTRY.gauge("chat_rate_limit_keys", "Users and connections with rate limit buckets that are not full",
+                   lambda: len(limiter))
+    REGISTRY.gauge("chat_rooms", "Rooms with at least one member on this process", lambda: len(rooms))
+    REGISTRY.gauge("chat_room_memberships", "Room memberships of users on this process", rooms.memberships)
+    REGISTRY.gauge("chat_history_messages", "Messages in the history log",
+                   lambda: len(history) if history is not None else 0)
+
+def send_queue_depths():
+    """
+    This function adds up the outbound queues of every logged-in connection
+
+    Returns: {("total",): bytes, ("largest",): bytes}
+    """
+    total = largest = 0
+    for user, user_conn in active_users.snapshot():
+        queued = user_conn.queue.queued_bytes
+        total += queued
+        largest = max(largest, queued)
+    return {("total",): total, ("largest",): largest}
 
 def periodic_broadcast():
     """
     This function broadcasts active users list every 30 seconds
 
     (It is not utilized in the final program, but it is functional)
+    It runs on the timer wheel, like the heartbeats, instead of starting a
+    new timer thread every time.
     """
     broadcast_active_users()
-    threading.Timer(30, periodic_broadcast).start()
+    wheel.schedule(30, periodic_broadcast)
+
+def prune_rate_limits():
+    """
+    This function forgets rate limit buckets that are full again, then runs again after PRUNE_INTERVAL
+    """
+    limiter.prune()
+    wheel.schedule(PRUNE_INTERVAL, prune_rate_limits)
+
+
+def start_worker(bus_fd):
+    """
+    This function sets up a worker process of a multi-process server (--workers N)
+
+    The bus socket to the hub was passed down as bus_fd. The worker gets a
+    copy of the user store and the presence state from the hub before it
+    starts accepting clients (see cluster.py).
+    """
+    global cluster, users, presence, reuse_port
+    cluster = WorkerBus(socket(fileno=bus_fd))
+    users = ReplicaUserStore(
+        lambda username, record: cluster.publish({"op": "user", "user": username, "record": record}))
+    presence = ClusterPresence(active_users, cluster)
+    reuse_port = True
+
+    # What to do with each message from the hub
+    cluster.handlers = {
+        "users": update_replica_users,
+        "presence": presence.apply,
+        "evict": evict_session,
+        "pm": deliver_public,
+        "room": deliver_room,
+        "deliver": deliver_direct,
+        "replay": deliver_replay,
+        "history": deliver_history_page,
+        "sent": deliver_status,
+        "delivered": deliver_receipt,
+    }
+    cluster.sync()
+
+def update_replica_users(message):
+    """
+    This function copies user records sent by the hub into this worker's user store
+    """
+    for username, record in message["items"]:
+        users.set(username, record)
+    user_index.update(username for username, _ in message["items"])
+
+def deliver_public(message):
+    """
+    This function sends a pm the hub stored (with its id) to this worker's users
+
+    If the sender is logged in here, they are sent the pm's status, which
+    only counts the recipients on this worker.
+    """
+    public_message = message["message"]
+    sender_conn = active_users.get(public_message["from"])
+    response = send_public(public_message, sender_conn)
+    if sender_conn is not None:
+        notify(sender_conn, response)
+
+def evict_session(message):
+    """
+    This function drops a local session because the user logged in on another worker
+    """
+    presence.evict(message)
+    rooms.leave_all(message["user"])
+
+def deliver_room(message):
+    """
+    This function sends a room message from another worker to this worker's members of the room
+    """
+    send_room_message(message["message"])
+
+def deliver_direct(message):
+    """
+    This function sends a dm routed here by the hub to its recipient, and its status back to the sender
+
+    It stays unread in the hub's history until the client acknowledges it.
+    """
+    direct_message = dict(message["message"], id=message["id"])
+    user_conn = active_users.get(message["user"])
+    if user_conn is None:
+        status = "message_stored" # Logged out meanwhile; it stays unread
+    else:
+        with user_conn.window.lock:
+            status = send_direct(user_conn, message["user"], direct_message)
+    cluster.publish({"op": "sent", "user": direct_message["from"], "id": message["id"], "status": status})
+
+def deliver_replay(message):
+    """
+    This function sends stored messages the hub looked up for a user: their
+    login replay, or the dms their window fell behind on
+    """
+    user_conn = active_users.get(message["user"])
+    if user_conn is None:
+        return
+    window = user_conn.window
+    with window.lock:
+        window.requested = False
+        try:
+            if message["resets"] != window.resets:
+                # Reset since it asked (see check_dropped), so the dms may start too late: ask again
+                catch_up(user_conn, message["user"])
+                return
+            window.behind = message["more"]
+            replay_history(user_conn, message["records"], window)
+        except ConnectionError:
+            pass
 
+def deliver_status(message):
+    """
+    This function sends a dm's status, with the id the hub gave it, to its sender
+    """
+    sender_conn = active_users.get(message["user"])
+    if sender_conn is not None:
+        notify(sender_conn, {"status": message["status"], "id": message["id"]})
+
+def deliver_receipt(message):
+    """
+    This function sends a delivered receipt the hub routed here to the dms' sender
+    """
+    send_receipt(message["user"], message["to"], message["ids"])
+
+def deliver_history_page(message):
+    """
+    This function sends a history page the hub looked up, then its history_end
+    """
+    user_conn = active_users.get(message["user"])
+    if user_conn is None:
+        return
+    try:
+        oldest = replay_history(user_conn, message["records"])
+        before = oldest if oldest is not None else message["before"]
+        user_conn.send_message({"status": "history_end", "before": before, "more": message["more"]})
+    except ConnectionError:
+        pass
+
+def call_now(callback, *args):
+    """
+    This function runs callback right away (the threaded engine's bus dispatch)
+    """
+    callback(*args)
+
+def run_hub(port_number, workers):
+    """
+    Runs the hub of a multi-process server (--workers N)
+
+    The hub starts the worker processes, which listen on the port
+    themselves, and routes messages between them (see cluster.py).
+    """
+    # Fails here, not in every worker, if the port is taken
+    probe = reuse_port_probe(port_number)
+    print(f"Server listening on port {port_number} with {workers} worker processes")
+    hub = Hub(users, history, workers, worker_command(sys.argv[1:]), presence.window, replay_public,
+              drain_timeout + WORKER_STOP_GRACE)
+    try:
+        asyncio.run(hub.run())
+    finally:
+        print("\n\nShutting down server")
+        probe.close()
 
 def run_server(port_number):
     """
-    Runs the server and creates threads to handle clients
+    Runs the server and creates threads to handle clients (threaded engine)
 
-    The argument specifies the port number
+    The argument specifies the port number. SIGTERM (or ^C) drains the
+    server, and SIGUSR2 hot restarts it (see handoff.py).
     """
-    server_sock = socket(AF_INET, SOCK_STREAM)
-    server_sock.bind(('', port_number))
-    server_sock.listen(100)
-    print(f"Server listening on port {port_number}")
+    global wakeup_pipe, stop_requested
+    presence.schedule = schedule_timer
+    if cluster is not None:
+        cluster.start(call_now)
+    threading.Thread(target=run_wheel, name="timer-wheel", daemon=True).start()
+    prune_rate_limits()
+    wakeup_pipe = os.pipe()
+    # The signal handler writes to this pipe to wake the accept loop
+    stop_pipe = os.pipe()
+    os.set_blocking(stop_pipe[0], False)
+    os.set_blocking(stop_pipe[1], False)
+    for signum in STOP_SIGNALS:
+        signal.signal(signum, lambda signum, frame: request_stop(signum, stop_pipe[1]))
 
+    if inheritance is not None:
+        server_sock = inheritance.listeners[0]
+        adopt_threaded()
+    else:
+        server_sock = socket(AF_INET, SOCK_STREAM)
+        # A server started right after a drain can bind while the drained connections are in TIME_WAIT
+        server_sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        if reuse_port:
+            server_sock.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+        server_sock.bind(('', port_number))
+        server_sock.listen(LISTEN_BACKLOG)
+    server_sock.setblocking(False)
+    print(f"Server listening on port {port_number}{' (TLS)' if tls_context is not None else ''}")
+
+    poller = select.poll()
+    poller.register(server_sock, select.POLLIN)
+    poller.register(stop_pipe[0], select.POLLIN)
     try:
         while True:
-            client_sock, addr = server_sock.accept()
-            client_thread = threading.Thread(target=handle_client, args=(client_sock, addr))
-            client_thread.start()
-            print(f"Started thread for {addr}")
-    except:
-        print("\n\nShutting down server")
+            accept_clients(server_sock, poller)
+            try:
+                os.read(stop_pipe[0], 1024)
+            except BlockingIOError:
+                pass
+            mode = stop_requested
+            stop_requested = None
+            if mode == "restart":
+                channel = begin_restart()
+                if channel is None:
+                    continue
+                hand_off_threaded(server_sock, channel)
+            else:
+                print("\n\nShutting down server")
+                drain_threaded(server_sock)
+            break
+    finally:
         server_sock.close()
 
-if __name__ == '__main__':
-    users = load_users()
+def request_stop(signum, stop_fd):
+    """
+    This function is the threaded engine's handler for STOP_SIGNALS: it wakes the accept loop
+    """
+    global stop_requested
+    if stopping is not None or stop_requested == "drain":
+        return # Already stopping
+    stop_requested = STOP_SIGNALS[signum]
+    try:
+        os.write(stop_fd, b"\0")
+    except BlockingIOError:
+        pass
 
-    # Ensure the correct number of arguments were passed (Ex: python3 server.py 12000)
-    if len(sys.argv) != 2:
-        print(f"Usage: python3 {sys.argv[0]} server_port")
-        sys.exit(1)
+def accept_clients(server_sock, poller):
+    """
+    This function accepts clients and starts their threads until a stop signal arrives (threaded engine)
+    """
+    while stop_requested is None:
+        poller.poll()
+        if stop_requested is not None:
+            break
+        try:
+            client_sock, addr = server_sock.accept()
+        except BlockingIOError:
+            continue # Another process took it, or the client gave up
+        except OSError as e:
+            # Keep serving the clients already connected, and try again shortly
+            accept_errors.inc()
+            print(f"Accept failed: {e}")
+            time.sleep(ACCEPT_RETRY_DELAY)
+            continue
+        # The connection's writer coalesces small frames itself (see outbound.py)
+        client_sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1 if coalesce_bytes else 0)
+        set_keepalive(client_sock, tcp_keepalive)
+        client_thread = threading.Thread(target=handle_client, args=(client_sock, addr), daemon=True)
+        client_thread.start()
+        print(f"Started thread for {addr}")
+
+def adopt_threaded():
+    """
+    This function takes over the connections of the previous process of a hot restart (threaded engine)
 
+    Every session is restored before any handler thread starts reading.
+    """
+    adopted = []
+    for state, client_sock in inheritance.connections:
+        addr = tuple(state["addr"]) if state["addr"] else None
+        decoder = FrameDecoder(max_frame_size)
+        client_conn = ThreadedConnection(client_sock, addr, send_queue_bytes, slow_consumer_policy,
+                                         coalesce_delay, coalesce_bytes)
+        payloads = restore_connection(client_conn, decoder, state)
+        adopted.append((client_conn, state, decoder, payloads))
+    restore_sessions([(client_conn, state) for client_conn, state, _, _ in adopted])
+    for client_conn, state, decoder, payloads in adopted:
+        threading.Thread(target=handle_client, args=(client_conn.sock, client_conn.addr,
+                                                     (client_conn, decoder, payloads)), daemon=True).start()
+    print(f"Took over {len(adopted)} connections from the previous server process")
+
+def stop_handlers(mode):
+    """
+    This function makes the handler threads stop reading (threaded engine)
+
+    Returns: List of the connections open at that moment
+    """
+    global stopping
+    stopping = mode
+    os.write(wakeup_pipe[1], b"\0")
+    with connections_changed:
+        return list(connections)
+
+def release_handlers(deadline):
+    """
+    This function lets the parked handler threads end, and waits for them until deadline (threaded engine)
+    """
+    global release_parked
+    with connections_changed:
+        release_parked = True
+        connections_changed.notify_all()
+        while connections and time.monotonic() < deadline:
+            connections_changed.wait(deadline - time.monotonic())
+
+def drain_threaded(server_sock):
+    """
+    This function stops the server gracefully (threaded engine)
+
+    Every client is told the server is shutting down and gets what is queued
+    for it (for up to drain_timeout seconds), then the handler threads log
+    the users out.
+    """
+    deadline = time.monotonic() + drain_timeout
+    server_sock.close()
+    current = stop_handlers("drain")
+    for client_conn in current:
+        notify(client_conn, SHUTDOWN)
+    for client_conn in current:
+        client_conn.finish(max(0.0, deadline - time.monotonic()))
+    # Logging out takes little time, even after the deadline
+    release_handlers(max(deadline, time.monotonic() + 1.0))
+
+def hand_off_threaded(server_sock, channel):
+    """
+    This function hands the listening socket and the client connections to
+    the new process of a hot restart (threaded engine, see handoff.py)
+    """
+    deadline = time.monotonic() + drain_timeout
+    current = stop_handlers("restart")
+    for client_conn in current:
+        if isinstance(client_conn.sock, ssl.SSLSocket):
+            # A TLS connection cannot move: its client logs in again to the new process
+            notify(client_conn, RESTARTING)
+            client_conn.finish(max(0.0, deadline - time.monotonic()))
+
+    # Wait for the other handler threads to finish the requests they are on and park
+    with connections_changed:
+        while len(parked) < len(connections) and time.monotonic() < deadline:
+            connections_changed.wait(deadline - time.monotonic())
+        waiting = [(client_conn, decoder) for client_conn, decoder in parked.items()
+                   if client_conn in connections]
+
+    candidates = [(client_conn, client_conn.sock.fileno(), decoder, ()) for client_conn, decoder in waiting]
+    moved, staying = hand_over(channel, [server_sock.fileno()], candidates,
+                               lambda client_conn: client_conn.detach(max(0.0, deadline - time.monotonic())))
+    for client_conn in staying:
+        notify(client_conn, RESTARTING)
+        client_conn.finish(max(0.0, deadline - time.monotonic()))
+    with connections_changed:
+        busy = [client_conn for client_conn in connections if client_conn not in parked]
+    for client_conn in busy:
+        if not isinstance(client_conn.sock, ssl.SSLSocket):
+            client_conn.abort() # Still working on a request at the deadline
+    release_handlers(max(deadline, time.monotonic() + 1.0))
+
+def schedule_timer(delay, callback):
+    """
+    This function runs callback once after delay seconds on a timer thread
+    """
+    timer = threading.Timer(delay, callback)
+    timer.daemon = True
+    timer.start()
+
+def run_wheel():
+    """
+    This function is the timer thread of the threaded engine: it advances the wheel every tick
+    """
+    while True:
+        time.sleep(wheel.tick)
+        wheel.advance()
+
+def tick_wheel(loop):
+    """
+    This function advances the wheel on the event loop (asyncio engine), then again one tick later
+    """
+    wheel.advance()
+    loop.call_later(wheel.tick, tick_wheel, loop)
+
+async def serve_async(port_number):
+    """
+    Runs the asyncio event loop server until it is stopped
+
+    The argument specifies the port number. SIGTERM (or ^C) drains the
+    server, and SIGUSR2 hot restarts it (see handoff.py).
+    """
+    loop = asyncio.get_running_loop()
+    presence.schedule = loop.call_later
+    if cluster is not None:
+        cluster.start(loop.call_soon_threadsafe)
+    tick_wheel(loop)
+    prune_rate_limits()
+    stop_requests = asyncio.Queue()
+    for signum, mode in STOP_SIGNALS.items():
+        loop.add_signal_handler(signum, stop_requests.put_nowait, mode)
+    # With TLS, handshakes run on the event loop between other work
+    tls_options = dict(ssl=tls_context, ssl_handshake_timeout=HANDSHAKE_TIMEOUT if tls_context is not None else None)
+    if inheritance is not None:
+        # One server per inherited socket (Ex: IPv4 and IPv6)
+        servers = [await loop.create_server(AsyncConnection, sock=listener, backlog=LISTEN_BACKLOG,
+                                            start_serving=False, **tls_options)
+                   for listener in inheritance.listeners]
+        await adopt_async(loop)
+        for server in servers:
+            await server.start_serving()
+    else:
+        servers = [await loop.create_server(AsyncConnection, '', port_number, backlog=LISTEN_BACKLOG,
+                                            reuse_port=reuse_port, **tls_options)]
+    print(f"Server listening on port {port_number} (asyncio engine{', TLS' if tls_context is not None else ''})")
     try:
-        server_port = int(sys.argv[1])
+        while True:
+            mode = await stop_requests.get()
+            if mode == "restart":
+                channel = await loop.run_in_executor(None, begin_restart)
+                if channel is None:
+                    continue
+                await hand_off_async(servers, channel)
+            else:
+                print("\n\nShutting down server")
+                await drain_async(servers)
+            return
+    finally:
+        for server in servers:
+            server.close()
+
+async def adopt_async(loop):
+    """
+    This function takes over the connections of the previous process of a hot restart (asyncio engine)
+
+    Every session is restored before any connection starts reading.
+    """
+    adopted = []
+    for state, client_sock in inheritance.connections:
+        _, client_conn = await loop.connect_accepted_socket(lambda state=state: AsyncConnection(state), client_sock)
+        adopted.append((client_conn, state))
+    restore_sessions(adopted)
+    for client_conn, state in adopted:
+        client_conn.transport.resume_reading()
+        client_conn._process_backlog()
+    print(f"Took over {len(adopted)} connections from the previous server process")
+
+async def wait_for_connections(loop, deadline, busy=None):
+    """
+    This function waits until deadline for the connections to close, or for busy() to be false
+    """
+    while loop.time() < deadline and (connections if busy is None else busy()):
+        await asyncio.sleep(0.01)
+
+async def close_connections(loop, deadline):
+    """
+    This function waits until deadline for the connections to close, then closes the rest at once
+
+    (Ex: a client too slow to take what is queued, or a TLS client that has
+    not answered the server's close_notify)
+    """
+    await wait_for_connections(loop, deadline)
+    for client_conn in list(connections):
+        client_conn.abort()
+    # Lets connection_lost log the last users out
+    await asyncio.sleep(0)
+
+async def drain_async(servers):
+    """
+    This function stops the server gracefully (asyncio engine)
+
+    Every client is told the server is shutting down and gets what is queued
+    for it (for up to drain_timeout seconds), and the users are logged out
+    as their connections close.
+    """
+    global stopping
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + drain_timeout
+    stopping = "drain"
+    for server in servers:
+        server.close()
+    for client_conn in list(connections):
+        notify(client_conn, SHUTDOWN)
+        client_conn.finish()
+    await close_connections(loop, deadline)
+
+async def hand_off_async(servers, channel):
+    """
+    This function hands the listening socket and the client connections to
+    the new process of a hot restart (asyncio engine, see handoff.py)
+    """
+    global stopping
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + drain_timeout
+    stopping = "restart"
+    # Copies of the listening sockets stay open for the new process; clients wait in their listen queues
+    listener_fds = [os.dup(listener.fileno()) for server in servers for listener in server.sockets]
+    for server in servers:
+        server.close()
+    plaintext = []
+    for client_conn in list(connections):
+        if client_conn.transport.get_extra_info('ssl_object') is not None:
+            # A TLS connection cannot move: its client logs in again to the new process
+            notify(client_conn, RESTARTING)
+            client_conn.finish()
+        else:
+            client_conn.transport.pause_reading()
+            plaintext.append(client_conn)
+
+    # Let password checks that are running finish, and queued frames go out
+    await wait_for_connections(loop, deadline, lambda: any(
+        client_conn.waiting or client_conn.queue or client_conn.transport.get_write_buffer_size()
+        for client_conn in plaintext if not client_conn.transport.is_closing()))
+
+    candidates = [(client_conn, client_conn.transport.get_extra_info('socket').fileno(), client_conn.decoder,
+                   list(client_conn.backlog))
+                  for client_conn in plaintext if not client_conn.transport.is_closing()]
+    try:
+        moved, staying = hand_over(channel, listener_fds, candidates, AsyncConnection.flushed)
+    finally:
+        for listener_fd in listener_fds:
+            os.close(listener_fd)
+    for client_conn in staying:
+        notify(client_conn, RESTARTING)
+        client_conn.finish()
+    for client_conn in moved:
+        # Closes only this process's copy of the socket
+        client_conn.transport.abort()
+    await close_connections(loop, max(deadline, loop.time() + 1.0))
+
+def run_async_server(port_number):
+    """
+    Runs the server on a single asyncio event loop (asyncio engine)
+
+    All connections are handled by one thread, so there is no per-connection
+    thread stack. The argument specifies the port number
+    """
+    asyncio.run(serve_async(port_number))
+
+# Server engines selectable with --engine
+ENGINES = {
+    "threaded": run_server,
+    "asyncio": run_async_server,
+}
+
+def parse_args(argv):
+    """
+    This function parses the command-line arguments
+
+    Ex: python3 server.py 12000 --engine asyncio
+    """
+    parser = argparse.ArgumentParser(description="Online Chat Room server")
+    parser.add_argument("server_port", help="Port number to listen on (1024-65535)")
+    parser.add_argument("--engine", choices=sorted(ENGINES), default="threaded",
+                        help="Server engine: one thread per client, or a single asyncio event loop")
+    parser.add_argument("--max-frame-size", type=int, default=DEFAULT_MAX_FRAME_SIZE,
+                        help="Largest message frame in bytes a client may send")
+    parser.add_argument("--send-queue-bytes", type=int, default=DEFAULT_SEND_QUEUE_BYTES,
+                        help="Bytes that may wait in one client's outbound queue")
+    parser.add_argument("--slow-consumer", choices=SLOW_CONSUMER_POLICIES, default=DEFAULT_SLOW_CONSUMER_POLICY,
+                        help="What to do when a client's outbound queue is full")
+    parser.add_argument("--coalesce-delay", type=float, default=DEFAULT_COALESCE_DELAY,
+                        help="Seconds a queued frame may wait for more frames to share one write")
+    parser.add_argument("--coalesce-bytes", type=int, default=DEFAULT_COALESCE_BYTES,
+                        help="Queued bytes written without waiting (0 writes every frame by itself)")
+    parser.add_argument("--tls-cert", help="Certificate file (PEM): only TLS connections are accepted")
+    parser.add_argument("--tls-key", help="Private key file of the certificate (PEM), if not in the certificate file")
+    parser.add_argument("--compression-threshold", type=int, default=DEFAULT_COMPRESSION_THRESHOLD,
+                        help="Smallest message in bytes that is compressed for clients that support it")
+    parser.add_argument("--compression-level", type=int, default=DEFAULT_COMPRESSION_LEVEL,
+                        help="zlib compression level from 1 (fastest) to 9 (smallest); 0 turns compression off")
+    parser.add_argument("--ping-interval", type=float, default=DEFAULT_PING_INTERVAL,
+                        help="Seconds of silence from a client before it is pinged (0 disables)")
+    parser.add_argument("--idle-timeout", type=float, default=DEFAULT_IDLE_TIMEOUT,
+                        help="Seconds of silence from a client before it is disconnected (0 disables)")
+    parser.add_argument("--read-timeout", type=float, default=DEFAULT_READ_TIMEOUT,
+                        help="Seconds a client has to finish sending a frame it started (0 disables)")
+    parser.add_argument("--tcp-keepalive", type=int, default=DEFAULT_TCP_KEEPALIVE,
+                        help="Seconds of silence before TCP keepalive probes (0 disables)")
+    parser.add_argument("--rate-limit", action="append", default=[], metavar="NAME=RATE[/BURST]",
+                        help="Requests per second and burst for one command of a user, \"user\" (all of a user's requests) "
+                             "or \"global\" (the whole process); repeat for several (Ex: pm=5/20, 0 turns a limit off)")
+    parser.add_argument("--no-rate-limits", action="store_true", help="Turn every rate limit off")
+    parser.add_argument("--presence-window", type=float, default=DEFAULT_PRESENCE_WINDOW,
+                        help="Seconds to collect logins/logouts into one presence update")
+    parser.add_argument("--user-store", choices=sorted(USER_STORES), default=DEFAULT_USER_STORE,
+                        help="User storage: append-only log, SQLite, or the legacy users.json")
+    parser.add_argument("--user-flush-interval", type=float, default=DEFAULT_FLUSH_INTERVAL,
+                        help="Seconds between batched user store writes")
+    parser.add_argument("--hash-workers", type=int, default=DEFAULT_HASH_WORKERS,
+                        help="Threads that hash and verify passwords")
+    parser.add_argument("--verify-cache-ttl", type=float, default=DEFAULT_CACHE_TTL,
+                        help="Seconds a successful login is remembered for fast reconnects (0 disables)")
+    parser.add_argument("--scrypt-n", type=int, default=SCRYPT_N,
+                        help="scrypt cost for new password hashes (power of two)")
+    parser.add_argument("--history-replay", type=int, default=DEFAULT_REPLAY_PUBLIC,
+                        help="Public messages sent to a user at login")
+    parser.add_argument("--ack-window", type=int, default=DEFAULT_ACK_WINDOW,
+                        help="dms sent to a client that may wait for its acknowledgement before more wait in the history")
+    parser.add_argument("--history-segment-bytes", type=int, default=DEFAULT_SEGMENT_BYTES,
+                        help="Size of one message history segment file")
+    parser.add_argument("--history-segments", type=int, default=DEFAULT_MAX_SEGMENTS,
+                        help="History segment files to keep (0 keeps all)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Worker processes sharing the port (more than 1 uses several CPU cores)")
+    parser.add_argument("--metrics-port", type=int, default=0,
+                        help="Serve metrics and the profiler on 127.0.0.1 at this port (0 disables)")
+    parser.add_argument("--drain-timeout", type=float, default=DEFAULT_DRAIN_TIMEOUT,
+                        help="Seconds to write what is queued for clients when the server stops or hot restarts")
+    # Set by the hub when it starts a worker (the worker's end of the bus, and its number)
+    parser.add_argument("--worker-fd", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--worker-index", type=int, default=0, help=argparse.SUPPRESS)
+    # Set by a hot restart when it starts the new process (its end of the handoff socket)
+    parser.add_argument("--handoff-fd", type=int, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    # Ensure the correct arguments were passed (Ex: python3 server.py 12000)
+    args = parse_args(sys.argv[1:])
+
+    try:
+        server_port = int(args.server_port)
     except ValueError:
         print("Port number must be an integer.")
         sys.exit(1)
@@ -219,8 +2050,163 @@ if __name__ == '__main__':
         print("Port number must be between 1024 and 65535.")
         sys.exit(1)
 
+    if args.max_frame_size <= 0:
+        print("Maximum frame size must be a positive integer.")
+        sys.exit(1)
+    max_frame_size = args.max_frame_size
+
+    if args.send_queue_bytes <= 0:
+        print("Send queue size must be a positive integer.")
+        sys.exit(1)
+    send_queue_bytes = args.send_queue_bytes
+    slow_consumer_policy = args.slow_consumer
+
+    if args.coalesce_delay < 0 or args.coalesce_delay > 1:
+        print("Coalescing delay must be between 0 and 1 second.")
+        sys.exit(1)
+    if args.coalesce_bytes < 0:
+        print("Coalescing size must not be negative.")
+        sys.exit(1)
+    coalesce_delay = args.coalesce_delay
+    coalesce_bytes = args.coalesce_bytes
+
+    if args.tls_key and not args.tls_cert:
+        print("A TLS key needs a certificate (--tls-cert).")
+        sys.exit(1)
+    if args.tls_cert:
+        try:
+            tls_context = server_context(args.tls_cert, args.tls_key)
+        except (OSError, ssl.SSLError) as e:
+            print(f"Could not load the TLS certificate: {e}")
+            sys.exit(1)
+
+    if args.compression_threshold < 0:
+        print("Compression threshold must not be negative.")
+        sys.exit(1)
+    if not (0 <= args.compression_level <= 9):
+        print("Compression level must be between 0 and 9.")
+        sys.exit(1)
+    compression_threshold = args.compression_threshold
+    compression_level = args.compression_level
+
+    if min(args.ping_interval, args.idle_timeout, args.read_timeout) < 0:
+        print("Heartbeat intervals and timeouts must not be negative.")
+        sys.exit(1)
+    if args.idle_timeout and args.idle_timeout <= args.ping_interval:
+        print("Idle timeout must be longer than the ping interval (or 0).")
+        sys.exit(1)
+    if args.tcp_keepalive < 0:
+        print("TCP keepalive time must not be negative.")
+        sys.exit(1)
+    heartbeats = HeartbeatMonitor(wheel, args.ping_interval, args.idle_timeout, args.read_timeout)
+    tcp_keepalive = args.tcp_keepalive
+
+    rate_limits = dict(DEFAULT_RATE_LIMITS)
+    for spec in args.rate_limit:
+        try:
+            name, rate, burst = parse_rate_limit(spec)
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+        if name not in METERED_COMMANDS and name not in ("user", "global"):
+            print(f"Unknown rate limit: {name} (use a command, user or global)")
+            sys.exit(1)
+        rate_limits[name] = (rate, burst)
+    limiter = RateLimiter({} if args.no_rate_limits else rate_limits)
+
+    if args.presence_window < 0:
+        print("Presence window must not be negative.")
+        sys.exit(1)
+    presence.window = args.presence_window
+
+    if args.user_flush_interval <= 0:
+        print("User store flush interval must be positive.")
+        sys.exit(1)
+
     """Periodic broadcast is commented out, as I opted to instead inform users when active_users changes"""
     # periodic_broadcast()
 
-    # Run the server based on the server port
-    run_server(server_port)
+    if args.hash_workers <= 0:
+        print("Number of hash workers must be positive.")
+        sys.exit(1)
+    if args.scrypt_n < 2 or args.scrypt_n & (args.scrypt_n - 1):
+        print("scrypt cost must be a power of two.")
+        sys.exit(1)
+    hasher = PasswordHasher(workers=args.hash_workers, cache_ttl=args.verify_cache_ttl, scrypt_n=args.scrypt_n)
+
+    if args.history_replay < 0:
+        print("History replay must not be negative.")
+        sys.exit(1)
+    if args.history_segment_bytes <= 0:
+        print("History segment size must be a positive integer.")
+        sys.exit(1)
+    if args.history_segments < 0 or args.history_segments == 1:
+        print("History segments must be 0 (keep all) or at least 2.")
+        sys.exit(1)
+    replay_public = args.history_replay
+    if args.ack_window <= 0:
+        print("Acknowledgement window must be a positive integer.")
+        sys.exit(1)
+    ack_window = args.ack_window
+
+    if args.workers < 1:
+        print("Number of workers must be positive.")
+        sys.exit(1)
+    if args.metrics_port and not (1024 <= args.metrics_port <= 65535 - args.workers):
+        print("Metrics port must be between 1024 and 65535 (with room for one port per worker).")
+        sys.exit(1)
+
+    if args.drain_timeout < 0:
+        print("Drain timeout must not be negative.")
+        sys.exit(1)
+    drain_timeout = args.drain_timeout
+
+    if args.handoff_fd is not None:
+        if args.workers > 1 or args.worker_fd is not None:
+            print("Hot restart is not supported with --workers.")
+            sys.exit(1)
+        # Started by a hot restart: the old process hands over its listening
+        # socket and clients once it has closed the stores
+        try:
+            inheritance = receive_handoff(args.handoff_fd)
+        except (ConnectionError, OSError, ValueError) as e:
+            print(f"Hot restart failed: {e}")
+            sys.exit(1)
+        for name in inheritance.names:
+            username_ids.add(name)
+
+    if args.worker_fd is not None:
+        # A worker of a multi-process server: the hub owns the user store and history
+        start_worker(args.worker_fd)
+    else:
+        users = load_users(args.user_store, args.user_flush_interval)
+        if args.workers == 1:
+            # (The hub of several workers answers no lookups)
+            user_index = PrefixIndex(users.usernames())
+        history = MessageLog(segment_bytes=args.history_segment_bytes, max_segments=args.history_segments)
+
+        # Hash any plaintext passwords left from users.json in the background
+        threading.Thread(target=migrate_plaintext, args=(users, hasher), daemon=True).start()
+
+    if args.metrics_port:
+        # With workers, the hub uses the port given and worker i the port + 1 + i
+        metrics_port = args.metrics_port
+        if args.worker_fd is not None:
+            metrics_port += 1 + args.worker_index
+        register_gauges()
+        try:
+            metrics_server = serve_metrics(metrics_port)
+        except OSError as e:
+            print(f"Could not serve metrics on port {metrics_port}: {e}")
+            sys.exit(1)
+        print(f"Metrics at http://127.0.0.1:{metrics_port}/metrics")
+
+    # Run the server based on the server port and chosen engine (or the hub of several workers)
+    try:
+        if args.workers > 1:
+            run_hub(server_port, args.workers)
+        else:
+            ENGINES[args.engine](server_port)
+    finally:
+        # Write any registrations still waiting in the store
+        close_stores()
@@ -0,0 +1,169 @@
+"""
+Session registry for logged-in users.
+
+The registry replaces the old global active_users dictionary. It is safe to
+use from many handler threads at once:
+- Sessions are split across shards, each with its own lock, so logins and
+  logouts of different users rarely wait on each other.
+- Lookups work both ways in O(1): username -> connection and
+  connection -> username.
+- snapshot() returns an immutable tuple of (username, connection) pairs for
+  fan-out. It is rebuilt only after the registry changes (copy-on-write), so
+  broadcasts never iterate a dictionary another thread is changing.
+"""
+import threading
+
+DEFAULT_SHARDS = 16
+
+class _Shard:
+    """
+    This class is one lock-protected slice of a mapping
+    """
+    __slots__ = ("lock", "items")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.items = {}
+
+class SessionRegistry:
+    """
+    This class tracks which connection each logged-in user is using.
+
+    Username shards map username -> connection, and connection shards map
+    connection -> username. A change takes the username shard lock first,
+    then the connection shard lock, so the two maps always agree.
+    """
+
+    def __init__(self, shards=DEFAULT_SHARDS):
+        self._name_shards = [_Shard() for _ in range(shards)]
+        self._conn_shards = [_Shard() for _ in range(shards)]
+        # Cached snapshot and a version number that changes on every update
+        self._version = 0
+        self._snapshot = ()
+        self._snapshot_version = 0
+        self._snapshot_lock = threading.Lock()
+
+    def _name_shard(self, username):
+        return self._name_shards[hash(username) % len(self._name_shards)]
+
+    def _conn_shard(self, conn):
+        return self._conn_shards[hash(conn) % len(self._conn_shards)]
+
+    def _changed(self):
+        # Invalidates the cached snapshot
+        with self._snapshot_lock:
+            self._version += 1
+
+    def add(self, username, conn):
+        """
+        This function registers a logged-in user on a connection
+
+        If the user was already logged in on another connection, that
+        session is replaced. Another user on conn stays logged in (the hub
+        maps every user of a worker to its link), so a client connection
+        that logs in again is logged out first (see process_request).
+
+        Returns: The replaced connection, or None
+        """
+        shard = self._name_shard(username)
+        with shard.lock:
+            previous = shard.items.get(username)
+            shard.items[username] = conn
+            if previous is not None:
+                previous_shard = self._conn_shard(previous)
+                with previous_shard.lock:
+                    previous_shard.items.pop(previous, None)
+            conn_shard = self._conn_shard(conn)
+            with conn_shard.lock:
+                conn_shard.items[conn] = username
+            self._changed()
+        return previous
+
+    def remove(self, username, conn=None):
+        """
+        This function logs a user out
+
+        If conn is given, the user is only removed while still on that connection.
+
+        Returns: The removed connection, or None if nothing was removed
+        """
+        shard = self._name_shard(username)
+        with shard.lock:
+            current = shard.items.get(username)
+            if current is None or (conn is not None and current is not conn):
+                return None
+            del shard.items[username]
+            conn_shard = self._conn_shard(current)
+            with conn_shard.lock:
+                conn_shard.items.pop(current, None)
+            self._changed()
+        return current
+
+    def remove_connection(self, conn):
+        """
+        This function logs out whichever user is on a connection (Ex: on disconnect)
+
+        Returns: The username that was removed, or None
+        """
+        username = self.username_for(conn)
+        if username is None or self.remove(username, conn) is None:
+            return None
+        return username
+
+    def get(self, username):
+        """
+        This function finds the connection of a logged-in user
+
+        Returns: Connection, or None if the user is not logged in
+        """
+        shard = self._name_shard(username)
+        with shard.lock:
+            return shard.items.get(username)
+
+    def username_for(self, conn):
+        """
+        This function finds the user logged in on a connection
+
+        Returns: Username, or None
+        """
+        shard = self._conn_shard(conn)
+        with shard.lock:
+            return shard.items.get(conn)
+
+    def __contains__(self, username):
+        return self.get(username) is not None
+
+    def __len__(self):
+        return sum(len(shard.items) for shard in self._name_shards)
+
+    def snapshot(self):
+        """
+        This function returns every session as a tuple of (username, connection)
+
+        The tuple is cached until the next add or remove, so back-to-back
+        broadcasts share one copy. It is safe to iterate while other threads
+        change the registry.
+        """
+        with self._snapshot_lock:
+            version = self._version
+            if version == self._snapshot_version:
+                return self._snapshot
+
+        sessions = []
+        for shard in self._name_shards:
+            with shard.lock:
+                sessions.extend(shard.items.items())
+        sessions = tuple(sessions)
+
+        with self._snapshot_lock:
+            # Only cache it if nothing changed while it was being built
+            if self._version == version:
+                self._snapshot = sessions
+                self._snapshot_version = version
+        return sessions
+
+    def usernames(self):
+        """
+        This function returns a list of every logged-in username
+        """
+        return [username for username, _ in self.snapshot()]
@@ -0,0 +1,498 @@
+"""
+Pluggable storage for registered users (username -> password).
+
+Backends (chosen with --user-store):
+log: Append-only log of JSON lines (default). Startup streams the file one
+     line at a time, registrations are appended in batches.
+sqlite: SQLite database in WAL mode, batches written in one transaction.
+json: The original users.json file, rewritten on every registration.
+
+The log and sqlite backends are write-behind: add() updates memory and
+returns at once, and a flusher thread writes the pending records every
+flush_interval seconds (or as soon as max_batch records are waiting). Each
+batch ends with an fsync, so a crash can only lose the registrations of the
+last unflushed batch, never corrupt earlier ones.
+
+The first time a log or sqlite store is opened and it is empty, any existing
+users.json is imported into it.
+"""
+import os
+import json
+import sqlite3
+import threading
+
+# Legacy user file (imported into a new store)
+USER_FILE = "users.json"
+USER_LOG = "users.log"
+USER_DB = "users.db"
+
+DEFAULT_USER_STORE = "log"
+DEFAULT_FLUSH_INTERVAL = 0.05
+DEFAULT_MAX_BATCH = 1024
+
+# Compact the log when it holds this many times more lines than users
+# (and at least COMPACT_MIN_LINES lines)
+COMPACT_RATIO = 2
+COMPACT_MIN_LINES = 1024
+
+class UserStore:
+    """
+    This class is the in-memory side of every backend.
+
+    Reads are served from memory. add() and set() update memory under a lock
+    and hand the record to _persist(). Subclasses implement _persist(),
+    flush() and close().
+    """
+
+    def __init__(self):
+        self.users = {}
+        self.lock = threading.Lock()
+
+    def __contains__(self, username):
+        return username in self.users
+
+    def __len__(self):
+        return len(self.users)
+
+    def get(self, username):
+        """
+        This function returns the stored password record, or None
+        """
+        return self.users.get(username)
+
+    def usernames(self):
+        """
+        This function returns a list of the registered usernames
+        """
+        with self.lock:
+            return list(self.users)
+
+    def items(self):
+        """
+        This function returns a list of (username, password record) pairs
+        """
+        with self.lock:
+            return list(self.users.items())
+
+    def add(self, username, password):
+        """
+        This function registers a new user
+
+        The check and the insert happen under one lock, so two clients
+        registering the same name at once cannot both succeed.
+
+        Returns: True if added, False if the username is taken
+        """
+        with self.lock:
+            if username in self.users:
+                return False
+            self.users[username] = password
+            self._persist(username, password)
+        return True
+
+    def set(self, username, password):
+        """
+        This function replaces the password record of a user
+        """
+        with self.lock:
+            self.users[username] = password
+            self._persist(username, password)
+
+    def replace(self, username, old_password, new_password):
+        """
+        This function replaces a record only if it still equals old_password
+        (Ex: rehashing a plaintext password without undoing a newer change)
+
+        Returns: True if replaced
+        """
+        with self.lock:
+            if self.users.get(username) != old_password:
+                return False
+            self.users[username] = new_password
+            self._persist(username, new_password)
+        return True
+
+    def replace_many(self, replacements):
+        """
+        This function replaces many records at once, each only if it still
+        equals its old record (Ex: migrating plaintext passwords at startup)
+
+        replacements is a list of (username, old_password, new_password).
+        The backend gets them as one batch, so the json backend rewrites its
+        file once instead of once per record.
+
+        Returns: Number of records replaced
+        """
+        with self.lock:
+            changed = [(username, new_password) for username, old_password, new_password in replacements
+                       if self.users.get(username) == old_password]
+            for username, new_password in changed:
+                self.users[username] = new_password
+            if changed:
+                self._persist_many(changed)
+        return len(changed)
+
+    def import_legacy(self, path=USER_FILE):
+        """
+        This function imports users from the legacy users.json file
+
+        Returns: Number of users imported
+        """
+        try:
+            with open(path, 'r') as openfile:
+                legacy = json.load(openfile)
+        except (FileNotFoundError, ValueError):
+            return 0
+        for username, password in legacy.items():
+            self.add(username, password)
+        self.flush()
+        return len(legacy)
+
+    def _persist(self, username, password):
+        raise NotImplementedError
+
+    def _persist_many(self, records):
+        # Called with self.lock held; backends that can write a batch at once override it
+        for username, password in records:
+            self._persist(username, password)
+
+    def flush(self):
+        """
+        This function blocks until every added user is on disk
+        """
+
+    def compact(self):
+        """
+        This function asks the backend to drop superseded records from disk
+        (Ex: plaintext passwords that have since been hashed)
+        """
+
+    def close(self):
+        """
+        This function flushes pending writes and releases the backend
+        """
+        self.flush()
+
+class WriteBehindStore(UserStore):
+    """
+    This class batches records and writes them on a flusher thread.
+
+    Subclasses implement _write_batch(records), which must make the batch
+    durable before returning.
+    """
+
+    def __init__(self, flush_interval=DEFAULT_FLUSH_INTERVAL, max_batch=DEFAULT_MAX_BATCH):
+        super().__init__()
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.pending = []
+        # Number of records handed to the backend (written or being written)
+        self.submitted = 0
+        self.written = 0
+        self.condition = threading.Condition(self.lock)
+        self.closed = False
+        self.compact_requested = False
+        self.flusher = None
+
+    def start(self):
+        self.flusher = threading.Thread(target=self._flush_loop, name="user-store-flusher", daemon=True)
+        self.flusher.start()
+
+    def _persist(self, username, password):
+        # Called with self.lock held
+        self.pending.append((username, password))
+        self.submitted += 1
+        if len(self.pending) >= self.max_batch:
+            self.condition.notify_all()
+
+    def _flush_loop(self):
+        while True:
+            with self.condition:
+                if not self.pending and not self.closed and not self.compact_requested:
+                    self.condition.wait(self.flush_interval)
+                batch = self.pending
+                self.pending = []
+                compact = not batch and self.compact_requested
+                self.compact_requested = self.compact_requested and not compact
+                if not batch and not compact:
+                    if self.closed:
+                        return
+                    continue
+
+            if compact:
+                try:
+                    self._compact()
+                except (OSError, sqlite3.Error) as e:
+                    print(f"User store compaction failed: {e}")
+                continue
+
+            try:
+                self._write_batch(batch)
+            except (OSError, sqlite3.Error) as e:
+                # Keep the records and try again on the next pass
+                print(f"User store write failed: {e}")
+                with self.condition:
+                    self.pending[:0] = batch
+                    self.condition.wait(self.flush_interval)
+                continue
+            with self.condition:
+                self.written += len(batch)
+                self.condition.notify_all()
+
+    def compact(self):
+        # Done by the flusher thread once no batch is pending
+        with self.condition:
+            self.compact_requested = True
+            self.condition.notify_all()
+
+    def _compact(self):
+        pass
+
+    def flush(self):
+        with self.condition:
+            target = self.submitted
+            self.condition.notify_all()
+            while self.written < target and self.flusher.is_alive():
+                self.condition.wait(self.flush_interval)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.flusher.join()
+
+    def _write_batch(self, records):
+        raise NotImplementedError
+
+class LogUserStore(WriteBehindStore):
+    """
+    This class stores users as an append-only log of JSON lines.
+
+    Each line is {"username": ..., "password": ...}; a later line for the
+    same username replaces the earlier one. A torn last line (from a crash
+    mid-write) is cut off on startup. When most lines are superseded, the
+    log is compacted into a fresh file and swapped in with os.replace.
+    """
+
+    def __init__(self, path=USER_LOG, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self.lines = self._load()
+        self.fd = None
+        if self._needs_compaction():
+            self._rewrite(dict(self.users))
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        self.start()
+
+    def _needs_compaction(self):
+        return self.lines > max(COMPACT_MIN_LINES, COMPACT_RATIO * len(self.users))
+
+    def _load(self):
+        """
+        This function streams the log into memory, one line at a time
+
+        Returns: Number of valid lines
+        """
+        lines = 0
+        good_offset = 0
+        try:
+            with open(self.path, 'rb') as logfile:
+                for line in logfile:
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    self.users[record["username"]] = record["password"]
+                    lines += 1
+                    good_offset += len(line)
+                size = logfile.seek(0, os.SEEK_END)
+        except FileNotFoundError:
+            return 0
+
+        if size != good_offset:
+            print(f"Discarding {size - good_offset} bytes of incomplete user log")
+            os.truncate(self.path, good_offset)
+        return lines
+
+    def _write_batch(self, records):
+        data = "".join(json.dumps({"username": username, "password": password}) + "\n"
+                       for username, password in records).encode('utf-8')
+        view = memoryview(data)
+        while view:
+            written = os.write(self.fd, view)
+            view = view[written:]
+        os.fsync(self.fd)
+        self.lines += len(records)
+
+        if self._needs_compaction():
+            self._compact()
+
+    def _compact(self):
+        # Runs on the flusher thread, so no batch is written meanwhile.
+        # Records added after the copy are still pending and will be
+        # appended to the new log.
+        with self.lock:
+            users = dict(self.users)
+        self._rewrite(users)
+
+    def _rewrite(self, users):
+        """
+        This function rewrites the log with one line per user
+
+        The new log is written and synced under a temporary name, then
+        atomically renamed over the old one.
+        """
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'w') as temp:
+            for username, password in users.items():
+                temp.write(json.dumps({"username": username, "password": password}) + "\n")
+            temp.flush()
+            os.fsync(temp.fileno())
+        os.replace(temp_path, self.path)
+        _fsync_directory(self.path)
+        self.lines = len(users)
+
+        # Reopen so later appends go to the new file
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+
+    def close(self):
+        super().close()
+        os.close(self.fd)
+
+class SqliteUserStore(WriteBehindStore):
+    """
+    This class stores users in an SQLite table.
+
+    The flusher thread owns its own connection and writes each batch in a
+    single transaction with synchronous=FULL.
+    """
+
+    def __init__(self, path=USER_DB, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        loader = sqlite3.connect(self.path)
+        try:
+            loader.execute("PRAGMA journal_mode=WAL")
+            loader.execute("CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, password TEXT NOT NULL)")
+            loader.commit()
+            for username, password in loader.execute("SELECT username, password FROM users"):
+                self.users[username] = password
+        finally:
+            loader.close()
+        self.db = None
+        self.start()
+
+    def _write_batch(self, records):
+        if self.db is None:
+            # Created on the flusher thread, which is the only thread using it
+            self.db = sqlite3.connect(self.path)
+            self.db.execute("PRAGMA synchronous=FULL")
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO users (username, password) VALUES (?, ?)", records)
+
+    def _compact(self):
+        # VACUUM rebuilds the file, so replaced rows are not left in free pages
+        if self.db is None:
+            self.db = sqlite3.connect(self.path)
+            self.db.execute("PRAGMA synchronous=FULL")
+        self.db.execute("VACUUM")
+
+    def close(self):
+        super().close()
+        if self.db is not None:
+            self.db.close()
+
+class JsonUserStore(UserStore):
+    """
+    This class keeps the original behaviour: users.json is rewritten in full
+    on every registration (kept for comparison and small setups).
+    """
+
+    def __init__(self, path=USER_FILE):
+        super().__init__()
+        self.path = path
+        try:
+            with open(self.path, 'r') as openfile:
+                self.users = json.load(openfile)
+        except FileNotFoundError:
+            self.users = {}
+
+    def _persist(self, username, password):
+        # Called with self.lock held, so concurrent registrations cannot lose writes
+        self._rewrite()
+
+    def _persist_many(self, records):
+        # Every record is already in self.users: one rewrite saves them all
+        self._rewrite()
+
+    def _rewrite(self):
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as outfile:
+            json.dump(self.users, outfile)
+        os.replace(temp_path, self.path)
+
+class ReplicaUserStore(UserStore):
+    """
+    This class is a worker's in-memory copy of the hub's user store
+    (multi-process mode, see cluster.py).
+
+    The hub owns the real store. A registration is checked and saved by the
+    hub before add() is called here, and changes made on other workers
+    arrive through set(), so neither writes anything. replace() (Ex:
+    rehashing a plaintext password) is sent on to the hub with forward().
+    """
+
+    def __init__(self, forward):
+        super().__init__()
+        self.forward = forward
+
+    def _persist(self, username, password):
+        pass
+
+    def replace(self, username, old_password, new_password):
+        if not super().replace(username, old_password, new_password):
+            return False
+        self.forward(username, new_password)
+        return True
+
+    def replace_many(self, replacements):
+        # Each record is forwarded to the hub on its own
+        return sum(self.replace(*replacement) for replacement in replacements)
+
+def _fsync_directory(path):
+    """
+    This function syncs the directory holding path, so a rename is durable
+    """
+    directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+
+# Backends selectable with --user-store
+USER_STORES = {
+    "log": LogUserStore,
+    "sqlite": SqliteUserStore,
+    "json": JsonUserStore,
+}
+
+def open_user_store(kind=DEFAULT_USER_STORE, flush_interval=DEFAULT_FLUSH_INTERVAL):
+    """
+    This function opens a user store backend
+
+    A new, empty log or sqlite store imports the legacy users.json file.
+
+    Returns: UserStore
+    """
+    if kind == "json":
+        return JsonUserStore()
+    store = USER_STORES[kind](flush_interval=flush_interval)
+    if not len(store):
+        imported = store.import_legacy()
+        if imported:
+            print(f"Imported {imported} users from {USER_FILE}")
+    return store